@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    keep the Loris caches (the source jp2s fetched from S3, and the
+    derivative tiles and info.json files) within bounds by evicting the
+    least recently used files.
+
+    An index of the cache trees is kept in a SQLite file and brought up
+    to date incrementally: a directory's mtime only changes when entries
+    are added to or removed from it, so only directories whose mtime
+    has changed are listed again, and only their files are stat'ed.
+    Access times in the index can be stale, since reading a file doesn't
+    touch its directory, so each file is stat'ed again just before it's
+    evicted, and spared if it has been read since.
+
+    When usage is above the high watermark, files are evicted, oldest
+    access first, until it is down to the low watermark. A watermark is
+    either a size (e.g. 40G, for the files in the caches) or a
+    percentage of the volume they're on (e.g. 90%). If the volume is so
+    full of other files that evicting the whole of the caches wouldn't
+    bring it down to the low watermark, nothing is evicted, and a
+    warning is logged instead. Files that can't be removed (e.g. for
+    want of permission) are logged and passed over.
+
+    Runs once (e.g. from cron), or as a daemon with --interval. Each run
+    logs, and optionally appends to a JSON-lines file, how long ago the
+    cached and the evicted files were last read.
+
+    This is meant to run inside the Loris container, so it depends on
+    nothing beyond the standard library.
+'''
+import os
+import sys
+import json
+import time
+import stat
+import errno
+import sqlite3
+import logging
+import argparse
+
+CACHE_ROOTS = ['/var/cache/loris', '/usr/local/share/images/loris']
+INDEX = '/var/cache/loris-janitor/index.db'
+HIGH_WATERMARK = '90%'
+LOW_WATERMARK = '80%'
+# directories changed this recently may change again within the same
+# mtime tick, so they're listed again on the next run too
+MTIME_SLACK = 2
+EVICT_BATCH = 1000
+
+# what _evict did with a file
+EVICTED = 'evicted'
+SPARED = 'spared'
+GONE = 'gone'
+FAILED = 'failed'
+
+# buckets of time since last access, in seconds, for the stats
+AGE_BUCKETS = [
+    ('1h', 60 * 60),
+    ('1d', 24 * 60 * 60),
+    ('7d', 7 * 24 * 60 * 60),
+    ('30d', 30 * 24 * 60 * 60),
+    ('90d', 90 * 24 * 60 * 60),
+    ('older', None),
+]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dir TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_atime ON files (atime);
+'''
+
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_watermark(value):
+    ''' '90%' -> ('percent', 90.0); '40G' -> ('bytes', 42949672960) '''
+    value = value.strip().upper()
+    if value.endswith('%'):
+        return 'percent', float(value[:-1])
+    if value.endswith('B'):
+        value = value[:-1]
+    if value and value[-1] in SIZE_UNITS:
+        return 'bytes', int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return 'bytes', int(value)
+
+
+def age_bucket(age):
+    for name, limit in AGE_BUCKETS:
+        if limit is None or age < limit:
+            return name
+
+
+class AgeHistogram(object):
+    ''' counts and bytes of files by time since they were last read '''
+
+    def __init__(self):
+        self.buckets = dict((name, [0, 0]) for name, limit in AGE_BUCKETS)
+
+    def add(self, age, size):
+        row = self.buckets[age_bucket(age)]
+        row[0] += 1
+        row[1] += size
+
+    def as_dict(self):
+        return dict((name, {'files': count, 'bytes': size})
+                    for name, (count, size) in self.buckets.items())
+
+    def format(self):
+        return ', '.join('{}{}: {} files/{:.1f}MB'.format(
+            '<' if limit else '', name, self.buckets[name][0],
+            self.buckets[name][1] / 1048576.0)
+            for name, limit in AGE_BUCKETS)
+
+
+class CacheIndex(object):
+    '''
+        the files under some cache roots, with their sizes and access
+        times, as of the last scan
+    '''
+
+    def __init__(self, path, roots):
+        self.logger = logging.getLogger(__name__)
+        self.roots = [os.path.abspath(root) for root in roots]
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def scan(self):
+        '''
+        bring the index up to date, listing only the directories whose
+        mtime has changed. Returns (directories checked, directories
+        listed).
+        '''
+        start = time.time()
+        checked = listed = 0
+        stack = list(self.roots)
+        while stack:
+            path = stack.pop()
+            checked += 1
+            try:
+                st = os.lstat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                self._forget_dir(path)
+                continue
+            row = self.db.execute('SELECT mtime FROM dirs WHERE path = ?',
+                                  (path,)).fetchone()
+            if row is not None and row[0] == st.st_mtime:
+                stack.extend(r[0] for r in self.db.execute(
+                    'SELECT path FROM dirs WHERE parent = ?', (path,)))
+                continue
+            listed += 1
+            stack.extend(self._list_dir(path, st, start))
+        self.db.commit()
+        self.logger.info('Scanned {} dirs, {} of them changed, in '
+                         '{:.1f}s'.format(checked, listed,
+                                          time.time() - start))
+        return checked, listed
+
+    def _list_dir(self, path, st, scan_start):
+        ''' update the index for the entries of `path`, returning its
+        subdirectories '''
+        subdirs = []
+        files = set()
+        try:
+            names = os.listdir(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            names = []
+        for name in names:
+            child = os.path.join(path, name)
+            try:
+                child_st = os.lstat(child)
+            except OSError:
+                continue
+            if stat.S_ISDIR(child_st.st_mode):
+                subdirs.append(child)
+                continue
+            files.add(child)
+            self.db.execute(
+                'INSERT OR REPLACE INTO files (path, dir, size, atime) '
+                'VALUES (?, ?, ?, ?)',
+                (child, path, child_st.st_size,
+                 max(child_st.st_atime, child_st.st_mtime)))
+
+        for (known,) in self.db.execute(
+                'SELECT path FROM files WHERE dir = ?', (path,)).fetchall():
+            if known not in files:
+                self.db.execute('DELETE FROM files WHERE path = ?', (known,))
+        known_subdirs = set(r[0] for r in self.db.execute(
+            'SELECT path FROM dirs WHERE parent = ?', (path,)))
+        for gone in known_subdirs - set(subdirs):
+            self._forget_dir(gone)
+        for subdir in set(subdirs) - known_subdirs:
+            self.db.execute('INSERT OR IGNORE INTO dirs (path, parent, mtime)'
+                            ' VALUES (?, ?, NULL)', (subdir, path))
+
+        # a change in the same mtime tick as this listing would go unseen
+        mtime = st.st_mtime if st.st_mtime < scan_start - MTIME_SLACK \
+            else None
+        parent = None if path in self.roots else os.path.dirname(path)
+        self.db.execute('INSERT OR REPLACE INTO dirs (path, parent, mtime) '
+                        'VALUES (?, ?, ?)', (path, parent, mtime))
+        return subdirs
+
+    def _forget_dir(self, path):
+        ''' drop a directory that has gone, and everything under it '''
+        pattern = path.replace('\\', '\\\\').replace('%', '\\%').replace(
+            '_', '\\_') + '/%'
+        self.db.execute('DELETE FROM files WHERE dir = ? OR dir LIKE ? '
+                        "ESCAPE '\\'", (path, pattern))
+        self.db.execute('DELETE FROM dirs WHERE path = ? OR path LIKE ? '
+                        "ESCAPE '\\'", (path, pattern))
+
+    def totals(self):
+        ''' (files, bytes) in the index '''
+        count, size = self.db.execute(
+            'SELECT COUNT(*), SUM(size) FROM files').fetchone()
+        return count, size or 0
+
+    def histogram(self, now=None):
+        ''' AgeHistogram of the indexed files '''
+        now = now or time.time()
+        histogram = AgeHistogram()
+        for size, atime in self.db.execute('SELECT size, atime FROM files'):
+            histogram.add(now - atime, size)
+        return histogram
+
+    def least_recently_used(self, limit=EVICT_BATCH):
+        ''' (path, size, atime) of the `limit` files read longest ago '''
+        return self.db.execute('SELECT path, size, atime FROM files '
+                               'ORDER BY atime LIMIT ?', (limit,)).fetchall()
+
+    def forget(self, path):
+        self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+
+    def touched(self, path, size, atime):
+        self.db.execute('UPDATE files SET size = ?, atime = ? WHERE path = ?',
+                        (size, atime, path))
+
+
+class Janitor(object):
+    '''
+        evicts files from the caches in `index` while usage is above the
+        high watermark, down to the low one
+    '''
+
+    def __init__(self, index, high=HIGH_WATERMARK, low=LOW_WATERMARK,
+                 dry_run=False):
+        self.logger = logging.getLogger(__name__)
+        self.index = index
+        self.high = parse_watermark(high)
+        self.low = parse_watermark(low)
+        if self.high[0] != self.low[0]:
+            raise ValueError('the watermarks must both be sizes or both be '
+                             'percentages')
+        self.dry_run = dry_run
+
+    def _volume_bytes(self):
+        st = os.statvfs(self.index.roots[0])
+        return st.f_blocks * st.f_frsize
+
+    def usage(self, cache_bytes):
+        ''' usage in the watermarks' unit: the bytes in the caches, or the
+        percentage of the volume in use '''
+        if self.high[0] == 'bytes':
+            return cache_bytes
+        st = os.statvfs(self.index.roots[0])
+        total = st.f_blocks * st.f_frsize
+        used = total - st.f_bavail * st.f_frsize
+        return 100.0 * used / total if total else 0
+
+    def run(self):
+        ''' scan, then evict if need be. Returns a dict of stats. '''
+        start = time.time()
+        checked, listed = self.index.scan()
+        count, cache_bytes = self.index.totals()
+        usage = before = self.usage(cache_bytes)
+        evicted = AgeHistogram()
+        evicted_files = evicted_bytes = spared = 0
+        # paths that couldn't be removed, left in the index
+        failed = set()
+        volume = self._volume_bytes() if self.high[0] == 'percent' else None
+        # the usage there'd be with the caches empty
+        floor = before - 100.0 * cache_bytes / volume if volume else 0
+        unreachable = usage > self.high[1] and floor > self.low[1]
+
+        if unreachable:
+            self.logger.warning(
+                'Usage {} is above the high watermark {}, but evicting all '
+                '{:.1f}MB of the caches would only bring it down to {}, '
+                'above the low watermark {}; not evicting'.format(
+                    usage, self.high[1], cache_bytes / 1048576.0, floor,
+                    self.low[1]))
+        elif usage > self.high[1]:
+            self.logger.info('Usage {} is above the high watermark {}; '
+                             'evicting'.format(usage, self.high[1]))
+            while usage > self.low[1]:
+                batch = self.index.least_recently_used(
+                    EVICT_BATCH + len(failed))
+                progress = False
+                for path, size, atime in batch:
+                    if path in failed:
+                        continue
+                    progress = True
+                    outcome = self._evict(path, atime)
+                    if outcome == FAILED:
+                        failed.add(path)
+                        continue
+                    if outcome == GONE:
+                        continue
+                    if outcome == SPARED:
+                        spared += 1
+                        continue
+                    evicted.add(start - atime, size)
+                    evicted_files += 1
+                    evicted_bytes += size
+                    cache_bytes -= size
+                    if self.high[0] == 'bytes':
+                        usage = cache_bytes
+                    else:
+                        usage = before - 100.0 * evicted_bytes / volume
+                    if usage <= self.low[1]:
+                        break
+                self.index.db.commit()
+                if self.dry_run or not progress:
+                    break
+            if self.high[0] == 'percent' and not self.dry_run:
+                usage = self.usage(cache_bytes)
+
+        stats = {
+            'time': start,
+            'seconds': time.time() - start,
+            'dirs_checked': checked,
+            'dirs_listed': listed,
+            'files': count - evicted_files,
+            'bytes': cache_bytes,
+            'usage_before': before,
+            'usage_after': usage,
+            'unit': self.high[0],
+            'evicted_files': evicted_files,
+            'evicted_bytes': evicted_bytes,
+            'spared': spared,
+            'failed': len(failed),
+            'low_unreachable': unreachable,
+            'cached_by_age': self.index.histogram(start).as_dict(),
+            'evicted_by_age': evicted.as_dict(),
+        }
+        self.logger.info('{} {} files ({:.1f}MB); spared {} read since '
+                         'the last scan; {} could not be removed; usage {} '
+                         '-> {}'.format(
+                             'Would evict' if self.dry_run else 'Evicted',
+                             evicted_files, evicted_bytes / 1048576.0,
+                             spared, len(failed), before, usage))
+        if evicted_files:
+            self.logger.info('Evicted files last read: {}'.format(
+                evicted.format()))
+        return stats
+
+    def _evict(self, path, atime):
+        '''
+        remove a file if it hasn't been read since the index last saw
+        it. Returns EVICTED, SPARED if it has been read, GONE if it had
+        already gone, or FAILED if it couldn't be removed.
+        '''
+        try:
+            st = os.lstat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.logger.warning('Not evicting {}: {}'.format(path, e))
+                return FAILED
+            self.index.forget(path)
+            return GONE
+        current = max(st.st_atime, st.st_mtime)
+        if current > atime:
+            self.index.touched(path, st.st_size, current)
+            return SPARED
+        if self.dry_run:
+            self.logger.info('Would evict {}'.format(path))
+            return EVICTED
+        try:
+            os.remove(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                self.logger.warning('Could not evict {}: {}'.format(path, e))
+                return FAILED
+        self.index.forget(path)
+        self._remove_empty_dirs(os.path.dirname(path))
+        return EVICTED
+
+    def _remove_empty_dirs(self, path):
+        while path not in self.index.roots and path != os.path.dirname(path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='evict least recently used files from the Loris caches')
+    parser.add_argument('roots', nargs='*', default=CACHE_ROOTS,
+                        help="cache dirs (default: {})".format(
+                            ' '.join(CACHE_ROOTS)))
+    parser.add_argument('--index', default=INDEX,
+                        help="SQLite file to keep the index of the caches in")
+    parser.add_argument('--high', default=HIGH_WATERMARK,
+                        help="start evicting above this: a size, e.g. 40G, "
+                        "or a percentage of the volume, e.g. 90%%")
+    parser.add_argument('--low', default=LOW_WATERMARK,
+                        help="evict down to this")
+    parser.add_argument('--interval', type=float, default=None,
+                        help="run every this many seconds, instead of once")
+    parser.add_argument('--stats', default=None,
+                        help="JSON-lines file to append each run's stats to")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="log what would be evicted, without evicting")
+    parser.add_argument('--logfile', default=None)
+    parser.add_argument('--loglevel', default='INFO')
+    argv = parser.parse_args(argv)
+
+    logging.basicConfig(
+        filename=argv.logfile,
+        level=getattr(logging, argv.loglevel.upper(), logging.INFO),
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+    logger = logging.getLogger(__name__)
+
+    roots = [root for root in argv.roots if os.path.isdir(root)]
+    if not roots:
+        parser.error('none of the cache dirs exist')
+    janitor = Janitor(CacheIndex(argv.index, roots), high=argv.high,
+                      low=argv.low, dry_run=argv.dry_run)
+    while True:
+        try:
+            stats = janitor.run()
+            if argv.stats:
+                with open(argv.stats, 'a') as f:
+                    f.write(json.dumps(stats, sort_keys=True) + '\n')
+        except Exception:
+            if argv.interval is None:
+                raise
+            logger.exception('Cache janitor run failed')
+        if argv.interval is None:
+            return 0
+        time.sleep(argv.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
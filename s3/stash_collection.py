@@ -0,0 +1,512 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    convert the images of a Nuxeo collection, including the components
+    of complex objects, to jp2 and stash them on S3, keyed by Nuxeo uid.
+
+    The stages overlap, joined by queues:
+        walk the collection in Nuxeo             (a thread)
+        download each object's file              (a pool of threads)
+        convert it to jp2                        (a pool of processes)
+        upload the jp2 and check its ETag on S3  (a pool of threads)
+    Downloads wait while too many sources are waiting to be converted,
+    so a slow stage holds back the ones before it instead of filling the
+    disk.
+
+    Byte-identical files attached to several documents are downloaded
+    and converted once: the others are copied from the first one's jp2
+    within S3. Duplicates are spotted by the md5 Nuxeo records for each
+    file, or else by the md5 taken while the file downloads.
+
+    Writes a log to logs/ and a JSON report, with a row per object and
+    throughput figures, to reports/.
+'''
+import sys
+import os
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import threading
+import Queue
+from pynux import utils
+from ucldc_iiif import batch, metrics
+from ucldc_iiif import ledger as ledger_states
+from ucldc_iiif.ledger import Ledger
+from ucldc_iiif.convert import available_cpus
+from ucldc_iiif.download import Downloader, get_download_url
+from ucldc_iiif.estimate import Estimator, format_estimate, SAMPLE_SIZE
+from ucldc_iiif.upload import Uploader, BackgroundUploader
+from ucldc_iiif.etag import s3_etag, part_size_for
+from ucldc_iiif.workspace import parse_size
+
+BUCKET = 'ucldc-nuxeo-ref-images'
+LOG_DIR = 'logs'
+REPORT_DIR = 'reports'
+
+# object statuses in the report
+STASHED = 'stashed'
+ALREADY_STASHED = 'already stashed'
+COPIED = 'copied from a duplicate'
+DONE_BEFORE = 'done in an earlier run'
+HELD_ELSEWHERE = 'held by another worker'
+NO_FILE = 'no file'
+NOT_AN_IMAGE = 'not an image'
+DOWNLOAD_FAILED = 'download failed'
+CONVERT_FAILED = 'convert failed'
+UPLOAD_FAILED = 'upload failed'
+VERIFY_FAILED = 'verify failed'
+COPY_FAILED = 'copy failed'
+FAILURES = (DOWNLOAD_FAILED, CONVERT_FAILED, UPLOAD_FAILED, VERIFY_FAILED,
+            COPY_FAILED)
+
+# end-of-stream marker passed along the queues
+DONE = None
+
+
+def walk(nx, path):
+    ''' yield each document under `path`, followed by its components if
+    it's a complex object, depth first '''
+    for doc in nx.children(path):
+        yield doc
+        for component in walk(nx, doc['path']):
+            yield component
+
+
+def file_content(nx, doc):
+    ''' the file:content property (name, mime-type, digest...) of a
+    document, or None if it has no file '''
+    properties = doc.get('properties') or {}
+    if 'file:content' not in properties:
+        properties = nx.get_metadata(uid=doc['uid']).get('properties', {})
+    return properties.get('file:content')
+
+
+def image_sources(nx, path):
+    '''
+    (download URL, mime-type) of each image file under `path`, once per
+    distinct md5, as the stasher would convert them
+    '''
+    seen = set()
+    for doc in walk(nx, path):
+        content = file_content(nx, doc)
+        if not content or not (content.get('mime-type') or '').startswith(
+                'image/'):
+            continue
+        if (content.get('digestAlgorithm') or '').upper() == 'MD5':
+            if content.get('digest') in seen:
+                continue
+            seen.add(content.get('digest'))
+        yield (get_download_url(doc['uid'], doc['path'], nx),
+               content['mime-type'])
+
+
+class CollectionStasher(object):
+    '''
+        runs the walk -> download -> convert -> upload pipeline for
+        everything under a Nuxeo path. `convert_options` are passed on to
+        ucldc_iiif.batch.convert_batch.
+    '''
+
+    def __init__(self, nx, path, bucketpath=BUCKET, work_dir=None,
+                 download_workers=4, convert_workers=None, upload_workers=2,
+                 replace=False, ledger=None, recorder=None,
+                 convert_options=None):
+
+        self.logger = logging.getLogger(__name__)
+        self.nx = nx
+        self.path = path
+        self.bucketpath = bucketpath
+        self.work_dir = work_dir
+        self.download_workers = download_workers
+        self.convert_workers = convert_workers or available_cpus()
+        self.ledger = ledger
+        self.recorder = recorder or metrics.Recorder({'collection': path})
+        self.convert_options = convert_options or {}
+        self.downloader = Downloader(auth=nx.auth, workers=download_workers)
+        self.uploader = Uploader(skip_existing=not replace,
+                                 recorder=self.recorder)
+        self.upload_workers = upload_workers
+        # what stopped the walk of the collection short, if anything
+        self.walk_error = None
+
+        self.rows = {}  # uid -> report row
+        self.by_input = {}  # downloaded source path -> uid
+        # source md5 -> the uid converted for it, its status once done,
+        # and the uids of its duplicates waiting for that
+        self.groups = {}
+        self.leading = {}  # uid -> md5 of the group it was converted for
+        self.lock = threading.Lock()
+        # sources downloaded or downloading but not yet converted
+        self.in_flight = threading.BoundedSemaphore(
+            download_workers + self.convert_workers * 2)
+
+    def _row(self, doc):
+        with self.lock:
+            row = self.rows[doc['uid']] = {
+                'uid': doc['uid'], 'path': doc['path'], 'status': None,
+                'msg': None, 'source_bytes': None, 'jp2_bytes': None,
+                's3_url': None, 'duplicate_of': None}
+        return row
+
+    def _finish(self, uid, status, msg, **fields):
+        ''' record an object's outcome in the report and the ledger '''
+        with self.lock:
+            row = self.rows[uid]
+            row.update(status=status, msg=msg, **fields)
+            group = self.groups.get(self.leading.get(uid))
+            duplicates = []
+            if group is not None:
+                group['status'] = status
+                duplicates, group['duplicates'] = group['duplicates'], []
+        log = self.logger.error if status in FAILURES else self.logger.info
+        log('{} ({}): {}'.format(row['path'], uid, msg))
+        for duplicate in duplicates:
+            self._copy_duplicate(duplicate, group)
+        if self.ledger is None or status in (DONE_BEFORE, HELD_ELSEWHERE):
+            return
+        if status in FAILURES:
+            self.ledger.finish(uid, ledger_states.FAILED,
+                               error_class=status, error=msg)
+        elif status in (NO_FILE, NOT_AN_IMAGE):
+            self.ledger.finish(uid, ledger_states.SKIPPED)
+        else:
+            self.ledger.finish(uid, ledger_states.DONE,
+                               source_hash=row.get('source_md5'),
+                               output_checksum=row.get('etag'))
+
+    def _is_duplicate(self, uid, digest):
+        '''
+        whether another document has the file with md5 `digest`; if so,
+        `uid` is copied from its jp2 once that's stashed. Otherwise,
+        `uid` is the one converted for that file.
+        '''
+        with self.lock:
+            self.rows[uid]['source_md5'] = digest
+            group = self.groups.get(digest)
+            if group is None:
+                self.groups[digest] = {'uid': uid, 'status': None,
+                                       'duplicates': []}
+                self.leading[uid] = digest
+                return False
+            if group['status'] is None:
+                group['duplicates'].append(uid)
+                return True
+        self._copy_duplicate(uid, group)
+        return True
+
+    def _copy_duplicate(self, uid, group):
+        original = group['uid']
+        if group['status'] not in (STASHED, ALREADY_STASHED, COPIED):
+            self._finish(uid, COPY_FAILED, 'same file as {}, which '
+                         'failed: {}'.format(original, group['status']),
+                         duplicate_of=original)
+            return
+        try:
+            result = self.uploader.copy(self.bucketpath, original, uid)
+        except Exception as e:
+            self._finish(uid, COPY_FAILED, repr(e), duplicate_of=original)
+            return
+        with self.lock:
+            etag = self.rows[original].get('etag')
+        self._finish(uid, COPIED, result.msg, duplicate_of=original,
+                     jp2_bytes=result.bytes, s3_url=result.url, etag=etag)
+
+    def _walk(self, download_q):
+        try:
+            for doc in walk(self.nx, self.path):
+                self._row(doc)
+                if self.ledger is not None:
+                    self.ledger.add([(doc['uid'], doc['path'], None, None)])
+                    if not self.ledger.claim_key(doc['uid']):
+                        self._unclaimed(doc['uid'])
+                        continue
+                download_q.put(doc)
+            self.logger.info('Found {} documents under {}'.format(
+                len(self.rows), self.path))
+        except Exception as e:
+            # the documents found so far are still stashed; run() reports
+            # the walk as failed
+            self.logger.exception('Failed walking {}'.format(self.path))
+            self.walk_error = e
+        finally:
+            for i in range(self.download_workers):
+                download_q.put(DONE)
+
+    def _unclaimed(self, uid):
+        ''' record why the ledger wouldn't let us claim `uid` '''
+        job = self.ledger.get(uid)
+        if job.state in (ledger_states.RUNNING, ledger_states.CONVERTED):
+            self._finish(uid, HELD_ELSEWHERE, 'claimed by {} ({})'.format(
+                job.worker, job.state))
+        else:
+            self._finish(uid, DONE_BEFORE, '{} in an earlier run'.format(
+                job.state))
+
+    def _download(self, download_q, convert_q):
+        while True:
+            doc = download_q.get()
+            if doc is DONE:
+                return
+            uid = doc['uid']
+            try:
+                content = file_content(self.nx, doc)
+                if not content:
+                    self._finish(uid, NO_FILE, 'has no file')
+                    continue
+                mimetype = content.get('mime-type') or ''
+                if not mimetype.startswith('image/'):
+                    self._finish(uid, NOT_AN_IMAGE,
+                                 'file is {}'.format(mimetype or 'untyped'))
+                    continue
+            except Exception as e:
+                self._finish(uid, DOWNLOAD_FAILED, repr(e))
+                continue
+
+            # named apart from the jp2 it's converted to, even if it's a
+            # jp2 itself
+            input_path = os.path.join(
+                self.work_dir,
+                uid + '.src' + os.path.splitext(content.get('name') or '')[1])
+            expected = None
+            if (content.get('digestAlgorithm') or '').upper() == 'MD5':
+                expected = content.get('digest')
+            if expected and self._is_duplicate(uid, expected):
+                continue
+            # released once the source has been converted
+            self.in_flight.acquire()
+            try:
+                result = self.downloader.download(
+                    get_download_url(uid, doc['path'], self.nx), input_path,
+                    expected)
+            except Exception as e:
+                self.in_flight.release()
+                self._finish(uid, DOWNLOAD_FAILED, repr(e))
+                continue
+            self.recorder.record('download', wall=result.seconds,
+                                 output_path=input_path, tool='http')
+            if not expected and self._is_duplicate(uid, result.digest):
+                os.remove(input_path)
+                self.in_flight.release()
+                continue
+            with self.lock:
+                self.rows[uid].update(source_bytes=result.bytes,
+                                      source_md5=result.digest)
+                self.by_input[input_path] = uid
+            convert_q.put((input_path,
+                           os.path.join(self.work_dir, uid + '.jp2'),
+                           mimetype))
+
+    def _close_when_done(self, threads, queue):
+        for thread in threads:
+            thread.join()
+        queue.put(DONE)
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _uploaded(self, upload):
+        uid = os.path.splitext(os.path.basename(upload.path))[0]
+        if not upload.ok:
+            self._finish(uid, UPLOAD_FAILED, upload.msg)
+        elif not self.uploader.matches(upload.path, self.bucketpath, uid):
+            self._finish(uid, VERIFY_FAILED, '{} does not match {}'.format(
+                upload.url, upload.path))
+        else:
+            etag = s3_etag(upload.path, part_size_for(upload.bytes,
+                                                      self.uploader.part_size))
+            self._finish(uid, ALREADY_STASHED if upload.skipped else STASHED,
+                         upload.msg, jp2_bytes=upload.bytes,
+                         s3_url=upload.url, etag=etag)
+        if os.path.exists(upload.path):
+            os.remove(upload.path)
+
+    def run(self, sink=None):
+        '''
+        stash everything under the path. Returns the report, a dict,
+        whose walk_error is set if walking the collection failed part way.
+        Metrics records are written to `sink` as they come in.
+        '''
+        cleanup = self.work_dir is None
+        if cleanup:
+            self.work_dir = tempfile.mkdtemp(prefix='stash-collection-')
+        start = time.time()
+        download_q = Queue.Queue(maxsize=self.download_workers * 2)
+        convert_q = Queue.Queue()
+        uploads = BackgroundUploader(self.uploader,
+                                     workers=self.upload_workers)
+
+        def write_metrics(records):
+            if sink is not None:
+                sink.write(records)
+
+        try:
+            self._start_thread(self._walk, download_q)
+            downloaders = [
+                self._start_thread(self._download, download_q, convert_q)
+                for i in range(self.download_workers)]
+            self._start_thread(self._close_when_done, downloaders,
+                               convert_q)
+
+            for result in batch.convert_batch(
+                    iter(convert_q.get, DONE), workers=self.convert_workers,
+                    tmp_root=self.work_dir, collection=self.path,
+                    stream=True, **self.convert_options):
+                self.in_flight.release()
+                if result.input != result.output:
+                    os.remove(result.input)
+                write_metrics(result.metrics)
+                uid = self.by_input[result.input]
+                if result.status == batch.CONVERTED:
+                    uploads.submit(result.output, self.bucketpath, uid)
+                else:
+                    self._finish(uid, CONVERT_FAILED, result.msg)
+                for upload in uploads.finished():
+                    self._uploaded(upload)
+                write_metrics(self.recorder.drain())
+            for upload in uploads.close():
+                self._uploaded(upload)
+            write_metrics(self.recorder.drain())
+        finally:
+            if cleanup:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+
+        return self.report(start, time.time())
+
+    def report(self, start, end):
+        rows = sorted(self.rows.values(), key=lambda row: row['path'])
+        counts = {}
+        for row in rows:
+            counts[row['status']] = counts.get(row['status'], 0) + 1
+        elapsed = end - start
+        source_bytes = sum(row['source_bytes'] or 0 for row in rows)
+        jp2_bytes = sum(row['jp2_bytes'] or 0 for row in rows
+                        if row['status'] == STASHED)
+        converted = counts.get(STASHED, 0) + counts.get(ALREADY_STASHED, 0)
+        return {
+            'path': self.path,
+            'bucket': self.bucketpath,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                     time.localtime(start)),
+            'seconds': elapsed,
+            'documents': len(rows),
+            'walk_error': (repr(self.walk_error)
+                           if self.walk_error is not None else None),
+            'counts': counts,
+            'source_bytes': source_bytes,
+            'jp2_bytes': jp2_bytes,
+            # downloads and conversions saved by copying duplicates
+            'duplicates': counts.get(COPIED, 0),
+            'images_per_hour': converted * 3600.0 / elapsed if elapsed else 0,
+            'download_mb_per_second':
+                source_bytes / 1048576.0 / elapsed if elapsed else 0,
+            'upload_mb_per_second':
+                jp2_bytes / 1048576.0 / elapsed if elapsed else 0,
+            'objects': rows,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='convert the images of a Nuxeo collection to jp2 and '
+        'stash them on S3')
+    parser.add_argument('path', help="Nuxeo path of the collection")
+    parser.add_argument('--bucket', default=BUCKET,
+                        help="bucket, or bucket/prefix, to stash the jp2s in")
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--convert-workers', type=int, default=None,
+                        help="conversion processes (default: cpu count)")
+    parser.add_argument('--upload-workers', type=int, default=2)
+    parser.add_argument('--replace', action='store_true',
+                        help="upload even when S3 already has the same jp2")
+    parser.add_argument('--work-dir', default=None,
+                        help="dir for downloads and jp2s (default: a temp "
+                        "dir)")
+    parser.add_argument('--ram-budget', type=parse_size, default=0,
+                        help="bytes of intermediate files to keep in RAM at "
+                        "once, e.g. 4G")
+    parser.add_argument('--memory-limit', type=parse_size, default=0,
+                        help="estimated peak memory of the conversions "
+                        "running at once, e.g. 16G")
+    parser.add_argument('--ledger', default=None,
+                        help="SQLite file recording each object's state, so "
+                        "a rerun only does what's left")
+    parser.add_argument('--metrics', default=None,
+                        help="JSON-lines file to append per-stage metrics to")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="stash nothing: read the images' headers, "
+                        "convert a sample, and estimate the cpu hours, "
+                        "time, scratch disk and S3 bytes for the collection")
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE,
+                        help="images to convert for --dry-run")
+
+    utils.get_common_options(parser)
+    if argv is None:
+        argv = parser.parse_args()
+
+    slug = argv.path.strip('/').replace('/', '_')
+    for dirname in (LOG_DIR, REPORT_DIR):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    logfile = os.path.join(LOG_DIR, 'stash_collection_{}.log'.format(slug))
+    logging.basicConfig(
+        filename=logfile,
+        level=getattr(logging, argv.loglevel.upper(), logging.INFO),
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    nx = utils.Nuxeo(rcfile=argv.rcfile, loglevel=argv.loglevel.upper())
+    if argv.dry_run:
+        estimator = Estimator(sample_size=argv.sample_size, auth=nx.auth,
+                              tmp_dir=argv.work_dir,
+                              convert_options={'ram_budget': argv.ram_budget})
+        estimate = estimator.estimate(image_sources(nx, argv.path),
+                                      memory_limit=argv.memory_limit)
+        report_file = os.path.join(REPORT_DIR, '{}-estimate-{}.json'.format(
+            slug, time.strftime('%Y%m%d-%H%M%S')))
+        with open(report_file, 'w') as f:
+            json.dump(estimate, f, indent=2, sort_keys=True)
+        print format_estimate(estimate)
+        print "report: {}".format(report_file)
+        return 0
+    stasher = CollectionStasher(
+        nx, argv.path, bucketpath=argv.bucket, work_dir=argv.work_dir,
+        download_workers=argv.download_workers,
+        convert_workers=argv.convert_workers,
+        upload_workers=argv.upload_workers, replace=argv.replace,
+        ledger=Ledger(argv.ledger) if argv.ledger else None,
+        convert_options={'ram_budget': argv.ram_budget,
+                         'memory_limit': argv.memory_limit})
+    sink = metrics.JsonLinesSink(argv.metrics) if argv.metrics else None
+    print "Stashing {} in {}; logfile: {}".format(argv.path, argv.bucket,
+                                                   logfile)
+    report = stasher.run(sink=sink)
+
+    report_file = os.path.join(REPORT_DIR, '{}-{}.json'.format(
+        slug, time.strftime('%Y%m%d-%H%M%S')))
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    print "\n{} documents in {:.0f}s:".format(report['documents'],
+                                             report['seconds'])
+    for status in sorted(report['counts']):
+        print "  {:25} {:6d}".format(status, report['counts'][status])
+    print "{:.1f} images/hour; {:.2f} MB/s downloaded, {:.2f} MB/s " \
+        "uploaded".format(report['images_per_hour'],
+                          report['download_mb_per_second'],
+                          report['upload_mb_per_second'])
+    if report['walk_error']:
+        print "Walking {} failed, so not everything was found: {}".format(
+            argv.path, report['walk_error'])
+    print "report: {}".format(report_file)
+    failed = sum(report['counts'].get(status, 0) for status in FAILURES)
+    return 1 if failed or report['walk_error'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
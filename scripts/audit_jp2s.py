@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+import sys
+import boto3
+import logging
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from ucldc_iiif import jp2
+
+EXPECTED_ENCODING = jp2.EXPECTED_ENCODING
+
+
+class AuditJp2s(object):
+    ''' check the encoding of every jp2 under an S3 prefix by reading just
+    the headers of each one with a ranged GET '''
+
+    def __init__(self, bucket, prefix='', workers=16):
+
+        self.logger = logging.getLogger(__name__)
+        self.s3 = boto3.client('s3')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.workers = workers
+
+    def list_keys(self):
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for object in page.get('Contents', []):
+                if object['Key'].endswith('.jp2'):
+                    yield object['Key']
+
+    def audit_key(self, key):
+        ''' returns (key, status, details) '''
+        def read_range(length):
+            response = self.s3.get_object(
+                Bucket=self.bucket, Key=key,
+                Range='bytes=0-{}'.format(length - 1))
+            return response['Body'].read()
+
+        try:
+            info = jp2.read_jp2_info_ranged(read_range)
+        except jp2.Jp2HeaderError as e:
+            return key, 'unreadable', str(e)
+        except Exception as e:
+            self.logger.exception("Failed to audit {}".format(key))
+            return key, 'error', repr(e)
+
+        mismatches = jp2.compare(info, EXPECTED_ENCODING)
+        if mismatches:
+            return key, 'mismatch', '; '.join(mismatches)
+        return key, 'ok', ''
+
+    def run(self):
+        ''' yield (key, status, details) for every jp2, in listing order.
+        Only a few requests per worker are queued ahead of the listing. '''
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = collections.deque()
+            for key in self.list_keys():
+                pending.append(executor.submit(self.audit_key, key))
+                if len(pending) >= self.workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+
+def main(bucket, prefix, workers, loglevel):
+
+    numeric_level = getattr(logging, loglevel, None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % loglevel)
+    logging.basicConfig(
+        level=numeric_level,
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    counts = {}
+    audit = AuditJp2s(bucket, prefix, workers=workers)
+    for key, status, details in audit.run():
+        counts[status] = counts.get(status, 0) + 1
+        print('\t'.join([key, status, details]))
+        sys.stdout.flush()
+
+    for status in sorted(counts):
+        print('{}: {}'.format(status, counts[status]), file=sys.stderr)
+    return 0 if set(counts) <= {'ok'} else 1
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check the encoding of the jp2s under an S3 prefix '
+        'without downloading them')
+    parser.add_argument('bucket')
+    parser.add_argument('--prefix', default='')
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--loglevel', default='WARNING')
+
+    argv = parser.parse_args()
+
+    sys.exit(main(argv.bucket, argv.prefix, argv.workers, argv.loglevel))
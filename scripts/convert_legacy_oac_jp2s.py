@@ -3,69 +3,297 @@ import sys
 import os
 import boto3
 import re
+import json
+import queue
 import tempfile
+import threading
 import shutil
 import subprocess
 import logging
-import argparse 
+import argparse
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from ucldc_iiif import jp2, etag, ledger as ledger_states
+from ucldc_iiif.ledger import Ledger
 
 OPERATION_PARAMETERS = {'Bucket': 'ucldc-private-files',
                         'Prefix': 'jp2000/'}
 
+KDU_COMPRESS_OPTS = jp2.KDU_COMPRESS_BASE_OPTS
+# what a file encoded with KDU_COMPRESS_OPTS looks like
+EXPECTED_ENCODING = jp2.EXPECTED_ENCODING
+
+CHECKPOINT_FILE = 'logs/convert_legacy_oac_jp2s.checkpoint'
+
+# end-of-stream marker passed along the pipeline queues
+DONE = None
+
+
+class Checkpoint(object):
+    ''' durable record of how far through the listing we've got.
+
+    Keys finish out of order, so we only advance the marker past a key
+    once every key listed before it has finished too. Keys that failed
+    are appended to a separate file so they can be retried. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.failed_path = path + '.failed'
+        self.lock = threading.Lock()
+        self.pending = []  # keys in listing order, not yet checkpointed
+        self.finished = set()
+        self.marker = None
+        self.count = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            self.marker = saved.get('marker')
+            self.count = saved.get('count', 0)
+
+    def listed(self, key):
+        with self.lock:
+            self.pending.append(key)
+
+    def finish(self, key, failed=False):
+        with self.lock:
+            if failed:
+                with open(self.failed_path, 'a') as f:
+                    f.write(key + '\n')
+            self.finished.add(key)
+            advanced = False
+            while self.pending and self.pending[0] in self.finished:
+                self.marker = self.pending.pop(0)
+                self.finished.remove(self.marker)
+                self.count += 1
+                advanced = True
+            if advanced:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'marker': self.marker, 'count': self.count}, f)
+        os.rename(tmp_path, self.path)
+
+
 class FixLegacyJp2(object):
 
-    def __init__(self):
+    def __init__(self, checkpoint, download_workers=4, encode_workers=None,
+                 upload_workers=4, part_workers=etag.PART_WORKERS,
+                 sniff=True, ledger=None):
 
         self.logger = logging.getLogger(__name__)
         self.s3 = boto3.client('s3')
         self.paginator = self.s3.get_paginator('list_objects')
         self.counter = 0
+        self.failures = 0
+        self.compliant = 0
+        self.counter_lock = threading.Lock()
         self.tmp_dir = tempfile.mkdtemp(dir='/tmp')
+        self.checkpoint = checkpoint
+        # each kdu_compress call runs 4 threads
+        self.download_workers = download_workers
+        self.encode_workers = encode_workers or max(1, os.cpu_count() // 4)
+        self.upload_workers = upload_workers
+        # parts of each file uploaded at once, per upload worker
+        self.part_workers = part_workers
+        # check each file's headers and skip the ones already encoded right
+        self.sniff = sniff
+        # durable record of every key's state, if any; keys it has as done
+        # or skipped aren't processed again
+        self.ledger = ledger
+        # ETag of each key in flight when it was listed
+        self.source_etags = {}
 
     def get_results_iterator(self, start_token=None):
-        
+
         # I can't get the paginator to return 'NextToken' or 'NextMarker', no matter what I try,
-        # so I'm not using `MaxItems` argument for now
-        PaginationConfig={}
+        # so we start from a `Marker` (the last key done) instead of a pagination token
+        params = dict(OPERATION_PARAMETERS)
         if start_token:
-            PaginationConfig['StartingToken']: start_token
-         
-        return self.paginator.paginate(**OPERATION_PARAMETERS, PaginationConfig=PaginationConfig)
+            params['Marker'] = start_token
+
+        return self.paginator.paginate(**params)
 
-    def process_page(self, page):
-    
-        for object in page['Contents']:
+    def process_page(self, page, download_q):
+
+        for object in page.get('Contents', []):
             # they all have the pattern `NNNNN-arkstuff-zN.jp2` — most of them starting `13030-`
             # the `z` number is the index number into complex object
             id = object['Key']
             if re.search(r'^jp2000/\d{5}-.*-z\d+\.jp2$', id):
-                self.counter = self.counter + 1
-                self.fix_file(id)
+                with self.counter_lock:
+                    self.counter = self.counter + 1
+                if self.ledger is not None:
+                    self.ledger.add([(id, id, None, None)])
+                    if not self.ledger.claim_key(id):
+                        self.logger.info("{} is done according to the "
+                                         "ledger".format(id))
+                        continue
+                    with self.counter_lock:
+                        self.source_etags[id] = object['ETag'].strip('"')
+                self.checkpoint.listed(id)
+                # blocks while the downloaders are behind
+                download_q.put(id)
 
-    def fix_file(self, id):
-        
-        original_filepath = os.path.join(self.tmp_dir, 'orig.jp2') 
-        uncompressed_filepath = os.path.join(self.tmp_dir, 'uncompressed.tiff') 
-        new_filepath = os.path.join(self.tmp_dir, 'new.jp2') 
+    def run(self, start_token=None):
+        ''' run the listing -> download -> encode -> upload pipeline.
+        Each stage is a pool of threads joined by bounded queues, so a slow
+        stage holds back the ones before it instead of filling the disk. '''
+        download_q = queue.Queue(maxsize=self.download_workers * 2)
+        encode_q = queue.Queue(maxsize=self.encode_workers * 2)
+        upload_q = queue.Queue(maxsize=self.upload_workers * 2)
+
+        stages = [
+            (self.download_workers, self.download_stage, download_q, encode_q),
+            (self.encode_workers, self.encode_stage, encode_q, upload_q),
+            (self.upload_workers, self.upload_stage, upload_q, None),
+        ]
+        threads = []
+        for num_workers, stage, in_q, out_q in stages:
+            threads.append([
+                self._start_thread(self._worker, stage, in_q, out_q)
+                for i in range(num_workers)])
+
+        try:
+            for page in self.get_results_iterator(start_token):
+                self.logger.info("Marker: {}".format(page.get('Marker')))
+                self.process_page(page, download_q)
+                self.logger.info("legacy jp2 count so far: {}".format(self.counter))
+        finally:
+            # shut the stages down in order once their input is drained
+            for (num_workers, stage, in_q, out_q), workers in zip(stages, threads):
+                for i in range(num_workers):
+                    in_q.put(DONE)
+                for thread in workers:
+                    thread.join()
+
+    def _start_thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _worker(self, stage, in_q, out_q):
+        while True:
+            job = in_q.get()
+            if job is DONE:
+                return
+            try:
+                job = stage(job)
+            except Exception as e:
+                self.logger.exception("Failed on {}".format(job))
+                job = self._fail(job, type(e).__name__, repr(e))
+            if job is not None and out_q is not None:
+                out_q.put(job)
+
+    def _fail(self, job, error_class, error=None):
+        id = job if isinstance(job, str) else job['id']
+        with self.counter_lock:
+            self.failures = self.failures + 1
+        if not isinstance(job, str):
+            shutil.rmtree(job['dir'], ignore_errors=True)
+        self._finish(id, ledger_states.FAILED, error_class=error_class,
+                     error=error)
+        return None
+
+    def _finish(self, id, state, **fields):
+        ''' record the outcome for a key in the checkpoint and ledger '''
+        self.checkpoint.finish(id, failed=state == ledger_states.FAILED)
+        if self.ledger is not None:
+            with self.counter_lock:
+                source_hash = self.source_etags.pop(id, None)
+            self.ledger.finish(id, state, source_hash=source_hash, **fields)
+
+    def needs_fix(self, id):
+        ''' fetch just the start of a jp2 with a ranged GET and see whether
+        its encoding differs from what KDU_COMPRESS_OPTS would write '''
+        def read_range(length):
+            response = self.s3.get_object(
+                Bucket='ucldc-private-files', Key=id,
+                Range='bytes=0-{}'.format(length - 1))
+            return response['Body'].read()
+
+        try:
+            info = jp2.read_jp2_info_ranged(read_range)
+        except jp2.Jp2HeaderError as e:
+            self.logger.warning("Couldn't parse the headers of {}: {}; "
+                                "fixing it anyway".format(id, e))
+            return True
+
+        mismatches = jp2.compare(info, EXPECTED_ENCODING)
+        if mismatches:
+            self.logger.info("{} needs fixing: {}".format(
+                id, '; '.join(mismatches)))
+        return bool(mismatches)
 
-        # check file header
-        #response = self.s3.get_object(Bucket='ucldc-private-files', Key=id)
-        #pp.pprint(response)
+    def download_stage(self, id):
+        if self.sniff and not self.needs_fix(id):
+            self.logger.info("{} is already encoded correctly".format(id))
+            with self.counter_lock:
+                self.compliant = self.compliant + 1
+            self._finish(id, ledger_states.SKIPPED)
+            return None
+
+        job = {'id': id, 'dir': tempfile.mkdtemp(dir=self.tmp_dir)}
+        job['orig'] = os.path.join(job['dir'], 'orig.jp2')
+        job['uncompressed'] = os.path.join(job['dir'], 'uncompressed.tiff')
+        job['new'] = os.path.join(job['dir'], 'new.jp2')
 
         # download file
-        with open(original_filepath, 'wb') as f:
+        with open(job['orig'], 'wb') as f:
             self.s3.download_fileobj('ucldc-private-files', id, f)
         self.logger.info("Downloaded {}".format(id))
+        return job
 
+    def encode_stage(self, job):
         # convert file
-        self.uncompress_jp2000(original_filepath, uncompressed_filepath)
-        self.tiff_to_jp2(uncompressed_filepath, new_filepath)
-        self.logger.info("Converted {}".format(id))
+        if not self.uncompress_jp2000(job['orig'], job['uncompressed']):
+            return self._fail(job, 'kdu_expand')
+        if not self.tiff_to_jp2(job['uncompressed'], job['new']):
+            return self._fail(job, 'kdu_compress')
+        os.remove(job['orig'])
+        os.remove(job['uncompressed'])
+        self.logger.info("Converted {}".format(job['id']))
+        return job
+
+    def already_uploaded(self, path, id):
+        ''' whether the object already has the new file's size and ETag,
+        e.g. when a run stopped between uploading and checkpointing '''
+        try:
+            head = self.s3.head_object(Bucket='ucldc-private-files', Key=id)
+        except ClientError:
+            return False
+        return etag.etag_matches(path, head['ContentLength'], head['ETag'])
+
+    def upload_stage(self, job):
+        # upload file, in parallel parts if it's big enough
+        if self.already_uploaded(job['new'], job['id']):
+            self.logger.info("{} is already up to date".format(job['id']))
+        else:
+            size = os.path.getsize(job['new'])
+            config = TransferConfig(
+                multipart_threshold=etag.MULTIPART_THRESHOLD,
+                multipart_chunksize=etag.part_size_for(size),
+                max_concurrency=self.part_workers)
+            self.s3.upload_file(job['new'], 'ucldc-private-files', job['id'],
+                                ExtraArgs={'ContentType': etag.CONTENT_TYPE},
+                                Config=config)
+            self.logger.info("Restashed {}".format(job['id']))
+        checksum = etag.s3_etag(job['new'], etag.part_size_for(
+            os.path.getsize(job['new'])))
+        shutil.rmtree(job['dir'], ignore_errors=True)
+        self._finish(job['id'], ledger_states.DONE, output_checksum=checksum)
 
-        # upload file
-        with open(new_filepath, 'rb') as f:
-            self.s3.upload_fileobj(f, 'ucldc-private-files', id)
-        self.logger.info("Restashed {}".format(id))
+    def fix_file(self, id):
+        ''' download, convert and restash a single file '''
+        job = self.download_stage(id)
+        if job is None:
+            # already encoded correctly
+            return
+        job = self.encode_stage(job)
+        if job is not None:
+            self.upload_stage(job)
 
     def uncompress_jp2000(self, input_path, output_path):
         ''' uncompress jp2 using kdu_expand '''
@@ -75,10 +303,12 @@ class FixLegacyJp2(object):
                     '/usr/local/bin/kdu_expand', "-i", input_path, "-o", output_path
                 ],
                 stderr=subprocess.STDOUT)
+            return True
         except subprocess.CalledProcessError as e:
             msg = '`kdu_expand` command failed: {}\nreturncode was: {}\n' \
                   'output was: {}'.format(e.cmd, e.returncode, e.output)
             self.logger.error(msg)
+            return False
 
     def tiff_to_jp2(self, input_path, output_path):
         ''' convert tiff to jp2 using kdu_compress '''
@@ -86,26 +316,23 @@ class FixLegacyJp2(object):
         try:
             subprocess.check_output(
                 [
-                    "/usr/local/bin/kdu_compress", "-i", input_path, "-o", output_path,
-                    "-quiet", "-rate",
-                    "2.4,1.48331273,.91673033,.56657224,.35016049,.21641118,.13374944,"
-                    ".08266171",
-                    "Creversible=yes", "Clevels=7", "Cblk={64,64}", "Cuse_sop=yes",
-                    "Cuse_eph=yes", "Corder=RLCP", "ORGgen_plt=yes", "ORGtparts=R",
-                    "Stiles={1024,1024}", "-double_buffering", "10", "-num_threads", "4",
-                    "-no_weights"
-                ],
+                    "/usr/local/bin/kdu_compress", "-i", input_path, "-o", output_path
+                ] + KDU_COMPRESS_OPTS,
                 stderr=subprocess.STDOUT)
+            return True
         except subprocess.CalledProcessError as e:
             msg = 'kdu_compress command failed: {}\nreturncode was: {}\n' \
                   'output was: {}'.format(e.cmd, e.returncode, e.output)
             self.logger.error(msg)
+            return False
 
     def remove_tmp(self):
         ''' clean up after ourselves '''
         shutil.rmtree(self.tmp_dir)
 
-def main(marker, loglevel):
+def main(marker, loglevel, checkpoint_file=CHECKPOINT_FILE,
+         download_workers=4, encode_workers=None, upload_workers=4,
+         part_workers=etag.PART_WORKERS, sniff=True, ledger_file=None):
 
     logfile = 'logs/convert_legacy_oac_jp2s'
     numeric_level = getattr(logging, loglevel, None)
@@ -118,30 +345,66 @@ def main(marker, loglevel):
         datefmt='%m/%d/%Y %I:%M:%S %p')
     logger = logging.getLogger(__name__)
 
+    checkpoint = Checkpoint(checkpoint_file)
+    if marker is None and checkpoint.marker:
+        marker = checkpoint.marker
+        print('Resuming from checkpoint', checkpoint_file)
+
     print('Starting at marker: ', marker)
     print('logfile: ', logfile)
 
-    fixjp2 = FixLegacyJp2()
-    results_iterator = fixjp2.get_results_iterator()
-
-    for page in results_iterator:
-        logger.info("Marker: {}".format(page['Marker']))
-        fixjp2.process_page(page) 
-        logger.info("page legacy jp2 count: {}".format(fixjp2.counter))
+    ledger = Ledger(ledger_file) if ledger_file else None
+    fixjp2 = FixLegacyJp2(checkpoint, download_workers=download_workers,
+                          encode_workers=encode_workers,
+                          upload_workers=upload_workers,
+                          part_workers=part_workers, sniff=sniff,
+                          ledger=ledger)
+    try:
+        fixjp2.run(start_token=marker)
+    finally:
+        fixjp2.remove_tmp()
 
-    fixjp2.remove_tmp()
-    
     logger.info("total legacy jp2 count: {}".format(fixjp2.counter))
+    logger.info("already compliant: {}".format(fixjp2.compliant))
+    logger.info("failed: {} (see {})".format(fixjp2.failures,
+                                             checkpoint.failed_path))
+    logger.info("last checkpointed key: {}".format(checkpoint.marker))
+    if ledger is not None:
+        logger.info("ledger: {}".format(ledger.counts()))
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description='Fix legacy jp2000s so they work with potto-loris')
-    parser.add_argument('--marker', default=None)
+    parser.add_argument('--marker', default=None,
+                        help="start listing after this key (default: resume "
+                        "from the checkpoint, if any)")
     parser.add_argument('--loglevel', default='INFO')
+    parser.add_argument('--checkpoint', default=CHECKPOINT_FILE)
+    parser.add_argument('--download-workers', type=int, default=4)
+    parser.add_argument('--encode-workers', type=int, default=None,
+                        help="default: one per 4 cpus")
+    parser.add_argument('--upload-workers', type=int, default=4)
+    parser.add_argument('--part-workers', type=int,
+                        default=etag.PART_WORKERS,
+                        help="parts of a big file each upload worker sends "
+                        "at once")
+    parser.add_argument('--ledger', default=None,
+                        help="SQLite file recording the state of every key; "
+                        "keys it has as done or skipped are passed over, so "
+                        "several processes can share a run")
+    parser.add_argument('--no-sniff', action='store_true',
+                        help="reconvert every matching key without checking "
+                        "its headers first")
 
     argv = parser.parse_args()
 
     marker = argv.marker
     loglevel = argv.loglevel
 
-    sys.exit(main(marker=marker, loglevel=loglevel))
+    sys.exit(main(marker=marker, loglevel=loglevel,
+                  checkpoint_file=argv.checkpoint,
+                  download_workers=argv.download_workers,
+                  encode_workers=argv.encode_workers,
+                  upload_workers=argv.upload_workers,
+                  part_workers=argv.part_workers,
+                  sniff=not argv.no_sniff, ledger_file=argv.ledger))
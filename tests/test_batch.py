@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from ucldc_iiif import batch, benchmark
+
+
+class DedupeTestCase(unittest.TestCase):
+    ''' convert_batch(dedupe=True), with the stand-in tools from
+    ucldc_iiif.benchmark '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_env = dict(os.environ)
+        os.environ.update(benchmark.make_stub_tools(
+            os.path.join(self.tmp_dir, 'bin')))
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tmp_dir)
+
+    def job(self, name, seed=0, same_as=None):
+        path = os.path.join(self.tmp_dir, name + '.tif')
+        if same_as is not None:
+            shutil.copyfile(same_as[0], path)
+        else:
+            benchmark.write_image(path, 'tiff', 64, 48, seed=seed)
+        return batch.make_job(path)
+
+    def convert(self, jobs):
+        return dict((result.input, result) for result in batch.convert_batch(
+            jobs, workers=2, tmp_root=self.tmp_dir, ram_budget=0,
+            dedupe=True))
+
+    def test_find_duplicates(self):
+        a = self.job('a', seed=1)
+        b = self.job('b', same_as=a)
+        c = self.job('c', seed=2)
+        d = self.job('d', same_as=a)
+        self.assertEqual(batch.find_duplicates([a, b, c, d], workers=2),
+                         ([a, c], {a[0]: [b, d]}))
+        self.assertEqual(batch.find_duplicates([c]), ([c], {}))
+
+    def test_duplicates_are_copied(self):
+        a = self.job('a', seed=1)
+        b = self.job('b', same_as=a)
+        c = self.job('c', seed=2)
+        results = self.convert([a, b, c])
+        self.assertEqual(sorted(results), sorted([a[0], b[0], c[0]]))
+        self.assertTrue(all(result.status == batch.CONVERTED
+                            for result in results.values()))
+        self.assertIn('Same content as {}'.format(a[0]), results[b[0]].msg)
+        with open(a[1], 'rb') as original:
+            with open(b[1], 'rb') as copy:
+                self.assertEqual(original.read(), copy.read())
+        stages = [record['stage'] for record in results[b[0]].metrics]
+        self.assertEqual(stages, ['copy_duplicate'])
+        self.assertEqual(results[b[0]].metrics[0]['duplicate_of'], a[0])
+
+    def test_duplicates_of_a_failure_fail(self):
+        bad = os.path.join(self.tmp_dir, 'bad.tif')
+        with open(bad, 'wb') as f:
+            f.write(b'not an image')
+        bad = batch.make_job(bad)
+        copy = self.job('copy', same_as=bad)
+        results = self.convert([bad, copy])
+        self.assertEqual(results[bad[0]].status, batch.FAILED)
+        self.assertEqual(results[copy[0]].status, batch.FAILED)
+        self.assertIn('which failed', results[copy[0]].msg)
+
+    def test_failed_copy_fails_just_the_duplicate(self):
+        a = self.job('a', seed=1)
+        b = self.job('b', same_as=a)
+        b = (b[0], os.path.join(self.tmp_dir, 'missing', 'b.jp2'), b[2])
+        results = self.convert([a, b])
+        self.assertEqual(results[a[0]].status, batch.CONVERTED)
+        self.assertEqual(results[b[0]].status, batch.FAILED)
+        self.assertIn('failed copying', results[b[0]].msg)
+        self.assertFalse(results[b[0]].metrics[0]['ok'])
+
+    def test_only_lists_are_deduplicated(self):
+        a = self.job('a', seed=1)
+        self.assertRaises(ValueError, list, batch.convert_batch(
+            iter([a]), stream=True, dedupe=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from ucldc_iiif.cache import ConversionCache, file_hash
+
+
+class CacheKeyTestCase(unittest.TestCase):
+
+    def test_stable(self):
+        key = ConversionCache.key('abc', ['_uncompress_tiff'], 'opts')
+        self.assertEqual(key, ConversionCache.key(
+            'abc', ['_uncompress_tiff'], 'opts'))
+        self.assertEqual(key, hashlib.sha1(
+            b'abc\n_uncompress_tiff\nopts').hexdigest())
+
+    def test_each_part_counts(self):
+        keys = set([
+            ConversionCache.key('abc', ['_uncompress_tiff'], 'opts'),
+            ConversionCache.key('abd', ['_uncompress_tiff'], 'opts'),
+            ConversionCache.key('abc', ['_pre_convert'], 'opts'),
+            ConversionCache.key('abc', [], 'opts'),
+            ConversionCache.key('abc', ['_uncompress_tiff'], 'other'),
+            ConversionCache.key('abc', ['_pre_convert', '_uncompress_tiff'],
+                                'opts'),
+            ConversionCache.key('abc', ['_uncompress_tiff', '_pre_convert'],
+                                'opts'),
+        ])
+        self.assertEqual(len(keys), 7)
+
+
+class ConversionCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = ConversionCache(os.path.join(self.tmp_dir, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_miss(self):
+        self.assertIsNone(self.cache.lookup('0' * 40))
+        self.assertFalse(self.cache.get('0' * 40, os.path.join(
+            self.tmp_dir, 'out.jp2')))
+
+    def test_put_and_get(self):
+        output = self.write('out.jp2', b'jp2 data')
+        key = ConversionCache.key('source', [], 'opts')
+        self.cache.put(key, 'source', output)
+        entry = self.cache.lookup(key)
+        self.assertEqual(entry['output_sha1'], file_hash(output))
+        self.assertEqual(entry['output_bytes'], 8)
+
+        # from the local copy, once the output is gone
+        os.remove(output)
+        elsewhere = os.path.join(self.tmp_dir, 'elsewhere.jp2')
+        self.assertTrue(self.cache.get(key, elsewhere))
+        with open(elsewhere, 'rb') as f:
+            self.assertEqual(f.read(), b'jp2 data')
+
+    def test_changed_copies_are_not_used(self):
+        output = self.write('out.jp2', b'jp2 data')
+        key = ConversionCache.key('source', [], 'opts')
+        self.cache.put(key, 'source', output)
+        self.write('out.jp2', b'jp2 date')
+        shutil.rmtree(os.path.join(self.tmp_dir, 'cache', 'blobs'))
+        self.assertFalse(self.cache.get(key, output))
+
+    def test_evict_by_size_keeps_entries(self):
+        keys = []
+        for i in range(3):
+            output = self.write('out{}.jp2'.format(i), b'x' * 100)
+            key = ConversionCache.key(str(i), [], 'opts')
+            self.cache.put(key, str(i), output)
+            # least recently used first
+            past = time.time() - 100 + i
+            os.utime(self.cache._entry_path(key), (past, past))
+            keys.append(key)
+        self.cache.max_bytes = 150
+        self.assertEqual(self.cache.evict(), 200)
+        self.assertEqual([os.path.exists(self.cache._blob_path(kept))
+                          for kept in keys], [False, False, True])
+        self.assertTrue(all(self.cache.lookup(kept) for kept in keys))
+
+    def test_evict_by_age(self):
+        output = self.write('out.jp2', b'x' * 100)
+        key = ConversionCache.key('source', [], 'opts')
+        self.cache.put(key, 'source', output)
+        past = time.time() - 1000
+        os.utime(self.cache._entry_path(key), (past, past))
+        self.cache.max_age = 500
+        self.assertEqual(self.cache.evict(), 100)
+        self.assertIsNone(self.cache.lookup(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import struct
+import tempfile
+import unittest
+import threading
+import subprocess
+
+from ucldc_iiif import convert, imageinfo
+from ucldc_iiif.workspace import Budget, Workspace
+from ucldc_iiif.convert import plan_conversion, choose_plan, \
+    estimate_job_resources, PRE_CONVERT_STEP, UNCOMPRESS_TIFF_STEP, \
+    TO_SRGB_STEP, IN_PROCESS_STEP, PRE_CONVERT_LIMITED_STEP, \
+    TO_SRGB_BY_BLOCK_STEP, JP2_PLAN, DEFAULT_PLAN, KDU_BASE, MB, \
+    KduThreadScheduler, kdu_opts_with_threads
+
+
+def info(**fields):
+    ''' an ImageInfo for an 8-bit RGB, uncompressed, strip-based TIFF,
+    with `fields` changed '''
+    values = dict(
+        format='tiff', width=4000, height=3000, bits_per_sample=8,
+        samples_per_pixel=3, compression=imageinfo.TIFF_COMPRESSION_NONE,
+        photometric=imageinfo.PHOTOMETRIC_RGB, planar_config=1, tiled=False,
+        extra_samples=0, icc_profile=None, orientation=1, palette=False)
+    values.update(fields)
+    return imageinfo.ImageInfo(**values)
+
+
+class PlanConversionTestCase(unittest.TestCase):
+
+    def test_jp2(self):
+        self.assertEqual(plan_conversion('image/jp2', info()), JP2_PLAN)
+        self.assertEqual(plan_conversion('image/jpx'), JP2_PLAN)
+
+    def test_no_header(self):
+        self.assertEqual(plan_conversion('image/tiff', None), DEFAULT_PLAN)
+
+    def test_baseline_tiff_needs_nothing(self):
+        self.assertEqual(plan_conversion('image/tiff', info()), [])
+        self.assertEqual(plan_conversion('image/tiff', info(
+            samples_per_pixel=1,
+            photometric=imageinfo.PHOTOMETRIC_MINISBLACK)), [])
+        self.assertEqual(plan_conversion('image/tiff', info(
+            icc_profile=b'... sRGB IEC61966-2.1 ...')), [])
+
+    def test_compressed_tiff(self):
+        self.assertEqual(plan_conversion('image/tiff', info(compression=5)),
+                         [UNCOMPRESS_TIFF_STEP])
+
+    def test_tiff_needing_srgb(self):
+        for fields in [dict(bits_per_sample=16), dict(palette=True),
+                       dict(samples_per_pixel=4, extra_samples=1),
+                       dict(samples_per_pixel=4, photometric=5),
+                       dict(icc_profile=b'Adobe RGB (1998)')]:
+            self.assertEqual(plan_conversion('image/tiff', info(**fields)),
+                             [TO_SRGB_STEP], fields)
+        self.assertEqual(
+            plan_conversion('image/tiff', info(compression=5,
+                                               bits_per_sample=16)),
+            [UNCOMPRESS_TIFF_STEP, TO_SRGB_STEP])
+
+    def test_tiff_needing_imagemagick(self):
+        for fields in [dict(orientation=6), dict(tiled=True),
+                       dict(planar_config=2)]:
+            self.assertEqual(plan_conversion('image/tiff', info(**fields)),
+                             [PRE_CONVERT_STEP], fields)
+
+    def test_jpeg(self):
+        jpeg = info(format='jpeg', compression=None, photometric=None)
+        self.assertEqual(plan_conversion('image/jpeg', jpeg),
+                         [PRE_CONVERT_STEP])
+        self.assertEqual(
+            plan_conversion('image/jpeg', jpeg._replace(samples_per_pixel=4)),
+            [PRE_CONVERT_STEP, TO_SRGB_STEP])
+
+    @unittest.skipIf(convert.Image is None, 'needs Pillow')
+    def test_jpeg_in_process(self):
+        jpeg = info(format='jpeg', compression=None, photometric=None)
+        self.assertEqual(plan_conversion('image/jpeg', jpeg,
+                                         in_process_max_pixels=12000000),
+                         [IN_PROCESS_STEP])
+        # too big
+        self.assertEqual(plan_conversion('image/jpeg', jpeg,
+                                         in_process_max_pixels=1000000),
+                         [PRE_CONVERT_STEP])
+        # not a type Pillow handles in-process
+        self.assertEqual(plan_conversion('image/tiff', info(compression=5),
+                                         in_process_max_pixels=12000000),
+                         [UNCOMPRESS_TIFF_STEP])
+
+    def test_strip_wise(self):
+        for fields, plan in [
+                (dict(), []),
+                (dict(compression=5), [UNCOMPRESS_TIFF_STEP]),
+                (dict(compression=5, tiled=True), [TO_SRGB_BY_BLOCK_STEP]),
+                (dict(bits_per_sample=16), [TO_SRGB_BY_BLOCK_STEP]),
+                (dict(orientation=3), [PRE_CONVERT_LIMITED_STEP]),
+                (dict(orientation=3, bits_per_sample=16),
+                 [PRE_CONVERT_LIMITED_STEP, TO_SRGB_BY_BLOCK_STEP])]:
+            self.assertEqual(plan_conversion('image/tiff', info(**fields),
+                                             strip_wise=True), plan, fields)
+        self.assertEqual(
+            plan_conversion('image/jpeg', info(format='jpeg'),
+                            in_process_max_pixels=10 ** 9, strip_wise=True),
+            [PRE_CONVERT_LIMITED_STEP])
+
+
+class ChoosePlanTestCase(unittest.TestCase):
+
+    def test_unknown_size(self):
+        self.assertEqual(choose_plan('image/tiff', None, 0, 1),
+                         (DEFAULT_PLAN, None, None, False))
+
+    def test_fits_in_memory(self):
+        image = info(compression=5, bits_per_sample=16)
+        plan, memory, disk, strip_wise = choose_plan('image/tiff', image)
+        self.assertEqual(plan, [UNCOMPRESS_TIFF_STEP, TO_SRGB_STEP])
+        self.assertEqual((memory, disk),
+                         estimate_job_resources(image, plan))
+        self.assertFalse(strip_wise)
+
+    def test_switches_to_strip_wise(self):
+        image = info(width=20000, height=15000, compression=5,
+                     bits_per_sample=16)
+        whole, memory, disk, strip_wise = choose_plan('image/tiff', image)
+        plan, less, disk, strip_wise = choose_plan(
+            'image/tiff', image, strip_wise_bytes=memory - 1)
+        self.assertTrue(strip_wise)
+        self.assertEqual(plan, [TO_SRGB_BY_BLOCK_STEP])
+        self.assertLess(less, memory)
+
+
+class JobResourcesTestCase(unittest.TestCase):
+
+    def test_job_resources(self):
+        image = info(width=1000, height=1000)
+        intermediate = convert.estimate_intermediate_bytes(image)
+        self.assertEqual(intermediate, 1000 * 1000 * 4 + 64 * 1024)
+        self.assertEqual(estimate_job_resources(image, []),
+                         (convert.KDU_COMPRESS_MEMORY, 0))
+        memory, disk = estimate_job_resources(image, [TO_SRGB_STEP])
+        self.assertEqual(memory, max(convert.KDU_COMPRESS_MEMORY,
+                                     1000 * 1000 * 4 + 16 * convert.MB))
+        self.assertEqual(disk, intermediate)
+        memory, disk = estimate_job_resources(
+            image, [PRE_CONVERT_STEP, UNCOMPRESS_TIFF_STEP, TO_SRGB_STEP])
+        self.assertEqual(disk, 2 * intermediate)
+
+    def test_admission_waits_for_the_budget(self):
+        memory = Budget(100)
+        converter = convert.Convert(memory_budget=memory,
+                                    disk_budget=Budget(100))
+        memory.acquire(80)
+        releaser = threading.Timer(0.2, memory.release, [80])
+        releaser.start()
+        started = time.time()
+        with converter._admitted('a.tif', 50, 50):
+            self.assertGreaterEqual(time.time() - started, 0.1)
+            self.assertEqual(memory.used, 50)
+            self.assertEqual(converter.disk_budget.used, 50)
+        releaser.join()
+        # given back, even if the job fails
+        self.assertEqual((memory.used, converter.disk_budget.used), (0, 0))
+        with self.assertRaises(RuntimeError):
+            with converter._admitted('a.tif', 50, None):
+                raise RuntimeError
+        self.assertEqual(memory.used, 0)
+
+
+@unittest.skipIf(convert.Image is None or convert.ImageCms is None,
+                 'needs Pillow')
+class InProcessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.converter = convert.Convert()
+        self.output = os.path.join(self.tmp_dir, 'preconverted.tiff')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def preconvert(self, input_path):
+        passed, msg = self.converter._pre_convert_in_process(input_path,
+                                                             self.output)
+        self.assertTrue(passed, msg)
+        image = convert.Image.open(self.output)
+        image.load()
+        self.assertEqual(image.format, 'TIFF')
+        return image
+
+    def test_alpha_flattened_onto_white(self):
+        # an sRGB profile Pillow doesn't recognise as one, so it's applied
+        profile = convert.ImageCms.ImageCmsProfile(
+            convert.ImageCms.createProfile('sRGB')).tobytes()
+        self.assertFalse(imageinfo.is_srgb_profile(profile))
+        image = convert.Image.new('RGBA', (30, 20), (0, 0, 0, 0))
+        image.paste((200, 0, 0, 255), (0, 0, 10, 20))
+        image.save(self.path('alpha.png'), icc_profile=profile)
+
+        image = self.preconvert(self.path('alpha.png'))
+        self.assertEqual((image.mode, image.size), ('RGB', (30, 20)))
+        self.assertEqual(image.getpixel((25, 10)), (255, 255, 255))
+        red, green, blue = image.getpixel((5, 10))
+        self.assertGreater(red, 150)
+        self.assertLess(max(green, blue), 50)
+
+    def test_grey_alpha(self):
+        convert.Image.new('LA', (8, 8), (0, 0)).save(self.path('la.png'))
+        image = self.preconvert(self.path('la.png'))
+        self.assertEqual((image.mode, image.getpixel((4, 4))), ('L', 255))
+
+    def test_cmyk(self):
+        convert.Image.new('CMYK', (30, 20), (0, 0, 0, 0)).save(
+            self.path('cmyk.jpg'), quality=100)
+        image = self.preconvert(self.path('cmyk.jpg'))
+        self.assertEqual((image.mode, image.size), ('RGB', (30, 20)))
+        self.assertTrue(all(value > 240 for value in image.getpixel((5, 5))))
+
+    def test_orientation(self):
+        image = convert.Image.new('RGB', (40, 20), (0, 0, 255))
+        image.paste((255, 0, 0), (0, 0, 20, 20))
+        # an EXIF block saying the image is displayed rotated 90 degrees
+        # clockwise (orientation 6)
+        exif = b'Exif\x00\x00MM\x00*' + struct.pack(
+            '>IHHHIHHI', 8, 1, 274, 3, 1, 6, 0, 0)
+        image.save(self.path('rotated.jpg'), quality=100, exif=exif)
+
+        image = self.preconvert(self.path('rotated.jpg'))
+        self.assertEqual((image.mode, image.size), ('RGB', (20, 40)))
+        # what was on the left is now at the top
+        self.assertGreater(image.getpixel((10, 5))[0], 200)
+        self.assertGreater(image.getpixel((10, 35))[2], 200)
+
+    def test_imagemagick_fallback_uses_the_workspace(self):
+        with open(self.path('broken.jpg'), 'wb') as f:
+            f.write(b'\xff\xd8 not really a jpeg')
+        workspace = Workspace(self.path('scratch'))
+        os.mkdir(workspace.disk_dir)
+        used = []
+
+        def pre_convert(input_path, output_path):
+            used.append(output_path)
+            open(output_path, 'wb').close()
+            return True, 'converted'
+
+        def to_srgb(input_path, output_path):
+            self.assertTrue(os.path.exists(input_path))
+            return True, 'converted'
+
+        self.converter._pre_convert = pre_convert
+        self.converter._tiff_to_srgb_libtiff = to_srgb
+        passed, msg = self.converter._pre_convert_in_process(
+            self.path('broken.jpg'), self.output, workspace=workspace)
+        self.assertTrue(passed)
+        self.assertEqual(os.path.dirname(used[0]), workspace.disk_dir)
+        self.assertFalse(os.path.exists(used[0]))
+
+    def test_fallback_has_room_on_disk(self):
+        image = info(format='jpeg', width=1000, height=1000)
+        self.assertEqual(
+            estimate_job_resources(image, [IN_PROCESS_STEP])[1],
+            2 * convert.estimate_intermediate_bytes(image))
+
+
+class KduThreadSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = KduThreadScheduler(cpus=8)
+
+    def test_small_images_run_single_threaded(self):
+        self.assertEqual(self.scheduler.threads_for(MB), 1)
+        # one thread per (roughly) 1024x1024 RGB tile
+        self.assertEqual(
+            self.scheduler.threads_for(3 * convert.KDU_BYTES_PER_THREAD), 4)
+
+    def test_one_big_image_gets_every_cpu(self):
+        self.assertEqual(self.scheduler.threads_for(500 * MB), 8)
+        capped = KduThreadScheduler(cpus=8, max_threads=3)
+        self.assertEqual(capped.threads_for(500 * MB), 3)
+
+    def test_shared_by_size_between_encodes(self):
+        with self.scheduler.job(), \
+                self.scheduler.encoding(300 * MB) as first:
+            with self.scheduler.job(), \
+                    self.scheduler.encoding(100 * MB) as second:
+                self.assertEqual(first, 8)
+                self.assertEqual(second, 2)
+                self.assertEqual(self.scheduler.threads_for(300 * MB), 6)
+        self.assertEqual(self.scheduler._jobs.value, 0)
+        self.assertEqual(self.scheduler._encoding.value, 0)
+        self.assertEqual(self.scheduler._encoding_bytes.value, 0)
+
+    def test_jobs_in_earlier_stages_take_a_cpu_each(self):
+        with self.scheduler.job(), self.scheduler.job(), \
+                self.scheduler.job():
+            with self.scheduler.job(), \
+                    self.scheduler.encoding(500 * MB) as threads:
+                self.assertEqual(threads, 5)
+            for i in range(20):
+                self.scheduler._add(self.scheduler._jobs, 1)
+            # never less than one
+            self.assertEqual(self.scheduler.threads_for(500 * MB), 1)
+
+    def test_num_threads_option(self):
+        opts = ['-rate', '2', '-num_threads', '4']
+        self.assertEqual(kdu_opts_with_threads(opts, 2),
+                         ['-rate', '2', '-num_threads', '2'])
+        self.assertEqual(opts[-1], '4')
+        self.assertEqual(kdu_opts_with_threads(['-rate', '2'], 3),
+                         ['-rate', '2', '-num_threads', '3'])
+
+    def test_kdu_compress_gets_the_scheduled_threads(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        tiff_path = os.path.join(tmp_dir, 'in.tif')
+        with open(tiff_path, 'wb') as f:
+            f.write(b'\0' * 3 * convert.KDU_BYTES_PER_THREAD)
+        calls = []
+
+        def check_output(stage, args, input_path, output_path, env=None):
+            calls.append(args)
+            return ''
+
+        converter = convert.Convert(scheduler=KduThreadScheduler(cpus=8))
+        converter._check_output = check_output
+        converted, msg = converter._tiff_to_jp2(
+            tiff_path, os.path.join(tmp_dir, 'out.jp2'))
+        self.assertTrue(converted, msg)
+        args = calls[0]
+        self.assertEqual(args[args.index('-num_threads') + 1], '4')
+
+
+class KduOptionMemoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_remembers_after_repeated_fallbacks(self):
+        path = os.path.join(self.tmp_dir, 'kdu.jsonl')
+        memory = convert.KduOptionMemory(path, fallback_after=2)
+        memory.record_fallback('kind')
+        self.assertIsNone(memory.lookup('kind'))
+        memory.record_fallback('kind')
+        self.assertEqual(memory.lookup('kind'), KDU_BASE)
+        # shared with other processes through the file
+        self.assertEqual(convert.KduOptionMemory(path).lookup('kind'),
+                         KDU_BASE)
+        self.assertIsNone(convert.KduOptionMemory(path).lookup('other'))
+
+    def test_transient_failures(self):
+        def failure(returncode, output=''):
+            return subprocess.CalledProcessError(returncode, ['kdu'], output)
+        self.assertTrue(convert.transient_failure(failure(-9)))
+        self.assertTrue(convert.transient_failure(
+            failure(1, 'write error: No space left on device')))
+        self.assertFalse(convert.transient_failure(
+            failure(1, 'Kakadu Error: unsupported sample depth')))
+
+
+if __name__ == '__main__':
+    unittest.main()
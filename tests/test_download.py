@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import hashlib
+import tempfile
+import unittest
+import threading
+
+import requests
+
+from ucldc_iiif import loadtest
+from ucldc_iiif.download import Downloader, ChecksumMismatch
+
+
+class DownloaderTestCase(unittest.TestCase):
+    ''' downloads from the load test's S3 stand-in, which serves Range
+    requests '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        root = os.path.join(self.tmp_dir, 'origin')
+        os.makedirs(os.path.join(root, 'bucket'))
+        rng = random.Random(0)
+        # not a multiple of the number of parts
+        self.data = bytes(bytearray(rng.randint(0, 255)
+                                    for i in range(100003)))
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        with open(os.path.join(root, 'bucket', 'master.tif'), 'wb') as f:
+            f.write(self.data)
+        self.server = loadtest.S3StandIn(('127.0.0.1', 0), root)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.origin = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.url = self.origin + '/bucket/master.tif'
+        self.path = os.path.join(self.tmp_dir, 'master.tif')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_ranges_are_reassembled_in_order(self):
+        downloader = Downloader(range_threshold=1000, range_parts=4)
+        result = downloader.download(self.url, self.path,
+                                     self.md5.upper())
+        self.assertTrue(result.ok and result.ranged)
+        self.assertEqual((result.bytes, result.digest),
+                         (len(self.data), self.md5))
+        self.assertEqual(self.read(), self.data)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        # a HEAD, then one GET per range
+        self.assertEqual(loadtest.origin_stats(self.origin),
+                         {'requests': 5, 'bytes': len(self.data)})
+
+    def test_small_files_are_streamed(self):
+        result = Downloader().download(self.url, self.path, self.md5)
+        self.assertFalse(result.ranged)
+        self.assertEqual(result.digest, self.md5)
+        self.assertEqual(self.read(), self.data)
+
+    def test_checksum_mismatch(self):
+        for range_threshold in (1000, Downloader().range_threshold):
+            downloader = Downloader(range_threshold=range_threshold)
+            self.assertRaises(ChecksumMismatch, downloader.download,
+                              self.url, self.path, '0' * 32)
+            self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['origin'])
+
+    def test_download_many(self):
+        jobs = [(self.url, self.path, self.md5),
+                (self.origin + '/bucket/missing.tif',
+                 os.path.join(self.tmp_dir, 'missing.tif'), None)]
+        results = sorted(Downloader(range_threshold=1000).download_many(jobs))
+        self.assertEqual([result.ok for result in results], [True, False])
+        self.assertIn('404', results[1].msg)
+        self.assertEqual(self.read(), self.data)
+        self.assertRaises(requests.HTTPError, Downloader().download,
+                          jobs[1][0], jobs[1][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
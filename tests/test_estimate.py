@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from ucldc_iiif.estimate import choose_sample, fit_linear, size_class, \
+    describe, _workers_within, Source, BYTES_PER_PIXEL
+
+
+def source(name, pixels, stratum):
+    return Source(name, 'image/tiff', pixels * 3, None, [], pixels, 0, 0,
+                  stratum, 'image/tiff [none]')
+
+
+class ChooseSampleTestCase(unittest.TestCase):
+
+    def test_every_stratum(self):
+        sources = [source('big{}'.format(i), 50000000, 'large')
+                   for i in range(20)]
+        sources.append(source('odd', 1000, 'small'))
+        sample = choose_sample(sources, sample_size=5)
+        self.assertEqual(len(sample), 5)
+        self.assertEqual([s.source for s in sample
+                          if s.stratum == 'small'], ['odd'])
+
+    def test_shared_by_pixels(self):
+        sources = [source('a{}'.format(i), 3000000, 'a')
+                   for i in range(30)]
+        sources += [source('b{}'.format(i), 1000000, 'b')
+                    for i in range(30)]
+        sample = choose_sample(sources, sample_size=10)
+        counts = dict((name, len([s for s in sample if s.stratum == name]))
+                      for name in ('a', 'b'))
+        # 8 spare: 6 to a's 3/4 of the pixels, 2 to b's 1/4
+        self.assertEqual(counts, {'a': 7, 'b': 3})
+
+    def test_spread_from_smallest_to_largest(self):
+        sources = [source(str(pixels), pixels, 'one')
+                   for pixels in (5, 1, 4, 2, 3)]
+        self.assertEqual([s.pixels for s in choose_sample(sources, 3)],
+                         [1, 3, 5])
+        self.assertEqual([s.pixels for s in choose_sample(sources, 1)],
+                         [3])
+
+    def test_small_collections(self):
+        sources = [source(str(i), i + 1, 'one') for i in range(3)]
+        self.assertEqual(len(choose_sample(sources, 30)), 3)
+        self.assertEqual(choose_sample([], 30), [])
+
+
+class FitLinearTestCase(unittest.TestCase):
+
+    def assertFit(self, fit, expected):
+        self.assertAlmostEqual(fit[0], expected[0])
+        self.assertAlmostEqual(fit[1], expected[1])
+
+    def test_exact(self):
+        self.assertFit(fit_linear([1, 2, 3], [5, 7, 9]), (3, 2))
+
+    def test_negative_intercept_goes_through_origin(self):
+        # least squares would be y = 2x - 1
+        self.assertFit(fit_linear([1, 2, 3], [1, 3, 5]), (0, 22 / 14.0))
+
+    def test_negative_slope(self):
+        self.assertFit(fit_linear([1, 2], [2, 1]), (0, 4 / 5.0))
+        self.assertFit(fit_linear([1, 2], [-2, -1]), (0, 0))
+
+    def test_one_distinct_x(self):
+        self.assertFit(fit_linear([2, 2], [3, 5]), (0, 2))
+        self.assertFit(fit_linear([0, 0], [3, 5]), (4, 0))
+
+    def test_empty(self):
+        self.assertEqual(fit_linear([], []), (0.0, 0.0))
+
+
+class DescribeTestCase(unittest.TestCase):
+
+    def test_size_class(self):
+        self.assertEqual(size_class(0), 'small')
+        self.assertEqual(size_class(4000000), 'medium')
+        self.assertEqual(size_class(63999999), 'large')
+        self.assertEqual(size_class(64000000), 'huge')
+
+    def test_without_header(self):
+        described = describe('a.tif', 'image/tiff', 3000, None)
+        self.assertEqual(described.pixels, int(3000 / BYTES_PER_PIXEL))
+        self.assertTrue(described.stratum.startswith('no header: '))
+        self.assertEqual(
+            describe('a.tif', 'image/tiff', 3000, None,
+                     bytes_per_pixel=1.5).pixels, 2000)
+
+    def test_workers_within(self):
+        self.assertEqual(_workers_within([1, 2, 3, 4], 7, 8), 2)
+        self.assertEqual(_workers_within([1, 2, 3, 4], 100, 3), 3)
+        # always at least one
+        self.assertEqual(_workers_within([10], 5, 4), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
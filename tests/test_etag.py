@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from ucldc_iiif.etag import part_size_for, s3_etag, etag_matches, MB, \
+    PART_SIZE, MIN_PART_SIZE, MAX_PARTS
+
+
+def multipart_etag(data, part_size):
+    ''' the ETag S3 gives `data` uploaded in `part_size` parts '''
+    parts = [data[i:i + part_size] for i in range(0, len(data), part_size)]
+    digests = b''.join(hashlib.md5(part).digest() for part in parts)
+    return '{}-{}'.format(hashlib.md5(digests).hexdigest(), len(parts))
+
+
+class PartSizeTestCase(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(part_size_for(100 * MB), PART_SIZE)
+        self.assertEqual(part_size_for(100 * MB, 16 * MB), 16 * MB)
+
+    def test_at_least_s3_minimum(self):
+        self.assertEqual(part_size_for(100 * MB, 1 * MB), MIN_PART_SIZE)
+
+    def test_grows_to_stay_within_max_parts(self):
+        size = 200 * 1024 * MB
+        part_size = part_size_for(size)
+        self.assertEqual(part_size % MB, 0)
+        self.assertLessEqual((size + part_size - 1) // part_size, MAX_PARTS)
+        self.assertGreater((size + part_size - MB - 1) // (part_size - MB),
+                           MAX_PARTS)
+
+
+class EtagTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, size):
+        data = (b'0123456789abcdef' * (size // 16 + 1))[:size]
+        path = os.path.join(self.tmp_dir, 'file')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path, data
+
+    def test_single_part(self):
+        path, data = self.write(1000)
+        self.assertEqual(s3_etag(path), hashlib.md5(data).hexdigest())
+
+    def test_multipart(self):
+        path, data = self.write(11 * MB)
+        self.assertEqual(s3_etag(path), multipart_etag(data, 8 * MB))
+        self.assertEqual(s3_etag(path, part_size=5 * MB),
+                         multipart_etag(data, 5 * MB))
+
+    def test_matches(self):
+        path, data = self.write(1000)
+        etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        self.assertTrue(etag_matches(path, 1000, etag))
+        self.assertFalse(etag_matches(path, 1001, etag))
+        self.assertFalse(etag_matches(path, 1000, '"' + '0' * 32 + '"'))
+
+    def test_matches_other_part_sizes(self):
+        path, data = self.write(20 * MB)
+        # ours
+        self.assertTrue(etag_matches(path, 20 * MB,
+                                     multipart_etag(data, 8 * MB)))
+        # a power of two MB, as many tools use
+        self.assertTrue(etag_matches(path, 20 * MB,
+                                     multipart_etag(data, 16 * MB)))
+        # the smallest whole MB giving that many parts
+        self.assertTrue(etag_matches(path, 20 * MB,
+                                     multipart_etag(data, 7 * MB)))
+        self.assertFalse(etag_matches(path, 20 * MB,
+                                      multipart_etag(data[:-1] + b'!',
+                                                     8 * MB)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import zlib
+import shutil
+import struct
+import tempfile
+import unittest
+
+from ucldc_iiif import imageinfo
+
+# TIFF field types
+SHORT = 3
+LONG = 4
+UNDEFINED = 7
+
+
+def tiff(entries, endian='<'):
+    '''
+    a TIFF with one IFD of (tag, type, values) entries; values too big
+    to fit in an entry go after the IFD. UNDEFINED values are bytes.
+    '''
+    formats = {SHORT: 'H', LONG: 'I'}
+    ifd_offset = 8
+    data_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    ifd = struct.pack(endian + 'H', len(entries))
+    data = b''
+    for tag, field_type, values in sorted(entries):
+        if field_type == UNDEFINED:
+            raw, count = values, len(values)
+        else:
+            if not isinstance(values, tuple):
+                values = (values,)
+            raw = struct.pack(endian + formats[field_type] * len(values),
+                              *values)
+            count = len(values)
+        if len(raw) > 4:
+            value = struct.pack(endian + 'I', data_offset + len(data))
+            data += raw
+        else:
+            value = raw + b'\0' * (4 - len(raw))
+        ifd += struct.pack(endian + 'HHI', tag, field_type, count) + value
+    ifd += struct.pack(endian + 'I', 0)
+    magic = b'II*\x00' if endian == '<' else b'MM\x00*'
+    return magic + struct.pack(endian + 'I', ifd_offset) + ifd + data
+
+
+def segment(code, content):
+    return struct.pack('>BBH', 0xff, code, len(content) + 2) + content
+
+
+def jpeg(width, height, components=3, orientation=None, icc_chunks=()):
+    data = b'\xff\xd8'
+    if orientation is not None:
+        data += segment(0xe1, b'Exif\x00\x00' + tiff(
+            [(274, SHORT, orientation)], endian='>'))
+    for sequence, count, chunk in icc_chunks:
+        data += segment(0xe2, b'ICC_PROFILE\x00' +
+                        struct.pack('>BB', sequence, count) + chunk)
+    data += segment(0xc0, struct.pack('>BHHB', 8, height, width, components)
+                    + b'\x01\x11\x00' * components)
+    return data + b'\xff\xda' + b'\0' * 16
+
+
+def chunk(chunk_type, content):
+    return struct.pack('>I', len(content)) + chunk_type + content + \
+        b'\0\0\0\0'
+
+
+def png(width, height, depth=8, color_type=2, icc_profile=None):
+    data = b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack(
+        '>IIBBBBB', width, height, depth, color_type, 0, 0, 0))
+    if icc_profile is not None:
+        data += chunk(b'iCCP', b'profile\x00\x00' +
+                      zlib.compress(icc_profile))
+    return data + chunk(b'IDAT', b'\0' * 16)
+
+
+def read(data):
+    return imageinfo.read_image_info_from_file(io.BytesIO(data))
+
+
+class TiffTestCase(unittest.TestCase):
+
+    def test_baseline_rgb(self):
+        info = read(tiff([
+            (256, LONG, 4000), (257, LONG, 3000), (258, SHORT, (8, 8, 8)),
+            (259, SHORT, 5), (262, SHORT, 2), (277, SHORT, 3)]))
+        self.assertEqual(info.format, 'tiff')
+        self.assertEqual((info.width, info.height), (4000, 3000))
+        self.assertEqual(info.bits_per_sample, 8)
+        self.assertEqual(info.samples_per_pixel, 3)
+        self.assertEqual(info.compression, 5)
+        self.assertEqual(info.photometric, imageinfo.PHOTOMETRIC_RGB)
+        self.assertEqual(info.orientation, 1)
+        self.assertFalse(info.tiled)
+        self.assertFalse(info.palette)
+        self.assertIsNone(info.icc_profile)
+
+    def test_big_endian(self):
+        info = read(tiff([(256, SHORT, 640), (257, SHORT, 480)],
+                         endian='>'))
+        self.assertEqual((info.width, info.height), (640, 480))
+        self.assertEqual(info.compression, imageinfo.TIFF_COMPRESSION_NONE)
+
+    def test_tiled_with_alpha_and_profile(self):
+        profile = b'not really an ICC profile'
+        info = read(tiff([
+            (256, LONG, 100), (257, LONG, 100), (258, SHORT, (16,) * 4),
+            (262, SHORT, 2), (274, SHORT, 6), (277, SHORT, 4),
+            (284, SHORT, 2), (322, SHORT, 256), (338, SHORT, 2),
+            (34675, UNDEFINED, profile)]))
+        self.assertTrue(info.tiled)
+        self.assertEqual(info.bits_per_sample, 16)
+        self.assertEqual(info.extra_samples, 1)
+        self.assertEqual(info.planar_config, 2)
+        self.assertEqual(info.orientation, 6)
+        self.assertEqual(info.icc_profile, profile)
+
+    def test_palette(self):
+        info = read(tiff([(256, LONG, 10), (257, LONG, 10),
+                          (262, SHORT, imageinfo.PHOTOMETRIC_PALETTE)]))
+        self.assertTrue(info.palette)
+
+
+class JpegTestCase(unittest.TestCase):
+
+    def test_dimensions(self):
+        info = read(jpeg(1200, 800, components=1))
+        self.assertEqual(info.format, 'jpeg')
+        self.assertEqual((info.width, info.height), (1200, 800))
+        self.assertEqual(info.samples_per_pixel, 1)
+        self.assertEqual(info.bits_per_sample, 8)
+        self.assertEqual(info.orientation, 1)
+
+    def test_exif_orientation(self):
+        self.assertEqual(read(jpeg(10, 20, orientation=8)).orientation, 8)
+
+    def test_icc_chunks_in_sequence_order(self):
+        info = read(jpeg(10, 10, icc_chunks=[(2, 2, b'second'),
+                                             (1, 2, b'first ')]))
+        self.assertEqual(info.icc_profile, b'first second')
+
+
+class PngGifTestCase(unittest.TestCase):
+
+    def test_png(self):
+        info = read(png(300, 200, depth=16, color_type=6,
+                        icc_profile=b'sRGB profile'))
+        self.assertEqual(info.format, 'png')
+        self.assertEqual((info.width, info.height), (300, 200))
+        self.assertEqual(info.bits_per_sample, 16)
+        self.assertEqual(info.samples_per_pixel, 4)
+        self.assertEqual(info.extra_samples, 1)
+        self.assertEqual(info.icc_profile, b'sRGB profile')
+        self.assertTrue(imageinfo.is_srgb_profile(info.icc_profile))
+
+    def test_png_palette(self):
+        info = read(png(30, 20, color_type=3))
+        self.assertTrue(info.palette)
+        self.assertEqual(info.samples_per_pixel, 1)
+
+    def test_gif(self):
+        info = read(b'GIF89a' + struct.pack('<HH', 640, 480) + b'\0' * 8)
+        self.assertEqual(info.format, 'gif')
+        self.assertEqual((info.width, info.height), (640, 480))
+        self.assertTrue(info.palette)
+
+    def test_unknown_format(self):
+        self.assertIsNone(read(b'%PDF-1.4\n' + b'\0' * 32))
+
+
+class ReadImageInfoTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_file(self):
+        path = os.path.join(self.tmp_dir, 'image.png')
+        with open(path, 'wb') as f:
+            f.write(png(30, 20))
+        self.assertEqual(imageinfo.read_image_info(path).width, 30)
+
+    def test_unparseable_file(self):
+        path = os.path.join(self.tmp_dir, 'truncated.tif')
+        with open(path, 'wb') as f:
+            f.write(tiff([(256, LONG, 10)])[:12])
+        self.assertIsNone(imageinfo.read_image_info(path))
+        self.assertIsNone(imageinfo.read_image_info(
+            os.path.join(self.tmp_dir, 'missing.tif')))
+
+    def test_sizes(self):
+        info = read(tiff([(256, LONG, 100), (257, LONG, 50),
+                          (258, SHORT, (16, 16, 16)), (277, SHORT, 3)]))
+        self.assertEqual(imageinfo.pixels(info), 5000)
+        self.assertEqual(imageinfo.uncompressed_bytes(info), 5000 * 3 * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+from ucldc_iiif import inventory
+from ucldc_iiif.inventory import InventoryItem, Snapshot, ADDED, REMOVED, \
+    CHANGED
+
+Key = namedtuple('Key', ['name', 'size', 'etag', 'last_modified'])
+
+MODIFIED = '2017-10-10T13:55:36.000Z'
+
+
+class FakeBucket(object):
+    ''' lists its keys like boto: in order, under a prefix, after a
+    marker '''
+
+    def __init__(self, sizes):
+        self.keys = {}
+        for name, size in sizes.items():
+            self.put(name, size)
+        self.listings = 0
+
+    def put(self, name, size, etag=None):
+        self.keys[name] = Key(name, size, '"{}"'.format(etag or name),
+                              MODIFIED)
+
+    def list(self, prefix='', marker=''):
+        self.listings += 1
+        for name in sorted(self.keys):
+            if name.startswith(prefix) and name > marker:
+                yield self.keys[name]
+
+
+class FakeBucketTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = FakeBucket(dict.fromkeys([
+            'jp2/-first', 'jp2/0abc', 'jp2/1', 'jp2/10', 'jp2/1f', 'jp2/7',
+            'jp2/7777', 'jp2/f', 'jp2/ffff', 'jp2/zz', 'jp2x/no',
+            'other/no'], 10))
+        self.saved_thread_bucket = inventory.thread_bucket
+        inventory.thread_bucket = lambda bucket_name: self.bucket
+
+    def tearDown(self):
+        inventory.thread_bucket = self.saved_thread_bucket
+
+
+class ShardRangesTestCase(FakeBucketTestCase):
+
+    def test_ranges(self):
+        self.assertEqual(inventory.shard_ranges('jp2/', '81'), [
+            (None, 'jp2/1'), ('jp2/1', 'jp2/8'), ('jp2/8', None)])
+        self.assertEqual(inventory.hex_boundaries(1), list('123456789abcdef'))
+        self.assertEqual(len(inventory.hex_boundaries()), 255)
+
+    def test_every_key_in_one_range(self):
+        for boundaries in (inventory.SHARD_BOUNDARIES, '7',
+                           inventory.hex_boundaries()):
+            shards = [inventory.list_range('bucket', 'jp2/', after, upto)
+                      for after, upto in inventory.shard_ranges(
+                          'jp2/', boundaries)]
+            keys = [item.key for shard in shards for item in shard]
+            self.assertEqual(keys, sorted(name for name in self.bucket.keys
+                                          if name.startswith('jp2/')))
+
+    def test_boundaries_end_a_range(self):
+        ranges = inventory.shard_ranges('jp2/')
+        self.assertEqual([item.key for item in inventory.list_range(
+            'bucket', 'jp2/', *ranges[0])], ['jp2/-first', 'jp2/0abc',
+                                             'jp2/1'])
+        self.assertEqual([item.key for item in inventory.list_range(
+            'bucket', 'jp2/', *ranges[-1])], ['jp2/ffff', 'jp2/zz'])
+
+    def test_list_inventory(self):
+        items = inventory.list_inventory('bucket/jp2', workers=4)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(items[0], InventoryItem('jp2/-first', 10,
+                                                 'jp2/-first', MODIFIED))
+        self.assertEqual(items, sorted(items))
+
+
+class DiffItemsTestCase(unittest.TestCase):
+
+    def test_diff(self):
+        old = [InventoryItem('a', 1, 'x', MODIFIED),
+               InventoryItem('b', 2, 'y', MODIFIED),
+               InventoryItem('c', 3, 'z', MODIFIED),
+               InventoryItem('d', 4, 'w', MODIFIED)]
+        new = [InventoryItem('a', 1, 'x', MODIFIED),
+               InventoryItem('b', 5, 'y', MODIFIED),
+               InventoryItem('c', 3, 'Z', MODIFIED),
+               InventoryItem('e', 6, 'v', MODIFIED)]
+        self.assertEqual(inventory.diff_items(old, new), [
+            (CHANGED, new[1], 2), (CHANGED, new[2], 3),
+            (REMOVED, old[3], 4), (ADDED, new[3], 0)])
+        self.assertEqual(inventory.diff_items(old, old), [])
+
+
+class SnapshotTestCase(FakeBucketTestCase):
+
+    def setUp(self):
+        FakeBucketTestCase.setUp(self)
+        self.tmp_dir = tempfile.mkdtemp()
+        self.snapshot_dir = os.path.join(self.tmp_dir, 'snapshot')
+
+    def tearDown(self):
+        FakeBucketTestCase.tearDown(self)
+        shutil.rmtree(self.tmp_dir)
+
+    def snapshot(self, boundaries='48c'):
+        return Snapshot(self.snapshot_dir, 'bucket/jp2', boundaries)
+
+    def test_first_listing_logs_nothing(self):
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.stale_shards(3600), [0, 1, 2, 3])
+        self.assertEqual(snapshot.refresh(workers=2), [])
+        self.assertEqual(snapshot.totals(), (10, 100))
+        self.assertEqual([item.key for item in snapshot.items()],
+                         sorted(name for name in self.bucket.keys
+                                if name.startswith('jp2/')))
+        self.assertEqual(list(snapshot.deltas()), [])
+
+    def test_deltas(self):
+        self.snapshot().refresh()
+        self.bucket.put('jp2/2new', 30)
+        self.bucket.put('jp2/7', 20, etag='new')
+        del self.bucket.keys['jp2/ffff']
+
+        snapshot = self.snapshot()
+        deltas = snapshot.refresh()
+        self.assertEqual([(delta['change'], delta['key'], delta['size'],
+                           delta['old_size']) for delta in deltas], [
+            (ADDED, 'jp2/2new', 30, 0),
+            (CHANGED, 'jp2/7', 20, 10),
+            (REMOVED, 'jp2/ffff', 0, 10)])
+        self.assertEqual(deltas[1]['etag'], 'new')
+        self.assertEqual(snapshot.totals(), (10, 130))
+        self.assertEqual(list(snapshot.deltas()), deltas)
+        self.assertEqual(list(snapshot.deltas(since=deltas[0]['time'] + 1)),
+                         [])
+
+    def test_fresh_ranges_are_not_relisted(self):
+        self.snapshot().refresh()
+        listings = self.bucket.listings
+        self.bucket.put('jp2/2new', 30)
+        snapshot = self.snapshot()
+        self.assertEqual(snapshot.stale_shards(3600), [])
+        self.assertEqual(snapshot.refresh(max_age=3600), [])
+        self.assertEqual(self.bucket.listings, listings)
+        self.assertEqual(snapshot.totals(), (10, 100))
+
+    def test_new_boundaries_start_again(self):
+        self.snapshot().refresh()
+        snapshot = self.snapshot('8')
+        self.assertEqual(snapshot.stale_shards(3600), [0, 1])
+        self.assertEqual(snapshot.totals(), (0, 0))
+
+    def test_get_inventory(self):
+        items = inventory.get_inventory('bucket/jp2', self.snapshot_dir)
+        self.assertEqual(len(items), 10)
+        self.assertEqual(items, list(Snapshot(
+            self.snapshot_dir, 'bucket/jp2').items()))
+
+
+class TotalsTestCase(unittest.TestCase):
+
+    def test_totals(self):
+        items = [InventoryItem(key, size, 'e', MODIFIED) for key, size in [
+            ('jp2/a/1.jp2', 1), ('jp2/a/2.jp2', 2), ('jp2/b/1.jp2', 4),
+            ('jp2/top.jp2', 8)]]
+        self.assertEqual(inventory.totals_by_prefix(items, 'jp2/'), {
+            'a/': [2, 3], 'b/': [1, 4], '': [1, 8]})
+        self.assertEqual(inventory.totals_by_collection(
+            items, {'a/1': '26098', 'a/2': '26098', 'top': '1'}, 'jp2/'), {
+                '26098': [2, 3], '1': [1, 8], '(unknown)': [1, 4]})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import errno
+import shutil
+import tempfile
+import unittest
+
+# the janitor runs on its own in the Loris container, from docker/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'docker'))
+from loris_cache_janitor import CacheIndex, Janitor, parse_watermark  # noqa
+
+
+class ParseWatermarkTestCase(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(parse_watermark('90%'), ('percent', 90.0))
+        self.assertEqual(parse_watermark(' 40g '), ('bytes', 40 * 1024 ** 3))
+        self.assertEqual(parse_watermark('1.5MB'), ('bytes', 1572864))
+        self.assertEqual(parse_watermark('250'), ('bytes', 250))
+        self.assertRaises(ValueError, Janitor, None, high='90%', low='40G')
+
+
+class JanitorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'cache')
+        self.index = CacheIndex(os.path.join(self.tmp_dir, 'index.db'),
+                                [self.root])
+        # read an hour apart, the first longest ago
+        self.paths = [self.write('ident{}/full/0/default.jpg'.format(i), 100,
+                                 time.time() - (5 - i) * 3600)
+                      for i in range(4)]
+        self.saved_remove = os.remove
+
+    def tearDown(self):
+        os.remove = self.saved_remove
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, size, atime):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        os.utime(path, (atime, atime))
+        return path
+
+    def remaining(self):
+        return [os.path.exists(path) for path in self.paths]
+
+    def test_below_the_high_watermark(self):
+        stats = Janitor(self.index, high='500', low='100').run()
+        self.assertEqual((stats['files'], stats['bytes']), (4, 400))
+        self.assertEqual(stats['evicted_files'], 0)
+        self.assertEqual(self.remaining(), [True] * 4)
+
+    def test_evict_down_to_the_low_watermark(self):
+        stats = Janitor(self.index, high='250', low='150').run()
+        self.assertEqual(self.remaining(), [False, False, False, True])
+        self.assertEqual((stats['usage_before'], stats['usage_after']),
+                         (400, 100))
+        self.assertEqual(stats['evicted_bytes'], 300)
+        self.assertEqual(stats['evicted_by_age']['1d']['files'], 3)
+        # empty dirs go too, but not the root
+        self.assertEqual(os.listdir(self.root), ['ident3'])
+        self.assertEqual(self.index.totals(), (1, 100))
+
+    def test_dry_run(self):
+        stats = Janitor(self.index, high='250', low='150',
+                        dry_run=True).run()
+        self.assertEqual(stats['evicted_files'], 3)
+        self.assertEqual(self.remaining(), [True] * 4)
+
+    def test_read_since_the_scan_is_spared(self):
+        # so the dirs aren't listed again
+        past = time.time() - 60
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            os.utime(dirpath, (past, past))
+        self.index.scan()
+        os.utime(self.paths[0], None)
+        stats = Janitor(self.index, high='250', low='150').run()
+        self.assertEqual(stats['spared'], 1)
+        self.assertEqual(self.remaining(), [True, False, False, False])
+
+    def test_files_that_cannot_be_removed_are_passed_over(self):
+        def remove(path):
+            if path == self.paths[0]:
+                raise OSError(errno.EACCES, 'Permission denied', path)
+            self.saved_remove(path)
+        os.remove = remove
+        stats = Janitor(self.index, high='250', low='150').run()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(self.remaining(), [True, False, False, False])
+        self.assertEqual(stats['usage_after'], 100)
+
+    def test_nothing_can_be_removed(self):
+        def remove(path):
+            raise OSError(errno.EBUSY, 'Device or resource busy', path)
+        os.remove = remove
+        stats = Janitor(self.index, high='250', low='150').run()
+        self.assertEqual((stats['failed'], stats['evicted_files']), (4, 0))
+        self.assertEqual(self.remaining(), [True] * 4)
+
+    def percent_janitor(self, volume, other):
+        ''' a Janitor for a `volume` byte volume, with `other` bytes of it
+        used by files outside the caches '''
+        percent_janitor = Janitor(self.index, high='85%', low='60%')
+        percent_janitor._volume_bytes = lambda: volume
+        percent_janitor.usage = lambda cache_bytes: \
+            100.0 * (other + cache_bytes) / volume
+        return percent_janitor
+
+    def test_percent_watermarks(self):
+        stats = self.percent_janitor(1000, 500).run()
+        self.assertEqual(stats['unit'], 'percent')
+        self.assertEqual(stats['usage_before'], 90.0)
+        self.assertEqual(self.remaining(), [False, False, False, True])
+        self.assertEqual(stats['usage_after'], 60.0)
+        self.assertFalse(stats['low_unreachable'])
+
+    def test_percent_watermark_out_of_reach(self):
+        # even with the caches empty, usage would be 80%
+        stats = self.percent_janitor(1000, 800).run()
+        self.assertTrue(stats['low_unreachable'])
+        self.assertEqual(stats['evicted_files'], 0)
+        self.assertEqual(self.remaining(), [True] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+import struct
+import unittest
+
+from ucldc_iiif import jp2
+
+
+def codestream(width=2000, height=1500, tile=1024, components=3, levels=5,
+               layers=3, progression='RPCL', code_block=(64, 64), sop=True,
+               eph=True, reversible=True, tlm=False, plt_tiles=None,
+               filler=16):
+    ''' a codestream with the given parameters, with a tile-part per tile
+    holding `filler` bytes of data, and PLT markers in the tiles numbered
+    in `plt_tiles` '''
+    siz = struct.pack('>HIIIIIIIIH', 0, width, height, 0, 0, tile, tile, 0,
+                      0, components) + b'\x07\x01\x01' * components
+    cod = struct.pack(
+        '>BBHBBBBBB', (0x02 if sop else 0) | (0x04 if eph else 0),
+        jp2.PROGRESSION_ORDERS.index(progression), layers,
+        1 if components == 3 else 0, levels,
+        code_block[0].bit_length() - 3, code_block[1].bit_length() - 3, 0,
+        1 if reversible else 0)
+    if reversible:
+        qcd = b'\x20' + b'\x48' * (3 * levels + 1)
+    else:
+        qcd = b'\x42' + b'\x48\x00' * (3 * levels + 1)
+    segments = [(jp2.SIZ, siz), (jp2.COD, cod), (jp2.QCD, qcd)]
+    if tlm:
+        segments.append((jp2.TLM, b'\x00\x00'))
+    data = struct.pack('>H', jp2.SOC)
+    for marker, segment in segments:
+        data += struct.pack('>HH', marker, len(segment) + 2) + segment
+
+    tiles = ((width + tile - 1) // tile) * ((height + tile - 1) // tile)
+    for index in range(tiles):
+        body = b''
+        if plt_tiles is not None and index in plt_tiles:
+            body += struct.pack('>HHB', jp2.PLT, 5, 0) + b'\x05\x05'
+        body += struct.pack('>H', jp2.SOD)
+        data += struct.pack('>HHHIBB', jp2.SOT, 10, index,
+                            12 + len(body) + filler, 0, 1)
+        data += body + b'\0' * filler
+    return data + struct.pack('>H', jp2.EOC)
+
+
+def box(box_type, content):
+    return struct.pack('>I', len(content) + 8) + box_type + content
+
+
+def jp2_file(stream, colorspace=16):
+    ''' `stream` wrapped in jp2 boxes, with an enumerated colour space '''
+    ihdr = box(b'ihdr', struct.pack('>IIHBBBB', 1500, 2000, 3, 7, 7, 0, 0))
+    colr = box(b'colr', struct.pack('>BBBI', 1, 0, 0, colorspace))
+    return (jp2.JP2_SIGNATURE + box(b'ftyp', b'jp2 \0\0\0\0jp2 ') +
+            box(b'jp2h', ihdr + colr) +
+            # a jp2c box of length 0 runs to the end of the file
+            struct.pack('>I', 0) + b'jp2c' + stream)
+
+
+class ReadJp2InfoTestCase(unittest.TestCase):
+
+    def test_raw_codestream(self):
+        info = jp2.read_jp2_info(codestream())
+        self.assertEqual((info.width, info.height), (2000, 1500))
+        self.assertEqual(info.components, 3)
+        self.assertEqual(info.bits_per_component, 8)
+        self.assertEqual((info.tile_width, info.tile_height), (1024, 1024))
+        self.assertEqual(info.tiles, 4)
+        self.assertEqual(info.levels, 5)
+        self.assertEqual(info.layers, 3)
+        self.assertEqual(info.progression, 'RPCL')
+        self.assertEqual(info.code_block, (64, 64))
+        self.assertTrue(info.sop)
+        self.assertTrue(info.eph)
+        self.assertTrue(info.reversible)
+        self.assertEqual(info.quantization, 'none')
+        self.assertEqual(info.guard_bits, 1)
+        self.assertIsNone(info.colorspace)
+        self.assertFalse(info.tlm)
+
+    def test_irreversible(self):
+        info = jp2.read_jp2_info(codestream(
+            reversible=False, sop=False, eph=False, progression='LRCP',
+            code_block=(32, 64)))
+        self.assertFalse(info.reversible)
+        self.assertEqual(info.quantization, 'scalar_expounded')
+        self.assertEqual(info.guard_bits, 2)
+        self.assertFalse(info.sop)
+        self.assertFalse(info.eph)
+        self.assertEqual(info.progression, 'LRCP')
+        self.assertEqual(info.code_block, (32, 64))
+
+    def test_jp2_boxes(self):
+        info = jp2.read_jp2_info(jp2_file(codestream(tlm=True)))
+        self.assertEqual(info.colorspace, 'sRGB')
+        self.assertEqual(info.width, 2000)
+        self.assertTrue(info.tlm)
+        info = jp2.read_jp2_info(jp2_file(codestream(), colorspace=17))
+        self.assertEqual(info.colorspace, 'sLUM')
+
+    def test_plt_in_first_tile_part(self):
+        self.assertTrue(jp2.read_jp2_info(codestream(plt_tiles=[0])).plt)
+        self.assertFalse(jp2.read_jp2_info(codestream()).plt)
+
+    def test_all_tile_parts(self):
+        info = jp2.read_jp2_info(codestream(plt_tiles=[0, 1, 2, 3]),
+                                 all_tile_parts=True)
+        self.assertEqual(info.tile_parts, 4)
+        self.assertTrue(info.plt)
+        # only some tile-parts have PLT markers
+        info = jp2.read_jp2_info(codestream(plt_tiles=[0, 2]),
+                                 all_tile_parts=True)
+        self.assertEqual(info.tile_parts, 4)
+        self.assertFalse(info.plt)
+
+    def test_not_jpeg2000(self):
+        self.assertRaises(jp2.Jp2HeaderError, jp2.read_jp2_info,
+                          b'II*\x00' + b'\0' * 100)
+
+    def test_truncated(self):
+        data = jp2_file(codestream())
+        for length in (20, 60, 90, 110):
+            self.assertRaises(jp2.Jp2Truncated, jp2.read_jp2_info,
+                              data[:length])
+
+    def test_ranged_reads_until_headers_fit(self):
+        stream = codestream(levels=32)
+        lengths = []
+
+        def read_range(length):
+            lengths.append(length)
+            return stream[:length]
+
+        info = jp2.read_jp2_info_ranged(read_range, length=64,
+                                        max_length=4096)
+        self.assertEqual(info.levels, 32)
+        self.assertEqual(lengths, [64, 256])
+
+    def test_ranged_gives_up_at_max_length(self):
+        stream = codestream(levels=32)
+        self.assertRaises(jp2.Jp2Truncated, jp2.read_jp2_info_ranged,
+                          lambda length: stream[:length], length=16,
+                          max_length=64)
+
+
+class ExpectedEncodingTestCase(unittest.TestCase):
+
+    def test_expected_from_kdu_opts(self):
+        expected = jp2.expected_from_kdu_opts([
+            '-rate', '1,0.5,0.25', 'Creversible=yes', 'Clevels=6',
+            'Cblk={32,64}', 'Corder=RPCL', 'Stiles={512,1024}',
+            'Cuse_sop=yes', 'Cuse_eph=no', 'ORGgen_plt=yes',
+            '-jp2_space', 'sRGB', '-num_threads', '4'])
+        self.assertEqual(expected, {
+            'layers': 3, 'reversible': True, 'quantization': 'none',
+            'levels': 6, 'code_block': (64, 32), 'progression': 'RPCL',
+            'tile_height': 512, 'tile_width': 1024, 'sop': True,
+            'eph': False, 'plt': True, 'colorspace': 'sRGB'})
+
+    def test_kdu_encoding_matches(self):
+        info = jp2.read_jp2_info(codestream(
+            width=3000, height=2000, levels=7, layers=8, progression='RLCP',
+            plt_tiles=[0]))
+        self.assertEqual(jp2.compare(info, jp2.EXPECTED_ENCODING), [])
+
+    def test_mismatches(self):
+        info = jp2.read_jp2_info(codestream(
+            width=3000, height=2000, levels=5, layers=8, progression='RLCP',
+            plt_tiles=[0]))
+        self.assertEqual(jp2.compare(info, jp2.EXPECTED_ENCODING),
+                         ['levels: expected 7, found 5'])
+
+    def test_small_image_may_be_untiled(self):
+        info = jp2.read_jp2_info(codestream(
+            width=800, height=600, tile=800, levels=7, layers=8,
+            progression='RLCP', plt_tiles=[0]))
+        self.assertEqual(jp2.compare(info, jp2.EXPECTED_ENCODING), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from ucldc_iiif import batch, benchmark, ledger as states
+from ucldc_iiif.ledger import Ledger
+
+
+class LedgerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ledger = Ledger(os.path.join(self.tmp_dir, 'run.db'),
+                             max_attempts=3, lease=60)
+        self.ledger.add([(key, key + '.tif', key + '.jp2', None)
+                         for key in ('a', 'b', 'c')])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def expire(self, key):
+        ''' backdate the claim on `key` past its lease '''
+        self.ledger._db().execute(
+            'UPDATE jobs SET claimed = claimed - 120 WHERE key = ?', (key,))
+
+    def run_all(self, failing=()):
+        ''' claim jobs until there are none left, failing those in
+        `failing`; returns the keys in the order they were claimed '''
+        claimed = []
+        while True:
+            job = self.ledger.claim(worker='test')
+            if job is None:
+                return claimed
+            claimed.append(job.key)
+            if job.key in failing:
+                self.ledger.finish(job.key, states.FAILED, worker='test',
+                                   error_class='convert', error='bad input')
+            else:
+                self.ledger.finish(job.key, states.DONE, worker='test')
+
+    def test_add_keeps_existing_jobs(self):
+        self.assertEqual(self.ledger.add([('a', 'x', 'y', None),
+                                          ('d', 'd.tif', 'd.jp2', None)]), 1)
+        self.assertEqual(self.ledger.get('a').source, 'a.tif')
+        self.assertEqual(self.ledger.counts(), {states.PENDING: 4})
+
+    def test_claim_and_finish(self):
+        job = self.ledger.claim(worker='host:1')
+        self.assertEqual((job.key, job.state, job.attempts, job.worker),
+                         ('a', states.RUNNING, 1, 'host:1'))
+        self.assertEqual(self.ledger.claimable(), 2)
+        self.ledger.finish('a', states.DONE, worker='host:1',
+                           source_hash='s', output_checksum='o')
+        job = self.ledger.get('a')
+        self.assertEqual(job.state, states.DONE)
+        self.assertEqual((job.source_hash, job.output_checksum), ('s', 'o'))
+        self.assertIsNotNone(job.seconds)
+        self.assertEqual(
+            [(old, new) for key, old, new in self.ledger._db().execute(
+                'SELECT key, old_state, new_state FROM transitions '
+                'WHERE key = ? ORDER BY id', ('a',))],
+            [(None, states.PENDING), (states.PENDING, states.RUNNING),
+             (states.RUNNING, states.DONE)])
+
+    def test_runs_out(self):
+        self.assertEqual(self.run_all(), ['a', 'b', 'c'])
+        self.assertIsNone(self.ledger.claim())
+        self.assertEqual(self.ledger.counts(), {states.DONE: 3})
+
+    def test_failing_job_does_not_starve_the_rest(self):
+        self.assertEqual(self.run_all(failing=['a']),
+                         ['a', 'b', 'c', 'a', 'a'])
+        self.assertEqual(self.ledger.counts(),
+                         {states.DONE: 2, states.FAILED: 1})
+        self.assertEqual(self.ledger.get('a').attempts, 3)
+        self.assertEqual(self.ledger.errors(), {'convert': 1})
+
+    def test_retry(self):
+        self.run_all(failing=['a'])
+        self.assertEqual(self.ledger.claimable(), 0)
+        self.assertEqual(self.ledger.retry(), 1)
+        job = self.ledger.get('a')
+        self.assertEqual((job.state, job.attempts), (states.PENDING, 0))
+        self.assertEqual(self.run_all(), ['a'])
+
+    def test_claim_key(self):
+        self.assertTrue(self.ledger.claim_key('b'))
+        self.assertFalse(self.ledger.claim_key('b'))
+        self.assertFalse(self.ledger.claim_key('missing'))
+        self.assertEqual(self.ledger.claim().key, 'a')
+
+    def test_lease_expiry(self):
+        self.ledger.claim_key('a', worker='died')
+        self.assertEqual(self.run_all(), ['b', 'c'])
+        self.expire('a')
+        job = self.ledger.claim(worker='test')
+        self.assertEqual((job.key, job.attempts, job.worker),
+                         ('a', 2, 'test'))
+
+    def test_converted_but_not_uploaded(self):
+        self.ledger.claim_key('a')
+        self.ledger.finish('a', states.CONVERTED, output_checksum='o')
+        self.assertEqual(self.run_all(), ['b', 'c'])
+        # the uploader died: claimed again once the lease runs out
+        self.expire('a')
+        self.assertEqual(self.ledger.claim().key, 'a')
+        self.ledger.finish('a', states.CONVERTED)
+        self.ledger.finish('a', states.DONE)
+        job = self.ledger.get('a')
+        self.assertEqual((job.state, job.output_checksum),
+                         (states.DONE, 'o'))
+
+    def test_stale_finish_is_ignored(self):
+        self.ledger.claim_key('a', worker='slow')
+        self.expire('a')
+        self.assertTrue(self.ledger.claim_key('a', worker='fresh'))
+        self.assertFalse(self.ledger.finish('a', states.FAILED,
+                                            worker='slow',
+                                            error_class='convert'))
+        job = self.ledger.get('a')
+        self.assertEqual((job.state, job.worker, job.error_class),
+                         (states.RUNNING, 'fresh', None))
+        self.assertTrue(self.ledger.finish('a', states.DONE, worker='fresh'))
+
+    def test_handed_over_for_upload(self):
+        self.ledger.claim_key('a', worker='converter')
+        self.assertTrue(self.ledger.finish(
+            'a', states.CONVERTED, worker='converter', hand_to='uploader'))
+        self.assertFalse(self.ledger.finish('a', states.DONE,
+                                            worker='converter'))
+        self.assertTrue(self.ledger.finish('a', states.DONE,
+                                           worker='uploader'))
+        self.assertEqual(self.ledger.get('a').state, states.DONE)
+
+    def test_shared_between_instances(self):
+        other = Ledger(self.ledger.path)
+        self.assertEqual(self.ledger.claim().key, 'a')
+        self.assertEqual(other.claim().key, 'b')
+
+    def test_finish_unknown_key(self):
+        self.assertRaises(KeyError, self.ledger.finish, 'missing',
+                          states.DONE)
+
+
+class BatchLedgerTestCase(unittest.TestCase):
+    ''' convert_batch working through a ledger, with the stand-in tools
+    from ucldc_iiif.benchmark '''
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_env = dict(os.environ)
+        os.environ.update(benchmark.make_stub_tools(
+            os.path.join(self.tmp_dir, 'bin')))
+        self.ledger = Ledger(os.path.join(self.tmp_dir, 'run.db'))
+        self.jobs = [self.job(i) for i in range(4)]
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tmp_dir)
+
+    def job(self, number):
+        path = os.path.join(self.tmp_dir, 'image{}.tif'.format(number))
+        benchmark.write_image(path, 'tiff', 64, 48, seed=number)
+        return batch.make_job(path)
+
+    def convert(self, jobs, **options):
+        return list(batch.convert_batch(
+            jobs, workers=2, tmp_root=self.tmp_dir, ram_budget=0,
+            ledger=self.ledger, **options))
+
+    def claims(self, key):
+        return self.ledger._db().execute(
+            'SELECT COUNT(*) FROM transitions WHERE key = ? AND '
+            'new_state = ?', (key, states.RUNNING)).fetchone()[0]
+
+    def test_workers_claim_each_job_once(self):
+        results = self.convert(self.jobs)
+        self.assertEqual(sorted(result.input for result in results),
+                         sorted(job[0] for job in self.jobs))
+        self.assertTrue(all(result.status == batch.CONVERTED
+                            for result in results))
+        self.assertEqual(self.ledger.counts(), {states.DONE: 4})
+        for input_path, output_path, mimetype in self.jobs:
+            self.assertEqual(self.claims(input_path), 1)
+            self.assertTrue(os.path.exists(output_path))
+
+    def test_rerun_skips_done_jobs(self):
+        self.convert(self.jobs)
+        self.assertEqual(self.convert(self.jobs), [])
+        extra = self.job(4)
+        results = self.convert(self.jobs + [extra])
+        self.assertEqual([result.input for result in results], [extra[0]])
+        self.assertEqual(self.claims(self.jobs[0][0]), 1)
+
+    def test_converted_until_uploaded(self):
+        self.convert(self.jobs, uploading=True)
+        self.assertEqual(self.ledger.counts(), {states.CONVERTED: 4})
+        key = self.jobs[0][0]
+        # handed to this process, which does the uploading
+        self.assertEqual(self.ledger.get(key).worker, states.worker_id())
+        self.assertTrue(self.ledger.finish(key, states.DONE))
+        self.assertEqual(self.ledger.counts(),
+                         {states.CONVERTED: 3, states.DONE: 1})
+        # nothing for a rerun to do while the uploads are in hand
+        self.assertEqual(self.convert(self.jobs, uploading=True), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import threading
+
+import requests
+
+from ucldc_iiif import jp2, loadtest
+from ucldc_iiif.loadtest import Request, Result, INFO, FULL, TILE
+
+LOG = '''\
+10.0.0.1 - - [10/Oct/2017:13:55:36 -0700] "GET /iiif/abc/info.json HTTP/1.1" \
+200 512 "-" "Mozilla/5.0"
+10.0.0.1 - - [10/Oct/2017:13:55:37 -0700] "GET /iiif/abc/full/256,/0/\
+default.jpg?t=1 HTTP/1.1" 200 9000
+10.0.0.1 - - [10/Oct/2017:13:55:38 -0700] "GET /iiif/abc/0,0,1024,1024/\
+256,/0/default.jpg HTTP/1.1" 304 0
+10.0.0.1 - - [10/Oct/2017:13:55:39 -0700] "GET /iiif/missing/info.json \
+HTTP/1.1" 404 0
+10.0.0.1 - - [10/Oct/2017:13:55:40 -0700] "POST /iiif/abc/info.json \
+HTTP/1.1" 200 0
+10.0.0.1 - - [10/Oct/2017:13:55:41 -0700] "GET /favicon.ico HTTP/1.1" 200 10
+not a log line
+'''
+
+
+def jp2_info(width=5000, height=3000, levels=5):
+    info = dict.fromkeys(jp2.Jp2Info._fields)
+    info.update(width=width, height=height, components=3, tile_width=1024,
+                tile_height=1024, levels=levels)
+    return jp2.Jp2Info(**info)
+
+
+class ReadLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_parse_log_time(self):
+        self.assertEqual(loadtest.parse_log_time('10/Oct/2017:13:55:36 -0700'),
+                         1507668936)
+        self.assertEqual(loadtest.parse_log_time('10/Oct/2017:22:25:36 +0130'),
+                         1507668936)
+
+    def test_read_log(self):
+        logged = loadtest.read_log([self.write('access.log', LOG)],
+                                   strip_prefix='/iiif')
+        self.assertEqual(logged, [
+            Request('/abc/info.json', 'abc', INFO, 0),
+            Request('/abc/full/256,/0/default.jpg', 'abc', FULL, 1),
+            Request('/abc/0,0,1024,1024/256,/0/default.jpg', 'abc', TILE, 2)])
+
+    def test_logs_are_merged_in_order(self):
+        lines = LOG.splitlines(True)
+        earlier = self.write('access.log.1', lines[0] + lines[1])
+        later = self.write('access.log', lines[2])
+        logged = loadtest.read_log([later, earlier], strip_prefix='/iiif')
+        # timed from the first line read
+        self.assertEqual([request.at for request in logged], [-2, -1, 0])
+        self.assertEqual([request.kind for request in logged],
+                         [INFO, FULL, TILE])
+
+    def test_ident_with_slashes(self):
+        logged = loadtest.read_log([self.write('access.log', (
+            '- - - [10/Oct/2017:13:55:36 -0700] "GET /a%2Fb/c/info.json '
+            'HTTP/1.1" 200 1\n'))])
+        self.assertEqual(logged[0].ident, 'a/b/c')
+
+
+class SummarizeTestCase(unittest.TestCase):
+
+    def test_summarize(self):
+        results = [
+            Result(INFO, 200, 0.1, 1024 * 1024, True, None),
+            Result(TILE, 200, 0.2, 1024 * 1024, False, None),
+            Result(TILE, 200, 0.3, 1024 * 1024, True, None),
+            Result(TILE, 500, 0.4, 0, None, 'HTTP 500'),
+            Result(FULL, None, 0.5, 0, None, 'ConnectionError'),
+        ]
+        summary = loadtest.summarize(
+            results, 2.0, label='run', origin_before={'requests': 5,
+                                                      'bytes': 100},
+            origin_after={'requests': 8, 'bytes': 400},
+            encodings={'abc': '1024x1024 tiles'})
+        self.assertEqual((summary['requests'], summary['errors']), (5, 2))
+        self.assertEqual(summary['requests_per_second'], 2.5)
+        self.assertEqual(summary['mb_per_second'], 1.5)
+        self.assertEqual(summary['latency_p50'], 0.3)
+        self.assertEqual(summary['latency_p99'], 0.5)
+        # requests that weren't checked against the cache don't count
+        self.assertAlmostEqual(summary['hit_ratio'], 2 / 3.0)
+        self.assertEqual(summary['tile_requests'], 3)
+        self.assertEqual(summary['tile_p50'], 0.3)
+        self.assertEqual(summary['info_p99'], 0.1)
+        self.assertEqual((summary['origin_requests'],
+                          summary['origin_bytes']), (3, 300))
+        self.assertIn('run', loadtest.format_summaries([summary]))
+
+    def test_nothing_run(self):
+        summary = loadtest.summarize([], 0)
+        self.assertEqual(summary['requests_per_second'], 0)
+        self.assertIsNone(summary['latency_p50'])
+        self.assertIsNone(summary['hit_ratio'])
+        self.assertNotIn('origin_requests', summary)
+        self.assertIn(' - ', loadtest.format_summaries([summary]))
+
+
+class SessionTestCase(unittest.TestCase):
+
+    def test_viewer_session(self):
+        session = loadtest.viewer_session('abc', jp2_info(),
+                                          random.Random(0))
+        self.assertEqual(session[:2], [
+            Request('/abc/info.json', 'abc', INFO, None),
+            Request('/abc/full/256,/0/default.jpg', 'abc', FULL, None)])
+        paths = [request.path for request in session]
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertTrue(all(request.kind == TILE for request in session[2:]))
+
+    def test_fit_reduce(self):
+        self.assertEqual(loadtest._fit_reduce(jp2_info(), (1200, 800)), 2)
+        self.assertEqual(loadtest._fit_reduce(jp2_info(), (6000, 4000)), 0)
+        self.assertEqual(loadtest._fit_reduce(jp2_info(levels=1),
+                                              (100, 100)), 1)
+
+    def test_synthesize(self):
+        images = [('a', jp2_info()), ('b', jp2_info(800, 600))]
+        sessions = loadtest.synthesize(images, sessions=20, seed=3)
+        self.assertEqual(len(sessions), 20)
+        self.assertEqual(sessions, loadtest.synthesize(images, sessions=20,
+                                                       seed=3))
+        self.assertEqual(set(session[0].ident for session in sessions),
+                         set(['a', 'b']))
+
+
+class S3StandInTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp_dir, 'bucket', 'jp2'))
+        self.data = bytes(bytearray(range(256))) * 4
+        with open(os.path.join(self.tmp_dir, 'bucket', 'jp2', 'a.jp2'),
+                  'wb') as f:
+            f.write(self.data)
+        self.server = loadtest.S3StandIn(('127.0.0.1', 0), self.tmp_dir)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_and_range(self):
+        response = requests.get(self.url + '/bucket/jp2/a.jp2')
+        self.assertEqual(response.content, self.data)
+        etag = response.headers['ETag']
+
+        response = requests.get(self.url + '/bucket/jp2/a.jp2',
+                                headers={'Range': 'bytes=10-19'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response.content, self.data[10:20])
+        self.assertEqual(response.headers['Content-Range'],
+                         'bytes 10-19/1024')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        response = requests.get(self.url + '/bucket/jp2/a.jp2',
+                                headers={'Range': 'bytes=-4'})
+        self.assertEqual(response.content, self.data[-4:])
+        self.assertEqual(requests.get(
+            self.url + '/bucket/jp2/a.jp2',
+            headers={'Range': 'bytes=2000-'}).status_code, 416)
+
+        self.assertEqual(loadtest.origin_stats(self.url),
+                         {'requests': 3, 'bytes': 1024 + 10 + 4})
+
+    def test_missing(self):
+        self.assertEqual(requests.get(
+            self.url + '/bucket/jp2/b.jp2').status_code, 404)
+        self.assertEqual(requests.get(
+            self.url + '/bucket/../../etc/passwd').status_code, 404)
+        self.assertEqual(requests.get(self.url + '/other').status_code, 404)
+
+    def test_list(self):
+        response = requests.get(self.url + '/bucket',
+                                params={'prefix': 'jp2/'})
+        self.assertIn('<Key>jp2/a.jp2</Key><Size>1024</Size>',
+                      response.text)
+        self.assertIn('<IsTruncated>false</IsTruncated>', response.text)
+
+
+if __name__ == '__main__':
+    unittest.main()
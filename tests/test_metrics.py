@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from ucldc_iiif import metrics
+from ucldc_iiif.metrics import Recorder, Aggregate, JOB_STAGE
+
+
+def record(stage, collection='c', tool='kdu_compress', ok=True, wall=1.0,
+           time=100.0, **fields):
+    values = dict(stage=stage, collection=collection, tool=tool, ok=ok,
+                  wall=wall, user=0.5, sys=0.25, max_rss=1024,
+                  bytes_in=1000, bytes_out=100, time=time)
+    values.update(fields)
+    return values
+
+
+class RunCommandTestCase(unittest.TestCase):
+
+    def test_output_and_returncode(self):
+        returncode, output, wall, usage = metrics.run_command(
+            ['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        self.assertEqual(returncode, 3)
+        self.assertEqual(sorted(output.split()), [b'err', b'out'])
+        self.assertGreaterEqual(wall, 0)
+        self.assertGreater(usage.ru_maxrss, 0)
+
+    def test_killed(self):
+        returncode, output, wall, usage = metrics.run_command(
+            ['sh', '-c', 'kill -9 $$'])
+        self.assertEqual(returncode, -9)
+
+
+class RecorderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_record(self):
+        recorder = Recorder({'collection': '26098'})
+        source, output = self.write('in', 1000), self.write('out', 250)
+        made = recorder.record('tiff_to_jp2', input_path=source,
+                               output_path=output, tool='kdu_compress',
+                               attempt=2)
+        self.assertEqual((made['bytes_in'], made['bytes_out']), (1000, 250))
+        self.assertEqual(made['ratio'], 4.0)
+        self.assertEqual((made['collection'], made['attempt']), ('26098', 2))
+
+        failed = recorder.record('tiff_to_jp2', ok=False, input_path=source,
+                                 output_path=output)
+        self.assertIsNone(failed['bytes_out'])
+        self.assertIsNone(failed['ratio'])
+        self.assertEqual(recorder.drain(), [made, failed])
+        self.assertEqual(recorder.drain(), [])
+
+    def test_missing_files(self):
+        made = Recorder().record('upload', input_path=os.path.join(
+            self.tmp_dir, 'missing'))
+        self.assertIsNone(made['bytes_in'])
+
+    def test_timed(self):
+        recorder = Recorder()
+        with recorder.timed('cache_lookup', tool='pillow') as result:
+            result['hit'] = True
+        with recorder.timed('verify_jp2') as result:
+            result['ok'] = False
+        with self.assertRaises(ValueError):
+            with recorder.timed('prewarm'):
+                raise ValueError
+        records = recorder.drain()
+        self.assertEqual([(r['stage'], r['ok']) for r in records],
+                         [('cache_lookup', True), ('verify_jp2', False),
+                          ('prewarm', False)])
+        self.assertTrue(records[0]['hit'])
+        self.assertEqual(records[0]['tool'], 'pillow')
+        self.assertGreaterEqual(records[0]['wall'], 0)
+
+    def test_null_recorder(self):
+        recorder = metrics.NullRecorder()
+        with recorder.timed('convert'):
+            pass
+        self.assertEqual(recorder.drain(), [])
+
+    def test_json_lines(self):
+        path = os.path.join(self.tmp_dir, 'metrics.jsonl')
+        sink = metrics.JsonLinesSink(path)
+        sink.write([record('a'), record('b')])
+        sink.write([])
+        with open(path, 'a') as f:
+            f.write('{"stage": "trunc\n')
+        sink.write([record('c')])
+        self.assertEqual([r['stage'] for r in metrics.read_records([path])],
+                         ['a', 'b', 'c'])
+
+
+class AggregateTestCase(unittest.TestCase):
+
+    def test_totals(self):
+        aggregate = Aggregate().add_all([
+            record('tiff_to_jp2', time=110.0, wall=4.0, max_rss=2048),
+            record('tiff_to_jp2', time=105.0, wall=2.0),
+            record('tiff_to_jp2', ok=False, time=120.0),
+            record('tiff_to_jp2', collection='other'),
+            record('pre_convert', tool='convert'),
+            record(JOB_STAGE, tool=None, wall=10.0),
+            record(JOB_STAGE, tool=None, ok=False),
+        ])
+        row = aggregate.stages[('c', 'tiff_to_jp2', 'kdu_compress')]
+        self.assertEqual((row['runs'], row['failures']), (3, 1))
+        self.assertEqual(row['wall'], 7.0)
+        # failed runs' bytes aren't counted
+        self.assertEqual((row['bytes_in'], row['bytes_out']), (2000, 200))
+        self.assertEqual(row['max_rss'], 2048)
+        self.assertEqual((row['first'], row['last']), (103.0, 120.0))
+        self.assertEqual(len(aggregate.stages), 3)
+        self.assertEqual(aggregate.jobs['c']['runs'], 2)
+        self.assertEqual(aggregate.jobs['c']['failures'], 1)
+
+    def test_report(self):
+        report = metrics.format_report(Aggregate().add_all([
+            record('tiff_to_jp2'), record(JOB_STAGE, tool=None)]))
+        self.assertIn('== c ==', report)
+        self.assertIn('tiff_to_jp2 (kdu_compress)', report)
+        self.assertIn('1 jobs, 0 failed', report)
+
+
+class PrometheusTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'ucldc_iiif.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_write(self):
+        metrics.write_prometheus(Aggregate().add_all([
+            record('tiff_to_jp2', collection='a "quoted" one'),
+            record('tiff_to_jp2', collection='a "quoted" one', ok=False),
+            record(JOB_STAGE, tool=None)]), self.path)
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        labels = '{collection="a \\"quoted\\" one",stage="tiff_to_jp2",' \
+                 'tool="kdu_compress"}'
+        self.assertIn('ucldc_iiif_stage_runs_total' + labels + ' 2', lines)
+        self.assertIn('ucldc_iiif_stage_failures_total' + labels + ' 1',
+                      lines)
+        self.assertIn('ucldc_iiif_stage_bytes_in_total' + labels + ' 1000',
+                      lines)
+        self.assertIn('# TYPE ucldc_iiif_stage_max_rss_bytes gauge', lines)
+        self.assertIn('ucldc_iiif_jobs_total{collection="c"} 1', lines)
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0o644)
+        self.assertEqual(os.listdir(self.tmp_dir), ['ucldc_iiif.prom'])
+
+
+if __name__ == '__main__':
+    unittest.main()
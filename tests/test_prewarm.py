@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from ucldc_iiif import benchmark, jp2, prewarm
+from ucldc_iiif.prewarm import Derivative, Prewarmer, parse_size
+
+
+def jp2_info(width=5000, height=3000, tile_width=1024, tile_height=1024,
+             levels=5):
+    info = dict.fromkeys(jp2.Jp2Info._fields)
+    info.update(width=width, height=height, components=3,
+                tile_width=tile_width, tile_height=tile_height,
+                levels=levels)
+    return jp2.Jp2Info(**info)
+
+
+class GeometryTestCase(unittest.TestCase):
+
+    def test_tile_size(self):
+        self.assertEqual(prewarm.tile_size(jp2_info()), (1024, 1024))
+        self.assertEqual(prewarm.tile_size(jp2_info(
+            tile_width=5000, tile_height=3000)), (256, 256))
+
+    def test_info_json(self):
+        info = prewarm.info_json(jp2_info(), 'https://iiif.example.org/',
+                                 'abc')
+        self.assertEqual(info['@id'], 'https://iiif.example.org/abc')
+        self.assertEqual((info['width'], info['height']), (5000, 3000))
+        self.assertEqual(info['tiles'], [{'width': 1024, 'scaleFactors': [
+            1, 2, 4, 8, 16, 32]}])
+        self.assertEqual(info['sizes'][0], {'width': 157, 'height': 94})
+        self.assertEqual(info['sizes'][-1], {'width': 5000, 'height': 3000})
+
+        info = prewarm.info_json(jp2_info(tile_height=512), 'b', 'abc')
+        self.assertEqual(info['tiles'][0]['height'], 512)
+
+    def test_level_tiles(self):
+        info = jp2_info()
+        self.assertEqual(prewarm.level_tiles(info, 3), [
+            Derivative('full', '625,', 3, (0, 0, 625, 375), 625, 375)])
+        self.assertEqual(prewarm.level_tiles(info, 2), [
+            Derivative('0,0,4096,3000', '1024,', 2, (0, 0, 1024, 750),
+                       1024, 750),
+            Derivative('4096,0,904,3000', '226,', 2, (1024, 0, 1250, 750),
+                       226, 750)])
+        self.assertEqual(len(prewarm.level_tiles(info, 1)), 6)
+
+    def test_tile_derivatives(self):
+        info = jp2_info()
+        derivatives = prewarm.tile_derivatives(info)
+        # levels 5 to 3 are one tile each, level 2 two and level 1 six;
+        # full resolution is never included
+        self.assertEqual([d.reduce for d in derivatives],
+                         [5, 4, 3, 2, 2] + [1] * 6)
+        self.assertEqual([d.size for d in derivatives[:3]],
+                         ['157,', '313,', '625,'])
+        # the next level would go over
+        self.assertEqual([d.reduce for d in prewarm.tile_derivatives(
+            info, max_tiles=4)], [5, 4, 3])
+
+    def test_parse_size(self):
+        info = jp2_info()
+        self.assertEqual(parse_size('500,', info), (500, 300))
+        self.assertEqual(parse_size(',300', info), (500, 300))
+        self.assertEqual(parse_size('!256,256', info), (256, 153))
+        self.assertEqual(parse_size('!1,1', info), (1, 1))
+        for size in ('256,256', ',', '!256,', 'full'):
+            self.assertRaises(ValueError, parse_size, size, info)
+
+    def test_thumbnail_derivatives(self):
+        self.assertEqual(prewarm.thumbnail_derivatives(jp2_info()), [
+            Derivative('full', '256,', 4, (0, 0, 313, 188), 256, 153),
+            Derivative('full', '512,', 3, (0, 0, 625, 375), 512, 307)])
+        # never bigger than the image
+        self.assertEqual(prewarm.thumbnail_derivatives(
+            jp2_info(width=200, height=100), ['!256,256']), [
+                Derivative('full', 'full', 0, (0, 0, 200, 100), 200, 100)])
+
+
+class PrewarmerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved_env = dict(os.environ)
+        os.environ.update(benchmark.make_stub_tools(
+            os.path.join(self.tmp_dir, 'bin')))
+        self.cache = os.path.join(self.tmp_dir, 'cache')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_env)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_derivatives_without_duplicates(self):
+        prewarmer = Prewarmer('b', thumbnail_sizes=['!625,625', '!256,256'])
+        derivatives = prewarmer.derivatives(jp2_info())
+        # the 625 pixel thumbnail is the level 3 tile
+        self.assertEqual(len(derivatives), 12)
+        self.assertEqual(derivatives[-1].size, '256,')
+
+    def test_paths(self):
+        prewarmer = Prewarmer('b', info_root='/info', image_root='/images')
+        self.assertEqual(prewarmer.info_path('abc'), '/info/abc/info.json')
+        self.assertEqual(prewarmer.image_path(
+            'abc', prewarm.thumbnail_derivatives(jp2_info())[0]),
+            '/images/abc/full/256,/0/default.jpg')
+
+    @unittest.skipIf(Image is None, 'needs Pillow')
+    def test_prewarm(self):
+        jp2_path = os.path.join(self.tmp_dir, 'abc.jp2')
+        benchmark.write_jp2(jp2_path, 1500, 1000, 3, jp2.EXPECTED_ENCODING,
+                            1000)
+        prewarmer = Prewarmer('https://iiif.example.org', self.cache,
+                              self.cache, max_tiles=3)
+        result = prewarmer.prewarm(jp2_path, 'abc')
+        self.assertTrue(result.ok)
+        # info.json, a tile at each of the three coarsest levels and two
+        # thumbnails
+        self.assertEqual(result.written, 6)
+        with open(prewarmer.info_path('abc')) as f:
+            self.assertEqual(json.load(f)['@id'],
+                             'https://iiif.example.org/abc')
+        thumbnail = Image.open(os.path.join(self.cache, 'abc', 'full',
+                                            '256,', '0', 'default.jpg'))
+        self.assertEqual(thumbnail.size, (256, 170))
+        self.assertEqual(thumbnail.format, 'JPEG')
+        self.assertFalse([name for root, dirs, files in os.walk(self.cache)
+                          for name in files if name.endswith('.tmp')])
+
+        # files already there are left alone
+        self.assertEqual(prewarmer.prewarm(jp2_path, 'abc').written, 0)
+
+    def test_prewarm_one_reports_failures(self):
+        result = Prewarmer('b', self.cache, self.cache).prewarm_one(
+            (os.path.join(self.tmp_dir, 'missing.jp2'), 'abc'))
+        self.assertFalse(result.ok)
+        self.assertIn('missing.jp2', result.msg)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from ucldc_iiif import upload
+from ucldc_iiif.etag import MB, s3_etag
+from ucldc_iiif.upload import Uploader
+
+
+class FakeKey(object):
+
+    def __init__(self, bucket, name, data=b''):
+        self.bucket = bucket
+        self.name = name
+        self.size = len(data)
+        self.etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+
+    def set_contents_from_filename(self, path, headers=None):
+        with open(path, 'rb') as f:
+            self.bucket.store(self.name, f.read())
+
+
+class FakeMultiPartUpload(object):
+    ''' stands in for boto's MultiPartUpload, on a FakeBucket '''
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.key_name = None
+        self.id = None
+
+    def _parts(self):
+        return self.bucket.uploads[self.id]['parts']
+
+    def upload_part_from_file(self, fp, part_num, size=None):
+        self._parts()[part_num] = fp.read(size)
+
+    def copy_part_from_key(self, src_bucket_name, src_key_name, part_num,
+                           start=None, end=None):
+        if part_num == self.bucket.fail_part:
+            raise IOError('part {} failed'.format(part_num))
+        data = self.bucket.data[src_key_name]
+        self._parts()[part_num] = data[start:end + 1]
+
+    def complete_upload(self):
+        parts = [data for number, data in sorted(self._parts().items())]
+        digests = b''.join(hashlib.md5(data).digest() for data in parts)
+        self.bucket.store(self.key_name, b''.join(parts), '{}-{}'.format(
+            hashlib.md5(digests).hexdigest(), len(parts)))
+        self.bucket.uploads[self.id]['state'] = 'completed'
+
+    def cancel_upload(self):
+        self.bucket.uploads[self.id]['state'] = 'cancelled'
+
+
+class FakeBucket(object):
+
+    def __init__(self):
+        self.keys = {}
+        self.data = {}
+        self.uploads = {}
+        self.copies = []
+        self.fail_part = None
+
+    def store(self, name, data, etag=None):
+        key = FakeKey(self, name, data)
+        if etag is not None:
+            key.etag = '"{}"'.format(etag)
+        self.keys[name] = key
+        self.data[name] = data
+
+    def get_key(self, name):
+        return self.keys.get(name)
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def copy_key(self, new_key_name, src_bucket_name, src_key_name):
+        self.copies.append((src_key_name, new_key_name))
+        self.store(new_key_name, self.data[src_key_name],
+                   self.keys[src_key_name].etag.strip('"'))
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        mp = FakeMultiPartUpload(self)
+        mp.key_name = key_name
+        mp.id = str(len(self.uploads))
+        self.uploads[mp.id] = {'key': key_name, 'parts': {}, 'state': None,
+                               'headers': headers}
+        return mp
+
+
+class UploaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.bucket = FakeBucket()
+        self.saved = upload.thread_bucket, upload.MultiPartUpload
+        upload.thread_bucket = lambda bucket_name: self.bucket
+        upload.MultiPartUpload = FakeMultiPartUpload
+
+    def tearDown(self):
+        upload.thread_bucket, upload.MultiPartUpload = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, size):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write((bytes(bytearray(range(251))) * (size // 251 + 1))[:size])
+        return path
+
+    def test_upload(self):
+        path = self.write('a.jp2', 1000)
+        uploader = Uploader()
+        result = uploader.upload(path, 'bucket/jp2', 'a')
+        self.assertTrue(result.ok)
+        self.assertFalse(result.skipped)
+        self.assertEqual(result.url, 's3://bucket/jp2/a')
+        self.assertTrue(uploader.matches(path, 'bucket/jp2', 'a'))
+        self.assertTrue(uploader.upload(path, 'bucket/jp2', 'a').skipped)
+
+    def test_multipart_upload(self):
+        path = self.write('a.jp2', 11 * MB)
+        uploader = Uploader(part_size=5 * MB, multipart_threshold=5 * MB)
+        result = uploader.upload(path, 'bucket', 'a')
+        self.assertIn('(3 parts)', result.msg)
+        with open(path, 'rb') as f:
+            self.assertEqual(self.bucket.data['a'], f.read())
+        self.assertEqual(self.bucket.keys['a'].etag.strip('"'),
+                         s3_etag(path, 5 * MB, 5 * MB))
+        self.assertTrue(uploader.matches(path, 'bucket', 'a'))
+
+    def test_copy(self):
+        self.bucket.store('jp2/a', b'jp2 data')
+        uploader = Uploader()
+        result = uploader.copy('bucket/jp2', 'a', 'b')
+        self.assertEqual((result.path, result.url, result.bytes),
+                         ('s3://bucket/jp2/a', 's3://bucket/jp2/b', 8))
+        self.assertFalse(result.skipped)
+        self.assertEqual(self.bucket.copies, [('jp2/a', 'jp2/b')])
+        self.assertEqual(self.bucket.data['jp2/b'], b'jp2 data')
+
+        self.assertTrue(uploader.copy('bucket/jp2', 'a', 'b').skipped)
+        self.assertFalse(Uploader(skip_existing=False).copy(
+            'bucket/jp2', 'a', 'b').skipped)
+        self.assertRaises(IOError, uploader.copy, 'bucket/jp2', 'missing',
+                          'b')
+
+    def test_big_objects_are_copied_in_parts(self):
+        path = self.write('a.jp2', 11 * MB)
+        uploader = Uploader(part_size=5 * MB, max_copy_size=10 * MB)
+        uploader.upload(path, 'bucket', 'a')
+        result = uploader.copy('bucket', 'a', 'b')
+        self.assertIn('(3 parts)', result.msg)
+        self.assertEqual(self.bucket.copies, [])
+        self.assertEqual(self.bucket.data['b'], self.bucket.data['a'])
+        # split the way an upload is, so it has the same ETag
+        self.assertEqual(self.bucket.keys['b'].etag,
+                         self.bucket.keys['a'].etag)
+        self.assertTrue(uploader.matches(path, 'bucket', 'b'))
+        self.assertEqual(self.bucket.uploads['1']['headers'],
+                         {'Content-Type': 'image/jp2'})
+
+    def test_failed_part_cancels_the_copy(self):
+        self.bucket.store('a', b'x' * 11 * MB)
+        self.bucket.fail_part = 2
+        uploader = Uploader(part_size=5 * MB, max_copy_size=10 * MB)
+        self.assertRaises(IOError, uploader.copy, 'bucket', 'a', 'b')
+        self.assertEqual(self.bucket.uploads['0']['state'], 'cancelled')
+        self.assertNotIn('b', self.bucket.keys)
+
+
+if __name__ == '__main__':
+    unittest.main()
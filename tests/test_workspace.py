@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+
+from ucldc_iiif.workspace import Budget, Workspace, parse_size
+
+
+class ParseSizeTestCase(unittest.TestCase):
+
+    def test_units(self):
+        self.assertEqual(parse_size('512'), 512)
+        self.assertEqual(parse_size('2k'), 2048)
+        self.assertEqual(parse_size('1.5G'), 3 * 1024 ** 3 // 2)
+        self.assertEqual(parse_size(' 4 MiB '), 4 * 1024 ** 2)
+        self.assertRaises(ValueError, parse_size, 'lots')
+
+
+class BudgetTestCase(unittest.TestCase):
+
+    def test_try_acquire_and_release(self):
+        budget = Budget(100)
+        self.assertTrue(budget.try_acquire(60))
+        self.assertFalse(budget.try_acquire(50))
+        self.assertEqual(budget.used, 60)
+        budget.release(60)
+        self.assertEqual(budget.used, 0)
+        self.assertTrue(budget.try_acquire(100))
+
+    def test_release_never_goes_negative(self):
+        budget = Budget(100)
+        budget.release(10)
+        self.assertEqual(budget.used, 0)
+
+    def test_over_budget_waits(self):
+        budget = Budget(100)
+        budget.acquire(80)
+        self.assertFalse(budget.acquire(30, timeout=0.2,
+                                        poll_interval=0.05))
+        self.assertEqual(budget.used, 80)
+
+        releaser = threading.Timer(0.2, budget.release, [80])
+        releaser.start()
+        started = time.time()
+        self.assertTrue(budget.acquire(30, timeout=5, poll_interval=0.05))
+        self.assertGreaterEqual(time.time() - started, 0.1)
+        self.assertEqual(budget.used, 30)
+        releaser.join()
+
+    def test_oversized_runs_alone(self):
+        budget = Budget(100)
+        budget.acquire(10)
+        self.assertFalse(budget.acquire(500, timeout=0.1,
+                                        poll_interval=0.05))
+        budget.release(10)
+        self.assertTrue(budget.acquire(500, timeout=0))
+        self.assertFalse(budget.try_acquire(1))
+
+
+class WorkspaceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.disk_dir = os.path.join(self.tmp_dir, 'disk')
+        self.ram_dir = os.path.join(self.tmp_dir, 'ram')
+        os.mkdir(self.disk_dir)
+        os.mkdir(self.ram_dir)
+        self.budget = Budget(100)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def touch(self, path):
+        open(path, 'wb').close()
+        return path
+
+    def test_ram_while_it_fits(self):
+        workspace = Workspace(self.disk_dir, self.ram_dir, self.budget)
+        first = workspace.path('first.tiff', 60)
+        second = workspace.path('second.tiff', 60)
+        unknown = workspace.path('unknown.tiff')
+        self.assertTrue(first.startswith(self.ram_dir + os.sep))
+        self.assertEqual(os.path.dirname(second), self.disk_dir)
+        self.assertEqual(os.path.dirname(unknown), self.disk_dir)
+        self.assertEqual(self.budget.used, 60)
+
+        # once the first is released, the next one fits again
+        workspace.release(self.touch(first))
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(self.budget.used, 0)
+        self.assertTrue(workspace.path('third.tiff', 60).startswith(
+            self.ram_dir + os.sep))
+
+    def test_no_ram_dir(self):
+        workspace = Workspace(self.disk_dir, budget=self.budget)
+        self.assertEqual(os.path.dirname(workspace.path('a.tiff', 10)),
+                         self.disk_dir)
+        self.assertEqual(self.budget.used, 0)
+
+    def test_release_of_disk_files(self):
+        workspace = Workspace(self.disk_dir, self.ram_dir, self.budget)
+        path = self.touch(workspace.path('a.tiff'))
+        workspace.release(path)
+        self.assertFalse(os.path.exists(path))
+        # already gone
+        workspace.release(path)
+
+    def test_cleanup(self):
+        workspace = Workspace(self.disk_dir, self.ram_dir, self.budget)
+        path = self.touch(workspace.path('a.tiff', 40))
+        self.touch(os.path.join(os.path.dirname(path), 'stray.tmp'))
+        workspace.path('b.tiff', 40)
+        self.assertEqual(self.budget.used, 80)
+        workspace.cleanup()
+        self.assertEqual(self.budget.used, 0)
+        self.assertEqual(os.listdir(self.ram_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import sys
+import os
+import time
+import shutil
+import tempfile
+import logging
+import argparse
+import multiprocessing
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from ucldc_iiif.convert import Convert, KduThreadScheduler, \
+    KduOptionMemory, IN_PROCESS_MAX_PIXELS, STRIP_WISE_BYTES
+from ucldc_iiif.workspace import Budget, DEFAULT_RAM_DIR, parse_size
+from ucldc_iiif.cache import ConversionCache, file_hash
+from ucldc_iiif.ledger import Ledger
+from ucldc_iiif import metrics, ledger as ledger_states
+from ucldc_iiif.upload import Uploader, BackgroundUploader, PART_SIZE, \
+    PART_WORKERS
+from ucldc_iiif.prewarm import Prewarmer, CACHE_ROOT
+from ucldc_iiif.estimate import Estimator, format_estimate, SAMPLE_SIZE
+
+BatchResult = namedtuple('BatchResult', ['input', 'output', 'status', 'msg',
+                                         'metrics'])
+
+CONVERTED = 'converted'
+FAILED = 'failed'
+UPLOADED = 'uploaded'
+SKIPPED = 'skipped'
+UPLOAD_FAILED = 'upload failed'
+
+# one Convert per worker process, set up by `_init_worker`, and the
+# Ledger and Prewarmer of the run, if any, with the ledger worker id of
+# the process uploading the jp2s, if they're being uploaded
+_convert = None
+_ledger = None
+_uploader = None
+_prewarmer = None
+
+# rewrite the Prometheus textfile at most this often, in seconds
+PROMETHEUS_INTERVAL = 15
+
+# threads hashing sources to find duplicates
+HASH_WORKERS = 8
+
+
+def read_manifest(manifest_path, output_dir=None):
+    '''
+    read a manifest of jobs. Each non-blank line is an input path,
+    optionally followed by a tab and an output path, and optionally a
+    further tab and the mime-type of the input. Lines starting with '#'
+    are ignored.
+    '''
+    jobs = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            jobs.append(make_job(*fields[:3], output_dir=output_dir))
+    return jobs
+
+
+def make_job(input_path, output_path=None, mimetype=None, output_dir=None):
+    ''' build a (input, output, mimetype) job tuple. If no output path is
+    given, the jp2 goes next to the input, or into `output_dir`. '''
+    if not output_path:
+        base = os.path.splitext(os.path.basename(input_path))[0] + '.jp2'
+        output_path = os.path.join(
+            output_dir or os.path.dirname(input_path), base)
+    return (input_path, output_path, mimetype or None)
+
+
+def _init_worker(scheduler, ram_dir, ram_budget, cache, verify,
+                 kdu_memory_path, in_process_max_pixels, memory_budget,
+                 disk_budget, strip_wise_bytes, labels, ledger,
+                 uploader, prewarmer):
+    global _convert, _ledger, _uploader, _prewarmer
+    _ledger = ledger
+    _uploader = uploader
+    _convert = Convert(scheduler=scheduler, ram_dir=ram_dir,
+                       ram_budget=ram_budget, cache=cache, verify=verify,
+                       kdu_memory=KduOptionMemory(kdu_memory_path),
+                       in_process_max_pixels=in_process_max_pixels,
+                       memory_budget=memory_budget, disk_budget=disk_budget,
+                       strip_wise_bytes=strip_wise_bytes,
+                       recorder=metrics.Recorder(labels))
+    _prewarmer = prewarmer
+    if prewarmer is not None:
+        prewarmer.recorder = _convert.recorder
+
+
+def _convert_one(args):
+    '''
+    run a single job in its own temp dir. Runs in a worker process. A
+    job of None means the next job claimed from the ledger; if there is
+    none left (another worker sharing the run got there first), returns
+    None.
+    '''
+    job, tmp_root = args
+    if job is None:
+        claimed = _ledger.claim()
+        if claimed is None:
+            return None
+        job = (claimed.source, claimed.output, claimed.mimetype)
+    input_path, output_path, mimetype = job
+    error_class = None
+    job_dir = tempfile.mkdtemp(prefix='ucldc-iiif-', dir=tmp_root)
+    try:
+        converted, msg = _convert.convert(
+            input_path, output_path, mimetype=mimetype, tmp_dir=job_dir)
+    except Exception as e:
+        converted = False
+        error_class = type(e).__name__
+        msg = 'Unexpected error converting {}: {!r}'.format(input_path, e)
+        logging.getLogger(__name__).exception(msg)
+    finally:
+        shutil.rmtree(job_dir, ignore_errors=True)
+    if converted and _prewarmer is not None:
+        # served under the name the jp2 is uploaded as
+        _prewarmer.prewarm_one(
+            (output_path, os.path.splitext(os.path.basename(output_path))[0]))
+
+    records = _convert.recorder.drain()
+    if _ledger is not None:
+        _finish_in_ledger(input_path, output_path, converted, msg,
+                          error_class, records)
+    status = CONVERTED if converted else FAILED
+    return BatchResult(input_path, output_path, status, msg, records)
+
+
+def _convert_claimed(tmp_root):
+    ''' _convert_one() for the next job claimed from the ledger, returning
+    any exception instead of raising it, so the caller always hears back
+    '''
+    try:
+        return _convert_one((None, tmp_root))
+    except Exception as e:
+        logging.getLogger(__name__).exception('Failed claiming a job')
+        return e
+
+
+def _claimed_results(pool, workers, tmp_root):
+    '''
+    keep `workers` jobs claimed from the ledger going in `pool`, starting
+    another as each one finishes, until the ledger has none left; yields
+    their BatchResults in completion order
+    '''
+    finished = queue.Queue()
+
+    def start():
+        pool.apply_async(_convert_claimed, (tmp_root,),
+                         callback=finished.put)
+
+    for i in range(workers):
+        start()
+    running = workers
+    while running:
+        result = finished.get()
+        if isinstance(result, Exception):
+            raise result
+        if result is None:
+            running -= 1
+            continue
+        start()
+        yield result
+
+
+def _finish_in_ledger(input_path, output_path, converted, msg, error_class,
+                      records):
+    ''' record how a job went. A failure's error class is the exception
+    raised, or else the stage that failed. '''
+    if converted:
+        # the cache lookup has already hashed the source, if there's a
+        # cache
+        source_hash = None
+        for record in records:
+            source_hash = record.get('source_hash') or source_hash
+        # handed to the uploading process, if any, to mark DONE
+        _ledger.finish(input_path, ledger_states.CONVERTED
+                       if _uploader is not None else ledger_states.DONE,
+                       source_hash=source_hash or file_hash(input_path),
+                       output_checksum=file_hash(output_path),
+                       hand_to=_uploader)
+        return
+    if error_class is None:
+        error_class = 'pre_check'
+        for record in records:
+            if not record['ok'] and record['stage'] != metrics.JOB_STAGE:
+                error_class = record['stage']
+                break
+    _ledger.finish(input_path, ledger_states.FAILED, error_class=error_class,
+                   error=msg)
+
+
+def find_duplicates(jobs, workers=HASH_WORKERS):
+    '''
+    split (input, output, mimetype) jobs by the content of their inputs:
+    returns the jobs for the first input with each content, and a dict
+    from each of those inputs to the jobs with the same content
+    '''
+    pool = ThreadPool(workers)
+    try:
+        hashes = pool.map(file_hash, [job[0] for job in jobs])
+    finally:
+        pool.close()
+        pool.join()
+    unique = []
+    first = {}
+    duplicates = {}
+    for job, source_hash in zip(jobs, hashes):
+        if source_hash in first:
+            duplicates.setdefault(first[source_hash], []).append(job)
+        else:
+            first[source_hash] = job[0]
+            unique.append(job)
+    return unique, duplicates
+
+
+def _copy_duplicates(result, jobs, labels, prewarmer=None):
+    ''' yield a BatchResult for each job whose input is the same as that
+    of `result`, copying its jp2 rather than converting it again '''
+    recorder = metrics.Recorder(labels)
+    for input_path, output_path, mimetype in jobs:
+        if result.status != CONVERTED:
+            yield BatchResult(
+                input_path, output_path, FAILED,
+                'Same content as {}, which failed: {}'.format(
+                    result.input, result.msg), [])
+            continue
+        try:
+            with recorder.timed('copy_duplicate', result.output,
+                                output_path, tool='copy',
+                                duplicate_of=result.input):
+                if os.path.abspath(output_path) != \
+                        os.path.abspath(result.output):
+                    shutil.copyfile(result.output, output_path)
+        except (IOError, OSError) as e:
+            msg = 'Same content as {}; failed copying {} to {}: {}'.format(
+                result.input, result.output, output_path, e)
+            logging.getLogger(__name__).error(msg)
+            yield BatchResult(input_path, output_path, FAILED, msg,
+                              recorder.drain())
+            continue
+        if prewarmer is not None:
+            prewarmer.prewarm_one((output_path, os.path.splitext(
+                os.path.basename(output_path))[0]))
+        msg = 'Same content as {}; copied {} to {}'.format(
+            result.input, result.output, output_path)
+        yield BatchResult(input_path, output_path, CONVERTED, msg,
+                          recorder.drain())
+
+
+def convert_batch(jobs, workers=None, tmp_root=None, max_threads=None,
+                  ram_dir=DEFAULT_RAM_DIR, ram_budget=0, cache=None,
+                  verify=True, kdu_memory_path=None,
+                  in_process_max_pixels=IN_PROCESS_MAX_PIXELS,
+                  memory_limit=0, disk_limit=0,
+                  strip_wise_bytes=STRIP_WISE_BYTES, collection=None,
+                  ledger=None, stream=False, dedupe=False, prewarmer=None,
+                  uploading=False):
+    '''
+    convert a list of (input, output, mimetype) jobs across a pool of
+    `workers` processes (default: one per cpu). Yields a BatchResult for
+    each job as it finishes, so results arrive in completion order.
+    kdu_compress threads are shared out among the workers by a
+    KduThreadScheduler, capped at `max_threads` per call.
+    Intermediate files are kept in `ram_dir` while they fit in
+    `ram_budget` bytes (shared by all workers), and in per-job temp dirs
+    under `tmp_root` otherwise. If a ConversionCache is given, unchanged
+    sources are not reconverted, and the cache is trimmed afterwards.
+    With `verify`, each jp2's headers are checked after encoding. Kinds of
+    input that need the fallback kdu_compress options are shared between
+    workers, and between runs, through the file at `kdu_memory_path`.
+    JPEG/PNG/GIF inputs of up to `in_process_max_pixels` are preconverted
+    with Pillow instead of ImageMagick.
+    Each job waits to start until its estimated peak memory and scratch
+    disk needs fit within `memory_limit` and `disk_limit` bytes (shared by
+    all workers; 0 for no limit), so `workers` can be set for typical
+    images without huge ones running out of room. Images that would need
+    more than `strip_wise_bytes` of memory are converted strip-wise.
+    Each result carries the metrics records (see ucldc_iiif.metrics) of
+    its job, labelled with `collection`.
+    With a Ledger, the jobs are added to it, and the workers claim
+    whichever of its jobs still need doing; other processes can work
+    through the same ledger at the same time. With `uploading`, converted
+    jobs are left CONVERTED in the ledger and handed to the calling
+    process, to mark DONE once their jp2s are uploaded; if it dies first,
+    they're claimed again when their lease runs out.
+    With `stream`, `jobs` can be any iterable, e.g. a generator fed as
+    sources are downloaded: each job goes to a worker as it arrives, and
+    `workers` isn't capped at the number of jobs.
+    With `dedupe`, inputs are hashed first, and only one of each set of
+    byte-identical inputs is converted; the others get a copy of its jp2.
+    With a Prewarmer, the workers write info.json and low resolution
+    tiles of each new jp2 into the Loris caches (see ucldc_iiif.prewarm);
+    a failure to prewarm doesn't fail the job.
+    '''
+    duplicates = {}
+    if (stream or ledger is not None) and dedupe:
+        raise ValueError("only a list of jobs can be deduplicated")
+    if stream:
+        if ledger is not None:
+            raise ValueError("a stream of jobs can't be added to a ledger")
+        tasks = ((job, tmp_root) for job in jobs)
+    elif ledger is not None:
+        jobs = list(jobs)
+        ledger.add((input_path, input_path, output_path, mimetype)
+                   for input_path, output_path, mimetype in jobs)
+        # each worker claims jobs until there are none left
+        tasks = ledger.claimable()
+    else:
+        jobs = list(jobs)
+        if dedupe:
+            jobs, duplicates = find_duplicates(jobs)
+        tasks = [(job, tmp_root) for job in jobs]
+    if not stream and not tasks:
+        return
+    scheduler = KduThreadScheduler(max_threads=max_threads)
+    workers = workers or scheduler.cpus
+    if ledger is not None:
+        workers = min(workers, tasks)
+    elif not stream:
+        workers = min(workers, len(tasks))
+    uploader = ledger_states.worker_id() if uploading else None
+    budget = Budget(ram_budget) if ram_budget else None
+    memory_budget = Budget(memory_limit) if memory_limit else None
+    disk_budget = Budget(disk_limit) if disk_limit else None
+    pool = multiprocessing.Pool(workers, initializer=_init_worker,
+                                initargs=(scheduler, ram_dir, budget, cache,
+                                          verify, kdu_memory_path,
+                                          in_process_max_pixels,
+                                          memory_budget, disk_budget,
+                                          strip_wise_bytes,
+                                          {'collection': collection},
+                                          ledger, uploader,
+                                          prewarmer))
+    if ledger is not None:
+        results = _claimed_results(pool, workers, tmp_root)
+    else:
+        results = pool.imap_unordered(_convert_one, tasks)
+    try:
+        for result in results:
+            if result is not None:
+                yield result
+                for duplicate in _copy_duplicates(
+                        result, duplicates.pop(result.input, []),
+                        {'collection': collection}, prewarmer):
+                    yield duplicate
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    if cache is not None:
+        cache.evict()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='convert a batch of images to jp2 in parallel')
+    parser.add_argument('inputs', nargs='*', help="image file(s) to convert")
+    parser.add_argument('--manifest', help="file listing jobs, one per line:"
+                        " input[<tab>output[<tab>mimetype]]")
+    parser.add_argument('--output-dir', help="directory for jp2 outputs "
+                        "(default: alongside each input)")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="number of worker processes (default: cpu count)")
+    parser.add_argument('--max-threads', type=int, default=None,
+                        help="most kdu_compress threads for a single image "
+                        "(default: cpu count)")
+    parser.add_argument('--tmp-dir', default=None,
+                        help="parent dir for per-job temp dirs")
+    parser.add_argument('--ram-dir', default=DEFAULT_RAM_DIR,
+                        help="RAM-backed dir for intermediate files")
+    parser.add_argument('--ram-budget', type=parse_size, default=0,
+                        help="bytes of intermediate files to keep in "
+                        "--ram-dir at once, e.g. 4G (default: none)")
+    parser.add_argument('--cache-dir', default=None,
+                        help="dir for the conversion cache (default: no "
+                        "cache)")
+    parser.add_argument('--cache-max-bytes', type=parse_size, default=None,
+                        help="size limit for cached jp2 copies, e.g. 50G")
+    parser.add_argument('--cache-max-age', type=float, default=None,
+                        help="days to keep cache entries")
+    parser.add_argument('--no-verify', action='store_true',
+                        help="don't check the headers of each jp2 written")
+    parser.add_argument('--kdu-memory', default=None,
+                        help="file recording which kinds of input need the "
+                        "fallback kdu_compress options")
+    parser.add_argument('--in-process-max-pixels', type=int,
+                        default=IN_PROCESS_MAX_PIXELS,
+                        help="preconvert JPEG/PNG/GIF images up to this many "
+                        "pixels with Pillow rather than ImageMagick (0 to "
+                        "always use ImageMagick)")
+    parser.add_argument('--memory-limit', type=parse_size, default=0,
+                        help="estimated peak memory of the jobs running at "
+                        "once, e.g. 16G; jobs wait until they fit "
+                        "(default: no limit)")
+    parser.add_argument('--disk-limit', type=parse_size, default=0,
+                        help="estimated scratch disk of the jobs running at "
+                        "once, e.g. 100G (default: no limit)")
+    parser.add_argument('--strip-wise-above', type=parse_size,
+                        default=STRIP_WISE_BYTES,
+                        help="convert images that would need more memory "
+                        "than this strip by strip, e.g. 2G (0 to never)")
+    parser.add_argument('--collection', default=None,
+                        help="label for the metrics of this batch, e.g. the "
+                        "collection being converted")
+    parser.add_argument('--metrics', default=None,
+                        help="JSON-lines file to append per-stage metrics to")
+    parser.add_argument('--prometheus', default=None,
+                        help="Prometheus textfile to keep updated with "
+                        "per-stage totals")
+    parser.add_argument('--upload-to', default=None,
+                        help="bucket, or bucket/prefix, to upload each jp2 "
+                        "to as soon as it's written, named after the output "
+                        "file without its extension (e.g. a Nuxeo uid)")
+    parser.add_argument('--upload-workers', type=int, default=2,
+                        help="files to upload at once")
+    parser.add_argument('--upload-part-workers', type=int,
+                        default=PART_WORKERS,
+                        help="parts of a big file to upload at once")
+    parser.add_argument('--upload-part-size', type=parse_size,
+                        default=PART_SIZE,
+                        help="smallest part size for multipart uploads, e.g. "
+                        "8M")
+    parser.add_argument('--no-skip-existing', action='store_true',
+                        help="upload even if the same file is already there")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="hash the inputs first, and convert each "
+                        "distinct one once, copying its jp2 for the others")
+    parser.add_argument('--ledger', default=None,
+                        help="SQLite file recording the state of every job, "
+                        "so a rerun (or other processes given the same "
+                        "file) only does the jobs still pending or failed")
+    parser.add_argument('--prewarm', metavar='BASE_URI', default=None,
+                        help="write info.json and low resolution tiles and "
+                        "thumbnails of each jp2 into the Loris caches, "
+                        "giving this IIIF base URI as its @id")
+    parser.add_argument('--prewarm-info-root', default=CACHE_ROOT,
+                        help="Loris info cache directory to prewarm")
+    parser.add_argument('--prewarm-image-root', default=CACHE_ROOT,
+                        help="Loris image cache directory to prewarm")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="convert nothing but a sample of the inputs, "
+                        "and print an estimate of the cpu hours, time, "
+                        "scratch disk and output bytes the batch needs")
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE,
+                        help="inputs to convert for --dry-run")
+    parser.add_argument('--logfile', default=None)
+    parser.add_argument('--loglevel', default='INFO')
+    argv = parser.parse_args(argv)
+
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(
+        filename=argv.logfile,
+        level=numeric_level,
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    jobs = [make_job(path, output_dir=argv.output_dir) for path in argv.inputs]
+    if argv.manifest:
+        jobs.extend(read_manifest(argv.manifest, output_dir=argv.output_dir))
+    if not jobs and not argv.ledger:
+        parser.error('no inputs given')
+    if argv.dedupe and argv.ledger:
+        parser.error("--dedupe can't be used with --ledger")
+    if argv.dry_run:
+        if not jobs:
+            parser.error('--dry-run needs inputs')
+        estimator = Estimator(
+            sample_size=argv.sample_size, tmp_dir=argv.tmp_dir,
+            convert_options=dict(
+                max_threads=argv.max_threads, ram_dir=argv.ram_dir,
+                ram_budget=argv.ram_budget, verify=not argv.no_verify,
+                kdu_memory_path=argv.kdu_memory,
+                in_process_max_pixels=argv.in_process_max_pixels,
+                strip_wise_bytes=argv.strip_wise_above))
+        estimate = estimator.estimate(
+            [(input_path, mimetype) for input_path, _, mimetype in jobs],
+            memory_limit=argv.memory_limit, disk_limit=argv.disk_limit)
+        print(format_estimate(estimate))
+        return 0
+    if argv.output_dir and not os.path.isdir(argv.output_dir):
+        os.makedirs(argv.output_dir)
+
+    cache = None
+    if argv.cache_dir:
+        max_age = argv.cache_max_age
+        cache = ConversionCache(
+            argv.cache_dir, max_bytes=argv.cache_max_bytes,
+            max_age=max_age * 24 * 60 * 60 if max_age is not None else None)
+
+    ledger = Ledger(argv.ledger) if argv.ledger else None
+    prewarmer = None
+    if argv.prewarm:
+        prewarmer = Prewarmer(argv.prewarm,
+                              info_root=argv.prewarm_info_root,
+                              image_root=argv.prewarm_image_root)
+    failed = 0
+    results = convert_batch(
+        jobs, workers=argv.workers, tmp_root=argv.tmp_dir,
+        max_threads=argv.max_threads, ram_dir=argv.ram_dir,
+        ram_budget=argv.ram_budget, cache=cache, verify=not argv.no_verify,
+        kdu_memory_path=argv.kdu_memory,
+        in_process_max_pixels=argv.in_process_max_pixels,
+        memory_limit=argv.memory_limit, disk_limit=argv.disk_limit,
+        strip_wise_bytes=argv.strip_wise_above, collection=argv.collection,
+        ledger=ledger, dedupe=argv.dedupe, prewarmer=prewarmer,
+        uploading=bool(argv.upload_to))
+    sink = metrics.JsonLinesSink(argv.metrics) if argv.metrics else None
+    totals = metrics.Aggregate()
+    # uploads run in threads of this process, overlapping with the
+    # workers encoding the next images
+    recorder = metrics.Recorder({'collection': argv.collection})
+    uploader = None
+    if argv.upload_to:
+        uploader = BackgroundUploader(
+            Uploader(part_workers=argv.upload_part_workers,
+                     part_size=argv.upload_part_size,
+                     skip_existing=not argv.no_skip_existing,
+                     recorder=recorder),
+            workers=argv.upload_workers)
+    last_written = [0]
+    # ledger key (the input) of each output being uploaded
+    uploading = {}
+
+    def report(line, records):
+        print('\t'.join(line))
+        sys.stdout.flush()
+        if sink is not None:
+            sink.write(records)
+        if argv.prometheus:
+            totals.add_all(records)
+            if time.time() - last_written[0] > PROMETHEUS_INTERVAL:
+                metrics.write_prometheus(totals, argv.prometheus)
+                last_written[0] = time.time()
+
+    def report_uploads(uploads):
+        failures = 0
+        for upload in uploads:
+            if ledger is not None and not upload.ok:
+                ledger.finish(uploading[upload.path], ledger_states.FAILED,
+                              error_class='upload', error=upload.msg)
+            elif ledger is not None:
+                ledger.finish(uploading[upload.path], ledger_states.DONE)
+            if not upload.ok:
+                failures += 1
+            status = UPLOADED if upload.ok else UPLOAD_FAILED
+            if upload.skipped:
+                status = SKIPPED
+            report([upload.path, upload.url, status,
+                    upload.msg.replace('\n', ' ')], recorder.drain())
+        return failures
+
+    for result in results:
+        if result.status != CONVERTED:
+            failed += 1
+        elif uploader is not None:
+            name = os.path.splitext(os.path.basename(result.output))[0]
+            uploading[result.output] = result.input
+            uploader.submit(result.output, argv.upload_to, name)
+        report([result.input, result.output, result.status,
+                result.msg.replace('\n', ' ')], result.metrics)
+        if uploader is not None:
+            failed += report_uploads(uploader.finished())
+    if uploader is not None:
+        failed += report_uploads(uploader.close())
+    if argv.prometheus:
+        metrics.write_prometheus(totals, argv.prometheus)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
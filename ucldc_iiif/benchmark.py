@@ -0,0 +1,750 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    benchmark the conversion pipeline on a synthetic corpus.
+
+    `python -m ucldc_iiif.benchmark run` generates TIFF/JPEG/PNG images of
+    the requested sizes (deterministically, from a seed), converts them
+    with ucldc_iiif.batch under each combination of worker count,
+    kdu_compress thread cap and scratch space (temp files on disk, or a
+    RAM-backed dir), and reports throughput, latency percentiles and peak
+    memory and scratch disk for each.
+
+    Each configuration runs against the real tools, if they are installed
+    (at the PATH_TIFFCP, PATH_KDU_COMPRESS, ... locations Convert uses),
+    and against deterministic stand-ins. The stand-ins read their whole
+    input, hash it (to cost cpu in proportion to its size) and write an
+    output of the size and, for TIFF and jp2, the headers the real tool
+    would, so every step of the pipeline, including verification, runs.
+    They are this module, run as `python -m ucldc_iiif.benchmark stub`.
+
+    Results can be saved with --json and compared against a saved
+    baseline with --baseline; a throughput drop or latency rise beyond
+    --tolerance makes the run exit non-zero.
+'''
+import sys
+import os
+import json
+import time
+import zlib
+import random
+import shutil
+import struct
+import hashlib
+import logging
+import argparse
+import tempfile
+import threading
+
+from ucldc_iiif import imageinfo, jp2, metrics
+from ucldc_iiif.workspace import parse_size
+
+FORMATS = ['tiff', 'tiff16', 'tiff-gray', 'jpeg', 'png']
+EXTENSIONS = {'tiff': '.tif', 'tiff16': '.tif', 'tiff-gray': '.tif',
+              'jpeg': '.jpg', 'png': '.png'}
+DEFAULT_SIZES = '1024x768,3000x2000'
+
+# the environment variables Convert reads tool locations from, and the
+# name of the tool at each
+TOOLS = [
+    ('PATH_TIFFCP', 'tiffcp'),
+    ('PATH_MAGICK_CONVERT', 'convert'),
+    ('PATH_KDU_COMPRESS', 'kdu_compress'),
+    ('PATH_TIFF2RGBA', 'tiff2rgba'),
+    ('PATH_TIFFICC', 'tifficc'),
+    ('PATH_KDU_EXPAND', 'kdu_expand'),
+]
+STUB = 'stub'
+REAL = 'real'
+
+TIFF_STRIP_BYTES = 64 * 1024
+CHUNK_SIZE = 1024 * 1024
+# how often to sample memory and scratch disk use, in seconds
+SAMPLE_INTERVAL = 0.1
+
+logger = logging.getLogger(__name__)
+
+
+# ---- synthetic images
+
+def _rows(row_bytes, height, samples, seed):
+    ''' yield `height` rows of a noisy diagonal gradient '''
+    rnd = random.Random(seed)
+    pixels_per_row = max(row_bytes // samples, 1)
+    base = bytearray(row_bytes)
+    for i in range(row_bytes):
+        base[i] = ((i // samples) * 256 // pixels_per_row +
+                   rnd.randint(0, 15)) & 0xff
+    base = bytes(base)
+    step = 3 * samples
+    for y in range(height):
+        shift = (y * step) % row_bytes
+        yield base[shift:] + base[:shift]
+
+
+def write_tiff(path, width, height, samples=3, bits=8, extra_samples=0,
+               seed=0):
+    ''' write an uncompressed, strip-based, little-endian TIFF '''
+    row_bytes = width * samples * (bits // 8)
+    rows_per_strip = max(1, min(height, TIFF_STRIP_BYTES // row_bytes))
+    strips = (height + rows_per_strip - 1) // rows_per_strip
+    data_bytes = row_bytes * height
+    ifd_offset = 8 + data_bytes + data_bytes % 2
+    photometric = (imageinfo.PHOTOMETRIC_MINISBLACK
+                   if samples - extra_samples == 1
+                   else imageinfo.PHOTOMETRIC_RGB)
+    entries = [
+        (256, 4, [width]),
+        (257, 4, [height]),
+        (258, 3, [bits] * samples),
+        (259, 3, [imageinfo.TIFF_COMPRESSION_NONE]),
+        (262, 3, [photometric]),
+        (273, 4, [8 + i * rows_per_strip * row_bytes
+                  for i in range(strips)]),
+        (277, 3, [samples]),
+        (278, 4, [rows_per_strip]),
+        (279, 4, [min(rows_per_strip, height - i * rows_per_strip) *
+                  row_bytes for i in range(strips)]),
+        (284, 3, [1]),
+    ]
+    if extra_samples:
+        # unassociated alpha
+        entries.append((338, 3, [2] * extra_samples))
+
+    formats = {3: 'H', 4: 'I'}
+    ifd = struct.pack('<H', len(entries))
+    external = b''
+    external_offset = ifd_offset + 2 + 12 * len(entries) + 4
+    for tag, field_type, values in entries:
+        value = struct.pack('<{}{}'.format(len(values), formats[field_type]),
+                            *values)
+        if len(value) <= 4:
+            value = value.ljust(4, b'\0')
+        else:
+            offset = external_offset + len(external)
+            external += value + b'\0' * (len(value) % 2)
+            value = struct.pack('<I', offset)
+        ifd += struct.pack('<HHI', tag, field_type, len(values)) + value
+    ifd += struct.pack('<I', 0)
+
+    with open(path, 'wb') as f:
+        f.write(b'II*\x00' + struct.pack('<I', ifd_offset))
+        for row in _rows(row_bytes, height, samples * (bits // 8), seed):
+            f.write(row)
+        f.write(b'\0' * (data_bytes % 2))
+        f.write(ifd + external)
+
+
+def _png_chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+
+def write_png(path, width, height, seed=0):
+    ''' write an 8-bit RGB PNG '''
+    compressor = zlib.compressobj(6)
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                                8, 2, 0, 0, 0)))
+        for row in _rows(width * 3, height, 3, seed):
+            data = compressor.compress(b'\0' + row)
+            if data:
+                f.write(_png_chunk(b'IDAT', data))
+        f.write(_png_chunk(b'IDAT', compressor.flush()))
+        f.write(_png_chunk(b'IEND', b''))
+
+
+def write_jpeg(path, width, height, seed=0):
+    '''
+    write an RGB JPEG with Pillow, or failing that ImageMagick. Without
+    either, write just the headers: enough for the stand-in tools, which
+    never decode anything. Returns whether the file is a real image.
+    '''
+    try:
+        from PIL import Image
+    except ImportError:
+        Image = None
+    if Image is not None:
+        data = b''.join(_rows(width * 3, height, 3, seed))
+        Image.frombytes('RGB', (width, height), data).save(
+            path, 'JPEG', quality=90)
+        return True
+
+    convert = os.environ.get('PATH_MAGICK_CONVERT', '/usr/local/bin/convert')
+    if os.access(convert, os.X_OK):
+        tiff_path = path + '.tif'
+        write_tiff(tiff_path, width, height, seed=seed)
+        try:
+            metrics.run_command([convert, tiff_path, path])
+        finally:
+            os.remove(tiff_path)
+        if imageinfo.read_image_info(path) is not None:
+            return True
+
+    sof = struct.pack('>BHHB', 8, height, width, 3) + b'\x01\x11\x00' + \
+        b'\x02\x11\x00' + b'\x03\x11\x00'
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8\xff\xc0' + struct.pack('>H', len(sof) + 2) + sof +
+                b'\xff\xd9')
+    return False
+
+
+def write_image(path, image_format, width, height, seed=0):
+    ''' write a synthetic image; returns whether real tools can read it '''
+    if image_format == 'tiff':
+        write_tiff(path, width, height, seed=seed)
+    elif image_format == 'tiff16':
+        write_tiff(path, width, height, bits=16, seed=seed)
+    elif image_format == 'tiff-gray':
+        write_tiff(path, width, height, samples=1, seed=seed)
+    elif image_format == 'png':
+        write_png(path, width, height, seed=seed)
+    elif image_format == 'jpeg':
+        return write_jpeg(path, width, height, seed=seed)
+    else:
+        raise ValueError('Unknown format: {}'.format(image_format))
+    return True
+
+
+def parse_sizes(sizes):
+    ''' parse '1024x768,3000x2000' into [(1024, 768), (3000, 2000)] '''
+    parsed = []
+    for size in sizes.split(','):
+        width, height = size.lower().split('x')
+        parsed.append((int(width), int(height)))
+    return parsed
+
+
+def make_corpus(corpus_dir, sizes, formats, count, seed=0):
+    '''
+    generate `count` images of each size and format in `corpus_dir`,
+    reusing any already there (file names include the seed). Returns a
+    list of (path, readable by real tools).
+    '''
+    if not os.path.isdir(corpus_dir):
+        os.makedirs(corpus_dir)
+    corpus = []
+    for width, height in sizes:
+        for image_format in formats:
+            for i in range(count):
+                image_seed = zlib.crc32('{}-{}x{}-{}-{}'.format(
+                    seed, width, height, image_format, i).encode('utf-8'))
+                path = os.path.join(corpus_dir, '{}-{}x{}-s{}-{}{}'.format(
+                    image_format, width, height, seed, i,
+                    EXTENSIONS[image_format]))
+                marker = path + '.header-only'
+                if not os.path.exists(path):
+                    logger.info('Generating {}'.format(path))
+                    if not write_image(path, image_format, width, height,
+                                       seed=image_seed):
+                        open(marker, 'w').close()
+                corpus.append((path, not os.path.exists(marker)))
+    return corpus
+
+
+# ---- stand-in tools
+
+def write_jp2(path, width, height, components, expected, body_bytes):
+    '''
+    write a jp2 whose headers match `expected` (as returned by
+    jp2.expected_from_kdu_opts), with `body_bytes` of filler for the
+    compressed data, spread over one tile-part per tile
+    '''
+    tile_width = expected.get('tile_width', width)
+    tile_height = expected.get('tile_height', height)
+    tiles = (((width + tile_width - 1) // tile_width) *
+             ((height + tile_height - 1) // tile_height))
+    levels = expected.get('levels', 5)
+    reversible = expected.get('reversible', False)
+    code_block = expected.get('code_block', (64, 64))
+    progression = expected.get('progression', 'LRCP')
+    colorspace = expected.get('colorspace') or \
+        ('sLUM' if components == 1 else 'sRGB')
+    enumerated = dict((name, value) for value, name in
+                      jp2.COLOR_SPACES.items())[colorspace]
+
+    siz = struct.pack('>HIIIIIIIIH', 0, width, height, 0, 0, tile_width,
+                      tile_height, 0, 0, components) + \
+        b'\x07\x01\x01' * components
+    cod = struct.pack(
+        '>BBHBBBBBB',
+        (0x02 if expected.get('sop') else 0) |
+        (0x04 if expected.get('eph') else 0),
+        jp2.PROGRESSION_ORDERS.index(progression),
+        expected.get('layers', 1), 1 if components == 3 else 0, levels,
+        code_block[0].bit_length() - 3, code_block[1].bit_length() - 3, 0,
+        1 if reversible else 0)
+    if reversible:
+        qcd = struct.pack('>B', 0x20) + b'\x48' * (3 * levels + 1)
+    else:
+        qcd = struct.pack('>B', 0x22) + b'\x48\x00' * (3 * levels + 1)
+    main_header = b'\xff\x4f'
+    for marker, segment in [(b'\xff\x51', siz), (b'\xff\x52', cod),
+                            (b'\xff\x5c', qcd)]:
+        main_header += marker + struct.pack('>H', len(segment) + 2) + segment
+
+    ihdr = b'ihdr' + struct.pack('>IIHBBBB', height, width, components, 7,
+                                 7, 0, 0)
+    colr = b'colr' + struct.pack('>BBBI', 1, 0, 0, enumerated)
+    jp2h = b'jp2h' + struct.pack('>I', len(ihdr) + 4) + ihdr + \
+        struct.pack('>I', len(colr) + 4) + colr
+    ftyp = b'ftypjp2 \0\0\0\0jp2 '
+    per_tile = max(body_bytes // tiles, 1)
+    with open(path, 'wb') as f:
+        f.write(jp2.JP2_SIGNATURE)
+        f.write(struct.pack('>I', len(ftyp) + 4) + ftyp)
+        f.write(struct.pack('>I', len(jp2h) + 4) + jp2h)
+        # a jp2c box of length 0 runs to the end of the file
+        f.write(struct.pack('>I', 0) + b'jp2c')
+        f.write(main_header)
+        for tile in range(tiles):
+            body = b''
+            if expected.get('plt'):
+                body += b'\xff\x58' + struct.pack('>HB', 5, 0) + b'\x05\x05'
+            body += b'\xff\x93'
+            f.write(b'\xff\x90' + struct.pack(
+                '>HHIBB', 10, tile, 12 + len(body) + per_tile, 0, 1))
+            f.write(body)
+            f.write(b'\0' * per_tile)
+        f.write(b'\xff\xd9')
+
+
+def _burn(path, passes):
+    ''' read a file and hash it `passes` times, to stand in for the cpu
+    cost of processing it '''
+    for i in range(passes):
+        digest = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(block)
+
+
+def _option(args, name):
+    return args[args.index(name) + 1]
+
+
+def run_stub(tool, args):
+    '''
+    stand in for `tool` called with `args`: read the input, then write
+    an output like the real tool's. The cpu cost is one hash of the
+    input per pass; set UCLDC_IIIF_STUB_PASSES to change the number of
+    passes.
+    '''
+    passes = int(os.environ.get('UCLDC_IIIF_STUB_PASSES', 1))
+    if tool in ('kdu_compress', 'kdu_expand'):
+        input_path, output_path = _option(args, '-i'), _option(args, '-o')
+    else:
+        input_path, output_path = args[-2], args[-1]
+    _burn(input_path, passes)
+
+    if tool == 'kdu_expand':
+        info = jp2.read_jp2_info_from_file(input_path, all_tile_parts=False)
+        write_tiff(output_path, info.width, info.height,
+                   samples=info.components)
+        return 0
+
+    info = imageinfo.read_image_info(input_path)
+    if info is None:
+        sys.stderr.write('{}: cannot read {}\n'.format(tool, input_path))
+        return 1
+    width, height = info.width, info.height
+    color_channels = info.samples_per_pixel - info.extra_samples
+    if tool == 'kdu_compress':
+        rate = float(_option(args, '-rate').split(',')[0]) \
+            if '-rate' in args else 2.0
+        write_jp2(output_path, width, height, info.samples_per_pixel,
+                  jp2.expected_from_kdu_opts(args),
+                  int(width * height * rate / 8))
+    elif tool == 'tiffcp':
+        write_tiff(output_path, width, height, samples=info.samples_per_pixel,
+                   bits=info.bits_per_sample,
+                   extra_samples=info.extra_samples)
+    elif tool == 'tiff2rgba':
+        write_tiff(output_path, width, height, samples=4, extra_samples=1)
+    elif tool == 'convert':
+        if info.orientation in (5, 6, 7, 8):
+            width, height = height, width
+        write_tiff(output_path, width, height,
+                   samples=1 if color_channels == 1 else 3)
+    elif tool == 'tifficc':
+        write_tiff(output_path, width, height, samples=3)
+    else:
+        sys.stderr.write('No stand-in for {}\n'.format(tool))
+        return 1
+    return 0
+
+
+def make_stub_tools(bin_dir):
+    ''' write wrapper scripts for the stand-in tools; returns the
+    environment variables pointing Convert at them '''
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__)))
+    env = {}
+    for variable, tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nPYTHONPATH="{}${{PYTHONPATH:+:$PYTHONPATH}}" '
+                    'exec "{}" -m ucldc_iiif.benchmark stub {} "$@"\n'.format(
+                        package_root, sys.executable, tool))
+        os.chmod(path, 0o755)
+        env[variable] = path
+    return env
+
+
+def real_tools():
+    ''' the environment variables for the real tools, or None if any of
+    them isn't installed '''
+    from ucldc_iiif.convert import Convert
+    convert = Convert()
+    env = {}
+    for variable, tool in TOOLS:
+        location = os.environ.get(variable) or getattr(convert, {
+            'PATH_TIFFCP': 'tiffcp_location',
+            'PATH_MAGICK_CONVERT': 'magick_convert_location',
+            'PATH_KDU_COMPRESS': 'kdu_compress_location',
+            'PATH_TIFF2RGBA': 'tiff2rgba_location',
+            'PATH_TIFFICC': 'tifficc_location',
+            'PATH_KDU_EXPAND': 'kdu_expand_location',
+        }[variable])
+        if not os.access(location, os.X_OK):
+            logger.info('{} not found at {}'.format(tool, location))
+            return None
+        env[variable] = location
+    return env
+
+
+# ---- measuring
+
+class Sampler(threading.Thread):
+    '''
+        samples the total RSS of this process and its descendants, and
+        the bytes under some scratch dirs, keeping the peaks
+    '''
+
+    def __init__(self, dirs, interval=SAMPLE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.dirs = dirs
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_scratch = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sample()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.sample()
+
+    def sample(self):
+        rss = _tree_rss(os.getpid())
+        if rss is not None:
+            self.peak_rss = max(self.peak_rss, rss)
+        self.peak_scratch = max(self.peak_scratch, sum(
+            _dir_bytes(dirname) for dirname in self.dirs))
+
+
+def _tree_rss(root_pid):
+    ''' total RSS in bytes of a process and its descendants (Linux only) '''
+    if not os.path.isdir('/proc'):
+        return None
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # the command name can contain spaces; fields resume after ')'
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total = 0
+    pending = [root_pid]
+    while pending:
+        pid = pending.pop()
+        pending.extend(children.get(pid, []))
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * page_size
+        except (IOError, OSError):
+            continue
+    return total
+
+
+def _dir_bytes(top):
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(top):
+        for filename in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+    return total
+
+
+def percentile(values, fraction):
+    ''' nearest-rank percentile of a list of numbers '''
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def config_name(config):
+    return '{toolchain} workers={workers} threads={max_threads} ' \
+           'scratch={scratch}'.format(**config)
+
+
+def run_config(corpus, config, tool_env, work_dir, ram_root, ram_budget):
+    '''
+    convert the corpus once with `config` (toolchain, workers,
+    max_threads, scratch) and return a dict of measurements
+    '''
+    from ucldc_iiif import batch
+
+    run_dir = tempfile.mkdtemp(prefix='run-', dir=work_dir)
+    output_dir = os.path.join(run_dir, 'out')
+    tmp_root = os.path.join(run_dir, 'tmp')
+    ram_dir = tempfile.mkdtemp(prefix='ucldc-iiif-bench-', dir=ram_root)
+    os.makedirs(output_dir)
+    os.makedirs(tmp_root)
+    jobs = [batch.make_job(path, output_dir=output_dir)
+            for path, readable in corpus]
+
+    saved_env = dict((variable, os.environ.get(variable))
+                     for variable in tool_env)
+    os.environ.update(tool_env)
+    sampler = Sampler([tmp_root, ram_dir])
+    sampler.start()
+    start = time.time()
+    try:
+        results = list(batch.convert_batch(
+            jobs, workers=config['workers'], tmp_root=tmp_root,
+            max_threads=config['max_threads'], ram_dir=ram_dir,
+            ram_budget=ram_budget if config['scratch'] == 'ram' else 0,
+            collection=config_name(config)))
+    finally:
+        elapsed = time.time() - start
+        sampler.stop()
+        for variable, value in saved_env.items():
+            if value is None:
+                os.environ.pop(variable, None)
+            else:
+                os.environ[variable] = value
+        shutil.rmtree(ram_dir, ignore_errors=True)
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    records = [record for result in results for record in result.metrics]
+    latencies = [record['wall'] for record in records
+                 if record['stage'] == metrics.JOB_STAGE]
+    input_bytes = sum(os.path.getsize(path) for path, readable in corpus)
+    failures = [result for result in results
+                if result.status != batch.CONVERTED]
+    for result in failures[:5]:
+        logger.warning('{} failed: {}'.format(result.input, result.msg))
+    measured = dict(config)
+    measured.update({
+        'name': config_name(config),
+        'images': len(results),
+        'failed': len(failures),
+        'seconds': elapsed,
+        'images_per_second': len(results) / elapsed if elapsed else 0,
+        'mb_per_second': input_bytes / 1024.0 / 1024.0 / elapsed
+        if elapsed else 0,
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p90': percentile(latencies, 0.9),
+        'latency_p99': percentile(latencies, 0.99),
+        'peak_process_rss': max([record.get('max_rss') or 0
+                                 for record in records] or [0]),
+        'peak_total_rss': sampler.peak_rss,
+        'peak_scratch': sampler.peak_scratch,
+    })
+    return measured
+
+
+def format_results(results):
+    lines = ['{:<44} {:>6} {:>4} {:>8} {:>7} {:>7} {:>7} {:>7} {:>7} '
+             '{:>8} {:>8} {:>8}'.format(
+                 'configuration', 'images', 'fail', 'seconds', 'img/s',
+                 'MB/s', 'p50 s', 'p90 s', 'p99 s', 'proc RSS', 'tot RSS',
+                 'scratch')]
+    for result in results:
+        lines.append(
+            '{:<44} {:>6} {:>4} {:>8.2f} {:>7.2f} {:>7.1f} {:>7.2f} {:>7.2f} '
+            '{:>7.2f} {:>7.0f}M {:>7.0f}M {:>7.0f}M'.format(
+                result['name'], result['images'], result['failed'],
+                result['seconds'], result['images_per_second'],
+                result['mb_per_second'], result['latency_p50'] or 0,
+                result['latency_p90'] or 0, result['latency_p99'] or 0,
+                result['peak_process_rss'] / 1024.0 / 1024.0,
+                result['peak_total_rss'] / 1024.0 / 1024.0,
+                result['peak_scratch'] / 1024.0 / 1024.0))
+    return '\n'.join(lines)
+
+
+def find_regressions(results, baseline, tolerance):
+    ''' human-readable regressions of `results` against the results of a
+    previous run, matching configurations by name '''
+    previous = dict((result['name'], result) for result in baseline)
+    regressions = []
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None:
+            continue
+        if result['images_per_second'] < \
+                before['images_per_second'] * (1 - tolerance):
+            regressions.append('{}: throughput {:.2f} img/s, was {:.2f}'.format(
+                result['name'], result['images_per_second'],
+                before['images_per_second']))
+        for name in ('latency_p50', 'latency_p99'):
+            if result[name] and before.get(name) and \
+                    result[name] > before[name] * (1 + tolerance):
+                regressions.append('{}: {} {:.2f}s, was {:.2f}s'.format(
+                    result['name'], name, result[name], before[name]))
+        if result['failed'] > before['failed']:
+            regressions.append('{}: {} failures, was {}'.format(
+                result['name'], result['failed'], before['failed']))
+    return regressions
+
+
+def _int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def _add_corpus_options(parser):
+    parser.add_argument('--corpus-dir', default=os.path.join(
+        tempfile.gettempdir(), 'ucldc-iiif-bench-corpus'),
+        help="where to generate (and reuse) the synthetic images")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help="image sizes, e.g. 1024x768,3000x2000")
+    parser.add_argument('--formats', default=','.join(FORMATS),
+                        help="any of {}".format(', '.join(FORMATS)))
+    parser.add_argument('--count', type=int, default=2,
+                        help="images of each size and format")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv[:1] == [STUB]:
+        return run_stub(argv[1], argv[2:])
+
+    parser = argparse.ArgumentParser(
+        description='benchmark the jp2 conversion pipeline on synthetic '
+        'images')
+    subparsers = parser.add_subparsers(dest='command')
+    corpus_parser = subparsers.add_parser(
+        'corpus', help="just generate the synthetic images")
+    _add_corpus_options(corpus_parser)
+    run_parser = subparsers.add_parser(
+        'run', help="convert the synthetic images under each configuration")
+    _add_corpus_options(run_parser)
+    run_parser.add_argument('--toolchains', default='{},{}'.format(STUB, REAL),
+                            help="'stub', 'real' or both; real is skipped "
+                            "if the tools aren't installed")
+    run_parser.add_argument('--workers', type=_int_list, default=[1, 4],
+                            help="worker counts to try, e.g. 1,4,8")
+    run_parser.add_argument('--max-threads', type=_int_list, default=[4],
+                            help="kdu_compress thread caps to try")
+    run_parser.add_argument('--scratch', default='disk,ram',
+                            help="'disk' (temp files), 'ram' (RAM-backed "
+                            "dir) or both")
+    run_parser.add_argument('--ram-dir', default='/dev/shm')
+    run_parser.add_argument('--ram-budget', type=parse_size, default='2G')
+    run_parser.add_argument('--stub-passes', type=int, default=1,
+                            help="hashes of its input each stand-in tool "
+                            "does, to simulate cpu cost")
+    run_parser.add_argument('--work-dir', default=None,
+                            help="dir for outputs and temp files")
+    run_parser.add_argument('--json', default=None,
+                            help="save the results to this file")
+    run_parser.add_argument('--baseline', default=None,
+                            help="results saved with --json by an earlier "
+                            "run, to check for regressions")
+    run_parser.add_argument('--tolerance', type=float, default=0.1,
+                            help="fraction by which throughput may drop or "
+                            "latency rise before it counts as a regression")
+    parser.add_argument('--loglevel', default='WARNING')
+    argv = parser.parse_args(argv)
+
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(
+        level=numeric_level,
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    corpus = make_corpus(argv.corpus_dir, parse_sizes(argv.sizes),
+                         argv.formats.split(','), argv.count, argv.seed)
+    if argv.command == 'corpus':
+        for path, readable in corpus:
+            print(path if readable else '{}\t(headers only)'.format(path))
+        return 0
+
+    os.environ['UCLDC_IIIF_STUB_PASSES'] = str(argv.stub_passes)
+    if argv.work_dir and not os.path.isdir(argv.work_dir):
+        os.makedirs(argv.work_dir)
+    work_dir = tempfile.mkdtemp(prefix='ucldc-iiif-bench-', dir=argv.work_dir)
+    ram_root = argv.ram_dir if os.path.isdir(argv.ram_dir) else work_dir
+    toolchains = {}
+    for toolchain in argv.toolchains.split(','):
+        if toolchain == STUB:
+            toolchains[STUB] = (make_stub_tools(os.path.join(work_dir, 'bin')),
+                                corpus)
+        elif toolchain == REAL:
+            env = real_tools()
+            if env is None:
+                logger.warning('Real tools not installed; skipping them')
+                continue
+            # header-only JPEGs are only good for the stand-ins
+            toolchains[REAL] = (env, [item for item in corpus if item[1]])
+
+    results = []
+    try:
+        for toolchain in sorted(toolchains):
+            env, images = toolchains[toolchain]
+            for workers in argv.workers:
+                for max_threads in argv.max_threads:
+                    for scratch in argv.scratch.split(','):
+                        config = dict(toolchain=toolchain, workers=workers,
+                                      max_threads=max_threads,
+                                      scratch=scratch)
+                        result = run_config(images, config, env, work_dir,
+                                            ram_root, argv.ram_budget)
+                        logger.info('{name}: {images_per_second:.2f} img/s'
+                                    .format(**result))
+                        results.append(result)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_results(results))
+    if argv.json:
+        with open(argv.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if argv.baseline:
+        with open(argv.baseline) as f:
+            regressions = find_regressions(results, json.load(f),
+                                           argv.tolerance)
+        for regression in regressions:
+            print('REGRESSION: {}'.format(regression))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
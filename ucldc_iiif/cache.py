@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    content-addressed cache of conversion results, so that re-running a
+    collection doesn't reconvert sources that haven't changed.
+
+    Entries are keyed by (source content hash, conversion plan, encoder
+    options hash) and record where the jp2 was written and its checksum.
+    A local tier also keeps a copy of each jp2, bounded by size and age.
+
+    Layout under the cache dir:
+        entries/<key[:2]>/<key>.json
+        blobs/<key[:2]>/<key>.jp2
+'''
+import os
+import json
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path, algorithm='sha1'):
+    ''' hex digest of a file's contents '''
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _makedirs(dirname):
+    ''' create `dirname` unless it exists (possibly created by another
+    process in the meantime) '''
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+
+
+def _write_atomic(path, data):
+    dirname = os.path.dirname(path)
+    _makedirs(dirname)
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class ConversionCache(object):
+    '''
+        a cache of jp2 conversions on the local filesystem. Safe to share
+        between processes: entries are written with an atomic rename.
+
+        `max_bytes` bounds the size of the local copies of jp2s, and
+        `max_age` (in seconds) the age of entries; see evict().
+    '''
+
+    def __init__(self, cache_dir, max_bytes=None, max_age=None):
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @staticmethod
+    def key(source_hash, plan, options_hash):
+        ''' cache key for a source, conversion plan and encoder options '''
+        plan_str = ','.join(plan)
+        return hashlib.sha1('\n'.join(
+            [source_hash, plan_str, options_hash]).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, 'entries', key[:2], key + '.json')
+
+    def _blob_path(self, key):
+        return os.path.join(self.cache_dir, 'blobs', key[:2], key + '.jp2')
+
+    def lookup(self, key):
+        ''' the recorded entry for `key`, or None '''
+        try:
+            with open(self._entry_path(key)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def get(self, key, output_path):
+        '''
+        if we've already converted this, make sure a verified copy of the
+        jp2 is at `output_path` and return True. Uses the local copy if we
+        still have it, otherwise checks the recorded output location.
+        '''
+        entry = self.lookup(key)
+        if entry is None:
+            return False
+
+        blob_path = self._blob_path(key)
+        candidates = [blob_path, entry['output_path'], output_path]
+        for path in candidates:
+            if not os.path.isfile(path) or \
+                    os.path.getsize(path) != entry['output_bytes'] or \
+                    file_hash(path) != entry['output_sha1']:
+                continue
+            if os.path.abspath(path) != os.path.abspath(output_path):
+                shutil.copyfile(path, output_path)
+            os.utime(self._entry_path(key), None)
+            self.logger.info('Cache hit for {}: {} from {}'.format(
+                key, output_path, path))
+            return True
+
+        self.logger.info('Cache entry {} found but no verified copy of the '
+                         'jp2 is left'.format(key))
+        return False
+
+    def put(self, key, source_hash, output_path):
+        ''' record a freshly converted jp2 and keep a local copy of it '''
+        output_sha1 = file_hash(output_path)
+        blob_path = self._blob_path(key)
+        blob_dir = os.path.dirname(blob_path)
+        _makedirs(blob_dir)
+        fd, tmp_blob = tempfile.mkstemp(dir=blob_dir, prefix='.tmp-')
+        os.close(fd)
+        shutil.copyfile(output_path, tmp_blob)
+        os.rename(tmp_blob, blob_path)
+
+        entry = {
+            'key': key,
+            'source_hash': source_hash,
+            'output_path': os.path.abspath(output_path),
+            'output_sha1': output_sha1,
+            'output_bytes': os.path.getsize(output_path),
+            'created': time.time(),
+        }
+        _write_atomic(self._entry_path(key), json.dumps(entry))
+        self.logger.debug('Cached {} as {}'.format(output_path, key))
+
+    def _walk(self, kind):
+        top = os.path.join(self.cache_dir, kind)
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                if not filename.startswith('.tmp-'):
+                    yield os.path.join(dirpath, filename)
+
+    def evict(self):
+        '''
+        drop entries (and their jp2 copies) older than `max_age`, then
+        drop the least recently used jp2 copies until they take up no
+        more than `max_bytes`. Entries whose copy is dropped are kept, so
+        the recorded output can still be verified and reused in place.
+        Returns the number of bytes freed.
+        '''
+        freed = 0
+        now = time.time()
+        if self.max_age is not None:
+            for entry_path in self._walk('entries'):
+                entry_key = os.path.basename(entry_path)[:-len('.json')]
+                try:
+                    expired = now - os.path.getmtime(entry_path) > self.max_age
+                except OSError:
+                    continue
+                if expired:
+                    freed += self._remove(self._blob_path(entry_key))
+                    self._remove(entry_path)
+
+        if self.max_bytes is not None:
+            blobs = []
+            for blob_path in self._walk('blobs'):
+                blob_key = os.path.basename(blob_path)[:-len('.jp2')]
+                try:
+                    size = os.path.getsize(blob_path)
+                except OSError:
+                    continue
+                try:
+                    last_used = os.path.getmtime(self._entry_path(blob_key))
+                except OSError:
+                    last_used = 0
+                blobs.append((last_used, size, blob_path))
+            total = sum(size for last_used, size, blob_path in blobs)
+            for last_used, size, blob_path in sorted(blobs):
+                if total <= self.max_bytes:
+                    break
+                freed += self._remove(blob_path)
+                total -= size
+
+        if freed:
+            self.logger.info('Evicted {} bytes from cache {}'.format(
+                freed, self.cache_dir))
+        return freed
+
+    @staticmethod
+    def _remove(path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+            return size
+        except OSError:
+            return 0
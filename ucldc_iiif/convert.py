@@ -2,36 +2,446 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
+import io
+import shutil
 import subprocess
+import tempfile
 import logging
+import mimetypes
+import hashlib
+import json
+import multiprocessing
+from contextlib import contextmanager
+from ucldc_iiif import imageinfo, jp2, metrics
+from ucldc_iiif.jp2 import KDU_COMPRESS_BASE_OPTS
+from ucldc_iiif.workspace import Workspace
+from ucldc_iiif.cache import file_hash
+try:
+    import magic
+except ImportError:
+    magic = None
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    from PIL import ImageCms
+except ImportError:
+    ImageCms = None
 
 VALID_TYPES = ['image/jpeg', 'image/gif', 'image/tiff', 'image/png', 'image/jp2', 'image/jpx', 'image/jpm']
 INVALID_TYPES = ['application/pdf']
-
-# Settings recommended as a starting point by Jon Stroop.
-# See https://groups.google.com/forum/?hl=en#!searchin/iiif-discuss/kdu_compress/iiif-discuss/OFzWFLaWVsE/wF2HaykHcd0J
-KDU_COMPRESS_BASE_OPTS = [
-    "-quiet", "-rate",
-    "2.4,1.48331273,.91673033,.56657224,.35016049,.21641118,.13374944,"
-    ".08266171",
-    "Creversible=yes", "Clevels=7", "Cblk={64,64}", "Cuse_sop=yes",
-    "Cuse_eph=yes", "Corder=RLCP", "ORGgen_plt=yes", "ORGtparts=R",
-    "Stiles={1024,1024}", "-double_buffering", "10", "-num_threads", "4",
-    "-no_weights"
-]
+JP2_TYPES = ['image/jp2', 'image/jpx', 'image/jpm']
 
 KDU_COMPRESS_DEFAULT_OPTS = KDU_COMPRESS_BASE_OPTS[:]
 KDU_COMPRESS_DEFAULT_OPTS.extend(["-jp2_space", "sRGB"])
 
+# names for the option sets above, as remembered by KduOptionMemory
+KDU_DEFAULT = 'default'
+KDU_BASE = 'base'
+# times the base options must rescue an input of a kind before that kind
+# goes straight to them
+KDU_FALLBACK_AFTER = 2
+# kdu_compress output that means it ran out of room rather than failed
+# on its input
+TRANSIENT_ERRORS = ['No space left on device', 'Cannot allocate memory',
+                    'out of memory']
+
+# what the codestream of a jp2 written with either option set looks like
+EXPECTED_JP2_ENCODING = jp2.EXPECTED_ENCODING
+
+# (method, intermediate filename) steps run before the final kdu_compress.
+PRE_CONVERT_STEP = ('_pre_convert', 'preconverted.tiff')
+UNCOMPRESS_TIFF_STEP = ('_uncompress_tiff', 'uncompressed.tiff')
+TO_SRGB_STEP = ('_tiff_to_srgb_libtiff', 'srgb.tiff')
+UNCOMPRESS_JP2_STEP = ('_uncompress_jp2000', 'uncompressed.tiff')
+# decodes, orients, flattens and converts to sRGB in one go, with Pillow
+IN_PROCESS_STEP = ('_pre_convert_in_process', 'preconverted.tiff')
+# steps that may write intermediates of their own, and so are handed the
+# job's Workspace
+WORKSPACE_STEPS = [IN_PROCESS_STEP]
+
+IN_PROCESS_TYPES = ['image/jpeg', 'image/png', 'image/gif']
+# images up to this size are preconverted in-process rather than by
+# forking ImageMagick, if Pillow is installed
+IN_PROCESS_MAX_PIXELS = 16 * 1000 * 1000
+
+# Pillow transposes that undo each EXIF/TIFF orientation
+ORIENTATION_TRANSPOSES = {
+    2: ['FLIP_LEFT_RIGHT'], 3: ['ROTATE_180'], 4: ['FLIP_TOP_BOTTOM'],
+    5: ['TRANSPOSE'], 6: ['ROTATE_270'], 7: ['TRANSVERSE'], 8: ['ROTATE_90'],
+}
+
+# steps for images too big to hold in memory at once; see
+# plan_conversion(strip_wise=True)
+PRE_CONVERT_LIMITED_STEP = ('_pre_convert_limited', 'preconverted.tiff')
+TO_SRGB_BY_BLOCK_STEP = ('_tiff_to_srgb_libtiff_by_block', 'srgb.tiff')
+
+JP2_PLAN = [UNCOMPRESS_JP2_STEP]
+# used when we can't read the image header
+DEFAULT_PLAN = [PRE_CONVERT_STEP, UNCOMPRESS_TIFF_STEP, TO_SRGB_STEP]
+
+
+# kdu_compress gets at most one thread per this many bytes of uncompressed
+# input, i.e. roughly one 1024x1024 RGB tile (see `Stiles` above).
+KDU_BYTES_PER_THREAD = 1024 * 1024 * 3
+
+MB = 1024 * 1024
+# ImageMagick's pixel cache limits in strip-wise mode; beyond these it
+# pages pixels through a file in the temp dir
+MAGICK_MEMORY_LIMIT = 256 * MB
+MAGICK_MAP_LIMIT = 512 * MB
+# rough peak memory of each step as (bytes per pixel, fixed overhead).
+# Steps with no per-pixel cost work through the image a strip or tile at
+# a time.
+STEP_MEMORY = {
+    # ImageMagick (Q16) holds 4 16-bit channels per pixel
+    '_pre_convert': (8, 64 * MB),
+    '_pre_convert_limited': (0, MAGICK_MEMORY_LIMIT + MAGICK_MAP_LIMIT),
+    # the decoded image plus a converted copy
+    '_pre_convert_in_process': (8, 64 * MB),
+    '_uncompress_tiff': (0, 64 * MB),
+    # tiff2rgba reads the whole raster with TIFFReadRGBAImage ...
+    '_tiff_to_srgb_libtiff': (4, 16 * MB),
+    # ... unless it's asked to go block by block
+    '_tiff_to_srgb_libtiff_by_block': (0, 64 * MB),
+    '_uncompress_jp2000': (0, 256 * MB),
+}
+# kdu_compress works tile by tile (see `Stiles` above)
+KDU_COMPRESS_MEMORY = 256 * MB
+# images whose full-raster steps would need more memory than this are
+# converted strip-wise instead
+STRIP_WISE_BYTES = 2 * 1024 * MB
+
+
+def available_cpus():
+    ''' number of cpus this process is allowed to run on '''
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def kdu_opts_with_threads(opts, num_threads):
+    ''' return a copy of kdu_compress `opts` using `num_threads` threads '''
+    opts = opts[:]
+    if '-num_threads' in opts:
+        opts[opts.index('-num_threads') + 1] = str(num_threads)
+    else:
+        opts.extend(["-num_threads", str(num_threads)])
+    return opts
+
+
+def encoder_options_hash():
+    ''' hash of the kdu_compress options that affect the jp2 we write
+    (the thread count doesn't) '''
+    opts = kdu_opts_with_threads(KDU_COMPRESS_DEFAULT_OPTS, 0)
+    opts.append('|')
+    opts.extend(kdu_opts_with_threads(KDU_COMPRESS_BASE_OPTS, 0))
+    return hashlib.sha1('\0'.join(opts).encode('utf-8')).hexdigest()
+
+
+def kdu_input_signature(info):
+    ''' a string describing the kind of uncompressed tiff we hand to
+    kdu_compress, or None if we couldn't read its header '''
+    if info is None:
+        return None
+    if info.icc_profile is None:
+        profile = 'none'
+    elif imageinfo.is_srgb_profile(info.icc_profile):
+        profile = 'sRGB'
+    else:
+        profile = hashlib.sha1(info.icc_profile).hexdigest()[:12]
+    return '|'.join(str(field) for field in [
+        info.photometric, info.samples_per_pixel, info.extra_samples,
+        info.bits_per_sample, profile])
+
+
+def transient_failure(error):
+    ''' whether a failed command (a CalledProcessError) was killed, e.g.
+    by the OOM killer, or ran out of memory or disk, in which case it
+    says nothing about its input '''
+    return error.returncode < 0 or any(
+        message in (error.output or '') for message in TRANSIENT_ERRORS)
+
+
+class KduOptionMemory(object):
+    '''
+        remembers kinds of input (see kdu_input_signature) for which the
+        default kdu_compress options failed and the base options worked,
+        so later inputs of the same kind go straight to the base options.
+        A kind is only remembered once that has happened
+        `fallback_after` times, so one flaky failure doesn't send a kind
+        to the base options for good.
+
+        If `path` is given, what we learn is appended to that file as
+        json lines, and picked up by other processes sharing it.
+    '''
+
+    def __init__(self, path=None, fallback_after=KDU_FALLBACK_AFTER):
+        self.path = path
+        self.fallback_after = fallback_after
+        self._known = {}
+        self._fallbacks = {}
+        self._read_bytes = 0
+
+    def _reload(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        if os.path.getsize(self.path) == self._read_bytes:
+            return
+        with open(self.path) as f:
+            f.seek(self._read_bytes)
+            for line in f:
+                if not line.endswith('\n'):
+                    break  # another process is still writing it
+                self._read_bytes += len(line)
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._known[record['signature']] = record['variant']
+
+    def lookup(self, signature):
+        ''' the option set that worked for inputs like this, if known '''
+        if signature is None:
+            return None
+        self._reload()
+        return self._known.get(signature)
+
+    def record_fallback(self, signature):
+        ''' note that the base options worked for an input like this
+        after the default ones failed '''
+        self._fallbacks[signature] = self._fallbacks.get(signature, 0) + 1
+        if self._fallbacks[signature] >= self.fallback_after:
+            self.record(signature, KDU_BASE)
+
+    def record(self, signature, variant):
+        if self._known.get(signature) == variant:
+            return
+        self._known[signature] = variant
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps({'signature': signature,
+                                    'variant': variant}) + '\n')
+
+
+class KduThreadScheduler(object):
+    '''
+        shares the available cpus among the conversions in flight and picks
+        the `-num_threads` value for each kdu_compress call.
+
+        Jobs that are in an earlier (single-threaded) stage are counted as
+        using one cpu each; the remaining cpus are split among the running
+        kdu_compress calls in proportion to the size of their input, so a
+        few big images get many threads each and lots of small images run
+        single-threaded side by side.
+
+        Counters are kept in multiprocessing shared memory, so a scheduler
+        created in a parent process can be handed to pool workers.
+    '''
+
+    def __init__(self, cpus=None, max_threads=None):
+        self.cpus = cpus or available_cpus()
+        self.max_threads = max_threads or self.cpus
+        self._jobs = multiprocessing.Value('i', 0)
+        self._encoding = multiprocessing.Value('i', 0)
+        self._encoding_bytes = multiprocessing.Value('d', 0)
+
+    @staticmethod
+    def _add(counter, amount):
+        with counter.get_lock():
+            counter.value += amount
+
+    @contextmanager
+    def job(self):
+        ''' register a conversion job for as long as the block runs '''
+        self._add(self._jobs, 1)
+        try:
+            yield
+        finally:
+            self._add(self._jobs, -1)
+
+    @contextmanager
+    def encoding(self, input_bytes):
+        ''' register a kdu_compress call on `input_bytes` of uncompressed
+        input and yield the number of threads it should use '''
+        self._add(self._encoding, 1)
+        self._add(self._encoding_bytes, input_bytes)
+        try:
+            yield self.threads_for(input_bytes)
+        finally:
+            self._add(self._encoding, -1)
+            self._add(self._encoding_bytes, -input_bytes)
+
+    def threads_for(self, input_bytes):
+        ''' number of threads for a kdu_compress call on `input_bytes` '''
+        encoding = max(self._encoding.value, 1)
+        other_jobs = max(self._jobs.value - encoding, 0)
+        free_cpus = max(self.cpus - other_jobs, 1)
+        total_bytes = max(self._encoding_bytes.value, input_bytes, 1)
+        share = free_cpus * float(input_bytes) / total_bytes
+        size_cap = input_bytes // KDU_BYTES_PER_THREAD + 1
+        return int(max(1, min(self.max_threads, size_cap, share)))
+
+
+def plan_conversion(mimetype, info=None, in_process_max_pixels=0,
+                    strip_wise=False):
+    '''
+    work out the shortest list of steps that gets an image into a form
+    kdu_compress can take (an uncompressed, 8-bit, gray or sRGB, strip
+    based TIFF), based on the header metadata in `info` (an
+    imageinfo.ImageInfo). Without header metadata, every step is run.
+    8-bit JPEG/PNG/GIF images of up to `in_process_max_pixels` pixels are
+    handled in-process by Pillow in a single step.
+    With `strip_wise`, only steps that work through the image a strip or
+    tile at a time are used, for images too big to hold in memory.
+    '''
+    if mimetype in JP2_TYPES:
+        return JP2_PLAN
+    if info is None:
+        return DEFAULT_PLAN
+    if (not strip_wise and Image is not None and
+            mimetype in IN_PROCESS_TYPES and info.bits_per_sample <= 8 and
+            0 < imageinfo.pixels(info) <= in_process_max_pixels):
+        return [IN_PROCESS_STEP]
+
+    color_channels = info.samples_per_pixel - info.extra_samples
+    needs_srgb = (
+        info.bits_per_sample != 8 or info.palette or info.extra_samples or
+        color_channels not in (1, 3) or
+        info.photometric not in (None, imageinfo.PHOTOMETRIC_MINISBLACK,
+                                 imageinfo.PHOTOMETRIC_RGB) or
+        (info.icc_profile is not None and
+         not imageinfo.is_srgb_profile(info.icc_profile)))
+
+    if strip_wise:
+        return _plan_strip_wise(mimetype, info, needs_srgb)
+
+    plan = []
+    baseline_tiff = (mimetype == 'image/tiff' and info.orientation == 1 and
+                     not info.tiled and info.planar_config == 1)
+    if not baseline_tiff:
+        # ImageMagick writes an uncompressed, upright, strip-based TIFF
+        plan.append(PRE_CONVERT_STEP)
+    elif info.compression != imageinfo.TIFF_COMPRESSION_NONE:
+        plan.append(UNCOMPRESS_TIFF_STEP)
+    if needs_srgb:
+        plan.append(TO_SRGB_STEP)
+    return plan
+
+
+def _plan_strip_wise(mimetype, info, needs_srgb):
+    ''' plan_conversion() for images too big to hold in memory '''
+    if mimetype == 'image/tiff' and info.orientation == 1:
+        if info.tiled or info.planar_config != 1 or needs_srgb:
+            # `tiff2rgba -b` reads tiles, separate planes and compressed
+            # data a block at a time, and writes uncompressed strips
+            return [TO_SRGB_BY_BLOCK_STEP]
+        if info.compression != imageinfo.TIFF_COMPRESSION_NONE:
+            # tiffcp copies strip-based images row by row
+            return [UNCOMPRESS_TIFF_STEP]
+        return []
+    # ImageMagick, with its pixel cache paged to disk
+    plan = [PRE_CONVERT_LIMITED_STEP]
+    if needs_srgb:
+        plan.append(TO_SRGB_BY_BLOCK_STEP)
+    return plan
+
+
+def estimate_intermediate_bytes(info):
+    ''' rough size of the biggest intermediate TIFF for an image, or
+    None if we don't know. tiff2rgba always writes 4 samples per pixel. '''
+    if info is None or not imageinfo.pixels(info):
+        return None
+    bytes_per_sample = (info.bits_per_sample + 7) // 8
+    samples = max(info.samples_per_pixel, 4)
+    return imageinfo.pixels(info) * samples * bytes_per_sample + 64 * 1024
+
+
+def estimate_job_resources(info, plan):
+    '''
+    rough peak (memory, scratch disk) bytes needed to run `plan` and
+    kdu_compress on an image, or (None, None) if we don't know its size.
+    Steps run one after the other, so the memory peak is that of the
+    hungriest step; on disk, each step's input and output exist at once.
+    '''
+    intermediate = estimate_intermediate_bytes(info)
+    if intermediate is None:
+        return None, None
+    pixels = imageinfo.pixels(info)
+    memory = KDU_COMPRESS_MEMORY
+    for method, filename in plan:
+        per_pixel, overhead = STEP_MEMORY.get(method, (0, 64 * MB))
+        memory = max(memory, pixels * per_pixel + overhead)
+    disk = intermediate * min(len(plan), 2)
+    if PRE_CONVERT_LIMITED_STEP in plan:
+        # ImageMagick's pixel cache file, 4 16-bit channels per pixel
+        disk = max(disk, intermediate + pixels * 8)
+    if IN_PROCESS_STEP in plan:
+        # room for the ImageMagick fallback's extra intermediate
+        disk = max(disk, intermediate * 2)
+    return memory, disk
+
+
+def choose_plan(mimetype, info=None, in_process_max_pixels=0,
+                strip_wise_bytes=0):
+    '''
+    plan_conversion(), switching to the strip-wise plan for images that
+    would need more than `strip_wise_bytes` of memory (0 for no limit).
+    Returns (plan, estimated memory, estimated scratch disk, whether the
+    plan is strip-wise).
+    '''
+    plan = plan_conversion(mimetype, info, in_process_max_pixels)
+    memory, disk = estimate_job_resources(info, plan)
+    if strip_wise_bytes and memory is not None and memory > strip_wise_bytes:
+        plan = plan_conversion(mimetype, info, strip_wise=True)
+        memory, disk = estimate_job_resources(info, plan)
+        return plan, memory, disk, True
+    return plan, memory, disk, False
+
+
+def get_mimetype(path):
+    ''' guess the mime-type of a file, using libmagic if available '''
+    if magic is not None:
+        return magic.from_file(path, mime=True)
+    return mimetypes.guess_type(path)[0]
+
 
 class Convert(object):
     '''
         utilities for use in converting an image file to jp2 format
     '''
 
-    def __init__(self):
+    def __init__(self, scheduler=None, ram_dir=None, ram_budget=None,
+                 cache=None, verify=True, kdu_memory=None,
+                 in_process_max_pixels=IN_PROCESS_MAX_PIXELS,
+                 memory_budget=None, disk_budget=None,
+                 strip_wise_bytes=STRIP_WISE_BYTES, recorder=None):
 
         self.logger = logging.getLogger(__name__)
+        self.scheduler = scheduler or KduThreadScheduler()
+        # intermediates go to `ram_dir` while they fit in `ram_budget`
+        # (a workspace.Budget); see ucldc_iiif.workspace
+        self.ram_dir = ram_dir
+        self.ram_budget = ram_budget
+        # a cache.ConversionCache consulted before doing any work
+        self.cache = cache
+        # check the headers of each jp2 we write
+        self.verify = verify
+        # which kdu_compress options work for which kinds of input
+        self.kdu_memory = kdu_memory or KduOptionMemory()
+        # small images are preconverted with Pillow rather than ImageMagick
+        self.in_process_max_pixels = in_process_max_pixels
+        # jobs wait until their estimated peak memory and scratch disk
+        # needs fit in these (workspace.Budget) before starting
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        # images needing more memory than this are converted strip-wise
+        self.strip_wise_bytes = strip_wise_bytes
+        # a metrics.Recorder collecting time, cpu, memory and bytes in/out
+        # of each stage; see ucldc_iiif.metrics
+        self.recorder = recorder or metrics.NullRecorder()
 
         self.tiffcp_location = os.environ.get('PATH_TIFFCP',
                                               '/usr/local/bin/tiffcp')
@@ -46,6 +456,16 @@ class Convert(object):
         self.kdu_expand_location = os.environ.get('PATH_KDU_EXPAND',
                                                '/usr/local/bin/kdu_expand')
 
+    def _check_output(self, stage, args, input_path, output_path, env=None):
+        ''' run a command like subprocess.check_output, with stderr
+        merged in, and record its time, cpu and memory use as `stage` '''
+        returncode, output, wall, usage = metrics.run_command(args, env=env)
+        self.recorder.record_command(stage, args, returncode, wall, usage,
+                                     input_path, output_path)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args, output)
+        return output
+
     def _pre_check(self, mimetype):
         ''' do a basic pre-check on the object to see if we think it's
         something know how to deal with '''
@@ -72,12 +492,12 @@ class Convert(object):
         ''' uncompress a tiff using tiffcp.
         See http://www.libtiff.org/tools.html '''
         try:
-            subprocess.check_output(
-                [
+            self._check_output(
+                'uncompress_tiff', [
                     self.tiffcp_location, "-c", "none", compressed_path,
                     uncompressed_path
                 ],
-                stderr=subprocess.STDOUT)
+                compressed_path, uncompressed_path)
             uncompressed = True
             msg = 'File uncompressed. Input: {}, output: {}'.format(
                 compressed_path, uncompressed_path)
@@ -93,11 +513,11 @@ class Convert(object):
     def _uncompress_jp2000(self, compressed_path, uncompressed_path):
         ''' uncompress a jp2000 file using kdu_expand '''
         try:
-            subprocess.check_output(
-                [
+            self._check_output(
+                'uncompress_jp2000', [
                     self.kdu_expand_location, "-i", compressed_path, "-o", uncompressed_path
                 ],
-                stderr=subprocess.STDOUT)
+                compressed_path, uncompressed_path)
             uncompressed = True
             msg = 'File uncompressed using kdu_expand. Input: {}, output: {}'.format(
                 compressed_path, uncompressed_path)
@@ -113,34 +533,77 @@ class Convert(object):
     def _tiff_to_jp2(self, tiff_path, jp2_path):
         ''' convert a tiff to jp2 using kdu_compress.
         tiff must be uncompressed.'''
+        try:
+            input_bytes = os.path.getsize(tiff_path)
+        except OSError:
+            input_bytes = 0
+        info = imageinfo.read_image_info(tiff_path)
+        signature = kdu_input_signature(info)
+        use_default = self._use_default_kdu_opts(info, signature)
+        with self.scheduler.encoding(input_bytes) as num_threads:
+            return self._kdu_compress(tiff_path, jp2_path, num_threads,
+                                      use_default, signature)
+
+    def _use_default_kdu_opts(self, info, signature):
+        ''' decide up front whether the default (sRGB) kdu_compress options
+        can work for this input, so we don't run encodes we know will fail '''
+        if info is not None and \
+                info.samples_per_pixel - info.extra_samples != 3:
+            # `-jp2_space sRGB` needs 3 colour channels
+            return False
+        return self.kdu_memory.lookup(signature) != KDU_BASE
+
+    def _kdu_compress(self, tiff_path, jp2_path, num_threads,
+                      use_default=True, signature=None):
+        ''' run kdu_compress with `num_threads` threads. Unless `use_default`
+        is False, try the default (sRGB) options first and fall back to the
+        base options, remembering inputs like this one (`signature`) that
+        needed the fallback. '''
         basic_args = [
             self.kdu_compress_location, "-i", tiff_path, "-o", jp2_path
         ]
         default_args = basic_args[:]
-        default_args.extend(KDU_COMPRESS_DEFAULT_OPTS)
+        default_args.extend(
+            kdu_opts_with_threads(KDU_COMPRESS_DEFAULT_OPTS, num_threads))
         alt_args = basic_args[:]
-        alt_args.extend(KDU_COMPRESS_BASE_OPTS)
+        alt_args.extend(
+            kdu_opts_with_threads(KDU_COMPRESS_BASE_OPTS, num_threads))
+        self.logger.debug('Running kdu_compress on {} with {} threads'.format(
+            tiff_path, num_threads))
+
+        if not use_default:
+            self.logger.info('Using base kdu_compress options for {}'.format(
+                tiff_path))
+            return self._run_kdu_compress(alt_args, tiff_path, jp2_path)
 
         try:
-            subprocess.check_output(
-                default_args, stderr=subprocess.STDOUT)
+            self._check_output('tiff_to_jp2', default_args, tiff_path,
+                               jp2_path)
             converted = True
             msg = '{} converted to {}'.format(tiff_path, jp2_path)
             self.logger.info(msg)
         except subprocess.CalledProcessError, e:
             self.logger.info(
                 'A kdu_compress command failed. Trying alternate.')
-            try:
-                subprocess.check_output(
-                    alt_args, stderr=subprocess.STDOUT)
-                converted = True
-                msg = '{} converted to {}'.format(tiff_path, jp2_path)
-                self.logger.info(msg)
-            except subprocess.CalledProcessError, e:
-                converted = False
-                msg = 'kdu_compress command failed: {}\nreturncode was: {}\n' \
-                      'output was: {}'.format(e.cmd, e.returncode, e.output)
-                self.logger.error(msg)
+            converted, msg = self._run_kdu_compress(alt_args, tiff_path,
+                                                    jp2_path)
+            if converted and signature is not None and \
+                    not transient_failure(e):
+                self.kdu_memory.record_fallback(signature)
+
+        return converted, msg
+
+    def _run_kdu_compress(self, args, tiff_path, jp2_path):
+        try:
+            self._check_output('tiff_to_jp2', args, tiff_path, jp2_path)
+            converted = True
+            msg = '{} converted to {}'.format(tiff_path, jp2_path)
+            self.logger.info(msg)
+        except subprocess.CalledProcessError, e:
+            converted = False
+            msg = 'kdu_compress command failed: {}\nreturncode was: {}\n' \
+                  'output was: {}'.format(e.cmd, e.returncode, e.output)
+            self.logger.error(msg)
 
         return converted, msg
 
@@ -150,12 +613,12 @@ class Convert(object):
          http://www.imagemagick.org/script/convert.php
         '''
         try:
-            subprocess.check_output(
-                [
+            self._check_output(
+                'pre_convert', [
                     self.magick_convert_location, "-compress", "None",
                     "-quality", "100", "-auto-orient", input_path, output_path
                 ],
-                stderr=subprocess.STDOUT)
+                input_path, output_path)
             preconverted = True
             msg = 'Used ImagMagick convert to convert {} to {}'.format(
                 input_path, output_path)
@@ -168,15 +631,131 @@ class Convert(object):
 
         return preconverted, msg
 
+    def _pre_convert_limited(self, input_path, output_path):
+        '''
+        convert file using ImageMagick `convert` as `_pre_convert` does,
+        but with its pixel cache limited to MAGICK_MEMORY_LIMIT in memory
+        and MAGICK_MAP_LIMIT memory-mapped, so the rest of the image is
+        paged through a temp file next to `output_path`
+        '''
+        env = dict(os.environ)
+        env['MAGICK_TEMPORARY_PATH'] = os.path.dirname(
+            os.path.abspath(output_path))
+        try:
+            self._check_output(
+                'pre_convert_limited', [
+                    self.magick_convert_location,
+                    "-limit", "memory", str(MAGICK_MEMORY_LIMIT),
+                    "-limit", "map", str(MAGICK_MAP_LIMIT),
+                    "-compress", "None", "-quality", "100", "-auto-orient",
+                    input_path, output_path
+                ],
+                input_path, output_path, env=env)
+            preconverted = True
+            msg = 'Used ImagMagick convert (with limited memory) to convert ' \
+                  '{} to {}'.format(input_path, output_path)
+            self.logger.info(msg)
+        except subprocess.CalledProcessError, e:
+            preconverted = False
+            msg = 'ImageMagic `convert` command failed: {}\nreturncode was:' \
+                  '{}\noutput was: {}'.format(e.cmd, e.returncode, e.output)
+            self.logger.error(msg)
+
+        return preconverted, msg
+
+    def _pre_convert_in_process(self, input_path, output_path,
+                                workspace=None):
+        '''
+        decode a JPEG/PNG/GIF with Pillow, auto-orient it, convert it to
+        sRGB, flatten any alpha onto white and write an uncompressed TIFF.
+        Falls back to ImageMagick `convert` and `tiff2rgba` if Pillow
+        can't handle the file, with the intermediate between the two in
+        `workspace` (by default, next to `output_path`).
+        '''
+        try:
+            with self.recorder.timed('pre_convert_in_process', input_path,
+                                     output_path, tool='pillow'):
+                self._pillow_to_tiff(input_path, output_path)
+            preconverted = True
+            msg = 'Used Pillow to convert {} to {}'.format(
+                input_path, output_path)
+            self.logger.info(msg)
+        except Exception, e:  # Pillow raises all sorts of things
+            self.logger.warning(
+                'In-process conversion of {} failed ({!r}). Falling back to '
+                'ImageMagick.'.format(input_path, e))
+            if workspace is None:
+                workspace = Workspace(os.path.dirname(
+                    os.path.abspath(output_path)))
+            magick_path = workspace.path(
+                os.path.basename(output_path) + '.magick.tiff')
+            try:
+                preconverted, msg = self._pre_convert(input_path, magick_path)
+                if preconverted:
+                    preconverted, msg = self._tiff_to_srgb_libtiff(
+                        magick_path, output_path)
+            finally:
+                workspace.release(magick_path)
+
+        return preconverted, msg
+
+    def _pillow_to_tiff(self, input_path, output_path):
+        opened = Image.open(input_path)
+        try:
+            self._pillow_save_tiff(opened, output_path)
+        finally:
+            # long-lived batch workers would otherwise hold on to the
+            # file until the image is garbage collected
+            opened.close()
+
+    def _pillow_save_tiff(self, image, output_path):
+        image.load()
+
+        orientation = 1
+        if hasattr(image, '_getexif'):
+            exif = image._getexif() or {}
+            orientation = exif.get(274, 1)
+        for transpose in ORIENTATION_TRANSPOSES.get(orientation, []):
+            image = image.transpose(getattr(Image, transpose))
+
+        # flatten any transparency onto white first, while the alpha is
+        # still there; the ICC transform below drops it
+        icc_profile = image.info.get('icc_profile')
+        if image.mode == 'LA':
+            background = Image.new('L', image.size, 255)
+            background.paste(image.convert('L'), mask=image.split()[1])
+            image = background
+        elif image.mode in ('RGBA', 'PA') or \
+                (image.mode == 'P' and 'transparency' in image.info):
+            image = image.convert('RGBA')
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[3])
+            image = background
+
+        if icc_profile and not imageinfo.is_srgb_profile(icc_profile):
+            if ImageCms is None:
+                raise ValueError('ImageCms is needed to apply ICC profile')
+            if image.mode not in ('RGB', 'CMYK', 'L'):
+                image = image.convert('RGB')
+            image = ImageCms.profileToProfile(
+                image, ImageCms.ImageCmsProfile(io.BytesIO(icc_profile)),
+                ImageCms.createProfile('sRGB'),
+                outputMode='L' if image.mode == 'L' else 'RGB')
+
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        image.save(output_path, 'TIFF')
+
     def _tiff_to_srgb_libtiff(self, input_path, output_path):
         '''
         convert color profile to sRGB using libtiff's `tiff2rgba` tool
         '''
         try:
-            subprocess.check_output([
+            self._check_output('tiff_to_srgb_libtiff', [
                 self.tiff2rgba_location, "-c", "none", input_path, output_path
             ],
-                stderr=subprocess.STDOUT)
+                input_path, output_path)
             to_srgb = True
             msg = "Used tiff2rgba to convert {} to {}, with color profile" \
                   "sRGB (if not already sRGB)".format(input_path, output_path)
@@ -189,15 +768,41 @@ class Convert(object):
 
         return to_srgb, msg
 
+    def _tiff_to_srgb_libtiff_by_block(self, input_path, output_path):
+        '''
+        convert color profile to sRGB using libtiff's `tiff2rgba` tool,
+        one strip or tile at a time rather than reading the whole image
+        into memory
+        '''
+        try:
+            self._check_output('tiff_to_srgb_libtiff_by_block', [
+                self.tiff2rgba_location, "-b", "-c", "none", input_path,
+                output_path
+            ],
+                input_path, output_path)
+            to_srgb = True
+            msg = "Used tiff2rgba -b to convert {} to {}, with color " \
+                  "profile sRGB (if not already sRGB)".format(input_path,
+                                                              output_path)
+            self.logger.info(msg)
+        except subprocess.CalledProcessError, e:
+            to_srgb = False
+            msg = 'libtiff `tiff2rgba` command failed: {}\nreturncode was:' \
+                  '{}\noutput was: {}'.format(e.cmd, e.returncode, e.output)
+            self.logger.error(msg)
+
+        return to_srgb, msg
+
     def _tiff_to_srgb_little_cms(self, input_path, output_path):
         '''
         convert color profile to sRGB using Little CMS's `tifficc`
         ICC profile applier tool.
         '''
         try:
-            subprocess.check_output(
+            self._check_output(
+                'tiff_to_srgb_little_cms',
                 [self.tifficc_location, input_path, output_path],
-                stderr=subprocess.STDOUT)
+                input_path, output_path)
             to_srgb = True
             msg = "Used tifficc to convert {} to {}, with color profile " \
                   "sRGB (if not already sRGB)".format(input_path, output_path)
@@ -210,9 +815,151 @@ class Convert(object):
 
         return to_srgb, msg
 
+    def _verify_jp2(self, jp2_path):
+        ''' check that a jp2 has the tiling, levels, progression order,
+        PLT markers etc. that Loris needs, by reading its headers '''
+        try:
+            info = jp2.read_jp2_info_from_file(jp2_path)
+        except (IOError, OSError, jp2.Jp2HeaderError), e:
+            verified = False
+            msg = "Couldn't read the jp2 headers of {}: {}".format(jp2_path, e)
+            self.logger.error(msg)
+            return verified, msg
+
+        mismatches = jp2.compare(info, EXPECTED_JP2_ENCODING)
+        if mismatches:
+            verified = False
+            msg = '{} is not encoded as expected: {}'.format(
+                jp2_path, '; '.join(mismatches))
+            self.logger.error(msg)
+        else:
+            verified = True
+            msg = 'Verified encoding of {}'.format(jp2_path)
+            self.logger.info(msg)
+
+        return verified, msg
+
+    def convert(self, input_path, output_path, mimetype=None, tmp_dir=None):
+        '''
+        run the whole conversion pipeline for a single image, from the
+        original file at `input_path` to a jp2 at `output_path`.
+        Intermediate files are written to `tmp_dir`, or to the RAM dir if
+        they fit in the RAM budget; if no `tmp_dir` is given, a temp dir is
+        created for this call and removed afterwards. Each intermediate is
+        deleted as soon as the next step has consumed it.
+        '''
+        if mimetype is None:
+            mimetype = get_mimetype(input_path)
+        passed, msg = self._pre_check(mimetype)
+        if not passed:
+            return passed, msg
+
+        cleanup = tmp_dir is None
+        if cleanup:
+            tmp_dir = tempfile.mkdtemp(prefix='ucldc-iiif-')
+        try:
+            with self.scheduler.job(), self.recorder.timed(
+                    metrics.JOB_STAGE, input_path, output_path,
+                    mimetype=mimetype) as result:
+                result['ok'], msg = self._run_plan(input_path, output_path,
+                                                   mimetype, tmp_dir)
+                return result['ok'], msg
+        finally:
+            if cleanup:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _run_plan(self, input_path, output_path, mimetype, tmp_dir):
+        info = None
+        if mimetype not in JP2_TYPES:
+            info = imageinfo.read_image_info(input_path)
+        plan, memory, disk, strip_wise = choose_plan(
+            mimetype, info, self.in_process_max_pixels,
+            self.strip_wise_bytes)
+        if strip_wise:
+            self.logger.info('{} is too big to convert in memory; '
+                             'converting strip-wise'.format(input_path))
+        self.logger.info('Conversion plan for {}: {}'.format(
+            input_path, ', '.join(
+                [method for method, filename in plan] + ['_tiff_to_jp2'])))
+
+        cache_key = None
+        if self.cache is not None:
+            with self.recorder.timed('cache_lookup', input_path,
+                                     output_path) as result:
+                source_hash = result['source_hash'] = file_hash(input_path)
+                cache_key = self.cache.key(
+                    source_hash, [method for method, filename in plan],
+                    encoder_options_hash())
+                result['hit'] = self.cache.get(cache_key, output_path)
+            if result['hit']:
+                msg = '{} already converted; using cached {}'.format(
+                    input_path, output_path)
+                self.logger.info(msg)
+                return True, msg
+
+        with self._admitted(input_path, memory, disk):
+            workspace = Workspace(tmp_dir, ram_dir=self.ram_dir,
+                                  budget=self.ram_budget)
+            size = estimate_intermediate_bytes(info)
+            try:
+                current_path = input_path
+                for method, filename in plan:
+                    next_path = workspace.path(filename, size)
+                    if (method, filename) in WORKSPACE_STEPS:
+                        passed, msg = getattr(self, method)(
+                            current_path, next_path, workspace=workspace)
+                    else:
+                        passed, msg = getattr(self, method)(current_path,
+                                                            next_path)
+                    if current_path != input_path:
+                        workspace.release(current_path)
+                    if not passed:
+                        return passed, msg
+                    current_path = next_path
+                converted, msg = self._tiff_to_jp2(current_path, output_path)
+            finally:
+                workspace.cleanup()
+
+        if converted and self.verify:
+            with self.recorder.timed('verify_jp2', output_path) as result:
+                converted, msg = self._verify_jp2(output_path)
+                result['ok'] = converted
+
+        if converted and cache_key is not None:
+            self.cache.put(cache_key, source_hash, output_path)
+        return converted, msg
+
+    @contextmanager
+    def _admitted(self, input_path, memory, disk):
+        ''' wait until a job's estimated `memory` and scratch `disk` fit in
+        the budgets, and hold them while the block runs. Jobs of unknown
+        size are let straight through. '''
+        reserved = []
+        try:
+            for budget, amount, kind in [
+                    (self.memory_budget, memory, 'memory'),
+                    (self.disk_budget, disk, 'disk')]:
+                if budget is None or not amount:
+                    continue
+                if budget.try_acquire(amount):
+                    reserved.append((budget, amount))
+                    continue
+                self.logger.info(
+                    'Waiting for {} bytes of {} to convert {}'.format(
+                        amount, kind, input_path))
+                with self.recorder.timed('admission_wait', input_path,
+                                         resource=kind, requested=amount):
+                    budget.acquire(amount)
+                reserved.append((budget, amount))
+            yield
+        finally:
+            for budget, amount in reserved:
+                budget.release(amount)
+
 
 def main(argv=None):
-    pass
+    from ucldc_iiif import batch
+    return batch.main(argv)
 
 
 if __name__ == "__main__":
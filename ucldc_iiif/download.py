@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    download files (e.g. Nuxeo masters) over HTTP quickly and safely:
+
+    - one requests Session, so connections are pooled and reused
+    - responses are streamed in chunks that grow while reads are fast
+      and shrink while they're slow, instead of a fixed tiny size
+    - large files are split into byte ranges fetched over parallel
+      connections, when the server supports Range requests
+    - a checksum is computed as data arrives, and checked against an
+      expected digest if one is given
+    - the number of connections open at once is bounded across all the
+      files being fetched, however they are split
+
+    Files are written to `<path>.part` and renamed when complete.
+'''
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # python 2
+    from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+MB = 1024 * 1024
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 8 * MB
+# grow the chunk size while a read takes less than this many seconds,
+# shrink it while reads take more than SLOW_READ
+FAST_READ = 0.05
+SLOW_READ = 1.0
+# files at least this big are fetched as RANGE_PARTS parallel ranges
+RANGE_THRESHOLD = 64 * MB
+RANGE_PARTS = 4
+MAX_CONNECTIONS = 16
+TIMEOUT = 60
+
+DownloadResult = namedtuple('DownloadResult', [
+    'url', 'path', 'ok', 'bytes', 'digest', 'seconds', 'ranged', 'msg'])
+
+
+class ChecksumMismatch(IOError):
+    ''' the downloaded file doesn't have the expected digest '''
+
+
+def get_download_url(nuxeo_id, nuxeo_path, nx):
+    """ Get object file download URL. We should really put this logic in pynux """
+    parts = urlsplit(nx.conf["api"])
+    filename = nuxeo_path.split('/')[-1]
+    url = '{}://{}/Nuxeo/nxbigfile/default/{}/file:content/{}'.format(parts.scheme, parts.netloc, nuxeo_id, filename)
+
+    return url
+
+
+def _hash_file(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(MAX_CHUNK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Downloader(object):
+    '''
+        downloads files over a shared, pooled Session. Safe to use from
+        several threads; download_many() does so.
+    '''
+
+    def __init__(self, auth=None, workers=4, max_connections=MAX_CONNECTIONS,
+                 range_threshold=RANGE_THRESHOLD, range_parts=RANGE_PARTS,
+                 checksum='md5', timeout=TIMEOUT, retries=3):
+
+        self.logger = logging.getLogger(__name__)
+        self.workers = workers
+        self.range_threshold = range_threshold
+        self.range_parts = range_parts
+        self.checksum = checksum
+        self.timeout = timeout
+        # one slot per open connection, shared by every download
+        self._connections = threading.BoundedSemaphore(max_connections)
+
+        self.session = requests.Session()
+        self.session.auth = auth
+        adapter = HTTPAdapter(
+            pool_connections=max_connections, pool_maxsize=max_connections,
+            max_retries=Retry(total=retries, backoff_factor=1,
+                              status_forcelist=[500, 502, 503, 504]))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def download(self, url, path, expected_digest=None):
+        '''
+        download `url` to `path`. Returns a DownloadResult; raises
+        requests exceptions, IOError, or ChecksumMismatch if the digest
+        isn't `expected_digest`.
+        '''
+        start = time.time()
+        part_path = path + '.part'
+        try:
+            length, ranged = self._probe(url)
+            if ranged and length >= self.range_threshold and \
+                    self.range_parts > 1:
+                digest = self._download_ranges(url, part_path, length)
+            else:
+                ranged = False
+                length, digest = self._download_stream(url, part_path)
+            if expected_digest and digest != expected_digest.lower():
+                raise ChecksumMismatch(
+                    '{} has {} {}, expected {}'.format(
+                        url, self.checksum, digest, expected_digest))
+            os.rename(part_path, path)
+        except Exception:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+
+        seconds = time.time() - start
+        msg = 'Downloaded {} bytes from {} to {} in {:.1f}s{}'.format(
+            length, url, path, seconds,
+            ' ({} ranges)'.format(self.range_parts) if ranged else '')
+        self.logger.info(msg)
+        return DownloadResult(url, path, True, length, digest, seconds,
+                              ranged, msg)
+
+    def _probe(self, url):
+        ''' (content length or None, whether Range requests work) '''
+        with self._connections:
+            res = self.session.head(url, allow_redirects=True,
+                                    timeout=self.timeout)
+        if not res.ok:
+            return None, False
+        length = res.headers.get('Content-Length')
+        length = int(length) if length and length.isdigit() else None
+        ranged = res.headers.get('Accept-Ranges', '').lower() == 'bytes' \
+            and length is not None
+        return length, ranged
+
+    def _copy(self, res, f, digest=None):
+        ''' copy a streamed response body into `f`, adapting the read size
+        to how fast data is arriving. Returns the number of bytes. '''
+        chunk_size = MIN_CHUNK_SIZE
+        total = 0
+        while True:
+            read_start = time.time()
+            block = res.raw.read(chunk_size, decode_content=True)
+            if not block:
+                return total
+            elapsed = time.time() - read_start
+            f.write(block)
+            if digest is not None:
+                digest.update(block)
+            total += len(block)
+            if elapsed < FAST_READ and len(block) == chunk_size:
+                chunk_size = min(chunk_size * 2, MAX_CHUNK_SIZE)
+            elif elapsed > SLOW_READ:
+                chunk_size = max(chunk_size // 2, MIN_CHUNK_SIZE)
+
+    def _download_stream(self, url, part_path):
+        digest = hashlib.new(self.checksum)
+        with self._connections:
+            res = self.session.get(url, stream=True, timeout=self.timeout)
+            try:
+                res.raise_for_status()
+                with open(part_path, 'wb') as f:
+                    length = self._copy(res, f, digest)
+            finally:
+                res.close()
+        return length, digest.hexdigest()
+
+    def _download_ranges(self, url, part_path, length):
+        '''
+        fetch `length` bytes as `range_parts` parallel ranges, each written
+        at its own offset. The checksum is taken over the finished file,
+        while it's still in the page cache.
+        '''
+        with open(part_path, 'wb') as f:
+            f.truncate(length)
+        part_size = (length + self.range_parts - 1) // self.range_parts
+        ranges = [(offset, min(offset + part_size, length) - 1)
+                  for offset in range(0, length, part_size)]
+
+        pool = ThreadPool(len(ranges))
+        try:
+            pool.map(lambda byte_range: self._download_range(
+                url, part_path, *byte_range), ranges)
+        finally:
+            pool.close()
+            pool.join()
+        return _hash_file(part_path, self.checksum)
+
+    def _download_range(self, url, part_path, first, last):
+        with self._connections:
+            res = self.session.get(
+                url, stream=True, timeout=self.timeout,
+                headers={'Range': 'bytes={}-{}'.format(first, last)})
+            try:
+                res.raise_for_status()
+                if res.status_code != 206:
+                    raise IOError('{} ignored the Range header'.format(url))
+                with open(part_path, 'r+b') as f:
+                    f.seek(first)
+                    copied = self._copy(res, f)
+            finally:
+                res.close()
+        if copied != last - first + 1:
+            raise IOError('Got {} bytes of range {}-{} of {}'.format(
+                copied, first, last, url))
+
+    def _download_one(self, job):
+        url, path, expected_digest = job
+        try:
+            return self.download(url, path, expected_digest)
+        except Exception as e:
+            msg = 'Failed to download {} to {}: {!r}'.format(url, path, e)
+            self.logger.error(msg)
+            return DownloadResult(url, path, False, None, None, None, False,
+                                  msg)
+
+    def download_many(self, jobs):
+        '''
+        download (url, path, expected digest or None) jobs, `workers` files
+        at a time. Yields a DownloadResult for each as it finishes.
+        '''
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self._download_one, jobs):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,649 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    estimate what converting a set of images will cost before doing it:
+    cpu hours, how long it will take, the peak scratch disk and memory,
+    the bytes it will add to S3, and how many workers to run.
+
+    - the header of every source is read (local files, or URLs with a few
+      Range requests each), so its dimensions, format and conversion plan
+      are known without downloading it
+    - sources are grouped into strata by mime-type, conversion plan and
+      size class, and a sample is drawn from each stratum, spread over
+      its range of sizes, with more taken from the strata holding the
+      most pixels
+    - the sample is converted for real, with the same options a run
+      would use, and a cost model (cpu and wall seconds, and output
+      bytes, each a + b * pixels) is fitted for each plan
+    - the models are applied to every source; peak memory and scratch
+      disk come from the estimates the conversion admits jobs by (see
+      convert.estimate_job_resources)
+
+    `python -m ucldc_iiif.batch --dry-run ...` and `s3/stash_collection.py
+    --dry-run` estimate a batch or a Nuxeo collection;
+    `python -m ucldc_iiif.estimate` takes paths or URLs.
+'''
+import os
+import sys
+import json
+import zlib
+import struct
+import shutil
+import logging
+import argparse
+import tempfile
+import mimetypes
+from collections import namedtuple, defaultdict
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+from ucldc_iiif import imageinfo, jp2, metrics
+from ucldc_iiif.convert import choose_plan, available_cpus, get_mimetype, \
+    JP2_TYPES, IN_PROCESS_MAX_PIXELS, STRIP_WISE_BYTES
+from ucldc_iiif.download import Downloader, TIMEOUT
+from ucldc_iiif.workspace import parse_size
+
+SAMPLE_SIZE = 30
+HEADER_WORKERS = 16
+# bytes fetched per Range request when reading a remote header
+BLOCK_SIZE = 64 * 1024
+# upper bounds, in megapixels, of the size classes sources are grouped by
+SIZE_CLASSES = [(4, 'small'), (16, 'medium'), (64, 'large')]
+HUGE = 'huge'
+# bytes per pixel assumed for sources whose headers can't be read, if
+# no other source of their type has a header to go by
+BYTES_PER_PIXEL = 3.0
+
+# a source to convert: its path or URL, mime-type, size, header
+# (imageinfo.ImageInfo, or None) and conversion plan, with the pixels,
+# peak memory and scratch disk that implies, and the stratum and model
+# it belongs to
+Source = namedtuple('Source', [
+    'source', 'mimetype', 'bytes', 'info', 'plan', 'pixels', 'memory',
+    'disk', 'stratum', 'model'])
+
+# how converting a sampled Source went
+Measurement = namedtuple('Measurement', [
+    'source', 'ok', 'wall', 'cpu', 'output_bytes', 'download_seconds'])
+
+
+def is_url(source):
+    return source.startswith('http://') or source.startswith('https://')
+
+
+class RangedFile(object):
+    '''
+        a read-only, seekable file over HTTP, fetching `block_size` blocks
+        with Range requests as they're read, so an image header can be
+        parsed without downloading the image
+    '''
+
+    def __init__(self, url, session, block_size=BLOCK_SIZE, timeout=TIMEOUT):
+        self.url = url
+        self.session = session
+        self.block_size = block_size
+        self.timeout = timeout
+        self.blocks = {}
+        self.size = None
+        self.position = 0
+
+    def _block(self, index):
+        if index not in self.blocks:
+            start = index * self.block_size
+            response = self.session.get(
+                self.url, stream=True, timeout=self.timeout,
+                headers={'Range': 'bytes={}-{}'.format(
+                    start, start + self.block_size - 1)})
+            try:
+                response.raise_for_status()
+                if response.status_code == 206:
+                    self.size = int(response.headers['Content-Range']
+                                    .rsplit('/', 1)[1])
+                elif start == 0:
+                    # no Range support: read the start, and no more
+                    self.size = int(response.headers.get('Content-Length')
+                                    or 0) or None
+                else:
+                    raise IOError("{} doesn't support Range requests".format(
+                        self.url))
+                self.blocks[index] = response.raw.read(self.block_size)
+            finally:
+                response.close()
+        return self.blocks[index]
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            if self.size is None:
+                self._block(0)
+            offset += self.size or 0
+        self.position = max(0, offset)
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        if size < 0:
+            if self.size is None:
+                self._block(0)
+            size = max(0, (self.size or 0) - self.position)
+        chunks = []
+        while size > 0:
+            index, offset = divmod(self.position, self.block_size)
+            block = self._block(index)[offset:offset + size]
+            if not block:
+                break
+            chunks.append(block)
+            self.position += len(block)
+            size -= len(block)
+        return b''.join(chunks)
+
+
+def _from_jp2(info):
+    ''' the ImageInfo of a jp2 source, from its Jp2Info '''
+    return imageinfo.ImageInfo(
+        format='jp2', width=info.width, height=info.height,
+        bits_per_sample=info.bits_per_component,
+        samples_per_pixel=info.components, compression=None,
+        photometric=None, planar_config=1, tiled=info.tiles > 1,
+        extra_samples=0, icc_profile=None, orientation=1, palette=False)
+
+
+def read_header(source, mimetype=None, session=None):
+    '''
+    (mime-type, size in bytes, ImageInfo or None) of a local file, or of
+    a URL read a few blocks at a time over `session`
+    '''
+    if not is_url(source):
+        if mimetype is None:
+            mimetype = get_mimetype(source)
+        if mimetype in JP2_TYPES:
+            try:
+                info = _from_jp2(jp2.read_jp2_info_from_file(
+                    source, all_tile_parts=False))
+            except (jp2.Jp2HeaderError, IOError):
+                info = None
+        else:
+            info = imageinfo.read_image_info(source)
+        return mimetype, os.path.getsize(source), info
+
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(source.split('?')[0])[0]
+    f = RangedFile(source, session or requests.Session())
+    if mimetype in JP2_TYPES:
+        def read_range(length):
+            f.seek(0)
+            return f.read(length)
+        try:
+            info = _from_jp2(jp2.read_jp2_info_ranged(read_range))
+        except jp2.Jp2HeaderError:
+            info = None
+    else:
+        try:
+            info = imageinfo.read_image_info_from_file(f)
+        except (IOError, struct.error, ValueError, zlib.error) as e:
+            logging.getLogger(__name__).warning(
+                "Couldn't read image header of {}: {}".format(source, e))
+            info = None
+    return mimetype, f.size, info
+
+
+def size_class(pixels):
+    for megapixels, name in SIZE_CLASSES:
+        if pixels < megapixels * 1000 * 1000:
+            return name
+    return HUGE
+
+
+def describe(source, mimetype, size, info,
+             in_process_max_pixels=IN_PROCESS_MAX_PIXELS,
+             strip_wise_bytes=STRIP_WISE_BYTES, bytes_per_pixel=None):
+    '''
+    a Source, with the plan Convert would choose for it. The pixels of a
+    source without a header are guessed from its size at
+    `bytes_per_pixel`.
+    '''
+    plan, memory, disk, strip_wise = choose_plan(
+        mimetype, info, in_process_max_pixels, strip_wise_bytes)
+    if info is not None and imageinfo.pixels(info):
+        pixels = imageinfo.pixels(info)
+    else:
+        pixels = int((size or 0) / (bytes_per_pixel or BYTES_PER_PIXEL))
+    model = '{} [{}]'.format(mimetype, ', '.join(
+        [method.lstrip('_') for method, filename in plan] or ['none']))
+    stratum = '{}: {}'.format(size_class(pixels) if info is not None
+                              else 'no header', model)
+    return Source(source, mimetype, size, info, plan, pixels, memory, disk,
+                  stratum, model)
+
+
+def choose_sample(sources, sample_size=SAMPLE_SIZE):
+    '''
+    at least one source from each stratum, and the rest shared out in
+    proportion to the strata's pixels; each stratum's picks are spread
+    evenly over it, from smallest to largest
+    '''
+    strata = defaultdict(list)
+    for source in sources:
+        strata[source.stratum].append(source)
+    total_pixels = float(sum(source.pixels for source in sources)) or 1.0
+    spare = max(0, sample_size - len(strata))
+    sample = []
+    for name in sorted(strata):
+        members = sorted(strata[name], key=lambda source: source.pixels)
+        share = sum(source.pixels for source in members) / total_pixels
+        count = min(len(members), 1 + int(round(spare * share)))
+        if count == 1:
+            picks = [len(members) // 2]
+        else:
+            picks = sorted(set(int(round(i * (len(members) - 1.0) /
+                                         (count - 1)))
+                               for i in range(count)))
+        sample.extend(members[i] for i in picks)
+    return sample
+
+
+def fit_linear(xs, ys):
+    '''
+    least-squares (intercept, slope) of ys against xs, kept non-negative:
+    through the origin if the intercept would be negative, or there's
+    only one distinct x
+    '''
+    n = len(xs)
+    if not n:
+        return 0.0, 0.0
+    mean_x = sum(xs) / float(n)
+    mean_y = sum(ys) / float(n)
+    spread = sum((x - mean_x) ** 2 for x in xs)
+    if spread:
+        slope = sum((x - mean_x) * (y - mean_y)
+                    for x, y in zip(xs, ys)) / spread
+        intercept = mean_y - slope * mean_x
+        if slope >= 0 and intercept >= 0:
+            return intercept, slope
+    squares = sum(x * x for x in xs)
+    if not squares:
+        return mean_y, 0.0
+    return 0.0, max(0.0, sum(x * y for x, y in zip(xs, ys)) / float(squares))
+
+
+def _top_sum(values, n):
+    return sum(sorted(values, reverse=True)[:n])
+
+
+def _workers_within(values, limit, most):
+    ''' the most workers (up to `most`) whose biggest jobs, run at once,
+    fit within `limit` '''
+    values = sorted(values, reverse=True)
+    workers = 1
+    while workers < most and sum(values[:workers + 1]) <= limit:
+        workers += 1
+    return workers
+
+
+def physical_memory():
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def free_disk(path):
+    try:
+        stat = os.statvfs(path)
+    except (OSError, AttributeError):
+        return None
+    return stat.f_bavail * stat.f_frsize
+
+
+class Estimator(object):
+    '''
+        estimates the cost of converting a set of sources by converting a
+        sample of them. `convert_options` are passed on to
+        ucldc_iiif.batch.convert_batch for the sample, so it runs the way
+        the real run would; `auth` is used to fetch URLs.
+    '''
+
+    def __init__(self, sample_size=SAMPLE_SIZE, sample_workers=1,
+                 header_workers=HEADER_WORKERS, auth=None, tmp_dir=None,
+                 convert_options=None):
+
+        self.logger = logging.getLogger(__name__)
+        self.sample_size = sample_size
+        # samples are converted one at a time by default, so each one's
+        # timings are its own
+        self.sample_workers = sample_workers
+        self.header_workers = header_workers
+        self.auth = auth
+        self.tmp_dir = tmp_dir
+        self.convert_options = convert_options or {}
+        self.session = requests.Session()
+        self.session.auth = auth
+
+    def read_sources(self, items):
+        ''' Sources for (path or URL, mime-type or None) items, reading
+        their headers in parallel '''
+        def read(item):
+            source, mimetype = item
+            try:
+                return (source,) + read_header(source, mimetype,
+                                               self.session)
+            except Exception as e:
+                self.logger.warning("Couldn't read the header of {}: "
+                                    "{!r}".format(source, e))
+                return source, mimetype, None, None
+
+        items = list(items)
+        pool = ThreadPool(max(1, min(self.header_workers, len(items))))
+        try:
+            headers = pool.map(read, items)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+        # bytes per pixel of each type, for sources without a header
+        ratios = defaultdict(list)
+        for source, mimetype, size, info in headers:
+            if info is not None and size and imageinfo.pixels(info):
+                ratios[mimetype].append(size / float(imageinfo.pixels(info)))
+        options = dict(
+            in_process_max_pixels=self.convert_options.get(
+                'in_process_max_pixels', IN_PROCESS_MAX_PIXELS),
+            strip_wise_bytes=self.convert_options.get(
+                'strip_wise_bytes', STRIP_WISE_BYTES))
+        sources = []
+        for source, mimetype, size, info in headers:
+            known = sorted(ratios.get(mimetype, []))
+            sources.append(describe(
+                source, mimetype, size, info,
+                bytes_per_pixel=known[len(known) // 2] if known else None,
+                **options))
+        return sources
+
+    def measure(self, sample):
+        ''' convert the sampled Sources, returning a Measurement of each '''
+        from ucldc_iiif import batch
+
+        work_dir = tempfile.mkdtemp(prefix='ucldc-iiif-estimate-',
+                                    dir=self.tmp_dir)
+        try:
+            downloads = {}
+            by_input = {}
+            jobs = []
+            measurements = []
+            downloader = None
+            for i, source in enumerate(sample):
+                input_path = source.source
+                if is_url(input_path):
+                    downloader = downloader or Downloader(auth=self.auth)
+                    input_path = os.path.join(work_dir, 'source{}{}'.format(
+                        i, os.path.splitext(source.source.split('?')[0])[1]))
+                    try:
+                        result = downloader.download(source.source,
+                                                     input_path)
+                    except Exception as e:
+                        self.logger.warning('Sample download of {} failed: '
+                                            '{!r}'.format(source.source, e))
+                        measurements.append(Measurement(
+                            source, False, None, None, None, None))
+                        continue
+                    downloads[input_path] = result.seconds
+                by_input[input_path] = source
+                jobs.append((input_path,
+                             os.path.join(work_dir, 'output{}.jp2'.format(i)),
+                             source.mimetype))
+            for result in batch.convert_batch(
+                    jobs, workers=self.sample_workers,
+                    tmp_root=work_dir, **self.convert_options):
+                job = [record for record in result.metrics
+                       if record['stage'] == metrics.JOB_STAGE]
+                ok = result.status == batch.CONVERTED and bool(job)
+                if not ok:
+                    self.logger.warning('Sample conversion of {} failed: '
+                                        '{}'.format(result.input, result.msg))
+                measurements.append(Measurement(
+                    by_input[result.input], ok,
+                    job[0]['wall'] if job else None,
+                    (job[0]['user'] or 0) + (job[0]['sys'] or 0)
+                    if job else None,
+                    os.path.getsize(result.output) if ok else None,
+                    downloads.get(result.input)))
+                if ok:
+                    os.remove(result.output)
+            return measurements
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def estimate(self, items, cpus=None, memory_limit=None,
+                 disk_limit=None):
+        '''
+        estimate converting (path or URL, mime-type or None) items on a
+        machine with `cpus` cpus, `memory_limit` bytes of memory and
+        `disk_limit` bytes of scratch disk (by default, this one's).
+        Returns a dict.
+        '''
+        sources = self.read_sources(items)
+        if not sources:
+            raise ValueError('nothing to estimate')
+        sample = choose_sample(sources, self.sample_size)
+        self.logger.info('Converting a sample of {} of {} sources'.format(
+            len(sample), len(sources)))
+        measurements = self.measure(sample)
+        return project(sources, measurements, cpus=cpus,
+                       memory_limit=memory_limit, disk_limit=disk_limit,
+                       tmp_dir=self.tmp_dir or tempfile.gettempdir())
+
+
+def fit_models(measurements):
+    '''
+    {model: (cpu, wall, output bytes) fits} for each conversion plan with
+    a working sample, plus one under None fitted to all of them
+    '''
+    groups = defaultdict(list)
+    for measurement in measurements:
+        if measurement.ok:
+            groups[measurement.source.model].append(measurement)
+            groups[None].append(measurement)
+    models = {}
+    for model, group in groups.items():
+        pixels = [float(m.source.pixels) for m in group]
+        models[model] = tuple(
+            fit_linear(pixels, [float(getattr(m, field)) for m in group])
+            for field in ('cpu', 'wall', 'output_bytes'))
+    return models
+
+
+def _predict(fit, pixels):
+    intercept, slope = fit
+    return intercept + slope * pixels
+
+
+def project(sources, measurements, cpus=None, memory_limit=None,
+            disk_limit=None, tmp_dir=None):
+    ''' apply cost models fitted to the Measurements of a sample to all
+    the Sources, and work out how many workers a run could use '''
+    models = fit_models(measurements)
+    if None not in models:
+        raise ValueError('none of the sample conversions worked')
+    cpus = cpus or available_cpus()
+    memory_limit = memory_limit or physical_memory()
+    disk_limit = disk_limit or free_disk(tmp_dir or tempfile.gettempdir())
+
+    strata = defaultdict(lambda: defaultdict(float))
+    cpu_total = wall_total = output_total = 0.0
+    longest = 0.0
+    for source in sources:
+        cpu, wall, output = models.get(source.model, models[None])
+        cpu = _predict(cpu, source.pixels)
+        wall = _predict(wall, source.pixels)
+        output = _predict(output, source.pixels)
+        cpu_total += cpu
+        wall_total += wall
+        output_total += output
+        longest = max(longest, wall)
+        stratum = strata[source.stratum]
+        stratum['sources'] += 1
+        stratum['megapixels'] += source.pixels / 1e6
+        stratum['input_bytes'] += source.bytes or 0
+        stratum['cpu_hours'] += cpu / 3600.0
+        stratum['output_bytes'] += output
+    for measurement in measurements:
+        stratum = strata[measurement.source.stratum]
+        stratum['sampled'] += 1
+        stratum['sample_failures'] += 0 if measurement.ok else 1
+
+    memories = [source.memory for source in sources if source.memory]
+    disks = [source.disk for source in sources if source.disk]
+    workers = min(cpus, len(sources))
+    limits = {'cpus': workers}
+    if memory_limit and memories:
+        limits['memory'] = _workers_within(memories, memory_limit, workers)
+    if disk_limit and disks:
+        limits['disk'] = _workers_within(disks, disk_limit, workers)
+    workers = min(limits.values())
+
+    failures = len([m for m in measurements if not m.ok])
+    downloads = [m for m in measurements if m.download_seconds]
+    input_bytes = sum(source.bytes or 0 for source in sources)
+    estimate = {
+        'sources': len(sources),
+        'no_header': len([s for s in sources if s.info is None]),
+        'sampled': len(measurements),
+        'sample_failures': failures,
+        'input_bytes': input_bytes,
+        'megapixels': sum(source.pixels for source in sources) / 1e6,
+        'cpu_hours': cpu_total / 3600.0,
+        'output_bytes': output_total,
+        'cpus': cpus,
+        'memory_limit': memory_limit,
+        'disk_limit': disk_limit,
+        'recommended_workers': workers,
+        'workers_limited_by': dict(limits),
+        # cpu-bound, unless a few long jobs take longer than the rest
+        'hours': max(cpu_total / cpus, wall_total / workers,
+                     longest) / 3600.0,
+        'peak_memory': _top_sum(memories, workers),
+        'peak_scratch': _top_sum(disks, workers),
+        'strata': dict((name, dict(values))
+                       for name, values in strata.items()),
+        'models': dict((model or 'all', {
+            'cpu_seconds': list(fits[0]), 'wall_seconds': list(fits[1]),
+            'output_bytes': list(fits[2])})
+            for model, fits in models.items()),
+    }
+    if downloads:
+        # one stream at a time, at the rate the sample came down
+        rate = sum(m.source.bytes or 0 for m in downloads) / sum(
+            m.download_seconds for m in downloads)
+        estimate['download_hours'] = (input_bytes / rate / 3600.0
+                                      if rate else None)
+    return estimate
+
+
+def _gb(n):
+    return (n or 0) / 1024.0 / 1024.0 / 1024.0
+
+
+def format_estimate(estimate):
+    lines = [
+        '{sources} sources ({no_header} without a readable header), '
+        '{megapixels:.0f} megapixels; converted a sample of {sampled} '
+        '({sample_failures} failed)'.format(**estimate),
+        '',
+        '{:<60} {:>7} {:>7} {:>9} {:>9} {:>9}'.format(
+            'stratum', 'sources', 'sampled', 'input GB', 'cpu h',
+            'output GB')]
+    for name in sorted(estimate['strata']):
+        stratum = estimate['strata'][name]
+        lines.append('{:<60} {:>7.0f} {:>7.0f} {:>9.2f} {:>9.2f} '
+                     '{:>9.2f}'.format(
+                         name[:60], stratum.get('sources', 0),
+                         stratum.get('sampled', 0),
+                         _gb(stratum.get('input_bytes')),
+                         stratum.get('cpu_hours', 0),
+                         _gb(stratum.get('output_bytes'))))
+    lines.extend([
+        '',
+        'cpu hours:            {:.1f}'.format(estimate['cpu_hours']),
+        'input:                {:.2f} GB'.format(
+            _gb(estimate['input_bytes'])),
+        'output (added to S3): {:.2f} GB'.format(
+            _gb(estimate['output_bytes'])),
+        'recommended workers:  {} (limits: {})'.format(
+            estimate['recommended_workers'], ', '.join(
+                '{} {}'.format(name, limit) for name, limit in
+                sorted(estimate['workers_limited_by'].items()))),
+        'with {} cpus:          {:.1f} hours'.format(
+            estimate['cpus'], estimate['hours']),
+        'peak memory:          {:.2f} GB'.format(
+            _gb(estimate['peak_memory'])),
+        'peak scratch disk:    {:.2f} GB'.format(
+            _gb(estimate['peak_scratch'])),
+    ])
+    if estimate.get('download_hours') is not None:
+        lines.append('download, one stream: {:.1f} hours'.format(
+            estimate['download_hours']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='estimate the cost of converting images to jp2, from '
+        'their headers and a converted sample')
+    parser.add_argument('sources', nargs='*', help="image files or URLs")
+    parser.add_argument('--manifest', help="manifest of jobs, as for "
+                        "ucldc_iiif.batch; only the inputs and mime-types "
+                        "are used")
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE,
+                        help="sources to convert for real")
+    parser.add_argument('--sample-workers', type=int, default=1,
+                        help="sample conversions to run at once")
+    parser.add_argument('--cpus', type=int, default=None,
+                        help="cpus of the machine to plan for (default: "
+                        "this one's)")
+    parser.add_argument('--memory-limit', type=parse_size, default=None,
+                        help="memory of the machine to plan for, e.g. 16G "
+                        "(default: this one's)")
+    parser.add_argument('--disk-limit', type=parse_size, default=None,
+                        help="scratch disk of the machine to plan for "
+                        "(default: free space in --tmp-dir)")
+    parser.add_argument('--tmp-dir', default=None)
+    parser.add_argument('--json', default=None,
+                        help="also write the estimate to this file")
+    parser.add_argument('--loglevel', default='WARNING')
+    argv = parser.parse_args(argv)
+
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(
+        level=numeric_level,
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    items = [(source, None) for source in argv.sources]
+    if argv.manifest:
+        from ucldc_iiif.batch import read_manifest
+        items.extend((input_path, mimetype) for input_path, _, mimetype
+                     in read_manifest(argv.manifest))
+    if not items:
+        parser.error('no sources given')
+
+    estimator = Estimator(sample_size=argv.sample_size,
+                          sample_workers=argv.sample_workers,
+                          tmp_dir=argv.tmp_dir)
+    estimate = estimator.estimate(items, cpus=argv.cpus,
+                                  memory_limit=argv.memory_limit,
+                                  disk_limit=argv.disk_limit)
+    print(format_estimate(estimate))
+    if argv.json:
+        with open(argv.json, 'w') as f:
+            json.dump(estimate, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    the multipart settings jp2s are uploaded to S3 with, and the ETags
+    S3 gives them, so an object can be checked against a local file
+    without downloading it.
+
+    Kept free of boto, so both ucldc_iiif.upload (boto) and the scripts
+    using boto3 can share it.
+'''
+import os
+import hashlib
+
+MB = 1024 * 1024
+MULTIPART_THRESHOLD = 8 * MB
+PART_SIZE = 8 * MB
+# S3's limits
+MIN_PART_SIZE = 5 * MB
+MAX_PARTS = 10000
+# the biggest object a single copy request can copy
+MAX_COPY_SIZE = 5 * 1024 * MB
+PART_WORKERS = 4
+CONTENT_TYPE = 'image/jp2'
+
+
+def part_size_for(size, part_size=PART_SIZE):
+    ''' the part size to upload a file of `size` bytes with: `part_size`,
+    or the smallest whole number of MB that needs no more than MAX_PARTS
+    parts '''
+    least = (size + MAX_PARTS - 1) // MAX_PARTS
+    least = (least + MB - 1) // MB * MB
+    return max(part_size, least, MIN_PART_SIZE)
+
+
+def s3_etag(path, part_size=PART_SIZE,
+            multipart_threshold=MULTIPART_THRESHOLD):
+    '''
+    the ETag S3 gives a file uploaded with these settings: the md5 of
+    the file, or for a multipart upload the md5 of the parts' md5s
+    followed by '-' and the number of parts
+    '''
+    size = os.path.getsize(path)
+    if size < multipart_threshold:
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(PART_SIZE), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    part_size = part_size_for(size, part_size)
+    digests = []
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(part_size), b''):
+            digests.append(hashlib.md5(block).digest())
+    return '{}-{}'.format(hashlib.md5(b''.join(digests)).hexdigest(),
+                          len(digests))
+
+
+def etag_matches(path, size, etag, part_size=PART_SIZE):
+    '''
+    whether the local file at `path` has the `size` and `etag` of an
+    object on S3. A multipart ETag is checked with our part size, and
+    with the likely part sizes that give the object's number of parts.
+    '''
+    etag = etag.strip('"')
+    local_size = os.path.getsize(path)
+    if local_size != size:
+        return False
+    if '-' not in etag:
+        return s3_etag(path, multipart_threshold=local_size + 1) == etag
+
+    parts = int(etag.rsplit('-', 1)[1])
+    least = (local_size + parts - 1) // parts
+    candidates = set([part_size_for(local_size, part_size),
+                      (least + MB - 1) // MB * MB])
+    # tools mostly use a power of two MB
+    power = MB
+    while power < least:
+        power *= 2
+    candidates.add(power)
+    for candidate in sorted(candidates):
+        if (local_size + candidate - 1) // candidate != parts:
+            continue
+        if s3_etag(path, part_size=candidate,
+                   multipart_threshold=0) == etag:
+            return True
+    return False
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    read basic image metadata (dimensions, bit depth, compression, color
+    space, embedded ICC profile, orientation) straight from TIFF, JPEG,
+    PNG and GIF headers, without decoding any pixels.
+'''
+import struct
+import zlib
+import logging
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+ImageInfo = namedtuple('ImageInfo', [
+    'format', 'width', 'height', 'bits_per_sample', 'samples_per_pixel',
+    'compression', 'photometric', 'planar_config', 'tiled', 'extra_samples',
+    'icc_profile', 'orientation', 'palette'
+])
+
+_DEFAULTS = dict(
+    format=None, width=0, height=0, bits_per_sample=8, samples_per_pixel=1,
+    compression=None, photometric=None, planar_config=1, tiled=False,
+    extra_samples=0, icc_profile=None, orientation=1, palette=False)
+
+# TIFF tags and values we care about
+TIFF_COMPRESSION_NONE = 1
+PHOTOMETRIC_MINISWHITE = 0
+PHOTOMETRIC_MINISBLACK = 1
+PHOTOMETRIC_RGB = 2
+PHOTOMETRIC_PALETTE = 3
+
+_TIFF_TAGS = {
+    256: 'width',
+    257: 'height',
+    258: 'bits_per_sample',
+    259: 'compression',
+    262: 'photometric',
+    274: 'orientation',
+    277: 'samples_per_pixel',
+    284: 'planar_config',
+    322: 'tile_width',
+    338: 'extra_samples',
+    34675: 'icc_profile',
+}
+
+# TIFF field type: (struct format char, size in bytes)
+_TIFF_TYPES = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('c', 1), 8: ('h', 2), 9: ('i', 4), 16: ('Q', 8),
+}
+
+
+def _make_info(**fields):
+    info = dict(_DEFAULTS)
+    info.update(fields)
+    return ImageInfo(**info)
+
+
+def pixels(info):
+    ''' number of pixels in the image '''
+    return info.width * info.height
+
+
+def uncompressed_bytes(info):
+    ''' size of the full uncompressed raster, as written to an
+    intermediate TIFF '''
+    bytes_per_sample = (info.bits_per_sample + 7) // 8
+    return pixels(info) * info.samples_per_pixel * bytes_per_sample
+
+
+def is_srgb_profile(icc_profile):
+    ''' True if an embedded ICC profile looks like an sRGB profile '''
+    return icc_profile is not None and b'sRGB' in icc_profile
+
+
+def read_image_info(path):
+    '''
+    read an ImageInfo from the header of the image at `path`. Returns None
+    if the format isn't recognized or the header can't be parsed.
+    '''
+    try:
+        with open(path, 'rb') as f:
+            return read_image_info_from_file(f)
+    except (IOError, OSError, struct.error, ValueError, zlib.error) as e:
+        logger.warning("Couldn't read image header of {}: {}".format(path, e))
+        return None
+
+
+def read_image_info_from_file(f):
+    ''' as read_image_info(), from a seekable file object '''
+    magic = f.read(8)
+    f.seek(0)
+    if magic[:4] in (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+'):
+        return _read_tiff(f)
+    if magic[:2] == b'\xff\xd8':
+        return _read_jpeg(f)
+    if magic == b'\x89PNG\r\n\x1a\n':
+        return _read_png(f)
+    if magic[:4] == b'GIF8':
+        return _read_gif(f)
+    return None
+
+
+def _read_tiff_ifd(f, base=0):
+    '''
+    read the first IFD of a TIFF (or of a TIFF structure embedded at
+    `base`, as in EXIF) and return a dict of the tags in _TIFF_TAGS
+    '''
+    f.seek(base)
+    header = f.read(8)
+    endian = '<' if header[:2] == b'II' else '>'
+    version, = struct.unpack(endian + 'H', header[2:4])
+    bigtiff = version == 43
+    if bigtiff:
+        header += f.read(8)
+        ifd_offset, = struct.unpack(endian + 'Q', header[8:16])
+        count_fmt, offset_fmt, entry_size, value_size = 'Q', 'Q', 20, 8
+    else:
+        ifd_offset, = struct.unpack(endian + 'I', header[4:8])
+        count_fmt, offset_fmt, entry_size, value_size = 'H', 'I', 12, 4
+
+    f.seek(base + ifd_offset)
+    count_size = struct.calcsize(count_fmt)
+    num_entries, = struct.unpack(endian + count_fmt, f.read(count_size))
+    entries = f.read(num_entries * entry_size)
+
+    tags = {}
+    for i in range(num_entries):
+        entry = entries[i * entry_size:(i + 1) * entry_size]
+        tag, field_type = struct.unpack(endian + 'HH', entry[:4])
+        if tag not in _TIFF_TAGS or field_type not in _TIFF_TYPES:
+            continue
+        count, = struct.unpack(endian + offset_fmt,
+                               entry[4:4 + value_size])
+        fmt, size = _TIFF_TYPES[field_type]
+        total = size * count
+        raw = entry[4 + value_size:]
+        if total > value_size:
+            value_offset, = struct.unpack(endian + offset_fmt, raw)
+            here = f.tell()
+            f.seek(base + value_offset)
+            raw = f.read(total)
+            f.seek(here)
+        raw = raw[:total]
+        name = _TIFF_TAGS[tag]
+        if name == 'icc_profile':
+            tags[name] = raw
+        else:
+            values = struct.unpack(endian + fmt * count, raw)
+            tags[name] = values if count > 1 else values[0]
+    return tags
+
+
+def _read_tiff(f):
+    tags = _read_tiff_ifd(f)
+    bits = tags.get('bits_per_sample', 1)
+    if isinstance(bits, tuple):
+        bits = max(bits)
+    extra = tags.get('extra_samples', ())
+    if not isinstance(extra, tuple):
+        extra = (extra, )
+    photometric = tags.get('photometric')
+    return _make_info(
+        format='tiff',
+        width=tags.get('width', 0),
+        height=tags.get('height', 0),
+        bits_per_sample=bits,
+        samples_per_pixel=tags.get('samples_per_pixel', 1),
+        compression=tags.get('compression', TIFF_COMPRESSION_NONE),
+        photometric=photometric,
+        planar_config=tags.get('planar_config', 1),
+        tiled='tile_width' in tags,
+        extra_samples=len(extra),
+        icc_profile=tags.get('icc_profile'),
+        orientation=tags.get('orientation', 1),
+        palette=photometric == PHOTOMETRIC_PALETTE)
+
+
+def _read_jpeg(f):
+    f.seek(2)
+    fields = dict(format='jpeg')
+    icc_chunks = {}
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            break
+        code = ord(marker[1:2])
+        if code == 0xd9 or code == 0xda:  # EOI / start of scan
+            break
+        if 0xd0 <= code <= 0xd7 or code == 0x01:  # no length
+            continue
+        length, = struct.unpack('>H', f.read(2))
+        segment_start = f.tell()
+        if code in (0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7, 0xc9, 0xca,
+                    0xcb, 0xcd, 0xce, 0xcf):
+            precision, height, width, components = struct.unpack(
+                '>BHHB', f.read(6))
+            fields.update(bits_per_sample=precision, height=height,
+                          width=width, samples_per_pixel=components)
+        elif code == 0xe1:
+            data = f.read(6)
+            if data == b'Exif\x00\x00':
+                exif = _read_tiff_ifd(f, base=segment_start + 6)
+                if 'orientation' in exif:
+                    fields['orientation'] = exif['orientation']
+        elif code == 0xe2:
+            data = f.read(length - 2)
+            if data.startswith(b'ICC_PROFILE\x00'):
+                icc_chunks[ord(data[12:13])] = data[14:]
+        f.seek(segment_start + length - 2)
+    if icc_chunks:
+        fields['icc_profile'] = b''.join(
+            icc_chunks[i] for i in sorted(icc_chunks))
+    return _make_info(**fields)
+
+
+def _read_png(f):
+    f.seek(8)
+    fields = dict(format='png')
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            break
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type == b'IHDR':
+            width, height, depth, color_type = struct.unpack(
+                '>IIBB', f.read(10))
+            samples = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}.get(color_type, 3)
+            fields.update(width=width, height=height, bits_per_sample=depth,
+                          samples_per_pixel=samples,
+                          extra_samples=1 if color_type in (4, 6) else 0,
+                          palette=color_type == 3)
+            f.seek(length - 10 + 4, 1)
+        elif chunk_type == b'iCCP':
+            data = f.read(length)
+            name, rest = data.split(b'\x00', 1)
+            fields['icc_profile'] = zlib.decompress(rest[1:])
+            f.seek(4, 1)
+        elif chunk_type == b'IDAT':
+            break
+        else:
+            f.seek(length + 4, 1)
+    return _make_info(**fields)
+
+
+def _read_gif(f):
+    f.seek(6)
+    width, height = struct.unpack('<HH', f.read(4))
+    return _make_info(format='gif', width=width, height=height,
+                      palette=True)
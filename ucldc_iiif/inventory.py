@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    list the objects in an S3 bucket, or under a prefix, quickly: the
+    keyspace is split into ranges that are listed in parallel, each
+    thread with its own connection.
+
+    A Snapshot keeps the listing on disk, one sorted file per range, and
+    refreshes only the ranges that are older than a given age. S3 has no
+    change feed, so a refresh relists a range, but only the differences
+    (keys added, removed or changed) are written to a delta log; that log
+    and the snapshot's totals feed capacity planning.
+
+    Snapshot layout:
+        state.json          bucketpath, ranges, when each was listed
+        shards/NNNN.tsv     key, size, etag, last modified; sorted
+        deltas.jsonl        one line per key added, removed or changed
+'''
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from boto import connect_s3
+from boto.s3.connection import OrdinaryCallingFormat
+
+logger = logging.getLogger(__name__)
+
+InventoryItem = namedtuple('InventoryItem',
+                           ['key', 'size', 'etag', 'last_modified'])
+
+# the keyspace after the prefix is split at these strings. Our keys
+# are mostly Nuxeo uids (hex), but any key falls in exactly one range.
+SHARD_BOUNDARIES = '123456789abcdef'
+DEFAULT_WORKERS = 16
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+_local = threading.local()
+
+
+def split_bucketpath(bucketpath):
+    ''' 'bucket/some/prefix' -> ('bucket', 'some/prefix/') '''
+    bucketpath = bucketpath.strip('/')
+    bucket, sep, prefix = bucketpath.partition('/')
+    return bucket, prefix + '/' if prefix else ''
+
+
+def object_key(bucketpath, name):
+    ''' the key for `name` (e.g. a Nuxeo uid) under a bucketpath '''
+    return split_bucketpath(bucketpath)[1] + name
+
+
+def hex_boundaries(digits=2):
+    ''' boundaries splitting hex keys into 16 ** `digits` ranges '''
+    return ['{:0{}x}'.format(i, digits) for i in range(1, 16 ** digits)]
+
+
+def thread_bucket(bucket_name):
+    ''' a connection to the bucket for the current thread, reused for all
+    the requests the thread makes '''
+    buckets = getattr(_local, 'buckets', None)
+    if buckets is None:
+        buckets = _local.buckets = {}
+    if bucket_name not in buckets:
+        conn = connect_s3(calling_format=OrdinaryCallingFormat())
+        buckets[bucket_name] = conn.get_bucket(bucket_name, validate=False)
+    return buckets[bucket_name]
+
+
+def shard_ranges(prefix='', boundaries=SHARD_BOUNDARIES):
+    '''
+    split the keys under `prefix` into (after, upto) ranges, holding the
+    keys k with after < k <= upto. `after` None is the start of the
+    prefix and `upto` None the end, so together the ranges cover every
+    key exactly once.
+    '''
+    points = [None] + [prefix + char for char in sorted(boundaries)] + [None]
+    return list(zip(points[:-1], points[1:]))
+
+
+def list_range(bucket_name, prefix, after=None, upto=None):
+    ''' list of InventoryItems for the keys under `prefix` in the range
+    after < key <= upto '''
+    bucket = thread_bucket(bucket_name)
+    items = []
+    for key in bucket.list(prefix=prefix, marker=after or ''):
+        if upto is not None and key.name > upto:
+            break
+        items.append(InventoryItem(key.name, int(key.size),
+                                   key.etag.strip('"'), key.last_modified))
+    return items
+
+
+def list_inventory(bucketpath, workers=DEFAULT_WORKERS,
+                   boundaries=SHARD_BOUNDARIES):
+    ''' sorted list of InventoryItems for everything under a bucketpath
+    ('bucket' or 'bucket/prefix'), listed with `workers` threads '''
+    bucket_name, prefix = split_bucketpath(bucketpath)
+    ranges = shard_ranges(prefix, boundaries)
+    start = time.time()
+    pool = ThreadPool(min(workers, len(ranges)))
+    try:
+        shards = pool.map(
+            lambda key_range: list_range(bucket_name, prefix, *key_range),
+            ranges)
+    finally:
+        pool.close()
+        pool.join()
+    items = [item for shard in shards for item in shard]
+    logger.info('Listed {} objects under {} in {:.1f}s'.format(
+        len(items), bucketpath, time.time() - start))
+    return items
+
+
+def _write_atomic(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        write(f)
+    os.rename(tmp_path, path)
+
+
+def save_items(items, path):
+    ''' write InventoryItems as a sorted, tab-separated file '''
+    def write(f):
+        for item in sorted(items):
+            f.write('\t'.join([item.key, str(item.size), item.etag,
+                               item.last_modified]) + '\n')
+    _write_atomic(path, write)
+
+
+def load_items(path):
+    ''' read the InventoryItems back from a file written by save_items '''
+    items = []
+    with open(path) as f:
+        for line in f:
+            key, size, etag, last_modified = line.rstrip('\n').split('\t')
+            items.append(InventoryItem(key, int(size), etag, last_modified))
+    return items
+
+
+def diff_items(old, new):
+    ''' (change, new or removed item, old size) for the differences
+    between two lists of InventoryItems for the same range '''
+    old = dict((item.key, item) for item in old)
+    changes = []
+    for item in new:
+        before = old.pop(item.key, None)
+        if before is None:
+            changes.append((ADDED, item, 0))
+        elif before.etag != item.etag or before.size != item.size:
+            changes.append((CHANGED, item, before.size))
+    for item in old.values():
+        changes.append((REMOVED, item, item.size))
+    return sorted(changes, key=lambda change: change[1].key)
+
+
+class Snapshot(object):
+    '''
+        an on-disk inventory of everything under a bucketpath, split into
+        ranges (see shard_ranges) that are listed and refreshed
+        independently
+    '''
+
+    def __init__(self, snapshot_dir, bucketpath, boundaries=None):
+        self.logger = logging.getLogger(__name__)
+        self.dir = snapshot_dir
+        self.bucketpath = bucketpath
+        self.bucket_name, self.prefix = split_bucketpath(bucketpath)
+        boundaries = list(boundaries or hex_boundaries())
+        shards_dir = os.path.join(self.dir, 'shards')
+        if not os.path.isdir(shards_dir):
+            os.makedirs(shards_dir)
+
+        self.state = self._load_state()
+        if (self.state is None or
+                self.state['bucketpath'] != bucketpath or
+                self.state['boundaries'] != boundaries):
+            if self.state is not None:
+                self.logger.warning(
+                    'Snapshot {} was for different ranges of {}; starting '
+                    'again'.format(self.dir, self.state['bucketpath']))
+            self.state = {
+                'bucketpath': bucketpath,
+                'boundaries': boundaries,
+                'shards': [{'after': after, 'upto': upto, 'listed': None,
+                            'count': 0, 'bytes': 0}
+                           for after, upto in shard_ranges(self.prefix,
+                                                           boundaries)],
+            }
+
+    def _state_path(self):
+        return os.path.join(self.dir, 'state.json')
+
+    def _shard_path(self, number):
+        return os.path.join(self.dir, 'shards', '{:04d}.tsv'.format(number))
+
+    def _load_state(self):
+        try:
+            with open(self._state_path()) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save_state(self):
+        _write_atomic(self._state_path(),
+                      lambda f: json.dump(self.state, f, indent=1))
+
+    def stale_shards(self, max_age=None):
+        ''' numbers of the ranges never listed, or listed more than
+        `max_age` seconds ago (all of them if `max_age` is None) '''
+        now = time.time()
+        return [number for number, shard in enumerate(self.state['shards'])
+                if shard['listed'] is None or max_age is None or
+                now - shard['listed'] > max_age]
+
+    def _refresh_shard(self, number):
+        shard = self.state['shards'][number]
+        listed = time.time()
+        items = list_range(self.bucket_name, self.prefix, shard['after'],
+                           shard['upto'])
+        path = self._shard_path(number)
+        changes = []
+        if shard['listed'] is not None and os.path.exists(path):
+            changes = diff_items(load_items(path), items)
+        if changes or shard['listed'] is None or not os.path.exists(path):
+            save_items(items, path)
+        return number, listed, items, changes
+
+    def refresh(self, max_age=None, workers=DEFAULT_WORKERS):
+        '''
+        relist the ranges older than `max_age` seconds (all of them if
+        None), in parallel, and log what changed since they were last
+        listed. Returns the list of changes, as dicts like the lines of
+        the delta log.
+        '''
+        stale = self.stale_shards(max_age)
+        if not stale:
+            return []
+        start = time.time()
+        pool = ThreadPool(min(workers, len(stale)))
+        try:
+            results = pool.map(self._refresh_shard, stale)
+        finally:
+            pool.close()
+            pool.join()
+
+        deltas = []
+        for number, listed, items, changes in results:
+            shard = self.state['shards'][number]
+            shard.update(listed=listed, count=len(items),
+                         bytes=sum(item.size for item in items))
+            for change, item, old_size in changes:
+                deltas.append({
+                    'time': listed, 'change': change, 'key': item.key,
+                    'size': 0 if change == REMOVED else item.size,
+                    'old_size': old_size, 'etag': item.etag,
+                    'last_modified': item.last_modified})
+        if deltas:
+            with open(os.path.join(self.dir, 'deltas.jsonl'), 'a') as f:
+                for delta in deltas:
+                    f.write(json.dumps(delta, sort_keys=True) + '\n')
+        self._save_state()
+        self.logger.info('Refreshed {} of {} ranges of {} in {:.1f}s; {} '
+                         'changes'.format(len(stale),
+                                          len(self.state['shards']),
+                                          self.bucketpath,
+                                          time.time() - start, len(deltas)))
+        return deltas
+
+    def items(self):
+        ''' yield every InventoryItem in the snapshot, in key order '''
+        for number in range(len(self.state['shards'])):
+            path = self._shard_path(number)
+            if os.path.exists(path):
+                for item in load_items(path):
+                    yield item
+
+    def totals(self):
+        ''' (object count, bytes) of everything in the snapshot '''
+        return (sum(shard['count'] for shard in self.state['shards']),
+                sum(shard['bytes'] for shard in self.state['shards']))
+
+    def deltas(self, since=None):
+        ''' yield the changes logged since the time `since` '''
+        path = os.path.join(self.dir, 'deltas.jsonl')
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                try:
+                    delta = json.loads(line)
+                except ValueError:
+                    continue
+                if since is None or delta['time'] >= since:
+                    yield delta
+
+
+def get_inventory(bucketpath, snapshot_dir=None, max_age=None,
+                  workers=DEFAULT_WORKERS):
+    '''
+    InventoryItems under a bucketpath: listed from S3, or taken from the
+    snapshot in `snapshot_dir` after refreshing any of its ranges older
+    than `max_age` seconds
+    '''
+    if snapshot_dir is None:
+        return list_inventory(bucketpath, workers=workers)
+    snapshot = Snapshot(snapshot_dir, bucketpath)
+    snapshot.refresh(max_age=max_age, workers=workers)
+    return list(snapshot.items())
+
+
+def relative_key(item, prefix):
+    return item.key[len(prefix):] if item.key.startswith(prefix) \
+        else item.key
+
+
+def totals_by_prefix(items, prefix='', depth=1):
+    '''
+    {key prefix: [count, bytes]} for the first `depth` '/'-separated
+    parts of each key after `prefix`. Keys with no more parts than that
+    are counted under ''.
+    '''
+    totals = {}
+    for item in items:
+        parts = relative_key(item, prefix).split('/')
+        group = '/'.join(parts[:depth]) + '/' if len(parts) > depth else ''
+        row = totals.setdefault(group, [0, 0])
+        row[0] += 1
+        row[1] += item.size
+    return totals
+
+
+def load_collections(path):
+    ''' {name: collection} from a file of name<tab>collection lines,
+    where name is a key after the prefix (e.g. a Nuxeo uid) '''
+    collections = {}
+    with open(path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2:
+                collections[fields[0]] = fields[1]
+    return collections
+
+
+def totals_by_collection(items, collections, prefix='',
+                         unknown='(unknown)'):
+    ''' {collection: [count, bytes]}, mapping each key after `prefix`,
+    without any file extension, to a collection with `collections` '''
+    totals = {}
+    for item in items:
+        name = os.path.splitext(relative_key(item, prefix))[0]
+        row = totals.setdefault(collections.get(name, unknown), [0, 0])
+        row[0] += 1
+        row[1] += item.size
+    return totals
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    read the encoding parameters of a jpeg2000 file (tiling, resolution
+    levels, progression order, code-blocks, quantization, SOP/EPH, PLT and
+    TLM markers, colour space) from its box structure and codestream
+    headers, so we can tell how a jp2 was encoded from the first few KB of
+    it, or from a memory-mapped file without decoding anything.
+
+    Works on python 2 and 3.
+'''
+import re
+import mmap
+import struct
+from collections import namedtuple
+
+# read this much of a file to get at the main header and the first
+# tile-part header; enough for anything kdu_compress writes
+HEADER_BYTES = 64 * 1024
+# give up on finding the end of the headers beyond this
+MAX_HEADER_BYTES = 1024 * 1024
+
+PROGRESSION_ORDERS = ['LRCP', 'RLCP', 'RPCL', 'PCRL', 'CPRL']
+
+# codestream markers
+SOC = 0xff4f
+SIZ = 0xff51
+COD = 0xff52
+TLM = 0xff55
+QCD = 0xff5c
+PLM = 0xff57
+PLT = 0xff58
+SOT = 0xff90
+SOD = 0xff93
+EOC = 0xffd9
+
+JP2_SIGNATURE = b'\x00\x00\x00\x0cjP  \r\n\x87\n'
+
+QUANTIZATION_STYLES = {0: 'none', 1: 'scalar_derived', 2: 'scalar_expounded'}
+# jp2 `colr` box enumerated colour spaces
+COLOR_SPACES = {16: 'sRGB', 17: 'sLUM', 18: 'sYCC'}
+
+Jp2Info = namedtuple('Jp2Info', [
+    'width', 'height', 'components', 'bits_per_component', 'tile_width',
+    'tile_height', 'tiles', 'levels', 'progression', 'layers', 'code_block',
+    'sop', 'eph', 'reversible', 'plt', 'tlm', 'quantization', 'guard_bits',
+    'colorspace', 'tile_parts'
+])
+
+
+class Jp2HeaderError(ValueError):
+    ''' the data isn't a jpeg2000 file we can parse '''
+
+
+class Jp2Truncated(Jp2HeaderError):
+    ''' we need more of the file to get to the end of the headers '''
+
+
+def _u16(data, offset):
+    if offset + 2 > len(data):
+        raise Jp2Truncated('Data ends inside the headers')
+    return struct.unpack('>H', data[offset:offset + 2])[0]
+
+
+def _boxes(data, offset, end):
+    ''' yield (type, content offset, box end) for the boxes in
+    data[offset:end]. A box running to the end of the file has end None. '''
+    while offset < end:
+        if offset + 8 > len(data):
+            raise Jp2Truncated('Data ends inside a box header')
+        length, box_type = struct.unpack('>I4s', data[offset:offset + 8])
+        header_length = 8
+        if length == 1:
+            if offset + 16 > len(data):
+                raise Jp2Truncated('Data ends inside a box header')
+            length, = struct.unpack('>Q', data[offset + 8:offset + 16])
+            header_length = 16
+        box_end = offset + length if length else None
+        yield box_type, offset + header_length, box_end
+        if box_end is None:
+            return
+        offset = box_end
+
+
+def _parse_colr(data, offset):
+    method = struct.unpack('>B', data[offset:offset + 1])[0]
+    if method == 1:
+        enum_cs, = struct.unpack('>I', data[offset + 3:offset + 7])
+        return COLOR_SPACES.get(enum_cs, str(enum_cs))
+    return 'icc'
+
+
+def find_codestream(data):
+    ''' (offset of the start of the codestream, colour space) for `data`,
+    which holds the start of a jp2 file or a raw codestream '''
+    if data[:2] == b'\xff\x4f':
+        return 0, None
+    if data[:12] != JP2_SIGNATURE:
+        raise Jp2HeaderError('Not a jpeg2000 file')
+    colorspace = None
+    for box_type, content, box_end in _boxes(data, 0, len(data) + 1):
+        if box_type == b'jp2c':
+            return content, colorspace
+        if box_type == b'jp2h':
+            if box_end is None or box_end > len(data):
+                raise Jp2Truncated('Data ends inside the jp2 header box')
+            for child, child_content, child_end in _boxes(data, content,
+                                                          box_end):
+                if child == b'colr' and colorspace is None:
+                    colorspace = _parse_colr(data, child_content)
+        elif box_end is None:
+            break
+    raise Jp2Truncated('Data ends before the codestream box')
+
+
+def parse_codestream(data, offset=0):
+    '''
+    parse the main header, and the header of the first tile-part, of the
+    codestream starting at `offset`. Returns a Jp2Info.
+    '''
+    if _u16(data, offset) != SOC:
+        raise Jp2HeaderError('Codestream does not start with SOC')
+    fields = dict(plt=False, tlm=False, quantization=None, guard_bits=None,
+                  colorspace=None, tile_parts=None)
+    pos = offset + 2
+    in_tile_part = False
+    while True:
+        marker = _u16(data, pos)
+        if marker == SOD or marker == EOC:
+            break
+        if marker == SOT and in_tile_part:
+            break
+        length = _u16(data, pos + 2)
+        segment = data[pos + 4:pos + 2 + length]
+        if len(segment) < length - 2:
+            raise Jp2Truncated('Data ends inside a marker segment')
+        if marker == SIZ:
+            _parse_siz(segment, fields)
+        elif marker == COD:
+            _parse_cod(segment, fields)
+        elif marker == QCD:
+            _parse_qcd(segment, fields)
+        elif marker == TLM:
+            fields['tlm'] = True
+        elif marker in (PLT, PLM):
+            fields['plt'] = True
+        elif marker == SOT:
+            in_tile_part = True
+        pos += 2 + length
+
+    if 'width' not in fields or 'levels' not in fields:
+        raise Jp2HeaderError('Codestream has no SIZ or COD marker')
+    return Jp2Info(**fields)
+
+
+def _parse_siz(segment, fields):
+    (rsiz, xsiz, ysiz, xosiz, yosiz, xtsiz, ytsiz, xtosiz, ytosiz,
+     csiz) = struct.unpack('>HIIIIIIIIH', segment[:36])
+    ssiz = struct.unpack('>B', segment[36:37])[0]
+    width = xsiz - xosiz
+    height = ysiz - yosiz
+    tiles_across = (xsiz - xtosiz + xtsiz - 1) // xtsiz
+    tiles_down = (ysiz - ytosiz + ytsiz - 1) // ytsiz
+    fields.update(width=width, height=height, components=csiz,
+                  bits_per_component=(ssiz & 0x7f) + 1,
+                  tile_width=xtsiz, tile_height=ytsiz,
+                  tiles=tiles_across * tiles_down)
+
+
+def _parse_cod(segment, fields):
+    scod, order, layers, mct, levels, xcb, ycb, style, transform = \
+        struct.unpack('>BBHBBBBBB', segment[:10])
+    fields.update(
+        sop=bool(scod & 0x02),
+        eph=bool(scod & 0x04),
+        progression=(PROGRESSION_ORDERS[order]
+                     if order < len(PROGRESSION_ORDERS) else str(order)),
+        layers=layers,
+        levels=levels,
+        code_block=(2 ** (xcb + 2), 2 ** (ycb + 2)),
+        reversible=transform == 1)
+
+
+def _parse_qcd(segment, fields):
+    sqcd = struct.unpack('>B', segment[:1])[0]
+    fields.update(quantization=QUANTIZATION_STYLES.get(sqcd & 0x1f),
+                  guard_bits=sqcd >> 5)
+
+
+def count_tile_parts(data, offset):
+    '''
+    walk every tile-part of the codestream starting at `offset`, jumping
+    from SOT to SOT by the tile-part lengths, and return (number of
+    tile-parts, number of them with PLT markers)
+    '''
+    pos = offset + 2
+    while _u16(data, pos) != SOT:
+        pos += 2 + _u16(data, pos + 2)
+    tile_parts = with_plt = 0
+    while pos + 12 <= len(data) and _u16(data, pos) == SOT:
+        psot, = struct.unpack('>I', data[pos + 6:pos + 10])
+        tile_parts += 1
+        marker_pos = pos + 12
+        while True:
+            marker = _u16(data, marker_pos)
+            if marker == SOD:
+                break
+            if marker == PLT:
+                with_plt += 1
+                break
+            marker_pos += 2 + _u16(data, marker_pos + 2)
+        if psot == 0:
+            break
+        pos += psot
+    return tile_parts, with_plt
+
+
+def read_jp2_info(data, all_tile_parts=False):
+    '''
+    Jp2Info for the jp2 file or codestream whose start is in `data`. With
+    `all_tile_parts`, `data` must hold the whole file: every tile-part
+    header is checked, and `plt` is only True if all of them have PLT
+    markers.
+    '''
+    offset, colorspace = find_codestream(data)
+    info = parse_codestream(data, offset)._replace(colorspace=colorspace)
+    if all_tile_parts:
+        tile_parts, with_plt = count_tile_parts(data, offset)
+        info = info._replace(tile_parts=tile_parts,
+                             plt=tile_parts > 0 and with_plt == tile_parts)
+    return info
+
+
+def read_jp2_info_from_file(path, all_tile_parts=True):
+    ''' Jp2Info for the jp2 at `path`, read through a memory map so only
+    the pages holding headers are read from disk '''
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise Jp2HeaderError('Empty file')
+        try:
+            return read_jp2_info(data, all_tile_parts=all_tile_parts)
+        finally:
+            data.close()
+
+
+def read_jp2_info_ranged(read_range, length=HEADER_BYTES,
+                         max_length=MAX_HEADER_BYTES):
+    '''
+    Jp2Info from the start of a remote file. `read_range(n)` should
+    return the first n bytes of the file (e.g. with an HTTP Range
+    request); we ask for more, up to `max_length`, until we have the
+    headers.
+    '''
+    while True:
+        data = read_range(length)
+        try:
+            return read_jp2_info(data)
+        except Jp2Truncated:
+            if len(data) < length or length >= max_length:
+                raise
+            length = min(length * 4, max_length)
+
+
+def _kdu_pair(value):
+    ''' parse a kdu_compress '{a,b}' value '''
+    a, b = re.match(r'^\{(\d+),(\d+)\}$', value).groups()
+    return int(a), int(b)
+
+
+def expected_from_kdu_opts(opts):
+    '''
+    the Jp2Info fields we expect in a file written by kdu_compress with
+    `opts` (e.g. KDU_COMPRESS_BASE_OPTS), as a dict
+    '''
+    expected = {}
+    for i, opt in enumerate(opts):
+        name, sep, value = opt.partition('=')
+        if opt == '-rate':
+            expected['layers'] = len(opts[i + 1].split(','))
+        elif opt == '-jp2_space':
+            expected['colorspace'] = opts[i + 1]
+        elif not sep:
+            continue
+        elif name == 'Stiles':
+            # kdu sizes are {rows,cols}
+            expected['tile_height'], expected['tile_width'] = _kdu_pair(value)
+        elif name == 'Cblk':
+            rows, cols = _kdu_pair(value)
+            expected['code_block'] = (cols, rows)
+        elif name == 'Clevels':
+            expected['levels'] = int(value)
+        elif name == 'Corder':
+            expected['progression'] = value
+        elif name == 'Creversible':
+            expected['reversible'] = value == 'yes'
+            if value == 'yes':
+                expected['quantization'] = 'none'
+        elif name == 'Cuse_sop':
+            expected['sop'] = value == 'yes'
+        elif name == 'Cuse_eph':
+            expected['eph'] = value == 'yes'
+        elif name == 'ORGgen_plt':
+            expected['plt'] = value == 'yes'
+    return expected
+
+
+# the kdu_compress options jp2s are encoded with, by ucldc_iiif.convert
+# and when the legacy OAC jp2s are re-encoded (see
+# scripts/convert_legacy_oac_jp2s.py), and what a file encoded with them
+# looks like. Settings recommended as a starting point by Jon Stroop.
+# See https://groups.google.com/forum/?hl=en#!searchin/iiif-discuss/kdu_compress/iiif-discuss/OFzWFLaWVsE/wF2HaykHcd0J
+KDU_COMPRESS_BASE_OPTS = [
+    "-quiet", "-rate",
+    "2.4,1.48331273,.91673033,.56657224,.35016049,.21641118,.13374944,"
+    ".08266171",
+    "Creversible=yes", "Clevels=7", "Cblk={64,64}", "Cuse_sop=yes",
+    "Cuse_eph=yes", "Corder=RLCP", "ORGgen_plt=yes", "ORGtparts=R",
+    "Stiles={1024,1024}", "-double_buffering", "10", "-num_threads", "4",
+    "-no_weights"
+]
+EXPECTED_ENCODING = expected_from_kdu_opts(KDU_COMPRESS_BASE_OPTS)
+
+
+def compare(info, expected):
+    ''' list of human-readable differences between a Jp2Info and the
+    expected values from expected_from_kdu_opts(); empty if it matches '''
+    mismatches = []
+    for name in sorted(expected):
+        found = getattr(info, name)
+        if name in ('tile_width', 'tile_height'):
+            # an image that fits in one requested tile may have been
+            # encoded untiled
+            size = info.width if name == 'tile_width' else info.height
+            if info.tiles == 1 and size <= found and size <= expected[name]:
+                continue
+        if found != expected[name]:
+            mismatches.append('{}: expected {}, found {}'.format(
+                name, expected[name], found))
+    return mismatches
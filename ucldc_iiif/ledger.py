@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    a durable record of a run over many objects (e.g. a collection or a
+    bucket migration), kept in a SQLite file.
+
+    Every object has a row in `jobs` with its current state, attempts,
+    source hash, output checksum, timings and the class of its last
+    error; every change of state is appended to `transitions`. Workers
+    claim jobs inside an IMMEDIATE transaction, so several processes can
+    share a run without two of them taking the same job. Hosts can share
+    one too, if the file is on a filesystem whose locks SQLite can rely
+    on. A rerun only picks up jobs that are pending, failed (with
+    attempts to spare), or whose claim has outlived its lease because
+    the worker holding it died, whether that was while converting it or
+    before its output was uploaded.
+
+    `python -m ucldc_iiif.ledger status run.db` prints how a run is
+    going.
+'''
+import os
+import sys
+import time
+import socket
+import logging
+import sqlite3
+import argparse
+import threading
+from collections import namedtuple
+
+PENDING = 'pending'
+RUNNING = 'running'
+# converted, but its output not yet uploaded: still held by its worker
+CONVERTED = 'converted'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+STATES = (PENDING, RUNNING, CONVERTED, DONE, SKIPPED, FAILED)
+
+MAX_ATTEMPTS = 3
+# a claim older than this is taken to belong to a worker that died
+LEASE = 6 * 60 * 60
+# seconds to wait for another process's transaction to finish
+BUSY_TIMEOUT = 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    source TEXT,
+    output TEXT,
+    mimetype TEXT,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    claimed REAL,
+    finished REAL,
+    seconds REAL,
+    source_hash TEXT,
+    output_checksum TEXT,
+    error_class TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS transitions (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    old_state TEXT,
+    new_state TEXT NOT NULL,
+    time REAL NOT NULL,
+    worker TEXT,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS transitions_key ON transitions (key);
+'''
+
+Job = namedtuple('Job', [
+    'key', 'source', 'output', 'mimetype', 'state', 'attempts', 'worker',
+    'claimed', 'finished', 'seconds', 'source_hash', 'output_checksum',
+    'error_class', 'error'])
+
+
+def worker_id():
+    ''' name for the current process in the ledger: host:pid '''
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class Ledger(object):
+    '''
+        a run's jobs in the SQLite file at `path`, created if need be.
+        Each thread (and each process, after a fork) uses its own
+        connection, so a Ledger can be shared by threads and handed to
+        worker processes.
+    '''
+
+    def __init__(self, path, max_attempts=MAX_ATTEMPTS, lease=LEASE):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._local = threading.local()
+        self._db().executescript(SCHEMA)
+
+    def _db(self):
+        # a connection inherited across a fork mustn't be used
+        if getattr(self._local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return self._local.db
+
+    def __getstate__(self):
+        return {'path': self.path, 'max_attempts': self.max_attempts,
+                'lease': self.lease}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _transaction(self, write):
+        ''' run write(db) in an IMMEDIATE transaction, which holds the
+        write lock from the start, and return what it returns '''
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            result = write(db)
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+        return result
+
+    @staticmethod
+    def _transition(db, key, old_state, new_state, worker=None, detail=None):
+        db.execute('INSERT INTO transitions (key, old_state, new_state, '
+                   'time, worker, detail) VALUES (?, ?, ?, ?, ?, ?)',
+                   (key, old_state, new_state, time.time(), worker, detail))
+
+    def add(self, jobs):
+        '''
+        add (key, source, output, mimetype) jobs as pending, leaving any
+        already in the ledger as they are. Returns the number added.
+        '''
+        def write(db):
+            added = 0
+            for key, source, output, mimetype in jobs:
+                cursor = db.execute(
+                    'INSERT OR IGNORE INTO jobs (key, source, output, '
+                    'mimetype, state) VALUES (?, ?, ?, ?, ?)',
+                    (key, source, output, mimetype, PENDING))
+                if cursor.rowcount:
+                    added += 1
+                    self._transition(db, key, None, PENDING)
+            return added
+        return self._transaction(write)
+
+    def _claimable(self, now):
+        return ('(state = ? OR (state = ? AND attempts < ?) OR '
+                '(state IN (?, ?) AND claimed < ?))',
+                [PENDING, FAILED, self.max_attempts, RUNNING, CONVERTED,
+                 now - self.lease])
+
+    def claim(self, worker=None):
+        ''' claim the next job that needs doing, returning it as a Job,
+        or None if there are none left. Pending jobs come before failed
+        ones being retried. '''
+        worker = worker or worker_id()
+
+        def write(db):
+            now = time.time()
+            where, params = self._claimable(now)
+            # retries go after everything else, so a job that keeps
+            # failing doesn't hold up the rest
+            row = db.execute('SELECT key, state FROM jobs WHERE ' + where +
+                             ' ORDER BY state = ?, attempts, key LIMIT 1',
+                             params + [FAILED]).fetchone()
+            if row is None:
+                return None
+            self._claim(db, row[0], row[1], worker, now)
+            return row[0]
+        key = self._transaction(write)
+        return self.get(key) if key is not None else None
+
+    def claim_key(self, key, worker=None):
+        ''' claim the job for `key` if it needs doing; returns whether it
+        was claimed '''
+        worker = worker or worker_id()
+
+        def write(db):
+            now = time.time()
+            where, params = self._claimable(now)
+            row = db.execute('SELECT state FROM jobs WHERE key = ? AND ' +
+                             where, [key] + params).fetchone()
+            if row is None:
+                return False
+            self._claim(db, key, row[0], worker, now)
+            return True
+        return self._transaction(write)
+
+    def _claim(self, db, key, old_state, worker, now):
+        db.execute('UPDATE jobs SET state = ?, worker = ?, claimed = ?, '
+                   'finished = NULL, seconds = NULL, '
+                   'attempts = attempts + 1 WHERE key = ?',
+                   (RUNNING, worker, now, key))
+        self._transition(db, key, old_state, RUNNING, worker,
+                         'lease expired' if old_state in (RUNNING, CONVERTED)
+                         else None)
+
+    def finish(self, key, state, worker=None, source_hash=None,
+               output_checksum=None, error_class=None, error=None,
+               hand_to=None):
+        '''
+        record that the job for `key` ended up `state` (DONE, SKIPPED or
+        FAILED), or is CONVERTED and waiting to be uploaded, in which case
+        the claim can be handed to the worker doing the upload with
+        `hand_to`. Only the worker holding the claim can finish a job: if
+        its lease ran out and someone else has claimed the job since, the
+        finish is ignored. Returns whether it was recorded.
+        '''
+        worker = worker or worker_id()
+
+        def write(db):
+            now = time.time()
+            row = db.execute('SELECT state, claimed, worker FROM jobs '
+                             'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            old_state, claimed, holder = row
+            if holder != worker:
+                return False
+            db.execute(
+                'UPDATE jobs SET state = ?, worker = ?, finished = ?, '
+                'seconds = ?, source_hash = COALESCE(?, source_hash), '
+                'output_checksum = COALESCE(?, output_checksum), '
+                'error_class = ?, error = ? WHERE key = ?',
+                (state, hand_to or worker, now,
+                 now - claimed if claimed else None, source_hash,
+                 output_checksum, error_class, error, key))
+            self._transition(db, key, old_state, state, worker, error_class)
+            return True
+        if self._transaction(write):
+            return True
+        logging.getLogger(__name__).warning(
+            'Not marking {} {}: {} no longer holds it'.format(
+                key, state, worker))
+        return False
+
+    def get(self, key):
+        row = self._db().execute('SELECT * FROM jobs WHERE key = ?',
+                                 (key,)).fetchone()
+        return Job(*row) if row is not None else None
+
+    def jobs(self, state=None):
+        ''' yield the Jobs in key order, or just those in `state` '''
+        if state is None:
+            cursor = self._db().execute('SELECT * FROM jobs ORDER BY key')
+        else:
+            cursor = self._db().execute(
+                'SELECT * FROM jobs WHERE state = ? ORDER BY key', (state,))
+        for row in cursor:
+            yield Job(*row)
+
+    def claimable(self):
+        ''' the number of jobs a worker could claim now '''
+        where, params = self._claimable(time.time())
+        return self._db().execute('SELECT COUNT(*) FROM jobs WHERE ' + where,
+                                  params).fetchone()[0]
+
+    def counts(self):
+        ''' {state: number of jobs} '''
+        return dict(self._db().execute(
+            'SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall())
+
+    def errors(self):
+        ''' {error class: number of failed jobs} '''
+        return dict(self._db().execute(
+            'SELECT error_class, COUNT(*) FROM jobs WHERE state = ? '
+            'GROUP BY error_class', (FAILED,)).fetchall())
+
+    def retry(self, state=FAILED):
+        ''' make the jobs in `state` pending again, with their attempts
+        reset. Returns how many. '''
+        def write(db):
+            keys = [row[0] for row in db.execute(
+                'SELECT key FROM jobs WHERE state = ?', (state,))]
+            for key in keys:
+                db.execute('UPDATE jobs SET state = ?, attempts = 0 '
+                           'WHERE key = ?', (PENDING, key))
+                self._transition(db, key, state, PENDING, detail='retry')
+            return len(keys)
+        return self._transaction(write)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='show or change the state of a run')
+    subparsers = parser.add_subparsers(dest='command')
+    status = subparsers.add_parser('status', help="count jobs by state, and "
+                                   "failures by error class")
+    status.add_argument('ledger')
+    listing = subparsers.add_parser('list', help="list jobs, tab-separated")
+    listing.add_argument('ledger')
+    listing.add_argument('--state', choices=STATES, default=None)
+    retry = subparsers.add_parser('retry', help="make failed (or other) "
+                                  "jobs pending again")
+    retry.add_argument('ledger')
+    retry.add_argument('--state', choices=STATES, default=FAILED)
+    argv = parser.parse_args(argv)
+
+    ledger = Ledger(argv.ledger)
+    if argv.command == 'status':
+        counts = ledger.counts()
+        for state in STATES:
+            print('{:10} {:10d}'.format(state, counts.get(state, 0)))
+        print('{:10} {:10d}'.format('claimable', ledger.claimable()))
+        errors = ledger.errors()
+        if errors:
+            print('failures by error class:')
+            for error_class in sorted(errors, key=lambda e: -errors[e]):
+                print('  {:40} {:10d}'.format(error_class or '(unknown)',
+                                              errors[error_class]))
+    elif argv.command == 'list':
+        for job in ledger.jobs(argv.state):
+            print('\t'.join('' if value is None else str(value)
+                            for value in job))
+    elif argv.command == 'retry':
+        print('{} jobs made pending again'.format(ledger.retry(argv.state)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
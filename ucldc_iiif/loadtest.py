@@ -0,0 +1,696 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    load test a Loris deployment with IIIF Image API traffic, so changes
+    to the mod_wsgi worker layout (`WSGIDaemonProcess ... processes=10
+    threads=15` in docker/apache-config.txt) or to the kdu_compress
+    options can be judged on evidence.
+
+    The traffic is either
+
+    - replayed from Apache access logs (`--log`), as fast as it can be
+      sent or paced by the logged times (`--speed`), or
+    - synthesized from the headers of a set of jp2s (`--jp2s`): viewer
+      sessions that fetch info.json and a thumbnail, open the image at
+      the level that fits the viewport, then zoom in and pan about,
+      asking for tiles the way OpenSeadragon does. Images are picked
+      with a Zipf-like popularity, so a few are hot and most are not.
+
+    To keep S3 out of it, Loris's resolver can be pointed at a local S3
+    stand-in that serves <root>/<bucket>/<key> path-style, with Range
+    requests, and counts what it serves:
+
+        python -m ucldc_iiif.loadtest s3 --root /data/s3 --port 9000
+
+    A run reports throughput, latency percentiles (overall and for
+    info.json, full-image and tile requests), how many requests were
+    cache hits, checked against the Loris cache dirs before each request
+    is sent (the server is local), and how often Loris went back to the
+    origin, from the stand-in's counts:
+
+        python -m ucldc_iiif.loadtest run --base-uri http://localhost:8080 \\
+            --jp2s /data/s3/ucldc-nuxeo-ref-images --sessions 200 \\
+            --concurrency 16 --info-root /tmp/loris-cache \\
+            --image-root /tmp/loris-cache --origin http://localhost:9000 \\
+            --label 'processes=10 threads=15' --json results.jsonl
+
+    Results of runs under different configurations, appended to one file
+    with --json, are compared with `python -m ucldc_iiif.loadtest report
+    results.jsonl`.
+'''
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import calendar
+import threading
+from collections import namedtuple, Counter
+from email.utils import formatdate
+from multiprocessing.pool import ThreadPool
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote, urlsplit, parse_qs
+except ImportError:  # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlsplit, parse_qs
+from xml.sax.saxutils import escape
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from ucldc_iiif import jp2, prewarm
+from ucldc_iiif.benchmark import percentile
+
+logger = logging.getLogger(__name__)
+
+INFO = 'info'
+FULL = 'full'
+TILE = 'tile'
+KINDS = (INFO, FULL, TILE)
+
+CONCURRENCY = 16
+TIMEOUT = 60
+VIEWPORT = (1200, 800)
+ZOOMS = 3
+PANS = 4
+SESSIONS = 100
+
+# an IIIF request: its path under the base URI, the image it's for, its
+# kind, and when it was made (seconds from the start of a log; None for
+# synthesized traffic)
+Request = namedtuple('Request', ['path', 'ident', 'kind', 'at'])
+Result = namedtuple('Result', ['kind', 'status', 'seconds', 'bytes', 'hit',
+                               'error'])
+
+LOG_LINE = re.compile(r'\[(?P<time>[^\]]+)\] "(?:GET|HEAD) (?P<path>\S+) '
+                      r'[^"]*" (?P<status>\d{3}) ')
+IIIF_INFO = re.compile(r'^/(?P<ident>.+)/info\.json$')
+IIIF_IMAGE = re.compile(r'^/(?P<ident>.+)/(?P<region>[^/]+)/[^/]+/[^/]+/'
+                        r'[^/]+\.\w+$')
+
+
+def parse_log_time(value):
+    ''' seconds since the epoch of an Apache log time, e.g.
+    '10/Oct/2017:13:55:36 -0700' '''
+    stamp, zone = value.split(' ')
+    seconds = calendar.timegm(time.strptime(stamp, '%d/%b/%Y:%H:%M:%S'))
+    offset = (int(zone[1:3]) * 60 + int(zone[3:5])) * 60
+    return seconds - offset if zone[0] == '+' else seconds + offset
+
+
+def read_log(paths, strip_prefix=''):
+    '''
+    the IIIF requests in Apache access logs (common or combined format)
+    that were answered with a 2xx or 304, in order, timed from the first
+    '''
+    logged = []
+    start = None
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                match = LOG_LINE.search(line)
+                if match is None or not (
+                        match.group('status').startswith('2') or
+                        match.group('status') == '304'):
+                    continue
+                request_path = unquote(match.group('path').split('?')[0])
+                if strip_prefix and request_path.startswith(strip_prefix):
+                    request_path = request_path[len(strip_prefix):]
+                info = IIIF_INFO.match(request_path)
+                image = IIIF_IMAGE.match(request_path)
+                if info is not None:
+                    ident, kind = info.group('ident'), INFO
+                elif image is not None:
+                    ident = image.group('ident')
+                    kind = FULL if image.group('region') == 'full' else TILE
+                else:
+                    continue
+                at = parse_log_time(match.group('time'))
+                start = at if start is None else start
+                logged.append(Request(request_path, ident, kind,
+                                      at - start))
+    logged.sort(key=lambda request: request.at)
+    return logged
+
+
+def read_jp2s(paths):
+    '''
+    (ident, Jp2Info) for each jp2 in `paths`, which can be files or dirs
+    of them; the ident is the file name, without any .jp2 extension
+    (like the S3 keys)
+    '''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(os.path.join(path, name)
+                         for name in sorted(os.listdir(path))
+                         if os.path.isfile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    images = []
+    for path in files:
+        try:
+            info = jp2.read_jp2_info_from_file(path, all_tile_parts=False)
+        except (jp2.Jp2HeaderError, IOError) as e:
+            logger.warning('Skipping {}: {!r}'.format(path, e))
+            continue
+        ident = os.path.basename(path)
+        if ident.endswith('.jp2'):
+            ident = ident[:-len('.jp2')]
+        images.append((ident, info))
+    return images
+
+
+def encoding(info):
+    ''' a short description of how a jp2 was encoded, to label runs '''
+    return '{}x{} tiles, {} levels, {}{}'.format(
+        info.tile_width, info.tile_height, info.levels, info.progression,
+        ', PLT' if info.plt else '')
+
+
+def image_path(ident, derivative):
+    return '/{}/{}/{}/0/{}.{}'.format(ident, derivative.region,
+                                      derivative.size, prewarm.QUALITY,
+                                      prewarm.FORMAT)
+
+
+def _fit_reduce(info, viewport):
+    ''' the -reduce level at which the whole image just fills the
+    viewport '''
+    scale = max(info.width / float(viewport[0]),
+                info.height / float(viewport[1]))
+    reduce = 0
+    while reduce < info.levels and 2 ** (reduce + 1) <= scale:
+        reduce += 1
+    return reduce
+
+
+def _visible_tiles(info, reduce, center, viewport):
+    ''' the tiles at `reduce` in view, with the viewport (shown at that
+    level's resolution) centred on `center` of the full image '''
+    tiles = prewarm.level_tiles(info, reduce)
+    if len(tiles) == 1:
+        return tiles
+    scale = 2 ** reduce
+    tile_width, tile_height = prewarm.tile_size(info)
+    step_x, step_y = tile_width * scale, tile_height * scale
+    half_x, half_y = viewport[0] * scale // 2, viewport[1] * scale // 2
+    left = max(0, int(center[0]) - half_x) // step_x * step_x
+    top = max(0, int(center[1]) - half_y) // step_y * step_y
+    right = min(info.width, int(center[0]) + half_x)
+    bottom = min(info.height, int(center[1]) + half_y)
+    return [prewarm.tile(info, reduce, x, y)
+            for y in range(top, max(bottom, top + 1), step_y)
+            for x in range(left, max(right, left + 1), step_x)]
+
+
+def viewer_session(ident, info, rng, zooms=ZOOMS, pans=PANS,
+                   viewport=VIEWPORT):
+    '''
+    the requests a viewer makes for one image: info.json, a thumbnail,
+    the tiles of the image fitted to the viewport, then the new tiles in
+    view as it zooms in `zooms` times towards random points, panning
+    `pans` times in all, in random directions. Tiles already fetched are
+    left to the browser's cache.
+    '''
+    session = [Request('/{}/info.json'.format(ident), ident, INFO, None)]
+    thumbnail = prewarm.thumbnail_derivatives(info,
+                                              prewarm.THUMBNAIL_SIZES[:1])[0]
+    session.append(Request(image_path(ident, thumbnail), ident, FULL, None))
+    seen = set()
+
+    def view(reduce, center):
+        for derivative in _visible_tiles(info, reduce, center, viewport):
+            path = image_path(ident, derivative)
+            if path not in seen:
+                seen.add(path)
+                kind = FULL if derivative.region == 'full' else TILE
+                session.append(Request(path, ident, kind, None))
+
+    reduce = _fit_reduce(info, viewport)
+    center = (info.width / 2.0, info.height / 2.0)
+    view(reduce, center)
+    steps = ['zoom'] * min(zooms, reduce) + ['pan'] * pans
+    rng.shuffle(steps)
+    for step in steps:
+        scale = 2 ** reduce
+        if step == 'zoom':
+            reduce -= 1
+            center = (center[0] + rng.uniform(-0.25, 0.25) *
+                      viewport[0] * scale,
+                      center[1] + rng.uniform(-0.25, 0.25) *
+                      viewport[1] * scale)
+        else:
+            dx, dy = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+            center = (center[0] + dx * viewport[0] * scale / 2.0,
+                      center[1] + dy * viewport[1] * scale / 2.0)
+        center = (min(max(center[0], 0), info.width),
+                  min(max(center[1], 0), info.height))
+        view(reduce, center)
+    return session
+
+
+def synthesize(images, sessions=SESSIONS, zooms=ZOOMS, pans=PANS,
+               viewport=VIEWPORT, seed=0):
+    ''' `sessions` viewer sessions (lists of Requests) over (ident,
+    Jp2Info) images, with the nth most popular image picked in
+    proportion to 1/n '''
+    rng = random.Random(seed)
+    images = list(images)
+    rng.shuffle(images)
+    weights = [1.0 / rank for rank in range(1, len(images) + 1)]
+    total = sum(weights)
+    sessions_ = []
+    for i in range(sessions):
+        pick = rng.uniform(0, total)
+        for (ident, info), weight in zip(images, weights):
+            pick -= weight
+            if pick <= 0:
+                break
+        sessions_.append(viewer_session(ident, info, rng, zooms, pans,
+                                        viewport))
+    return sessions_
+
+
+class LoadTest(object):
+    '''
+        sends IIIF requests to the server at `base_uri` from `concurrency`
+        threads over a pooled Session. With the Loris cache dirs, each
+        request is checked against the cache first, to count hits.
+    '''
+
+    def __init__(self, base_uri, concurrency=CONCURRENCY, info_root=None,
+                 image_root=None, timeout=TIMEOUT):
+
+        self.base_uri = base_uri.rstrip('/')
+        self.concurrency = concurrency
+        self.info_root = info_root
+        self.image_root = image_root
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _cached(self, request):
+        root = self.info_root if request.kind == INFO else self.image_root
+        if root is None:
+            return None
+        return os.path.exists(os.path.join(root, request.path.lstrip('/')))
+
+    def fetch(self, request):
+        ''' send one Request, returning a Result '''
+        hit = self._cached(request)
+        start = time.time()
+        try:
+            response = self.session.get(self.base_uri + request.path,
+                                        timeout=self.timeout)
+            size = len(response.content)
+            status = response.status_code
+            error = 'HTTP {}'.format(status) if status >= 400 else None
+        except requests.RequestException as e:
+            size, status, error = 0, None, type(e).__name__
+        seconds = time.time() - start
+        if error is not None:
+            logger.debug('{}: {}'.format(request.path, error))
+        return Result(request.kind, status, seconds, size, hit, error)
+
+    def _fetch_session(self, session):
+        return [self.fetch(request) for request in session]
+
+    def run_sessions(self, sessions):
+        ''' run viewer sessions, `concurrency` at once, each sending its
+        requests one after another; returns the Results '''
+        pool = ThreadPool(self.concurrency)
+        try:
+            results = [result for results in pool.imap_unordered(
+                self._fetch_session, sessions) for result in results]
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+    def replay(self, logged, speed=0):
+        '''
+        send logged Requests, as fast as `concurrency` threads can, or
+        with `speed`, at their logged times (2 for twice as fast); a
+        request whose time comes while all the threads are busy waits
+        for one. Returns the Results.
+        '''
+        pool = ThreadPool(self.concurrency)
+        try:
+            if not speed:
+                results = list(pool.imap_unordered(self.fetch, logged))
+            else:
+                start = time.time()
+                pending = []
+                for request in logged:
+                    delay = start + request.at / speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                    pending.append(pool.apply_async(self.fetch, (request,)))
+                results = [result.get() for result in pending]
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        return results
+
+
+def origin_stats(origin):
+    ''' the stand-in's counts of requests and bytes served so far '''
+    response = requests.get(origin.rstrip('/') + '/_stats', timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def summarize(results, seconds, label=None, origin_before=None,
+              origin_after=None, encodings=None):
+    ''' a dict of measurements of a run '''
+    latencies = [result.seconds for result in results]
+    checked = [result.hit for result in results if result.hit is not None]
+    summary = {
+        'label': label,
+        'requests': len(results),
+        'errors': len([result for result in results if result.error]),
+        'seconds': seconds,
+        'requests_per_second': len(results) / seconds if seconds else 0,
+        'mb_per_second': (sum(result.bytes for result in results) /
+                          1024.0 / 1024.0 / seconds if seconds else 0),
+        'latency_p50': percentile(latencies, 0.5),
+        'latency_p90': percentile(latencies, 0.9),
+        'latency_p99': percentile(latencies, 0.99),
+        'hit_ratio': (float(sum(checked)) / len(checked)
+                      if checked else None),
+        'encodings': dict(encodings or {}),
+    }
+    for kind in KINDS:
+        of_kind = [result.seconds for result in results
+                   if result.kind == kind]
+        summary[kind + '_requests'] = len(of_kind)
+        summary[kind + '_p50'] = percentile(of_kind, 0.5)
+        summary[kind + '_p99'] = percentile(of_kind, 0.99)
+    if origin_before is not None and origin_after is not None:
+        summary['origin_requests'] = (origin_after['requests'] -
+                                      origin_before['requests'])
+        summary['origin_bytes'] = (origin_after['bytes'] -
+                                   origin_before['bytes'])
+    return summary
+
+
+def format_summaries(summaries):
+    lines = ['{:<32} {:>7} {:>5} {:>7} {:>7} {:>7} {:>7} {:>7} {:>7} '
+             '{:>7} {:>6} {:>8}'.format(
+                 'label', 'reqs', 'errs', 'req/s', 'MB/s', 'p50 s', 'p90 s',
+                 'p99 s', 'tile p99', 'info p99', 'hits', 'origin')]
+    for summary in summaries:
+        hit_ratio = summary.get('hit_ratio')
+        lines.append(
+            '{:<32} {:>7} {:>5} {:>7.1f} {:>7.1f} {:>7.3f} {:>7.3f} {:>7.3f} '
+            '{:>7.3f} {:>7.3f} {:>6} {:>8}'.format(
+                (summary.get('label') or '')[:32], summary['requests'],
+                summary['errors'], summary['requests_per_second'],
+                summary['mb_per_second'], summary['latency_p50'] or 0,
+                summary['latency_p90'] or 0, summary['latency_p99'] or 0,
+                summary.get('tile_p99') or 0, summary.get('info_p99') or 0,
+                '{:.0%}'.format(hit_ratio) if hit_ratio is not None
+                else '-',
+                summary.get('origin_requests', '-')))
+    return '\n'.join(lines)
+
+
+class S3StandIn(ThreadingMixIn, HTTPServer):
+    '''
+        a local stand-in for S3, serving the files under `root` as
+        objects, <root>/<bucket>/<key>, path-style. GET and HEAD of
+        objects (with Range) and bucket listings are enough for boto and
+        for plain HTTP resolvers. Counts what it serves, at /_stats.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, root):
+        HTTPServer.__init__(self, address, S3Handler)
+        self.root = os.path.abspath(root)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0}
+        # (path, size, mtime) -> md5, for ETags
+        self.etags = {}
+
+    def count(self, sent):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['bytes'] += sent
+
+    def etag(self, path, stat):
+        key = (path, stat.st_size, stat.st_mtime)
+        if key not in self.etags:
+            digest = hashlib.md5()
+            with open(path, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            self.etags[key] = digest.hexdigest()
+        return self.etags[key]
+
+
+class S3Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, data, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(data)
+
+    def _error(self, status, code, body):
+        data = ('<?xml version="1.0" encoding="UTF-8"?>\n<Error><Code>{}'
+                '</Code></Error>'.format(code)).encode('utf-8')
+        self._send(status, data, 'application/xml', body)
+
+    def _serve(self, body):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path)
+        if path == '/_stats':
+            with self.server.lock:
+                data = json.dumps(self.server.stats).encode('utf-8')
+            return self._send(200, data, 'application/json', body)
+        bucket, _, key = path.lstrip('/').partition('/')
+        if not key:
+            return self._list(bucket, parse_qs(parts.query), body)
+        filename = os.path.abspath(os.path.join(self.server.root, bucket,
+                                                key))
+        if not filename.startswith(self.server.root + os.sep) or \
+                not os.path.isfile(filename):
+            return self._error(404, 'NoSuchKey', body)
+
+        stat = os.stat(filename)
+        size = stat.st_size
+        start, end = 0, size - 1
+        status = 200
+        headers = {'ETag': '"{}"'.format(self.server.etag(filename, stat)),
+                   'Last-Modified': formatdate(stat.st_mtime, usegmt=True),
+                   'Accept-Ranges': 'bytes'}
+        ranged = re.match(r'bytes=(\d*)-(\d*)$',
+                          self.headers.get('Range') or '')
+        if ranged is not None and size:
+            first, last = ranged.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+            elif last:
+                start = max(0, size - int(last))
+            if start > end:
+                return self._error(416, 'InvalidRange', body)
+            status = 206
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end,
+                                                                size)
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        self._send(status, data, 'image/jp2', body, headers)
+        self.server.count(len(data) if body else 0)
+
+    def _list(self, bucket, query, body):
+        directory = os.path.join(self.server.root, bucket)
+        if not bucket or not os.path.isdir(directory):
+            return self._error(404, 'NoSuchBucket', body)
+        prefix = query.get('prefix', [''])[0]
+        max_keys = int(query.get('max-keys', ['1000'])[0])
+        keys = []
+        for dirpath, dirnames, filenames in os.walk(directory):
+            for filename in filenames:
+                key = os.path.relpath(os.path.join(dirpath, filename),
+                                      directory).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append((key, os.path.getsize(
+                        os.path.join(dirpath, filename))))
+        keys.sort()
+        contents = ''.join(
+            '<Contents><Key>{}</Key><Size>{}</Size></Contents>'.format(
+                escape(key), size) for key, size in keys[:max_keys])
+        data = ('<?xml version="1.0" encoding="UTF-8"?>\n<ListBucketResult>'
+                '<Name>{}</Name><Prefix>{}</Prefix><MaxKeys>{}</MaxKeys>'
+                '<IsTruncated>{}</IsTruncated>{}</ListBucketResult>'.format(
+                    escape(bucket), escape(prefix), max_keys,
+                    'true' if len(keys) > max_keys else 'false',
+                    contents)).encode('utf-8')
+        self._send(200, data, 'application/xml', body)
+
+
+def _viewport(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='load test an IIIF image server')
+    subparsers = parser.add_subparsers(dest='command')
+
+    s3_parser = subparsers.add_parser(
+        's3', help="serve jp2s as a local S3 stand-in")
+    s3_parser.add_argument('--root', required=True,
+                           help="dir holding <bucket>/<key> files")
+    s3_parser.add_argument('--host', default='127.0.0.1')
+    s3_parser.add_argument('--port', type=int, default=9000)
+
+    run_parser = subparsers.add_parser(
+        'run', help="send replayed or synthesized traffic to a server")
+    run_parser.add_argument('--base-uri', required=True,
+                            help="the server's IIIF base URI")
+    run_parser.add_argument('--log', action='append', default=None,
+                            help="Apache access log to replay; can be "
+                            "repeated")
+    run_parser.add_argument('--strip-prefix', default='',
+                            help="leading path to drop from logged requests "
+                            "to get paths under --base-uri")
+    run_parser.add_argument('--speed', type=float, default=0,
+                            help="replay at the logged times, this many "
+                            "times as fast (default: as fast as possible)")
+    run_parser.add_argument('--jp2s', nargs='+', default=None,
+                            help="jp2 files, or dirs of them, to synthesize "
+                            "viewer sessions for, named as the server "
+                            "knows them")
+    run_parser.add_argument('--sessions', type=int, default=SESSIONS)
+    run_parser.add_argument('--zooms', type=int, default=ZOOMS,
+                            help="zooms in per session")
+    run_parser.add_argument('--pans', type=int, default=PANS,
+                            help="pans per session")
+    run_parser.add_argument('--viewport', type=_viewport,
+                            default='{}x{}'.format(*VIEWPORT))
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                            help="requests (or sessions) in flight at once")
+    run_parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    run_parser.add_argument('--info-root', default=None,
+                            help="the server's Loris info cache dir, to "
+                            "count cache hits")
+    run_parser.add_argument('--image-root', default=None,
+                            help="the server's Loris image cache dir, to "
+                            "count cache hits")
+    run_parser.add_argument('--origin', default=None,
+                            help="URL of the S3 stand-in, to count origin "
+                            "fetches")
+    run_parser.add_argument('--label', default=None,
+                            help="name of the configuration under test, "
+                            "e.g. 'processes=10 threads=15'")
+    run_parser.add_argument('--json', default=None,
+                            help="append the results to this JSON-lines "
+                            "file")
+
+    report_parser = subparsers.add_parser(
+        'report', help="compare the results of runs saved with --json")
+    report_parser.add_argument('results', nargs='+')
+    parser.add_argument('--loglevel', default='WARNING')
+    argv = parser.parse_args(argv)
+
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(
+        level=numeric_level,
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    if argv.command == 's3':
+        server = S3StandIn((argv.host, argv.port), argv.root)
+        print('Serving {} as S3 at http://{}:{}/'.format(
+            server.root, argv.host, server.server_address[1]))
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if argv.command == 'report':
+        summaries = []
+        for path in argv.results:
+            with open(path) as f:
+                summaries.extend(json.loads(line) for line in f
+                                 if line.strip())
+        print(format_summaries(summaries))
+        return 0
+
+    if bool(argv.log) == bool(argv.jp2s):
+        run_parser.error('give either --log or --jp2s')
+    load_test = LoadTest(argv.base_uri, concurrency=argv.concurrency,
+                         info_root=argv.info_root,
+                         image_root=argv.image_root, timeout=argv.timeout)
+    encodings = None
+    if argv.log:
+        logged = read_log(argv.log, argv.strip_prefix)
+        if not logged:
+            run_parser.error('no IIIF requests found in the logs')
+    else:
+        images = read_jp2s(argv.jp2s)
+        if not images:
+            run_parser.error('no jp2s found')
+        encodings = Counter(encoding(info) for ident, info in images)
+        sessions = synthesize(images, argv.sessions, argv.zooms, argv.pans,
+                              argv.viewport, argv.seed)
+
+    before = origin_stats(argv.origin) if argv.origin else None
+    start = time.time()
+    if argv.log:
+        results = load_test.replay(logged, argv.speed)
+    else:
+        results = load_test.run_sessions(sessions)
+    seconds = time.time() - start
+    after = origin_stats(argv.origin) if argv.origin else None
+
+    summary = summarize(results, seconds, argv.label, before, after,
+                        encodings)
+    print(format_summaries([summary]))
+    errors = Counter(result.error for result in results if result.error)
+    for error, count in errors.most_common():
+        print('{:>7} {}'.format(count, error))
+    if argv.json:
+        with open(argv.json, 'a') as f:
+            f.write(json.dumps(summary, sort_keys=True) + '\n')
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
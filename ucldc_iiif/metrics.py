@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    per-stage metrics for the conversion pipeline.
+
+    Each external command (tiffcp, tiff2rgba, tifficc, ImageMagick,
+    kdu_compress, kdu_expand) is run through run_command(), which reaps
+    the child with wait4() to get its own cpu time and peak RSS. A
+    Recorder turns those into records like:
+
+        {"stage": "tiff_to_jp2", "tool": "kdu_compress", "ok": true,
+         "wall": 12.3, "user": 40.1, "sys": 0.8, "max_rss": 201326592,
+         "bytes_in": 600000000, "bytes_out": 40000000, "ratio": 15.0,
+         "input": "...", "output": "...", "collection": "...",
+         "time": 1500000000.0}
+
+    Records can be appended to a JSON-lines file and summed up into a
+    Prometheus textfile (for node_exporter's textfile collector).
+    `python -m ucldc_iiif.metrics report metrics.jsonl` prints where the
+    time went, per collection and stage.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+
+# stage of the record covering a whole conversion job
+JOB_STAGE = 'convert'
+
+
+def run_command(args, env=None):
+    '''
+    run a command to completion, with stderr merged into stdout. Returns
+    (returncode, output, wall seconds, resource usage of the child).
+    '''
+    start = time.time()
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    output = proc.stdout.read()
+    proc.stdout.close()
+    pid, status, usage = os.wait4(proc.pid, 0)
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return proc.returncode, output, time.time() - start, usage
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except (OSError, TypeError):
+        return None
+
+
+class Recorder(object):
+    '''
+        collects metrics records in memory. `labels` (e.g. the collection
+        being converted) are added to every record. Use drain() to take
+        the records collected so far.
+    '''
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.records = []
+        # records may come from several threads, e.g. uploads
+        self.lock = threading.Lock()
+
+    def record(self, stage, ok=True, wall=None, user=None, sys=None,
+               max_rss=None, input_path=None, output_path=None, tool=None,
+               **fields):
+        bytes_in = _size(input_path)
+        bytes_out = _size(output_path) if ok else None
+        record = {
+            'stage': stage, 'tool': tool, 'ok': ok, 'wall': wall,
+            'user': user, 'sys': sys, 'max_rss': max_rss,
+            'bytes_in': bytes_in, 'bytes_out': bytes_out,
+            'ratio': (float(bytes_in) / bytes_out
+                      if bytes_in and bytes_out else None),
+            'input': input_path, 'output': output_path, 'time': time.time(),
+        }
+        record.update(self.labels)
+        record.update(fields)
+        with self.lock:
+            self.records.append(record)
+        return record
+
+    def record_command(self, stage, args, returncode, wall, usage,
+                       input_path=None, output_path=None):
+        ''' record a command run with run_command() '''
+        return self.record(
+            stage, ok=returncode == 0, wall=wall, user=usage.ru_utime,
+            sys=usage.ru_stime, max_rss=usage.ru_maxrss * 1024,
+            input_path=input_path, output_path=output_path,
+            tool=os.path.basename(args[0]))
+
+    @contextmanager
+    def timed(self, stage, input_path=None, output_path=None, **fields):
+        '''
+        record the work done in this process while the block runs. The
+        block can set result['ok'] to False. Peak RSS is the process's
+        peak so far, which may predate the block.
+        '''
+        result = {'ok': True}
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        before_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield result
+        except Exception:
+            result['ok'] = False
+            raise
+        finally:
+            after = resource.getrusage(resource.RUSAGE_SELF)
+            after_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            fields.update(result)
+            self.record(
+                stage, wall=time.time() - start,
+                user=(after.ru_utime - before.ru_utime +
+                      after_children.ru_utime - before_children.ru_utime),
+                sys=(after.ru_stime - before.ru_stime +
+                     after_children.ru_stime - before_children.ru_stime),
+                max_rss=after.ru_maxrss * 1024, input_path=input_path,
+                output_path=output_path, **fields)
+
+    def drain(self):
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+
+class NullRecorder(Recorder):
+    ''' a Recorder that throws its records away '''
+
+    def record(self, stage, **fields):
+        return None
+
+
+class JsonLinesSink(object):
+    ''' appends records to a JSON-lines file '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, records):
+        if not records:
+            return
+        with open(self.path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_records(paths):
+    ''' yield the records in JSON-lines files, skipping damaged lines '''
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+class Aggregate(object):
+    '''
+        running totals of records by (collection, stage, tool), plus
+        totals of whole jobs by collection
+    '''
+
+    FIELDS = ['wall', 'user', 'sys', 'bytes_in', 'bytes_out']
+
+    def __init__(self):
+        self.stages = {}
+        self.jobs = {}
+
+    def add(self, record):
+        collection = record.get('collection') or ''
+        if record['stage'] == JOB_STAGE:
+            key = collection
+            totals = self.jobs
+        else:
+            key = (collection, record['stage'], record.get('tool') or '')
+            totals = self.stages
+        row = totals.setdefault(key, dict(
+            [(name, 0) for name in self.FIELDS],
+            runs=0, failures=0, max_rss=0, first=None, last=None))
+        row['runs'] += 1
+        if not record.get('ok'):
+            row['failures'] += 1
+        for name in self.FIELDS:
+            if name.startswith('bytes_') and not record.get('ok'):
+                # so throughput and ratios are of the work that was kept
+                continue
+            row[name] += record.get(name) or 0
+        row['max_rss'] = max(row['max_rss'], record.get('max_rss') or 0)
+        end = record.get('time')
+        if end is not None:
+            start = end - (record.get('wall') or 0)
+            row['first'] = start if row['first'] is None else \
+                min(row['first'], start)
+            row['last'] = end if row['last'] is None else \
+                max(row['last'], end)
+
+    def add_all(self, records):
+        for record in records:
+            self.add(record)
+        return self
+
+
+def _prometheus_labels(**labels):
+    return '{' + ','.join('{}="{}"'.format(
+        name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in sorted(labels.items())) + '}'
+
+
+def write_prometheus(aggregate, path, prefix='ucldc_iiif'):
+    '''
+    write the stage totals in `aggregate` to `path` in the Prometheus
+    text format, atomically so a scraper never sees half a file
+    '''
+    metrics = [
+        ('stage_runs_total', 'counter', 'runs', 'Stage runs'),
+        ('stage_failures_total', 'counter', 'failures', 'Failed stage runs'),
+        ('stage_wall_seconds_total', 'counter', 'wall',
+         'Wall time spent in a stage'),
+        ('stage_user_seconds_total', 'counter', 'user',
+         'User cpu time spent in a stage'),
+        ('stage_sys_seconds_total', 'counter', 'sys',
+         'System cpu time spent in a stage'),
+        ('stage_bytes_in_total', 'counter', 'bytes_in',
+         'Bytes read by a stage'),
+        ('stage_bytes_out_total', 'counter', 'bytes_out',
+         'Bytes written by a stage'),
+        ('stage_max_rss_bytes', 'gauge', 'max_rss',
+         'Peak RSS of a single run of a stage'),
+    ]
+    lines = []
+    for name, kind, field, help_text in metrics:
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for (collection, stage, tool), row in sorted(
+                aggregate.stages.items()):
+            lines.append('{}_{}{} {}'.format(
+                prefix, name, _prometheus_labels(
+                    collection=collection, stage=stage, tool=tool),
+                row[field]))
+    for name, field, help_text in [
+            ('jobs_total', 'runs', 'Conversion jobs'),
+            ('jobs_failed_total', 'failures', 'Failed conversion jobs')]:
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+        lines.append('# TYPE {}_{} counter'.format(prefix, name))
+        for collection, row in sorted(aggregate.jobs.items()):
+            lines.append('{}_{}{} {}'.format(
+                prefix, name, _prometheus_labels(collection=collection),
+                row[field]))
+
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.chmod(tmp_path, 0o644)
+    os.rename(tmp_path, path)
+
+
+def _mb(n):
+    return n / 1024.0 / 1024.0
+
+
+def format_report(aggregate):
+    ''' a plain-text report of where the time went in each collection '''
+    lines = []
+    collections = sorted(set(
+        [key[0] for key in aggregate.stages] + list(aggregate.jobs)))
+    for collection in collections:
+        job = aggregate.jobs.get(collection)
+        lines.append('== {} =='.format(collection or '(no collection)'))
+        if job:
+            elapsed = (job['last'] or 0) - (job['first'] or 0)
+            lines.append(
+                '{} jobs, {} failed; {:.1f}s elapsed, {:.1f}s of job time '
+                '({:.1f} jobs/hour); {:.1f} MB in, {:.1f} MB out'.format(
+                    job['runs'], job['failures'], elapsed, job['wall'],
+                    job['runs'] * 3600.0 / elapsed if elapsed else 0,
+                    _mb(job['bytes_in']), _mb(job['bytes_out'])))
+        rows = [(key[1], key[2], row) for key, row in aggregate.stages.items()
+                if key[0] == collection]
+        stage_wall = sum(row['wall'] for stage, tool, row in rows) or 1
+        lines.append('{:<32} {:>6} {:>5} {:>10} {:>6} {:>6} {:>9} {:>8} '
+                     '{:>6}'.format('stage (tool)', 'runs', 'fail',
+                                    'wall s', 'wall%', 'cpu%', 'MB/s in',
+                                    'max RSS', 'ratio'))
+        for stage, tool, row in sorted(rows, key=lambda r: -r[2]['wall']):
+            wall = row['wall']
+            cpu = row['user'] + row['sys']
+            lines.append('{:<32} {:>6} {:>5} {:>10.1f} {:>6.1f} {:>6.0f} '
+                         '{:>9.1f} {:>7.0f}M {:>6}'.format(
+                             '{} ({})'.format(stage, tool) if tool else stage,
+                             row['runs'], row['failures'], wall,
+                             100.0 * wall / stage_wall,
+                             100.0 * cpu / wall if wall else 0,
+                             _mb(row['bytes_in']) / wall if wall else 0,
+                             _mb(row['max_rss']),
+                             '{:.2f}'.format(float(row['bytes_in']) /
+                                             row['bytes_out'])
+                             if row['bytes_out'] else '-'))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='summarize conversion pipeline metrics')
+    subparsers = parser.add_subparsers(dest='command')
+    report = subparsers.add_parser(
+        'report', help="print where the time went, per collection and stage")
+    report.add_argument('paths', nargs='+', help="JSON-lines metrics files")
+    report.add_argument('--collection', default=None,
+                        help="only report on this collection")
+    prometheus = subparsers.add_parser(
+        'prometheus', help="write a Prometheus textfile of the totals")
+    prometheus.add_argument('paths', nargs='+',
+                            help="JSON-lines metrics files")
+    prometheus.add_argument('--output', required=True)
+    argv = parser.parse_args(argv)
+
+    records = read_records(argv.paths)
+    if getattr(argv, 'collection', None) is not None:
+        records = (record for record in records
+                   if record.get('collection') == argv.collection)
+    aggregate = Aggregate().add_all(records)
+    if argv.command == 'report':
+        sys.stdout.write(format_report(aggregate))
+    else:
+        write_prometheus(aggregate, argv.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,510 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    prewarm the Loris caches for a jp2, so the first viewer to open an
+    image doesn't wait for Loris to fetch it, read it and decode its
+    overview levels:
+
+    - info.json is built from the jp2's codestream headers (dimensions,
+      tile size, resolution levels), without decoding anything
+    - the tiles a viewer asks for first, i.e. those of the coarsest
+      levels of the pyramid, up to `max_tiles` of them, are decoded at
+      reduced resolution with `kdu_expand -reduce` and cut up with Pillow
+      (or ImageMagick, if Pillow isn't installed)
+    - thumbnails of the sizes Calisphere asks for are made the same way
+
+    Everything is written where Loris 2.x keeps its caches, by default
+    both under /var/cache/loris:
+
+        <info_root>/<ident>/info.json
+        <image_root>/<ident>/<region>/<size>/<rotation>/<quality>.<format>
+
+    with the region and size in their canonical IIIF 2.0 forms ('full',
+    'x,y,w,h', 'w,'). Tiles are requested the way OpenSeadragon's IIIF
+    tile source does. Other Loris versions or configs may lay their
+    caches out differently, so the roots and quality name can be set.
+
+    Prewarming can be a stage of a batch (`--prewarm`, see
+    ucldc_iiif.batch), or run on deploy for the jp2s of hot collections:
+
+        python -m ucldc_iiif.prewarm --base-uri https://.../iiif/ \\
+            --bucket ucldc-nuxeo-ref-images --idents hot.txt
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import subprocess
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from ucldc_iiif import jp2, metrics
+from ucldc_iiif.inventory import split_bucketpath, thread_bucket
+
+CACHE_ROOT = '/var/cache/loris'
+# the tile size given for jp2s that aren't tiled (or are a single tile)
+TILE_SIZE = 256
+# tiles to make per image, coarsest levels first
+MAX_TILES = 16
+# IIIF sizes of the thumbnails to make
+THUMBNAIL_SIZES = ['!256,256', '!512,512']
+QUALITY = 'default'
+FORMAT = 'jpg'
+JPEG_QUALITY = 90
+
+IIIF_CONTEXT = 'http://iiif.io/api/image/2/context.json'
+IIIF_PROTOCOL = 'http://iiif.io/api/image'
+IIIF_PROFILE = 'http://iiif.io/api/image/2/level2.json'
+
+# an image to write: the canonical IIIF region and size, the `-reduce`
+# level to decode at, the box to cut from that level (left, upper,
+# right, lower) and the size to scale it to
+Derivative = namedtuple('Derivative', ['region', 'size', 'reduce', 'box',
+                                       'width', 'height'])
+
+PrewarmResult = namedtuple('PrewarmResult', ['path', 'ident', 'ok',
+                                             'written', 'seconds', 'msg'])
+
+
+def _ceil_div(a, b):
+    return -(-a // b)
+
+
+def tile_size(info):
+    ''' the (width, height) of the tiles given in info.json: the jp2's
+    own tiles, if it has more than one '''
+    if info.tile_width < info.width or info.tile_height < info.height:
+        return info.tile_width, info.tile_height
+    return TILE_SIZE, TILE_SIZE
+
+
+def scale_factors(info):
+    return [2 ** level for level in range(info.levels + 1)]
+
+
+def level_size(info, reduce):
+    ''' the size of the image decoded with `-reduce reduce` '''
+    return (_ceil_div(info.width, 2 ** reduce),
+            _ceil_div(info.height, 2 ** reduce))
+
+
+def info_json(info, base_uri, ident):
+    ''' the IIIF Image API 2.0 info.json (as a dict) for a Jp2Info '''
+    width, height = tile_size(info)
+    tiles = {'width': width, 'scaleFactors': scale_factors(info)}
+    if height != width:
+        tiles['height'] = height
+    sizes = [dict(zip(('width', 'height'), level_size(info, reduce)))
+             for reduce in reversed(range(info.levels + 1))]
+    return {
+        '@context': IIIF_CONTEXT,
+        '@id': base_uri.rstrip('/') + '/' + ident,
+        'protocol': IIIF_PROTOCOL,
+        'width': info.width,
+        'height': info.height,
+        'tiles': [tiles],
+        'sizes': sizes,
+        'profile': [IIIF_PROFILE],
+    }
+
+
+def canonical_region(x, y, w, h, info):
+    if (x, y, w, h) == (0, 0, info.width, info.height):
+        return 'full'
+    return '{},{},{},{}'.format(x, y, w, h)
+
+
+def canonical_size(width, height, region_width, region_height):
+    if (width, height) == (region_width, region_height):
+        return 'full'
+    return '{},'.format(width)
+
+
+def level_tiles(info, reduce):
+    ''' the tiles OpenSeadragon asks for at scale factor 2**reduce, in
+    rows from the top left '''
+    tile_width, tile_height = tile_size(info)
+    scale = 2 ** reduce
+    width, height = level_size(info, reduce)
+    if width < tile_width and height < tile_height:
+        return [Derivative('full', canonical_size(
+            width, height, info.width, info.height), reduce,
+            (0, 0, width, height), width, height)]
+    return [tile(info, reduce, x, y)
+            for y in range(0, info.height, tile_height * scale)
+            for x in range(0, info.width, tile_width * scale)]
+
+
+def tile(info, reduce, x, y):
+    ''' the tile at scale factor 2**reduce whose region starts at (x, y)
+    of the full image, as OpenSeadragon asks for it '''
+    tile_width, tile_height = tile_size(info)
+    scale = 2 ** reduce
+    width, height = level_size(info, reduce)
+    w = min(tile_width * scale, info.width - x)
+    h = min(tile_height * scale, info.height - y)
+    box = (x // scale, y // scale, min(_ceil_div(x + w, scale), width),
+           min(_ceil_div(y + h, scale), height))
+    return Derivative(
+        canonical_region(x, y, w, h, info),
+        canonical_size(_ceil_div(w, scale), _ceil_div(h, scale), w, h),
+        reduce, box, _ceil_div(w, scale), _ceil_div(h, scale))
+
+
+def tile_derivatives(info, max_tiles=MAX_TILES):
+    '''
+    the tiles OpenSeadragon asks for at each scale factor, from the
+    coarsest level down, stopping before the level that would take the
+    total over `max_tiles`. Full resolution tiles are left to Loris.
+    '''
+    derivatives = []
+    for reduce in reversed(range(1, info.levels + 1)):
+        tiles = level_tiles(info, reduce)
+        if len(derivatives) + len(tiles) > max_tiles:
+            break
+        derivatives.extend(tiles)
+    return derivatives
+
+
+def parse_size(size, info):
+    ''' the (width, height) a IIIF size ('w,', ',h' or '!w,h') of the full
+    image comes to '''
+    best_fit = size.startswith('!')
+    width, height = size.lstrip('!').split(',')
+    width = int(width) if width else None
+    height = int(height) if height else None
+    if best_fit != (width is not None and height is not None) or \
+            (width is None and height is None):
+        raise ValueError('Unsupported IIIF size {!r}'.format(size))
+    if width is None:
+        width = max(1, int(round(info.width * height / float(info.height))))
+    elif height is None:
+        height = max(1, int(round(info.height * width / float(info.width))))
+    else:
+        scale = min(width / float(info.width), height / float(info.height))
+        width = max(1, int(info.width * scale))
+        height = max(1, int(info.height * scale))
+    return width, height
+
+
+def thumbnail_derivatives(info, sizes=THUMBNAIL_SIZES):
+    ''' full-image thumbnails, each cut down from the smallest level at
+    least as big as it '''
+    derivatives = []
+    for size in sizes:
+        width, height = parse_size(size, info)
+        width, height = min(width, info.width), min(height, info.height)
+        reduce = 0
+        while reduce < info.levels:
+            smaller = level_size(info, reduce + 1)
+            if smaller[0] < width or smaller[1] < height:
+                break
+            reduce += 1
+        level_width, level_height = level_size(info, reduce)
+        derivatives.append(Derivative(
+            'full', canonical_size(width, height, info.width, info.height),
+            reduce, (0, 0, level_width, level_height), width, height))
+    return derivatives
+
+
+class Prewarmer(object):
+    '''
+        writes info.json and low resolution tiles and thumbnails of jp2s
+        into the Loris caches. Safe to use from several threads.
+    '''
+
+    def __init__(self, base_uri, info_root=CACHE_ROOT, image_root=CACHE_ROOT,
+                 max_tiles=MAX_TILES, thumbnail_sizes=THUMBNAIL_SIZES,
+                 quality=QUALITY, fmt=FORMAT, overwrite=False, recorder=None):
+
+        self.logger = logging.getLogger(__name__)
+        self.base_uri = base_uri
+        self.info_root = info_root
+        self.image_root = image_root
+        self.max_tiles = max_tiles
+        self.thumbnail_sizes = thumbnail_sizes
+        self.quality = quality
+        self.fmt = fmt
+        # otherwise files already in the cache are left as they are
+        self.overwrite = overwrite
+        self.recorder = recorder or metrics.NullRecorder()
+
+        self.kdu_expand_location = os.environ.get(
+            'PATH_KDU_EXPAND', '/usr/local/bin/kdu_expand')
+        self.magick_convert_location = os.environ.get(
+            'PATH_MAGICK_CONVERT', '/usr/local/bin/convert')
+
+    def info_path(self, ident):
+        return os.path.join(self.info_root, ident, 'info.json')
+
+    def image_path(self, ident, derivative):
+        return os.path.join(self.image_root, ident, derivative.region,
+                            derivative.size, '0',
+                            '{}.{}'.format(self.quality, self.fmt))
+
+    def derivatives(self, info):
+        ''' the tiles and thumbnails to make for a Jp2Info, without
+        duplicates '''
+        derivatives = []
+        seen = set()
+        for derivative in (tile_derivatives(info, self.max_tiles) +
+                           thumbnail_derivatives(info,
+                                                 self.thumbnail_sizes)):
+            if (derivative.region, derivative.size) not in seen:
+                seen.add((derivative.region, derivative.size))
+                derivatives.append(derivative)
+        return derivatives
+
+    def prewarm(self, jp2_path, ident, tmp_dir=None):
+        '''
+        prewarm the caches for the jp2 at `jp2_path`, to be served as
+        `ident`. Returns a PrewarmResult; raises Jp2HeaderError, IOError
+        or subprocess.CalledProcessError.
+        '''
+        start = time.time()
+        with self.recorder.timed('prewarm', input_path=jp2_path,
+                                 ident=ident) as result:
+            info = jp2.read_jp2_info_from_file(jp2_path,
+                                               all_tile_parts=False)
+            written = 0
+            info_path = self.info_path(ident)
+            if self.overwrite or not os.path.exists(info_path):
+                self._write(info_path, lambda path: self._write_json(
+                    path, info_json(info, self.base_uri, ident)))
+                written += 1
+
+            todo = [derivative for derivative in self.derivatives(info)
+                    if self.overwrite or not os.path.exists(
+                        self.image_path(ident, derivative))]
+            if todo:
+                work_dir = tempfile.mkdtemp(prefix='ucldc-iiif-prewarm-',
+                                            dir=tmp_dir)
+                try:
+                    written += self._write_derivatives(jp2_path, ident,
+                                                       todo, work_dir)
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+            result['written'] = written
+
+        msg = 'Prewarmed {} from {}: wrote {} files in {:.1f}s'.format(
+            ident, jp2_path, written, time.time() - start)
+        self.logger.info(msg)
+        return PrewarmResult(jp2_path, ident, True, written,
+                             time.time() - start, msg)
+
+    def prewarm_one(self, job):
+        ''' prewarm a (jp2 path, ident) job, returning a PrewarmResult
+        whether it worked or not '''
+        jp2_path, ident = job
+        try:
+            return self.prewarm(jp2_path, ident)
+        except Exception as e:
+            msg = 'Failed to prewarm {} from {}: {!r}'.format(ident,
+                                                             jp2_path, e)
+            self.logger.error(msg)
+            return PrewarmResult(jp2_path, ident, False, 0, None, msg)
+
+    def _write_derivatives(self, jp2_path, ident, derivatives, work_dir):
+        ''' decode each level needed once, and cut the derivatives from
+        it, smallest level first '''
+        written = 0
+        for reduce in sorted(set(d.reduce for d in derivatives),
+                             reverse=True):
+            level_path = os.path.join(work_dir,
+                                      'level{}.tif'.format(reduce))
+            self._decode(jp2_path, level_path, reduce)
+            level = None
+            if Image is not None:
+                level = Image.open(level_path)
+                level.load()
+                if level.mode not in ('RGB', 'L'):
+                    level = level.convert('RGB')
+            for derivative in derivatives:
+                if derivative.reduce != reduce:
+                    continue
+                self._write(self.image_path(ident, derivative),
+                            lambda path: self._cut(level, level_path,
+                                                   derivative, path))
+                written += 1
+            os.remove(level_path)
+        return written
+
+    def _decode(self, jp2_path, level_path, reduce):
+        ''' decode the whole jp2 at 1/2**reduce of its size '''
+        args = [self.kdu_expand_location, '-i', jp2_path, '-o', level_path,
+                '-reduce', str(reduce)]
+        returncode, output, wall, usage = metrics.run_command(args)
+        self.recorder.record_command('prewarm_decode', args, returncode,
+                                     wall, usage, jp2_path, level_path)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args, output)
+
+    def _cut(self, level, level_path, derivative, path):
+        ''' write a derivative cut from a decoded level, with Pillow if
+        there is a `level` image, or ImageMagick '''
+        left, upper, right, lower = derivative.box
+        size = (derivative.width, derivative.height)
+        if level is not None:
+            image = level
+            if derivative.box != (0, 0) + level.size:
+                image = image.crop(derivative.box)
+            if image.size != size:
+                image = image.resize(size, Image.LANCZOS)
+            image.save(path, 'JPEG', quality=JPEG_QUALITY)
+            return
+        args = [self.magick_convert_location, level_path, '-crop',
+                '{}x{}+{}+{}'.format(right - left, lower - upper, left,
+                                     upper),
+                '+repage', '-resize', '{}x{}!'.format(*size), '-quality',
+                str(JPEG_QUALITY), 'jpg:' + path]
+        returncode, output, wall, usage = metrics.run_command(args)
+        self.recorder.record_command('prewarm_cut', args, returncode, wall,
+                                     usage, level_path, path)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args, output)
+
+    @staticmethod
+    def _write_json(path, data):
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+    @staticmethod
+    def _write(path, write):
+        ''' write(tmp path) and move the result to `path`, so Loris never
+        sees half a file '''
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            write(tmp_path)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def _fetch(bucketpath, ident, tmp_dir):
+    ''' download the jp2 for `ident` under a bucketpath to a temp file '''
+    bucket_name, prefix = split_bucketpath(bucketpath)
+    key = thread_bucket(bucket_name).get_key(prefix + ident)
+    if key is None:
+        raise IOError('s3://{}/{}{} does not exist'.format(bucket_name,
+                                                            prefix, ident))
+    fd, path = tempfile.mkstemp(prefix='ucldc-iiif-prewarm-',
+                                suffix='.jp2', dir=tmp_dir)
+    os.close(fd)
+    key.get_contents_to_filename(path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='write info.json and low resolution tiles and '
+        'thumbnails of jp2s into the Loris caches')
+    parser.add_argument('jp2s', nargs='*', help="local jp2 file(s), served "
+                        "as their file name without its extension")
+    parser.add_argument('--base-uri', required=True,
+                        help="the image server's IIIF base URI, for the "
+                        "@id in info.json")
+    parser.add_argument('--bucket', default=None,
+                        help="bucket, or bucket/prefix, to fetch the jp2s "
+                        "of --idents from")
+    parser.add_argument('--idents', default=None,
+                        help="file listing identifiers to prewarm, one per "
+                        "line (e.g. the Nuxeo uids of a hot collection)")
+    parser.add_argument('--info-root', default=CACHE_ROOT,
+                        help="Loris info cache directory")
+    parser.add_argument('--image-root', default=CACHE_ROOT,
+                        help="Loris image cache directory")
+    parser.add_argument('--max-tiles', type=int, default=MAX_TILES,
+                        help="tiles to make per image, coarsest first")
+    parser.add_argument('--thumbnail-size', action='append', default=None,
+                        help="IIIF size of a thumbnail to make, e.g. "
+                        "'!256,256'; can be repeated (default: {})".format(
+                            ' '.join(THUMBNAIL_SIZES)))
+    parser.add_argument('--quality', default=QUALITY,
+                        help="quality name in cache paths ('native' for "
+                        "Loris 1.x)")
+    parser.add_argument('--overwrite', action='store_true',
+                        help="rewrite files already in the cache")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="images to prewarm at once")
+    parser.add_argument('--tmp-dir', default=None)
+    parser.add_argument('--logfile', default=None)
+    parser.add_argument('--loglevel', default='INFO')
+    argv = parser.parse_args(argv)
+
+    numeric_level = getattr(logging, argv.loglevel.upper(), None)
+    if not isinstance(numeric_level, int):
+        raise ValueError('Invalid log level: %s' % argv.loglevel)
+    logging.basicConfig(
+        filename=argv.logfile,
+        level=numeric_level,
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    if argv.idents and not argv.bucket:
+        parser.error('--idents needs --bucket')
+    jobs = [(path, os.path.splitext(os.path.basename(path))[0])
+            for path in argv.jp2s]
+    idents = []
+    if argv.idents:
+        with open(argv.idents) as f:
+            idents = [line.strip() for line in f if line.strip()]
+    if not jobs and not idents:
+        parser.error('no jp2s or identifiers given')
+
+    prewarmer = Prewarmer(argv.base_uri, info_root=argv.info_root,
+                          image_root=argv.image_root,
+                          max_tiles=argv.max_tiles,
+                          thumbnail_sizes=(argv.thumbnail_size or
+                                           THUMBNAIL_SIZES),
+                          quality=argv.quality, overwrite=argv.overwrite)
+
+    def prewarm(job):
+        path, ident = job
+        if path is not None:
+            return prewarmer.prewarm_one(job)
+        try:
+            path = _fetch(argv.bucket, ident, argv.tmp_dir)
+        except Exception as e:
+            msg = 'Failed to fetch {}: {!r}'.format(ident, e)
+            logging.getLogger(__name__).error(msg)
+            return PrewarmResult(None, ident, False, 0, None, msg)
+        try:
+            return prewarmer.prewarm_one((path, ident))
+        finally:
+            os.remove(path)
+
+    jobs.extend((None, ident) for ident in idents)
+    pool = ThreadPool(max(1, min(argv.workers, len(jobs))))
+    failed = 0
+    try:
+        for result in pool.imap_unordered(prewarm, jobs):
+            if not result.ok:
+                failed += 1
+            print('\t'.join([result.ident, 'prewarmed' if result.ok
+                             else 'failed', result.msg.replace('\n', ' ')]))
+            sys.stdout.flush()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    upload files (e.g. jp2 outputs) to S3 quickly:
+
+    - files at least MULTIPART_THRESHOLD bytes are sent as a multipart
+      upload, with several parts in flight at once, each over its own
+      connection
+    - the part size grows with the file, so even very large files stay
+      within S3's limit on the number of parts
+    - an upload is skipped when the object already there has the same
+      size and ETag as the local file
+    - a BackgroundUploader sends finished files from a queue while the
+      caller gets on with encoding the next ones
+    - a duplicate of a file already uploaded can be copied within S3
+      instead of being uploaded again, in parallel parts if it's too big
+      for a single copy request
+
+    The defaults match boto3's (and so the aws cli's), so the ETags of
+    objects uploaded with those can be checked too.
+'''
+import os
+import time
+import logging
+import threading
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from boto.s3.multipart import MultiPartUpload
+
+from ucldc_iiif.inventory import split_bucketpath, thread_bucket
+from ucldc_iiif.etag import MULTIPART_THRESHOLD, PART_SIZE, MIN_PART_SIZE, \
+    MAX_COPY_SIZE, PART_WORKERS, CONTENT_TYPE, part_size_for, etag_matches
+
+UploadResult = namedtuple('UploadResult', [
+    'path', 'url', 'ok', 'skipped', 'bytes', 'seconds', 'msg'])
+
+# end-of-queue marker for the BackgroundUploader threads
+DONE = None
+
+
+class Uploader(object):
+    '''
+        uploads files to S3, splitting big ones into parts uploaded by
+        `part_workers` threads. Safe to use from several threads.
+    '''
+
+    def __init__(self, part_workers=PART_WORKERS, part_size=PART_SIZE,
+                 multipart_threshold=MULTIPART_THRESHOLD, skip_existing=True,
+                 content_type=CONTENT_TYPE, max_copy_size=MAX_COPY_SIZE,
+                 recorder=None):
+
+        self.logger = logging.getLogger(__name__)
+        self.part_workers = part_workers
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.multipart_threshold = max(multipart_threshold, self.part_size)
+        self.skip_existing = skip_existing
+        self.headers = {'Content-Type': content_type} if content_type else {}
+        # objects bigger than this are copied in parts
+        self.max_copy_size = max_copy_size
+        self.recorder = recorder
+
+    def upload(self, path, bucketpath, name):
+        '''
+        upload `path` as `name` under a bucketpath ('bucket' or
+        'bucket/prefix'). Returns an UploadResult; raises boto exceptions
+        or IOError.
+        '''
+        start = time.time()
+        bucket_name, prefix = split_bucketpath(bucketpath)
+        key_name = prefix + name
+        url = 's3://{}/{}'.format(bucket_name, key_name)
+        size = os.path.getsize(path)
+
+        skipped = self.skip_existing and self._exists(path, bucket_name,
+                                                      key_name)
+        if skipped:
+            msg = '{} is already at {}; not uploading'.format(path, url)
+        else:
+            if size >= self.multipart_threshold:
+                parts = self._upload_multipart(path, bucket_name, key_name,
+                                               size)
+            else:
+                parts = 1
+                key = thread_bucket(bucket_name).new_key(key_name)
+                key.set_contents_from_filename(path, headers=self.headers)
+            msg = 'Uploaded {} bytes from {} to {} in {:.1f}s{}'.format(
+                size, path, url, time.time() - start,
+                ' ({} parts)'.format(parts) if parts > 1 else '')
+        seconds = time.time() - start
+        self.logger.info(msg)
+        if self.recorder is not None:
+            self.recorder.record('upload', wall=seconds, input_path=path,
+                                 tool='s3', skipped=skipped, url=url)
+        return UploadResult(path, url, True, skipped, size, seconds, msg)
+
+    def matches(self, path, bucketpath, name):
+        ''' whether `name` under a bucketpath has the size and ETag of the
+        file at `path`, e.g. to verify an upload '''
+        bucket_name, prefix = split_bucketpath(bucketpath)
+        return self._exists(path, bucket_name, prefix + name)
+
+    def _exists(self, path, bucket_name, key_name):
+        ''' whether the object is already there, with the same content '''
+        key = thread_bucket(bucket_name).get_key(key_name)
+        if key is None:
+            return False
+        return etag_matches(path, int(key.size), key.etag,
+                            part_size=self.part_size)
+
+    def _multipart(self, bucket_name, key_name, size, send_part):
+        '''
+        make `key_name` from parts sent in parallel by
+        send_part(upload id, part number, offset, length); returns how
+        many. The parts are the ones an upload of the same size is split
+        into, so the object gets the same ETag either way.
+        '''
+        part_size = part_size_for(size, self.part_size)
+        parts = [(number, offset, min(part_size, size - offset))
+                 for number, offset in enumerate(range(0, size, part_size),
+                                                 1)]
+        mp = thread_bucket(bucket_name).initiate_multipart_upload(
+            key_name, headers=self.headers)
+        pool = ThreadPool(min(self.part_workers, len(parts)))
+        try:
+            pool.map(lambda part: send_part(mp.id, *part), parts)
+            mp.complete_upload()
+        except Exception:
+            mp.cancel_upload()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return len(parts)
+
+    @staticmethod
+    def _part_upload(bucket_name, key_name, upload_id):
+        ''' a MultiPartUpload bound to this thread's own connection '''
+        mp = MultiPartUpload(thread_bucket(bucket_name))
+        mp.key_name = key_name
+        mp.id = upload_id
+        return mp
+
+    def _upload_multipart(self, path, bucket_name, key_name, size):
+        ''' upload the file's parts in parallel; returns how many '''
+        def upload_part(upload_id, number, offset, length):
+            mp = self._part_upload(bucket_name, key_name, upload_id)
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                mp.upload_part_from_file(f, number, size=length)
+        return self._multipart(bucket_name, key_name, size, upload_part)
+
+    def _copy_multipart(self, bucket_name, source_key_name, key_name, size):
+        ''' copy the object's parts in parallel; returns how many '''
+        def copy_part(upload_id, number, offset, length):
+            mp = self._part_upload(bucket_name, key_name, upload_id)
+            mp.copy_part_from_key(bucket_name, source_key_name, number,
+                                  offset, offset + length - 1)
+        return self._multipart(bucket_name, key_name, size, copy_part)
+
+    def copy(self, bucketpath, source_name, name):
+        '''
+        copy the object `source_name` to `name`, both under a bucketpath,
+        within S3 (server-side), e.g. for a duplicate of a file already
+        uploaded. Objects over `max_copy_size`, which S3 won't copy in one
+        request, are copied in parts. Returns an UploadResult whose path is
+        the source's url; raises boto exceptions, or IOError if there's no
+        such source.
+        '''
+        start = time.time()
+        bucket_name, prefix = split_bucketpath(bucketpath)
+        bucket = thread_bucket(bucket_name)
+        source_url = 's3://{}/{}'.format(bucket_name, prefix + source_name)
+        url = 's3://{}/{}'.format(bucket_name, prefix + name)
+        source = bucket.get_key(prefix + source_name)
+        if source is None:
+            raise IOError('{} does not exist'.format(source_url))
+        size = int(source.size)
+
+        existing = bucket.get_key(prefix + name) if self.skip_existing \
+            else None
+        skipped = (existing is not None and existing.etag == source.etag and
+                   int(existing.size) == size)
+        if skipped:
+            msg = '{} is already a copy of {}; not copying'.format(
+                url, source_url)
+        else:
+            if size > self.max_copy_size:
+                parts = self._copy_multipart(bucket_name,
+                                             prefix + source_name,
+                                             prefix + name, size)
+            else:
+                parts = 1
+                bucket.copy_key(prefix + name, bucket_name,
+                                prefix + source_name)
+            msg = 'Copied {} bytes from {} to {} in {:.1f}s{}'.format(
+                size, source_url, url, time.time() - start,
+                ' ({} parts)'.format(parts) if parts > 1 else '')
+        seconds = time.time() - start
+        self.logger.info(msg)
+        if self.recorder is not None:
+            self.recorder.record('copy', wall=seconds, tool='s3',
+                                 skipped=skipped, url=url,
+                                 source_url=source_url)
+        return UploadResult(source_url, url, True, skipped, size, seconds,
+                            msg)
+
+    def upload_one(self, job):
+        ''' upload a (path, bucketpath, name) job, returning an
+        UploadResult whether it worked or not '''
+        path, bucketpath, name = job
+        try:
+            return self.upload(path, bucketpath, name)
+        except Exception as e:
+            url = 's3://{}'.format(bucketpath.strip('/') + '/' + name)
+            msg = 'Failed to upload {} to {}: {!r}'.format(path, url, e)
+            self.logger.error(msg)
+            if self.recorder is not None:
+                self.recorder.record('upload', ok=False, input_path=path,
+                                     tool='s3', url=url)
+            return UploadResult(path, url, False, False, None, None, msg)
+
+
+class BackgroundUploader(object):
+    '''
+        uploads files from a queue with `workers` threads, so files can be
+        handed over as soon as they're written. submit() blocks while
+        `workers` * 2 files are waiting, so uploads falling behind hold
+        back the caller rather than piling up on disk.
+    '''
+
+    def __init__(self, uploader, workers=2):
+        self.uploader = uploader
+        self.jobs = queue.Queue(maxsize=workers * 2)
+        self.results = queue.Queue()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            if job is DONE:
+                return
+            self.results.put(self.uploader.upload_one(job))
+
+    def submit(self, path, bucketpath, name):
+        self.jobs.put((path, bucketpath, name))
+
+    def finished(self):
+        ''' yield the UploadResults of the uploads finished so far '''
+        while True:
+            try:
+                yield self.results.get_nowait()
+            except queue.Empty:
+                return
+
+    def close(self):
+        ''' wait for the queued uploads, yielding their UploadResults.
+        Nothing is waited for until the results are iterated over. '''
+        for thread in self.threads:
+            self.jobs.put(DONE)
+        for thread in self.threads:
+            thread.join()
+        for result in self.finished():
+            yield result
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+    scratch space for the intermediate files of a conversion.
+
+    The intermediate TIFFs can't be streamed through pipes: libtiff and
+    kdu_compress both seek around in them. Instead, intermediates go to a
+    RAM-backed dir (e.g. /dev/shm) as long as their estimated sizes fit in
+    a byte budget shared by all workers, and spill to disk otherwise.
+'''
+import os
+import re
+import time
+import shutil
+import tempfile
+import logging
+import multiprocessing
+
+DEFAULT_RAM_DIR = '/dev/shm'
+
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3,
+               'T': 1024 ** 4}
+
+
+def parse_size(size):
+    ''' parse a byte count like '512M' or '2G' '''
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', str(size),
+                     re.IGNORECASE)
+    if not match:
+        raise ValueError('Invalid size: {}'.format(size))
+    number, unit = match.groups()
+    return int(float(number) * _SIZE_UNITS[unit.upper()])
+
+
+class Budget(object):
+    '''
+        a number of bytes shared between processes. Create it in the
+        parent process and hand it to workers (e.g. as pool initargs).
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = multiprocessing.Value('d', 0)
+
+    @property
+    def used(self):
+        return self._used.value
+
+    def try_acquire(self, amount):
+        ''' reserve `amount` if it fits; return whether it did '''
+        with self._used.get_lock():
+            if self._used.value + amount > self.limit:
+                return False
+            self._used.value += amount
+            return True
+
+    def acquire(self, amount, timeout=None, poll_interval=0.5):
+        '''
+        wait until `amount` fits and reserve it. Amounts bigger than the
+        whole budget are let through once nothing else is reserved, so a
+        single oversized request can't wait forever. Returns False if
+        `timeout` seconds pass first.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._used.get_lock():
+                if (self._used.value + amount <= self.limit or
+                        self._used.value == 0):
+                    self._used.value += amount
+                    return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(poll_interval)
+
+    def release(self, amount):
+        with self._used.get_lock():
+            self._used.value = max(self._used.value - amount, 0)
+
+
+class Workspace(object):
+    '''
+        hands out paths for the intermediate files of one conversion job,
+        in `ram_dir` while their estimated size fits in `budget`, and in
+        `disk_dir` otherwise.
+    '''
+
+    def __init__(self, disk_dir, ram_dir=None, budget=None):
+        self.logger = logging.getLogger(__name__)
+        self.disk_dir = disk_dir
+        self.ram_dir = ram_dir
+        self.budget = budget
+        self._job_ram_dir = None
+        self._reserved = {}
+
+    def path(self, filename, size=None):
+        ''' path for an intermediate file expected to be about `size`
+        bytes. Files of unknown size always go to disk. '''
+        if (self.ram_dir and self.budget is not None and size and
+                self.budget.try_acquire(size)):
+            if self._job_ram_dir is None:
+                self._job_ram_dir = tempfile.mkdtemp(prefix='ucldc-iiif-',
+                                                     dir=self.ram_dir)
+            path = os.path.join(self._job_ram_dir, filename)
+            self._reserved[path] = size
+            self.logger.debug('Using RAM for {} ({} bytes)'.format(path, size))
+            return path
+        return os.path.join(self.disk_dir, filename)
+
+    def release(self, path):
+        ''' delete an intermediate file we're done with '''
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        size = self._reserved.pop(path, None)
+        if size is not None:
+            self.budget.release(size)
+
+    def cleanup(self):
+        ''' delete everything left in the RAM dir and free the budget '''
+        for path in list(self._reserved):
+            self.release(path)
+        if self._job_ram_dir is not None:
+            shutil.rmtree(self._job_ram_dir, ignore_errors=True)
+            self._job_ram_dir = None
@@ -1,18 +1,109 @@
 #!/usr/bin/env python
-import boto
+import sys
+import json
+import time
+import logging
+import argparse
+from ucldc_iiif import inventory
 
-#boto.set_stream_logger('boto')
-s3 = boto.connect_s3()
-s3bucket = s3.get_bucket('ucldc-nuxeo-ref-images')
+GB = 1024.0 * 1024 * 1024
 
-size = 0
-totalCount = 0
 
-for key in s3bucket.list():
-    totalCount += 1
-    size += key.size
+def print_totals(title, totals):
+    print title
+    for name in sorted(totals):
+        count, size = totals[name]
+        print "  %-50s %10d  %10.3f GB" % (name or '(top level)', count,
+                                            size / GB)
 
-print 'total size:'
-print "%.3f GB" % (size*1.0/1024/1024/1024)
-print 'total count:'
-print totalCount
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='count the objects in an S3 bucket and add up their '
+        'sizes')
+    parser.add_argument('bucket', nargs='?', default='ucldc-nuxeo-ref-images',
+                        help="bucket, or bucket/prefix")
+    parser.add_argument('--snapshot', default=None,
+                        help="dir keeping an inventory snapshot, so later "
+                        "runs only relist stale ranges")
+    parser.add_argument('--max-age', type=float, default=24,
+                        help="hours before a range of the snapshot is "
+                        "relisted")
+    parser.add_argument('--workers', type=int,
+                        default=inventory.DEFAULT_WORKERS,
+                        help="threads listing the bucket in parallel")
+    parser.add_argument('--prefix-depth', type=int, default=1,
+                        help="number of '/'-separated key parts to total by")
+    parser.add_argument('--collections', default=None,
+                        help="file of uid<tab>collection lines, to total by "
+                        "collection")
+    parser.add_argument('--growth-days', type=float, default=30,
+                        help="days of snapshot changes to report growth over")
+    parser.add_argument('--json', action='store_true',
+                        help="print the totals as JSON")
+    parser.add_argument('--loglevel', default='WARNING')
+    argv = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=getattr(logging, argv.loglevel.upper(), logging.WARNING),
+        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+        datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    bucket_name, prefix = inventory.split_bucketpath(argv.bucket)
+    snapshot = None
+    if argv.snapshot:
+        snapshot = inventory.Snapshot(argv.snapshot, argv.bucket)
+        snapshot.refresh(max_age=argv.max_age * 60 * 60,
+                         workers=argv.workers)
+        items = list(snapshot.items())
+    else:
+        items = inventory.list_inventory(argv.bucket, workers=argv.workers)
+
+    report = {
+        'bucket': argv.bucket,
+        'count': len(items),
+        'bytes': sum(item.size for item in items),
+        'by_prefix': inventory.totals_by_prefix(items, prefix,
+                                                argv.prefix_depth),
+    }
+    # when objects were last written, for capacity planning
+    by_month = {}
+    for item in items:
+        row = by_month.setdefault(item.last_modified[:7], [0, 0])
+        row[0] += 1
+        row[1] += item.size
+    report['by_month'] = by_month
+    if argv.collections:
+        report['by_collection'] = inventory.totals_by_collection(
+            items, inventory.load_collections(argv.collections), prefix)
+    if snapshot is not None:
+        since = time.time() - argv.growth_days * 24 * 60 * 60
+        growth = {'days': argv.growth_days}
+        for delta in snapshot.deltas(since):
+            row = growth.setdefault(delta['change'], [0, 0])
+            row[0] += 1
+            row[1] += delta['size'] - delta['old_size']
+        report['growth'] = growth
+
+    if argv.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+        return
+
+    print 'total size:'
+    print "%.3f GB" % (report['bytes'] * 1.0 / GB)
+    print 'total count:'
+    print report['count']
+    print_totals('by prefix:', report['by_prefix'])
+    print_totals('by month last modified:', report['by_month'])
+    if 'by_collection' in report:
+        print_totals('by collection:', report['by_collection'])
+    if 'growth' in report:
+        growth = report['growth']
+        print 'changes over the last %g days:' % growth['days']
+        for change in (inventory.ADDED, inventory.CHANGED, inventory.REMOVED):
+            count, size = growth.get(change, [0, 0])
+            print "  %-10s %10d  %+10.3f GB" % (change, count, size / GB)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,16 +3,19 @@
 
 import sys, os
 import argparse
+import logging
 from pynux import utils
+import boto
 from boto import connect_s3
 from boto.s3.connection import S3Connection, OrdinaryCallingFormat
 from boto.s3.key import Key
 import urlparse
+from ucldc_iiif import inventory
 
 def check_object_on_s3(nuxeo_id, bucketpath):
 
     # see if a jp2 file exists on S3 for this object
-    conn = connect_s3(calling_format = OrdinaryCallingFormat())    
+    conn = connect_s3(calling_format = OrdinaryCallingFormat())
     bucketpath = bucketpath.strip("/")
     bucketbase = bucketpath.split("/")[0]
     obj_key = nuxeo_id
@@ -30,12 +33,27 @@ def check_object_on_s3(nuxeo_id, bucketpath):
         print "bucketbase:", bucketbase
         print "object doesn't exist on S3:", parts.path
 
+def check_objects(objects, nx, bucketpath, keys):
+    ''' yield (uid, nuxeo path, s3 url, exists) for each object, checking
+    against `keys`, a set of the keys in the bucket '''
+    for obj in objects:
+        # documents listed by nuxeo already carry their uid
+        nuxeo_id = obj.get('uid') or nx.get_uid(obj['path'])
+        obj_key = inventory.object_key(bucketpath, nuxeo_id)
+        s3_url = "s3://{0}/{1}".format(bucketpath.strip("/"), nuxeo_id)
+        yield nuxeo_id, obj['path'], s3_url, obj_key in keys
+
 def main(argv=None):
 
     parser = argparse.ArgumentParser(description='check for existence of jp2 file on s3 for given nuxeo path')
     parser.add_argument('path', help="Nuxeo document path")
     parser.add_argument('bucket', help="S3 bucket name")
     parser.add_argument('--pynuxrc', default='~/.pynux-prod', help="rc file for use by pynux")
+    parser.add_argument('--per-object', action='store_true', help="look up each object on S3 separately instead of listing the bucket once")
+    parser.add_argument('--workers', type=int, default=inventory.DEFAULT_WORKERS, help="threads listing the bucket in parallel")
+    parser.add_argument('--snapshot', help="dir keeping an inventory snapshot of the bucket (as used by bucket_obj_counter.py), so only stale ranges are relisted")
+    parser.add_argument('--max-age', type=float, default=1, help="hours before a range of the snapshot is relisted")
+    parser.add_argument('--missing', help="write the missing objects to this file (default: stdout), as uid<tab>nuxeo path<tab>s3 url")
 
     utils.get_common_options(parser)
     if argv is None:
@@ -47,14 +65,41 @@ def main(argv=None):
     nx = utils.Nuxeo(rcfile=argv.pynuxrc, loglevel=argv.loglevel.upper())
     # just for simple objects for now
     objects = nx.children(argv.path)
-    print "\nFound objects at {}.\nChecking S3 bucket {} for existence of corresponding files.\nThis could take a while...".format(nuxeo_path, bucketpath)
-    i = 0
-    for obj in objects:
-        nuxeo_id = nx.get_uid(obj['path'])
-        check_object_on_s3(nuxeo_id, bucketpath)
-        i = i + 1
 
-    print "Done. Checked {} objects".format(i)
+    if argv.per_object:
+        print "\nFound objects at {}.\nChecking S3 bucket {} for existence of corresponding files.\nThis could take a while...".format(nuxeo_path, bucketpath)
+        i = 0
+        for obj in objects:
+            nuxeo_id = nx.get_uid(obj['path'])
+            check_object_on_s3(nuxeo_id, bucketpath)
+            i = i + 1
+
+        print "Done. Checked {} objects".format(i)
+        return
+
+    logging.basicConfig(level=getattr(logging, argv.loglevel.upper(), logging.INFO),
+                        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
+    items = inventory.get_inventory(bucketpath, snapshot_dir=argv.snapshot,
+                                    max_age=argv.max_age * 60 * 60,
+                                    workers=argv.workers)
+    keys = set(item.key for item in items)
+    print >> sys.stderr, "Listed {} objects in S3 bucket {}. Checking objects at {}...".format(len(keys), bucketpath, nuxeo_path)
+
+    out = open(argv.missing, 'w') if argv.missing else sys.stdout
+    checked = missing = 0
+    try:
+        for nuxeo_id, path, s3_url, exists in check_objects(objects, nx, bucketpath, keys):
+            checked += 1
+            if not exists:
+                missing += 1
+                out.write('\t'.join([nuxeo_id, path, s3_url]) + '\n')
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    print >> sys.stderr, "Done. Checked {} objects; {} missing from S3".format(checked, missing)
+    return 1 if missing else 0
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -3,55 +3,65 @@
 
 import sys, os
 import argparse
+import logging
 from pynux import utils
-import urlparse
-import tempfile
-import requests
+from ucldc_iiif.download import Downloader, get_download_url, \
+    RANGE_THRESHOLD, RANGE_PARTS, MAX_CONNECTIONS
+from ucldc_iiif.workspace import parse_size
 
 def main(argv=None):
 
-    parser = argparse.ArgumentParser(description='check for existence of jp2 file on s3 for given nuxeo path')
-    parser.add_argument('path', help="Nuxeo document path")
+    parser = argparse.ArgumentParser(description='download the files of the given nuxeo paths')
+    parser.add_argument('path', nargs='+', help="Nuxeo document path(s)")
+    parser.add_argument('--output-dir', default=os.getcwd(), help="dir to download to (default: current dir)")
+    parser.add_argument('--workers', type=int, default=4, help="files to download at once")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS, help="connections to open at once, across all files")
+    parser.add_argument('--range-threshold', type=parse_size, default=RANGE_THRESHOLD, help="split files at least this big into parallel ranges, e.g. 64M")
+    parser.add_argument('--range-parts', type=int, default=RANGE_PARTS, help="number of ranges to split big files into")
 
     utils.get_common_options(parser)
     if argv is None:
         argv = parser.parse_args()
 
-    nuxeo_path = argv.path
-    
-    print "\nnuxeo_path:", nuxeo_path
+    logging.basicConfig(level=getattr(logging, argv.loglevel.upper(), logging.INFO),
+                        format='%(asctime)s (%(name)s) [%(levelname)s]: %(message)s',
+                        datefmt='%m/%d/%Y %I:%M:%S %p')
 
-    # get the Nuxeo ID
     nx = utils.Nuxeo(rcfile=argv.rcfile, loglevel=argv.loglevel.upper())
-    nuxeo_id = nx.get_uid(nuxeo_path)
-    print "nuxeo_id:", nuxeo_id
+    jobs = []
+    for nuxeo_path in argv.path:
+        print "\nnuxeo_path:", nuxeo_path
 
-    download_url = get_download_url(nuxeo_id, nuxeo_path, nx)
-    print download_url, '\n'
+        # get the Nuxeo ID
+        nuxeo_id = nx.get_uid(nuxeo_path)
+        print "nuxeo_id:", nuxeo_id
 
-    filename = os.path.basename(nuxeo_path)
-    filepath = os.path.join(os.getcwd(), filename)
-    download_nuxeo_file(download_url, filepath, nx)
+        download_url = get_download_url(nuxeo_id, nuxeo_path, nx)
+        print download_url, '\n'
 
-    print "\nDone\n"
+        filename = os.path.basename(nuxeo_path)
+        jobs.append((download_url, os.path.join(argv.output_dir, filename), None))
 
-def download_nuxeo_file(download_url, local_filepath, nx):
-    res = requests.get(download_url, auth=nx.auth)
-    res.raise_for_status()
-    with open(local_filepath, 'wb') as f:
-        for block in res.iter_content(1024):
-            if block:
-                f.write(block)
-                f.flush()
-    print "Downloaded file to {}".format(local_filepath)
+    downloader = Downloader(auth=nx.auth, workers=argv.workers,
+                            max_connections=argv.max_connections,
+                            range_threshold=argv.range_threshold,
+                            range_parts=argv.range_parts)
+    failed = 0
+    for result in downloader.download_many(jobs):
+        if result.ok:
+            print "Downloaded file to {} (md5 {})".format(result.path, result.digest)
+        else:
+            failed += 1
+            print result.msg
 
-def get_download_url(nuxeo_id, nuxeo_path, nx):
-    """ Get object file download URL. We should really put this logic in pynux """
-    parts = urlparse.urlsplit(nx.conf["api"])
-    filename = nuxeo_path.split('/')[-1]
-    url = '{}://{}/Nuxeo/nxbigfile/default/{}/file:content/{}'.format(parts.scheme, parts.netloc, nuxeo_id, filename)
+    print "\nDone\n"
+    return 1 if failed else 0
 
-    return url
+def download_nuxeo_file(download_url, local_filepath, nx, expected_md5=None):
+    result = Downloader(auth=nx.auth).download(download_url, local_filepath,
+                                               expected_md5)
+    print "Downloaded file to {}".format(local_filepath)
+    return result
 
 if __name__ == "__main__":
     sys.exit(main())